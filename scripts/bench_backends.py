@@ -0,0 +1,86 @@
+"""Benchmark for the model execution backends supported by session runners (eager, TorchScript, torch.compile).
+
+This script instantiates some of the framework's bundled models, prepares them for inference with each of the
+execution backends of :func:`thelper.nn.utils.compile_model` on CPU, and then measures their preparation time and
+their average forward pass latency/throughput on random inputs. The outputs of each backend are also compared to
+the eager outputs to make sure that the prepared models are equivalent. Backends that cannot be used with a model
+fall back to eager mode (this is reported as such in the results).
+
+Usage::
+
+    python scripts/bench_backends.py --batch-size 8 --input-size 224 --runs 20 --threads 4
+"""
+
+import argparse
+import time
+
+import torch
+
+import thelper.nn.fcn
+import thelper.nn.mobilenet
+import thelper.nn.resnet
+import thelper.nn.unet
+import thelper.nn.utils
+import thelper.tasks
+
+CLASS_NAMES = [str(idx) for idx in range(10)]
+
+
+def make_model(name, input_size):
+    if name == "resnet":
+        return thelper.nn.resnet.ResNet(thelper.tasks.Classification(CLASS_NAMES, "input", "label"))
+    if name == "mobilenet":
+        return thelper.nn.mobilenet.MobileNetV2(thelper.tasks.Classification(CLASS_NAMES, "input", "label"),
+                                                input_size=input_size)
+    if name == "unet":
+        return thelper.nn.unet.UNet(thelper.tasks.Segmentation(CLASS_NAMES, "input", "label_map"))
+    if name == "fcn":
+        return thelper.nn.fcn.FCN32s(thelper.tasks.Segmentation(CLASS_NAMES, "input", "label_map"), init_vgg16=False)
+    raise AssertionError(f"unknown model name '{name}'")
+
+
+def run_forwards(model, inputs, runs, warmup):
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(inputs)
+        start = time.perf_counter()
+        for _ in range(runs):
+            outputs = model(inputs)
+    if isinstance(outputs, dict):
+        outputs = outputs["out"]  # segmentation models might return dicts of outputs
+    return (time.perf_counter() - start) / runs, outputs
+
+
+def main():
+    ap = argparse.ArgumentParser(description="model execution backend benchmark (cpu)")
+    ap.add_argument("--models", nargs="+", default=["resnet", "mobilenet", "unet", "fcn"], help="models to test")
+    ap.add_argument("--backends", nargs="+", default=thelper.nn.utils.EXECUTION_BACKENDS, help="backends to test")
+    ap.add_argument("--batch-size", type=int, default=8, help="number of samples in each input batch")
+    ap.add_argument("--input-size", type=int, default=224, help="height/width of the input images")
+    ap.add_argument("--runs", type=int, default=20, help="number of timed forward passes for each backend")
+    ap.add_argument("--warmup", type=int, default=3, help="number of untimed forward passes for each backend")
+    ap.add_argument("--threads", type=int, default=0, help="number of threads used by torch (0 = default)")
+    args = ap.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    inputs = torch.randn(args.batch_size, 3, args.input_size, args.input_size)
+    print(f"input shape: {tuple(inputs.shape)}, threads: {torch.get_num_threads()}, torch: {torch.__version__}")
+    for model_name in args.models:
+        model = make_model(model_name, args.input_size).eval()
+        print(f"\n{model_name} ({thelper.nn.utils.get_learnable_param_count(model)} params):")
+        eager_latency, expected = run_forwards(model, inputs, args.runs, args.warmup)
+        for backend in args.backends:
+            start = time.perf_counter()
+            compiled_model = thelper.nn.utils.compile_model(model, backend, example_input=inputs)
+            prep_time = time.perf_counter() - start
+            fallback = backend != "eager" and compiled_model is model
+            latency, outputs = run_forwards(compiled_model, inputs, args.runs, args.warmup)
+            max_diff = (outputs - expected).abs().max().item()
+            print(f"  {backend:>8}: {latency * 1000:8.1f} ms/batch  {args.batch_size / latency:8.1f} img/s  "
+                  f"(x{eager_latency / latency:.2f} vs eager)  prep: {prep_time:6.2f} s  max diff: {max_diff:.2e}" +
+                  ("  [FALLBACK TO EAGER]" if fallback else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Benchmark for the spatial index used by the geo dataset croppers/cleaners.
+
+This script generates a synthetic set of polygon 'features' and a regular grid of square 'tiles', and then
+compares the brute-force tile-to-feature lookup (which was originally used by the croppers) against the
+STRtree-based lookup of :class:`thelper.data.geo.utils.SpatialIndex`, in serial and in parallel.
+
+Usage::
+
+    python scripts/bench_geo_index.py --features 20000 --tiles 100 --parallel 8
+"""
+
+import argparse
+import time
+
+import numpy as np
+import shapely.geometry
+
+import thelper.data.geo.utils
+
+
+def make_features(count, extent, max_radius, seed):
+    rng = np.random.RandomState(seed)
+    features = []
+    for center in rng.uniform(0, extent, size=(count, 2)):
+        # note: random star-like polygons, closer to real lake/river shapes than plain boxes
+        angles = np.sort(rng.uniform(0, 2 * np.pi, size=12))
+        radii = rng.uniform(max_radius / 4, max_radius, size=12)
+        features.append(shapely.geometry.Polygon(np.stack([center[0] + np.cos(angles) * radii,
+                                                           center[1] + np.sin(angles) * radii], axis=-1)).buffer(0))
+    return features
+
+
+def make_tiles(count_per_axis, extent):
+    tile_size = extent / count_per_axis
+    return [shapely.geometry.box(x * tile_size, y * tile_size, (x + 1) * tile_size, (y + 1) * tile_size)
+            for y in range(count_per_axis) for x in range(count_per_axis)]
+
+
+def brute_force(features, tiles):
+    hits = []
+    for tile in tiles:
+        tile_centroid, tile_radius = tile.centroid, np.linalg.norm(np.subtract(tile.bounds[0:2], tile.bounds[2:4])) / 2
+        hits.append([idx for idx, f in enumerate(features)
+                     if f.distance(tile_centroid) <= tile_radius and not f.intersection(tile).is_empty])
+    return hits
+
+
+def main():
+    ap = argparse.ArgumentParser(description="spatial index benchmark on synthetic geometries")
+    ap.add_argument("--features", type=int, default=20000, help="number of synthetic features to generate")
+    ap.add_argument("--tiles", type=int, default=100, help="number of tiles along each axis of the grid")
+    ap.add_argument("--extent", type=float, default=100000., help="size of the (square) synthetic area")
+    ap.add_argument("--max-radius", type=float, default=500., help="max radius of the synthetic features")
+    ap.add_argument("--parallel", type=int, default=0, help="number of processes to use in parallel lookups")
+    ap.add_argument("--brute-force-tiles", type=int, default=200, help="number of tiles tested via brute force")
+    ap.add_argument("--seed", type=int, default=0, help="seed used to generate the synthetic features")
+    args = ap.parse_args()
+    features = make_features(args.features, args.extent, args.max_radius, args.seed)
+    tiles = make_tiles(args.tiles, args.extent)
+    print(f"generated {len(features)} features and {len(tiles)} tiles")
+    subset = tiles[:args.brute_force_tiles]
+    start = time.perf_counter()
+    ref_hits = brute_force(features, subset)
+    brute_time = (time.perf_counter() - start) * len(tiles) / max(len(subset), 1)
+    print(f"brute force (extrapolated from {len(subset)} tiles): {brute_time:.2f} sec")
+    start = time.perf_counter()
+    index = thelper.data.geo.utils.SpatialIndex(features)
+    print(f"index construction: {time.perf_counter() - start:.2f} sec")
+    start = time.perf_counter()
+    hits = thelper.data.geo.utils.query_intersections(index, tiles)
+    index_time = time.perf_counter() - start
+    print(f"indexed lookup (serial): {index_time:.2f} sec  (x{brute_time / index_time:.1f})")
+    assert hits[:len(subset)] == ref_hits, "indexed lookup results do not match brute force results"
+    if args.parallel > 1:
+        start = time.perf_counter()
+        par_hits = thelper.data.geo.utils.query_intersections(index, tiles, parallel=args.parallel)
+        par_time = time.perf_counter() - start
+        print(f"indexed lookup ({args.parallel} processes): {par_time:.2f} sec  (x{brute_time / par_time:.1f})")
+        assert par_hits == hits, "parallel lookup results do not match serial results"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Benchmark for the import time of the framework's packages (with a regression budget).
+
+This script imports each target module in a fresh interpreter started with ``python -X importtime``, parses
+the resulting timing report, and prints the cumulative import time of the target along with its slowest
+dependencies. If the import time of a target exceeds the given budget (in milliseconds), or if a target
+imports one of the 'forbidden' heavy dependencies, the script exits with a non-zero code so that it can be
+used to catch regressions (e.g. in CI). Each target is imported several times and the best run is kept.
+
+Usage::
+
+    python scripts/bench_import_time.py --module thelper --module thelper.cli --budget-ms 150
+"""
+
+import argparse
+import subprocess
+import sys
+
+# these should never be imported by 'import thelper' or by the CLI entrypoint before a command is dispatched
+DEFAULT_FORBIDDEN_MODULES = ["torch", "torchvision", "numpy", "cv2", "matplotlib", "sklearn", "h5py", "gdal"]
+
+
+def get_import_times(module_name):
+    """Returns the list of (name, nesting depth, self time, cumulative time) of all modules imported by a module.
+
+    Times are given in microseconds. Modules imported by the interpreter at startup are also listed.
+    """
+    res = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if res.returncode != 0:
+        raise RuntimeError(f"could not import '{module_name}':\n{res.stderr}")
+    times = []
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_time, cumul_time, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times.append((name.strip(), depth, int(self_time), int(cumul_time)))
+    return times
+
+
+def get_total_time(times, module_name):
+    """Returns the total import time in microseconds of a module (and of its parent packages)."""
+    root_name = module_name.split(".")[0]
+    return sum([cumul_time for name, depth, _, cumul_time in times
+                if depth == 0 and (name == root_name or name.startswith(root_name + "."))])
+
+
+def main():
+    ap = argparse.ArgumentParser(description="import time benchmark with regression budget")
+    ap.add_argument("--module", action="append", default=None, help="module to import (can be repeated)")
+    ap.add_argument("--budget-ms", type=float, default=150., help="max cumulative import time for each module")
+    ap.add_argument("--forbid", action="append", default=None, help="top-level module that must not be imported")
+    ap.add_argument("--runs", type=int, default=5, help="number of runs per module (the best one is kept)")
+    ap.add_argument("--top", type=int, default=10, help="number of slowest imports to print for each module")
+    args = ap.parse_args()
+    module_names = args.module or ["thelper", "thelper.cli"]
+    forbidden = args.forbid or DEFAULT_FORBIDDEN_MODULES
+    failed = False
+    for module_name in module_names:
+        runs = [get_import_times(module_name) for _ in range(max(args.runs, 1))]
+        times = min(runs, key=lambda t: get_total_time(t, module_name))
+        total_ms = get_total_time(times, module_name) / 1000
+        print(f"\n'import {module_name}': {total_ms:.1f} ms ({len(times)} modules imported, including startup)")
+        for name, _, self_time, cumul_time in sorted(times, key=lambda t: -t[3])[:args.top]:
+            print(f"    {cumul_time / 1000:8.1f} ms  (self: {self_time / 1000:6.1f} ms)  {name}")
+        found_forbidden = sorted(set([t[0].split(".")[0] for t in times]) & set(forbidden))
+        if found_forbidden:
+            print(f"  FAILED: heavy dependencies imported: {found_forbidden}")
+            failed = True
+        if total_ms > args.budget_ms:
+            print(f"  FAILED: import time exceeds budget ({total_ms:.1f} ms > {args.budget_ms:.1f} ms)")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
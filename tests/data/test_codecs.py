@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+import thelper
+
+
+@pytest.mark.parametrize("codec_name", ["none", "lz4", "png"])
+def test_codec_roundtrip(codec_name):
+    array = np.random.randint(0, 2 ** 12, size=(32, 32, 3), dtype=np.uint16)
+    encoder = thelper.data.codecs.get_encoder(codec_name)
+    assert encoder is thelper.data.codecs.get_encoder(codec_name)  # bound codecs should be cached
+    buffer = encoder(array)
+    out = np.empty_like(array)
+    decoded = thelper.utils.decode_data(buffer, codec_name, out=out)
+    assert decoded is out and np.array_equal(out, array)
+    decoded = thelper.utils.decode_data(buffer, codec_name)
+    assert np.array_equal(np.frombuffer(decoded, dtype=np.uint16).reshape(array.shape), array)
+    with pytest.raises(AssertionError):
+        thelper.data.codecs.get_decoder(codec_name)(buffer, out=np.empty((4,), dtype=np.uint16))
+
+
+def test_codec_registry():
+    with pytest.raises(AssertionError):
+        _ = thelper.data.codecs.get_codec("potato")
+    assert thelper.data.codecs.get_codec(None).name == "none"
+    assert "jpeg" not in thelper.data.codecs.get_codec_names()
+    assert "jpeg" in thelper.data.codecs.get_codec_names(aliases=True)
+
+    def make_codec():
+        return thelper.data.codecs.Codec(
+            "negate", lambda: (lambda data: np.bitwise_not(data)),
+            lambda: (lambda data, out=None: np.bitwise_not(data, out=out)))
+
+    thelper.data.codecs.register_codec("test_negate", make_codec, override=True)
+    with pytest.raises(AssertionError):
+        thelper.data.codecs.register_codec("test_negate", make_codec)
+    array = np.arange(10, dtype=np.uint8)
+    assert np.array_equal(thelper.utils.decode_data(thelper.utils.encode_data(array, "test_negate"), "test_negate"), array)
+    results = thelper.data.codecs.benchmark_codecs([array, array + 1], codecs=["none", "lz4", "potato", "test_negate"])
+    assert results["none"]["exact"] and results["none"]["ratio"] == 1.0
+    assert results["lz4"]["exact"] and results["lz4"]["decode_mbps"] > 0
+    assert "error" in results["potato"]
+    assert results["test_negate"]["exact"]
+
+
+def test_codec_cv_flags():
+    image = np.random.randint(0, 255, size=(16, 16, 3), dtype=np.uint8)
+    buffer = thelper.utils.encode_data(image, "png")
+    decoded = thelper.utils.decode_data(buffer, "png", flags="cv.IMREAD_GRAYSCALE")
+    assert decoded.shape == (16, 16)
+    with pytest.raises(AssertionError):
+        _ = thelper.data.codecs.get_decoder("png", flags="os.system('ls')")
@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+import pytest
+
+import thelper
+
+pytestmark = pytest.mark.skipif(not thelper.utils.check_installed("gdal"), reason="geo packages not installed")
+
+
+@pytest.mark.parametrize("label_count", [3, 6, 8, 11])
+def test_decode_label_stack(label_count):
+    rng = np.random.RandomState(label_count)
+    # sparse flags, so that pixels with no label, one label, and overlapping labels are all covered
+    label_stack = (rng.rand(2, 16, 12, label_count) < 0.2).astype(np.uint8)
+    mask = (rng.rand(2, 16, 12) < 0.9).astype(np.int16)
+    expected = thelper.data.geo.agrivis._decode_label_stack_loop(label_stack, mask)
+    label_map = thelper.data.geo.agrivis.decode_label_stack(label_stack, mask)
+    assert label_map.dtype == expected.dtype == np.int16 and np.array_equal(label_map, expected)
+    assert np.array_equal(thelper.data.geo.agrivis.decode_label_stack(label_stack[0], mask[0]), expected[0])
+    unmasked = thelper.data.geo.agrivis.decode_label_stack(label_stack)
+    assert np.array_equal(unmasked[mask != 0], expected[mask != 0]) and unmasked.max() == label_count
+
+
+def _create_dummy_archive(hdf5_path, nb_samples=5, size=8):
+    import h5py
+    rng = np.random.RandomState(0)
+    label_count = len(thelper.data.geo.agrivis.class_names) - 1
+    with h5py.File(hdf5_path, "w") as fd:
+        for group_name in ["train", "test"]:
+            group = fd.create_group(group_name)
+            group.create_dataset("features", data=rng.randint(256, size=(nb_samples, size, size, 4)).astype(np.uint8))
+            group.create_dataset("boundaries", data=(rng.rand(nb_samples, size, size) < 0.9).astype(np.uint8))
+            group.create_dataset("keys", data=[f"{group_name}{idx}" for idx in range(nb_samples)],
+                                 dtype=h5py.special_dtype(vlen=str))
+            if group_name != "test":
+                labels = (rng.rand(nb_samples, size, size, label_count) < 0.2).astype(np.uint8)
+                group.create_dataset("labels", data=labels)
+                group.create_dataset("n_labelled_pixels", data=labels.sum(axis=(1, 2)))
+
+
+def test_packed_label_maps(tmpdir):
+    hdf5_path = os.path.join(str(tmpdir), "agrivis.hdf5")
+    _create_dummy_archive(hdf5_path)
+    expected = {}
+    for group_name in ["train", "test"]:
+        dataset = thelper.data.geo.agrivis.Hdf5AgricultureDataset(hdf5_path, group_name)
+        assert not dataset.packed and dataset.hdf5_handle is None
+        expected[group_name] = [dataset[idx] for idx in range(len(dataset))]
+        assert dataset.hdf5_handle is None  # the archive should only be kept open if requested
+    thelper.data.geo.agrivis.pack_label_maps(hdf5_path, progress_bar=False)
+    for group_name in ["train", "test"]:
+        for keep_file_open in [False, True]:
+            dataset = thelper.data.geo.agrivis.Hdf5AgricultureDataset(hdf5_path, group_name,
+                                                                      keep_file_open=keep_file_open)
+            assert dataset.packed and (dataset.hdf5_handle is not None) == keep_file_open
+            for sample, expected_sample in zip([dataset[idx] for idx in range(len(dataset))], expected[group_name]):
+                assert np.array_equal(sample["image"], expected_sample["image"])
+                assert np.array_equal(sample["mask"], expected_sample["mask"])
+                if group_name == "test":
+                    assert sample["label_map"] is None and expected_sample["label_map"] is None
+                else:
+                    assert np.array_equal(sample["label_map"], expected_sample["label_map"])
@@ -0,0 +1,79 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import thelper
+
+pytestmark = pytest.mark.skipif(not thelper.utils.check_installed("gdal"), reason="geo packages not installed")
+
+dummy_band_names = ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B11", "B12"]
+
+
+def _create_dummy_patches(root, nb_patches=5, size=8):
+    import cv2 as cv
+    rng = np.random.RandomState(0)
+    class_names = ["Pastures", "Sea and ocean", "Mixed forest"]
+    for patch_idx in range(nb_patches):
+        patch_name = f"S2A_MSIL2A_20170613T1010{patch_idx:02d}_{patch_idx}_{patch_idx + 10}"
+        patch_path = os.path.join(root, patch_name)
+        os.makedirs(patch_path)
+        for band_name in dummy_band_names:
+            band = rng.randint(0, 10000, size=(size, size)).astype(np.uint16)
+            assert cv.imwrite(os.path.join(patch_path, f"{patch_name}_{band_name}.tif"), band)
+        metadata = {
+            "labels": [class_names[idx] for idx in range(patch_idx % 4) if idx < len(class_names)],
+            "coordinates": {"ulx": 100.0 * patch_idx, "uly": 200.0, "lrx": 100.0 * patch_idx + 80.5, "lry": 119.5},
+            "projection": "PROJCS[\"WGS 84 / UTM zone 29N\"]",
+            "tile_source": f"S2A_MSIL1C_20170613T1010{patch_idx:02d}",
+            "acquisition_date": f"2017-06-13 10:10:{patch_idx:02d}",
+        }
+        with open(os.path.join(patch_path, f"{patch_name}_labels_metadata.json"), "w") as fd:
+            json.dump(metadata, fd)
+
+
+def test_patch_table_roundtrip(tmpdir):
+    import h5py
+    _create_dummy_patches(str(tmpdir))
+    patches = thelper.data.geo.bigearthnet.HDF5Compactor._load_patch_metadata(str(tmpdir), progress_bar=False)
+    assert len(patches) == 5 and any([not patch.labels for patch in patches])
+    class_names = sorted(set([label for patch in patches for label in patch.labels]))
+    table = thelper.data.geo.bigearthnet._get_patch_table(patches, class_names)
+    assert table["label_matrix"].shape == (len(patches), len(class_names))
+    with h5py.File(os.path.join(str(tmpdir), "table.hdf5"), "w") as fd:
+        group = fd.create_group("metadata_table")
+        for column_name, column in table.items():
+            group.create_dataset(name=column_name, data=column,
+                                 dtype=h5py.special_dtype(vlen=str) if column.dtype == object else column.dtype)
+    with h5py.File(os.path.join(str(tmpdir), "table.hdf5"), "r") as fd:
+        assert thelper.data.geo.bigearthnet._get_patches_from_table(fd["metadata_table"]) == patches
+
+
+@pytest.mark.parametrize("image_compression,num_workers", [
+    ("chunk_lz4", 2),
+    (("lz4", {"content_checksum": True}), 1),
+])
+def test_slab_export(tmpdir, image_compression, num_workers):
+    import h5py
+    root_path = os.path.join(str(tmpdir), "root")
+    _create_dummy_patches(root_path)
+    compactor = thelper.data.geo.bigearthnet.HDF5Compactor(root_path, num_workers=1)
+    hdf5_path = os.path.join(str(tmpdir), "bigearthnet.hdf5")
+    compactor.export(hdf5_path, target_size=8, image_compression=image_compression,
+                     progress_bar=False, num_workers=num_workers, slab_size=2)
+    compactor._test_close_vals(hdf5_path)
+    if isinstance(image_compression, tuple):
+        # the encoder parameters should be used when encoding the flattened patches
+        with h5py.File(hdf5_path, "r") as fd:
+            for patch_idx, patch in enumerate(compactor.patches):
+                expected = thelper.utils.encode_data(patch.load_array(target_size=8), "lz4", **image_compression[1])
+                assert bytes(fd["imgdata"][patch_idx]) == expected
+                assert expected != thelper.utils.encode_data(patch.load_array(target_size=8), "lz4")
+    dataset = thelper.data.geo.bigearthnet.BigEarthNet(hdf5_path, use_global_normalization=False)
+    assert dataset.samples == compactor.patches
+    for patch_idx, patch in enumerate(compactor.patches):
+        sample = dataset[patch_idx]
+        assert np.array_equal(sample["image"], np.transpose(patch.load_array(target_size=8), (1, 2, 0)))
+        expected_labels = [name in patch.labels for name in dataset.class_names]
+        assert np.array_equal(sample["labels"].astype(bool), expected_labels)
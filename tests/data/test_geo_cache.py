@@ -0,0 +1,80 @@
+import collections.abc
+import os
+
+import numpy as np
+import pytest
+
+import thelper
+
+pytestmark = pytest.mark.skipif(not thelper.utils.check_installed("gdal"), reason="geo packages not installed")
+
+
+def _check_equal(value, expected):
+    import shapely.geometry.base
+    assert type(value) is type(expected) or \
+        (isinstance(value, collections.abc.Mapping) and isinstance(expected, collections.abc.Mapping)), \
+        f"type mismatch: {type(value)} vs {type(expected)}"
+    if isinstance(expected, np.ndarray):
+        assert value.dtype == expected.dtype and value.shape == expected.shape
+        for item, expected_item in zip(value.ravel(), expected.ravel()):
+            _check_equal(item, expected_item)
+    elif isinstance(expected, np.generic):
+        assert value.dtype == expected.dtype and value == expected
+    elif isinstance(expected, (list, tuple)):
+        assert len(value) == len(expected)
+        for item, expected_item in zip(value, expected):
+            _check_equal(item, expected_item)
+    elif isinstance(expected, collections.abc.Mapping):
+        assert set(value.keys()) == set(expected.keys())
+        for key in expected:
+            _check_equal(value[key], expected[key])
+    elif isinstance(expected, shapely.geometry.base.BaseGeometry):
+        assert value.equals(expected)
+    else:
+        assert value == expected
+
+
+def test_columnar_cache_roundtrip(tmpdir):
+    import shapely.geometry
+    features = [{"id": idx, "geometry": shapely.geometry.Point(idx, idx).buffer(1.0)} for idx in range(3)]
+    records = [
+        {"int": 1, "float": 1.5, "bool": True, "mixed": 1, "none": None, "bigint": 2 ** 70,
+         "np_float": np.float32(0.5), "list": [1, 2, 3], "tuple": (1.5, 2.5), "mixed_list": [1, 2.5],
+         "ragged": [1, 2], "nested": [[1, 2], (3, 4.5)], "array": np.arange(4, dtype=np.int16),
+         "ragged_array": np.arange(3, dtype=np.float32), "nested_arrays": [np.zeros((2, 2), np.uint8), np.ones(3)],
+         "props": {"name": "a", 3: (1, None)}, "geometry": shapely.geometry.Point(1, 2),
+         "feature": features[0], "features": [features[0], features[1]], "sparse": "x"},
+        {"int": 2, "float": 2.0, "bool": False, "mixed": 2.5, "none": 3, "bigint": 1,
+         "np_float": np.float32(1.5), "list": [4, 5, 6], "tuple": (3.5, 4.5), "mixed_list": [True, 2],
+         "ragged": [], "nested": None, "array": np.arange(4, 8, dtype=np.int16),
+         "ragged_array": np.arange(5, dtype=np.float32), "nested_arrays": [np.array(["a", "b"], dtype=object)],
+         "props": {"name": "b"}, "geometry": shapely.geometry.Point(3, 4),
+         "feature": features[2], "features": []},
+        {"int": 3, "float": -1.0, "bool": True, "mixed": None, "none": None, "bigint": 2,
+         "np_float": np.float32(-2.5), "list": [7, 8, 9], "tuple": (5.5, 6.5), "mixed_list": [],
+         "ragged": [3, 4, 5], "nested": [np.int64(2)], "array": np.arange(8, 12, dtype=np.int16),
+         "ragged_array": np.zeros(0, dtype=np.float32), "nested_arrays": [],
+         "props": {}, "geometry": shapely.geometry.LineString([(0, 0), (1, 1)]),
+         "feature": features[1], "features": [features[2]]},
+    ]
+    cache_path = os.path.join(str(tmpdir), "test.crops")
+    assert not thelper.data.geo.cache.is_columnar_cache(cache_path)
+    thelper.data.geo.cache.write_columnar_cache(cache_path, records, links=features)
+    assert thelper.data.geo.cache.is_columnar_cache(cache_path)
+    table = thelper.data.geo.cache.ColumnarTable(cache_path, links=features)
+    assert len(table) == len(records)
+    expected_kinds = {"int": "array", "float": "array", "bool": "array", "mixed": "json", "none": "json",
+                      "bigint": "json", "np_float": "array", "list": "array", "tuple": "array", "mixed_list": "json",
+                      "ragged": "ragged", "nested": "json", "array": "array", "ragged_array": "ragged",
+                      "nested_arrays": "json", "props": "json", "geometry": "wkb", "feature": "link",
+                      "features": "links", "sparse": "json"}
+    assert {key: column["kind"] for key, column in table.columns.items()} == expected_kinds
+    for record, view in zip(records, table):
+        assert set(view.keys()) == set(record.keys())
+        for key in record:
+            if key in ["feature", "features"]:
+                assert view[key] is record[key] if key == "feature" else \
+                    all([a is b for a, b in zip(view[key], record[key])]) and len(view[key]) == len(record[key])
+            else:
+                _check_equal(view[key], record[key])
+    assert "sparse" in table[0] and "sparse" not in table[1]
@@ -0,0 +1,101 @@
+import collections
+import json
+import os
+
+import numpy as np
+import pytest
+
+import thelper
+
+pytestmark = pytest.mark.skipif(not thelper.utils.check_installed("gdal"), reason="geo packages not installed")
+
+dummy_metadata = [
+    "collections.OrderedDict([('name', 'tile0'), ('res', 0.5), ('bounds', OrderedDict([('x', [1, 2])]))])",
+    "ordereddict([('name', 'tile1'), ('res', 1.0), ('bounds', ordereddict())])",
+]
+
+
+def _create_dummy_archive(work_folder, metadata=dummy_metadata, nb_samples=12, size=4):
+    import h5py
+    rng = np.random.RandomState(0)
+    hdf5_path = os.path.join(work_folder, "trn_samples.hdf5")
+    with h5py.File(hdf5_path, "w") as fd:
+        fd.create_dataset("sat_img", data=rng.rand(nb_samples, size, size, 3).astype(np.float32))
+        fd.create_dataset("map_img", data=rng.randint(4, size=(nb_samples, size, size)).astype(np.int16))
+        fd.create_dataset("metadata", data=metadata, dtype=h5py.special_dtype(vlen=str))
+        fd.create_dataset("meta_idx", data=[idx % (len(metadata) + 1) - 1 for idx in range(nb_samples)])
+    return hdf5_path
+
+
+def _create_dataset(work_folder, **kwargs):
+    return thelper.data.geo.gdl.SegmentationDataset(["a", "b", "c"], work_folder, "trn", **kwargs)
+
+
+def test_decode_metadata():
+    metadata = thelper.data.geo.gdl.decode_metadata(np.asarray([dummy_metadata[0].encode()], dtype=object))
+    assert isinstance(metadata, collections.OrderedDict) and isinstance(metadata["bounds"], collections.OrderedDict)
+    assert list(metadata.items()) == [("name", "tile0"), ("res", 0.5), ("bounds", {"x": [1, 2]})]
+    assert thelper.data.geo.gdl.decode_metadata(dummy_metadata[1]) == \
+        collections.OrderedDict([("name", "tile1"), ("res", 1.0), ("bounds", collections.OrderedDict())])
+    assert thelper.data.geo.gdl.decode_metadata("not a dict") == "not a dict"
+    # only literals and OrderedDict constructors should be evaluated
+    for metadata in ["collections.OrderedDict([('a', eval('1'))])", "collections.OrderedDict(__import__('os'))",
+                     "collections.OrderedDict([('a', 1)], b=2)", "collections.OrderedDict([('a', x)])"]:
+        with pytest.raises((AssertionError, ValueError)):
+            _ = thelper.data.geo.gdl.decode_metadata(metadata)
+
+
+def test_metadata_cache(tmpdir):
+    hdf5_path = _create_dummy_archive(str(tmpdir))
+    dataset = _create_dataset(str(tmpdir))
+    expected = [thelper.data.geo.gdl.decode_metadata(metadata) for metadata in dummy_metadata]
+    assert dataset.metadata == expected and os.path.isfile(dataset.metadata_cache_path)
+    with open(dataset.metadata_cache_path, "r") as fd:
+        cache = json.load(fd)
+    assert cache["source_stamp"] == [os.path.getsize(hdf5_path), os.path.getmtime(hdf5_path)]
+    # the cache should be used as long as the archive is unchanged...
+    cache["metadata"][0]["name"] = "cached"
+    with open(dataset.metadata_cache_path, "w") as fd:
+        json.dump(cache, fd)
+    reloaded = _create_dataset(str(tmpdir))
+    assert reloaded.metadata[0]["name"] == "cached" and isinstance(reloaded.metadata[0], collections.OrderedDict)
+    assert list(reloaded.metadata[0].keys()) == list(expected[0].keys())
+    # ...and be ignored (and rewritten) once the archive is modified
+    os.utime(hdf5_path, (os.path.getatime(hdf5_path), os.path.getmtime(hdf5_path) + 10))
+    assert _create_dataset(str(tmpdir)).metadata == expected
+    assert _create_dataset(str(tmpdir)).metadata == expected
+    with open(dataset.metadata_cache_path, "r") as fd:
+        assert json.load(fd)["source_stamp"][1] == os.path.getmtime(hdf5_path)
+
+
+def test_metadata_cache_invalid(tmpdir):
+    # tuples cannot be stored in json without loss, so the metadata should not be cached
+    _create_dummy_archive(str(tmpdir), metadata=["collections.OrderedDict([('size', (4, 4))])"])
+    dataset = _create_dataset(str(tmpdir))
+    assert dataset.metadata == [collections.OrderedDict([("size", (4, 4))])]
+    assert not os.path.exists(dataset.metadata_cache_path)
+    with open(dataset.metadata_cache_path, "w") as fd:
+        fd.write("{invalid")  # a corrupted cache should be ignored
+    assert _create_dataset(str(tmpdir)).metadata == dataset.metadata
+
+
+@pytest.mark.parametrize("dontcare", [None, (0, 255)])
+def test_getitems(tmpdir, dontcare):
+    _create_dummy_archive(str(tmpdir))
+    dataset = _create_dataset(str(tmpdir), dontcare=dontcare)
+    expected = [dataset[idx] for idx in range(len(dataset))]
+    label_values = set(np.unique([sample["map_img"] for sample in expected]).tolist())
+    assert label_values == ({0, 1, 2, 3} if dontcare is None else {0, 1, 2, 255})
+    rng = np.random.RandomState(0)
+    for indices in [rng.permutation(len(dataset)), list(range(3, 9)), [5, 5, 2, 5, 3, 4, 2], [-1, 0, -12, 11]]:
+        samples = dataset.__getitems__(indices)
+        assert len(samples) == len(indices)
+        for sample, idx in zip(samples, indices):
+            expected_sample = expected[idx]
+            assert np.array_equal(sample["sat_img"], expected_sample["sat_img"])
+            assert np.array_equal(sample["map_img"], expected_sample["map_img"])
+            assert sample["metadata"] == expected_sample["metadata"]
+    assert all([np.array_equal(a["sat_img"], b["sat_img"]) for a, b in zip(dataset[2:7], expected[2:7])])
+    assert expected[0]["metadata"] is None and expected[1]["metadata"] == dataset.metadata[0]
+    with pytest.raises(AssertionError):
+        _ = dataset.__getitems__([len(dataset)])
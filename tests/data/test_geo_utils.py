@@ -0,0 +1,157 @@
+import numpy as np
+import pytest
+
+import thelper
+
+pytestmark = pytest.mark.skipif(not thelper.utils.check_installed("gdal"), reason="geo packages not installed")
+
+dummy_geotransform = (100.0, 1.0, 0.0, 200.0, 0.0, -1.0)
+
+
+def _check_masks(geoms, cols=32, rows=24):
+    import shapely.geometry
+    import shapely.ops
+    cv_mask = thelper.data.geo.utils.rasterize_geometries(geoms, dummy_geotransform, cols, rows)
+    gdal_mask = thelper.data.geo.utils.rasterize_geometries_gdal(geoms, dummy_geotransform, cols, rows)
+    assert cv_mask.shape == gdal_mask.shape == (rows, cols)
+    assert cv_mask.dtype == gdal_mask.dtype == np.uint8
+    assert np.count_nonzero(gdal_mask) > 0
+    # the opencv path approximates gdal's 'all touched' rasterization, so only boundary pixels may differ
+    union = shapely.ops.unary_union(geoms)
+    for row, col in np.ndindex(rows, cols):
+        center = shapely.geometry.Point(dummy_geotransform[0] + col + 0.5, dummy_geotransform[3] - row - 0.5)
+        if union.contains(center):
+            assert cv_mask[row, col] == 1 and gdal_mask[row, col] == 1
+        elif union.distance(center) > 1.0:
+            assert cv_mask[row, col] == 0 and gdal_mask[row, col] == 0
+    return cv_mask, gdal_mask
+
+
+def test_rasterize_polygon():
+    import shapely.geometry
+    poly = shapely.geometry.Polygon([(103.3, 196.6), (115.7, 197.2), (112.4, 185.1), (104.2, 188.9)])
+    _check_masks([poly])
+
+
+def test_rasterize_multipolygon():
+    import shapely.geometry
+    holed_poly = shapely.geometry.Polygon([(102.2, 197.7), (112.6, 197.4), (111.9, 186.3), (102.7, 186.8)],
+                                          [[(105.1, 194.4), (109.3, 194.6), (108.8, 190.2), (105.4, 190.1)]])
+    poly = shapely.geometry.Polygon([(117.4, 195.3), (129.1, 193.8), (124.6, 180.2)])
+    cv_mask, _ = _check_masks([shapely.geometry.MultiPolygon([holed_poly, poly])])
+    assert cv_mask[200 - 193, 107 - 100] == 0  # center of the hole
+
+
+def test_rasterize_fallback():
+    import shapely.geometry
+    poly = shapely.geometry.Polygon([(103.3, 196.6), (115.7, 197.2), (112.4, 185.1)])
+    line = shapely.geometry.LineString([(118.2, 198.1), (129.7, 182.4)])
+    point = shapely.geometry.Point(120.5, 195.5)
+    # lines and points cannot be drawn by opencv, so gdal should be used instead (and nothing should be dropped)
+    cv_mask, gdal_mask = _check_masks([poly, line])
+    assert np.array_equal(cv_mask, gdal_mask) and cv_mask[200 - 190, 124 - 100] == 1
+    cv_mask, gdal_mask = _check_masks([shapely.geometry.GeometryCollection([poly, point])])
+    assert np.array_equal(cv_mask, gdal_mask) and cv_mask[200 - 196, 120 - 100] == 1
+
+
+def _create_dummy_raster(path, origin, data, epsg=3857, nodata=None, overviews=None):
+    import gdal
+    import osr
+    raster = gdal.GetDriverByName("GTiff").Create(path, data.shape[2], data.shape[1], data.shape[0], gdal.GDT_UInt16)
+    raster.SetGeoTransform((origin[0], 1.0, 0.0, origin[1], 0.0, -1.0))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    raster.SetProjection(srs.ExportToWkt())
+    for band_idx in range(data.shape[0]):
+        if nodata is not None:
+            raster.GetRasterBand(band_idx + 1).SetNoDataValue(nodata)
+        raster.GetRasterBand(band_idx + 1).WriteArray(data[band_idx])
+    if overviews:
+        raster.BuildOverviews("NEAREST", overviews)
+    raster = None  # noqa # flush and close output fd
+
+
+def test_raster_catalog_mosaic(tmpdir):
+    import os
+    import osr
+    import shapely.geometry
+    rng = np.random.RandomState(0)
+    raster_arrays = [rng.randint(1, 1000, size=(2, 12, 16)).astype(np.uint16) for _ in range(2)]
+    raster_paths = [os.path.join(str(tmpdir), f"raster{idx}.tif") for idx in range(2)]
+    for raster_path, origin, data in zip(raster_paths, [(1000, 2000), (1016, 2000)], raster_arrays):
+        _create_dummy_raster(raster_path, origin, data)
+    srs_target = osr.SpatialReference()
+    srs_target.ImportFromEPSG(3857)
+    cache_dir = os.path.join(str(tmpdir), "cache")
+    os.makedirs(cache_dir)
+    rasters_data, coverage = thelper.data.geo.utils.parse_rasters(raster_paths, srs_target, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 2  # raster metadata should be cached (and reused)
+    assert thelper.data.geo.utils.get_rasters_info(raster_paths, cache_dir=cache_dir) == \
+        thelper.data.geo.utils.get_rasters_info(raster_paths)
+    catalog = thelper.data.geo.utils.RasterCatalog(rasters_data)
+    assert len(catalog) == 2 and catalog[1]["file_path"] == raster_paths[1]
+    assert coverage.equals(shapely.geometry.box(1000, 1988, 1032, 2000))
+    catalog.mosaic = thelper.data.geo.utils.build_vrt_mosaic(catalog, os.path.join(str(tmpdir), "mosaic.vrt"),
+                                                             srs_target)
+    assert catalog.mosaic is not None and (catalog.mosaic["cols"], catalog.mosaic["rows"]) == (32, 12)
+    # this crop spans the boundary between both rasters (x=1016); it covers rows 2-9 and cols 10-21 of the mosaic
+    crop_geotransform = (1010.0, 1.0, 0.0, 1998.0, 0.0, -1.0)
+    crop_roi = shapely.geometry.box(1010, 1990, 1022, 1998)
+    assert catalog.intersects(crop_roi) == [0, 1] and catalog.intersects(shapely.geometry.box(1001, 1990, 1005, 1998)) == [0]
+    expected = np.concatenate([raster_arrays[0][:, 2:10, 10:16], raster_arrays[1][:, 2:10, 0:6]], axis=2)
+    expected = np.transpose(expected, (1, 2, 0))
+    crops = []
+    for raster_hits in [[catalog.mosaic], [catalog[idx] for idx in catalog.intersects(crop_roi)]]:
+        crop = np.ma.array(np.zeros((8, 12, 2), dtype=np.uint16), mask=np.ones((8, 12, 2), dtype=bool))
+        for raster_data in raster_hits:
+            window = thelper.data.geo.utils.get_crop_window(raster_data, crop_geotransform, srs_target)
+            assert window is not None
+            rasterfile = thelper.data.geo.utils.open_rasterfile(raster_data)
+            thelper.data.geo.utils.read_crop_window(rasterfile, window, crop)
+        crops.append(crop)
+    for crop in crops:
+        assert not crop.mask.any() and np.array_equal(crop.data, expected)
+    # rasters that are not aligned on the same pixel grid cannot be mosaicked
+    misaligned_path = os.path.join(str(tmpdir), "raster2.tif")
+    _create_dummy_raster(misaligned_path, (1032.5, 2000), raster_arrays[0])
+    rasters_data, _ = thelper.data.geo.utils.parse_rasters(raster_paths + [misaligned_path], srs_target)
+    assert thelper.data.geo.utils.build_vrt_mosaic(rasters_data, os.path.join(str(tmpdir), "bad.vrt"), srs_target) is None
+
+
+def test_query_intersections_parallel():
+    import shapely.geometry
+    rng = np.random.RandomState(0)
+    geoms = [shapely.geometry.Point(*center).buffer(radius) for center, radius in
+             zip(rng.uniform(0, 100, size=(200, 2)), rng.uniform(0.5, 5, size=200))]
+    index = thelper.data.geo.utils.SpatialIndex(geoms)
+    tiles = [shapely.geometry.box(x, y, x + 10, y + 10) for y in range(0, 100, 10) for x in range(0, 100, 10)]
+    hits = thelper.data.geo.utils.query_intersections(index, tiles)
+    assert hits == [[idx for idx, geom in enumerate(geoms) if geom.intersects(tile)] for tile in tiles]
+    # the index is shared by all chunks, and only sent once to each worker process
+    assert thelper.data.geo.utils.query_intersections(index, tiles, parallel=2) == hits
+
+
+def test_validity_mask(tmpdir):
+    import os
+    import cv2 as cv
+    nodata = 500  # mid-range value, which the average of valid values can fall on
+    data = np.full((2, 48, 64), nodata, dtype=np.uint16)
+    data[0, 3, 5] = 400  # single valid pixel in the first band, dropped by nearest neighbor overviews
+    data[1, 20, 30], data[1, 21, 31] = 400, 600  # valid pixels in the second band that average to nodata
+    data[:, 40:48, 56:64] = 1000  # fully valid block
+    raster_path = os.path.join(str(tmpdir), "raster.tif")
+    _create_dummy_raster(raster_path, (1000, 2000), data, nodata=nodata, overviews=[2, 4, 8])
+    mask, geotransform = thelper.data.geo.utils.get_validity_mask(raster_path, max_size=8)
+    assert mask.shape == (6, 8) and np.allclose(geotransform, (1000, 8, 0, 2000, 0, -8))
+    expected = np.zeros((6, 8), dtype=np.uint8)
+    expected[0, 0] = expected[2, 3] = expected[5, 7] = 1
+    assert np.array_equal(mask, cv.dilate(expected, np.ones((3, 3), dtype=np.uint8)))
+    bboxes = [(1000, 1992, 1008, 2000), (1028, 1980, 1036, 1984), (1020, 1960, 1028, 1968), (1060, 1956, 1064, 1960)]
+    assert thelper.data.geo.utils.get_validity_hits(mask, geotransform, bboxes).tolist() == [True, True, False, True]
+    data[:] = nodata
+    _create_dummy_raster(raster_path, (1000, 2000), data, nodata=nodata)
+    mask, _ = thelper.data.geo.utils.get_validity_mask(raster_path, max_size=8)
+    assert not mask.any()
+    _create_dummy_raster(raster_path, (1000, 2000), data)  # no nodata value, so all pixels are valid
+    mask, _ = thelper.data.geo.utils.get_validity_mask(raster_path, max_size=16)
+    assert mask.shape == (12, 16) and mask.all()
@@ -141,7 +141,8 @@ def dummy_hdf5(request):
 
     dataset = DummyDataset(1000)
     data_loader = thelper.data.DataLoader(dataset, num_workers=0, batch_size=3)
-    thelper.data.create_hdf5(test_hdf5_path, dataset.task, data_loader, None, None)
+    compression = getattr(request, "param", None)
+    thelper.data.create_hdf5(test_hdf5_path, dataset.task, data_loader, None, None, compression=compression)
     return dataset
 
 
@@ -173,6 +174,26 @@ def test_hdf5_dataset(fake_op, dummy_hdf5):
     hdf5_dataset.close()
 
 
+@pytest.mark.parametrize("dummy_hdf5", [{
+    "1": {"type": "lz4", "block_size": 16},
+    "2": {"type": "none", "block_size": 7},
+}], indirect=True)
+def test_hdf5_dataset_blocks(dummy_hdf5):
+    hdf5_dataset = thelper.data.HDF5Dataset(test_hdf5_path, subset="train", block_cache_size=2)
+    assert sorted(hdf5_dataset.block_readers.keys()) == ["1", "2"]
+    assert len(dummy_hdf5) == len(hdf5_dataset)
+    for idx in range(len(dummy_hdf5)):
+        for key in dummy_hdf5.task.keys:
+            assert np.array_equal(dummy_hdf5[idx][key], hdf5_dataset[idx][key])
+    reader = hdf5_dataset.block_readers["1"]
+    assert reader.misses == len(reader.blocks) == (len(dummy_hdf5) + 15) // 16  # sequential reads: one miss per block
+    boundaries = reader.get_block_boundaries()
+    assert boundaries[0] == 0 and boundaries[-1] == len(dummy_hdf5) and len(boundaries) == len(reader.blocks) + 1
+    _ = hdf5_dataset[0]
+    assert reader.misses == len(reader.blocks) + 1  # first block was evicted from the cache
+    hdf5_dataset.close()
+
+
 def test_classif_dataset():
     with pytest.raises(AssertionError):
         _ = thelper.data.ClassificationDataset(["0", "1"], None, "label")
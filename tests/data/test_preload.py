@@ -0,0 +1,102 @@
+import copy
+import multiprocessing
+import pickle
+
+import numpy as np
+import pytest
+
+import thelper
+
+arena_backends = ["memmap"]
+if thelper.data.preload.shared_memory is not None:
+    arena_backends.append("shm")
+
+
+def _get_arena_sum(arena, idx):
+    return int(arena[idx].sum())
+
+
+def _collate_list(batch):
+    return batch
+
+
+@pytest.fixture
+def dummy_arrays():
+    rng = np.random.RandomState(0)
+    return [
+        rng.randint(0, 255, size=(32, 48, 3), dtype=np.uint8),
+        rng.rand(7, 5).astype(np.float32),
+        np.arange(100, dtype=np.int64)[::2],  # non-contiguous input
+        np.zeros((0, 3), dtype=np.float64),
+        np.asarray(3.5),
+        rng.randint(0, 255, size=(64, 64, 3), dtype=np.uint8),
+    ]
+
+
+@pytest.mark.parametrize("backend", arena_backends)
+def test_arena_roundtrip(dummy_arrays, backend):
+    arena = thelper.data.preload.SharedArrayArena(backend=backend, segment_size=10000)
+    idxs = [arena.append(array) for array in dummy_arrays]
+    assert idxs == list(range(len(dummy_arrays)))
+    with pytest.raises(AssertionError):
+        _ = arena[0]  # not sealed yet
+    arena.seal()
+    with pytest.raises(AssertionError):
+        arena.append(dummy_arrays[0])
+    assert len(arena) == len(dummy_arrays)
+    assert len(arena.segment_names) > 1  # the last array does not fit in the first segment
+    for idx, array in enumerate(dummy_arrays):
+        assert arena[idx].dtype == array.dtype and np.array_equal(arena[idx], array)
+        assert not arena[idx].flags.writeable
+    assert len(pickle.dumps(arena)) < sum([array.nbytes for array in dummy_arrays])  # no array data in pickles
+    attached = pickle.loads(pickle.dumps(arena))
+    assert all([np.array_equal(attached[idx], array) for idx, array in enumerate(dummy_arrays)])
+    assert copy.deepcopy(arena) is arena
+    del attached
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        assert pool.apply(_get_arena_sum, (arena, 5)) == int(dummy_arrays[5].sum())
+    arena.close()
+
+
+class DummyPreloadDataset(thelper.data.Dataset, thelper.data.preload.SharedPreloadMixin):
+    def __init__(self, arrays, backend):
+        super().__init__()
+        self._init_preload_arena(["image", "label_map"], backend=backend)
+        self.samples = []
+        for idx, array in enumerate(arrays):
+            self._preload_sample_arrays({"image": array, "label_map": array[..., 0] if idx % 2 else None})
+            self.samples.append({"idx": idx})
+        self._finalize_preload()
+
+    def __getitem__(self, idx):
+        return {**self.samples[idx], **self._get_preloaded_arrays(idx)}
+
+
+@pytest.mark.parametrize("backend", arena_backends)
+def test_preload_mixin(backend):
+    arrays = [np.full((8, 8, 3), idx, dtype=np.uint8) for idx in range(10)]
+    dataset = DummyPreloadDataset(arrays, backend)
+    assert dataset.preload_array_idxs.shape == (10, 2)
+    for idx in range(10):
+        sample = dataset[idx]
+        assert np.array_equal(sample["image"], arrays[idx])
+        assert (sample["label_map"] is None) == (idx % 2 == 0)
+    dataset_copy = copy.deepcopy(dataset)
+    assert dataset_copy.preload_arena is dataset.preload_arena
+    loader = thelper.data.DataLoader(dataset, batch_size=5, num_workers=2, collate_fn=_collate_list)
+    batches = [batch for batch in loader]
+    assert len(batches) == 2 and all([np.array_equal(s["image"], arrays[s["idx"]]) for b in batches for s in b])
+
+
+@pytest.mark.skipif(thelper.data.preload.shared_memory is None, reason="shared memory requires python >= 3.8")
+def test_arena_shm_free_space(monkeypatch, dummy_arrays):
+    monkeypatch.setattr(thelper.data.preload, "get_shm_free_space", lambda: 5000)
+    # segments that cannot fit in shared memory should not be allocated there (they would crash once written to)
+    assert thelper.data.preload.SharedArrayArena(segment_size=10000).backend == "memmap"
+    arena = thelper.data.preload.SharedArrayArena(backend="shm", segment_size=10000)
+    with pytest.raises(AssertionError):
+        arena.append(dummy_arrays[0])
+    assert not arena.segment_names
+    monkeypatch.setattr(thelper.data.preload, "get_shm_free_space", lambda: 2 ** 20)
+    assert thelper.data.preload.SharedArrayArena(segment_size=10000).backend == "shm"
@@ -185,3 +185,49 @@ def test_subset_random_epoch_step(fake_dataset, sampler_type):
     for idx in sampler:
         epoch0_reset_label_groups[fake_dataset[1][idx]].append(fake_dataset[0][idx])
     assert epoch0_reset_label_groups == epoch0_label_groups
+
+
+def test_block_shuffle_sampler():
+    indices = list(range(1000))
+    with pytest.raises(AssertionError):
+        _ = thelper.data.BlockShuffleSampler(indices, window=4)  # no block size or dataset
+    sampler = thelper.data.BlockShuffleSampler(indices, window=4, block_size=50, seeds={"torch": 13})
+    epoch0 = list(sampler)
+    assert sorted(epoch0) == indices and epoch0 != indices
+    epoch1 = list(sampler)
+    assert sorted(epoch1) == indices and epoch1 != epoch0
+    sampler.set_epoch(0)
+    assert list(sampler) == epoch0
+    block_ids = sampler.get_block_ids(indices)
+    assert block_ids[0] == 0 and block_ids[-1] == 19
+    # with a cache that holds the whole window, each block should be decoded about once per epoch
+    stats = thelper.data.samplers.get_sampling_locality_stats(epoch0, block_ids, cache_size=5)
+    assert 20 / 1000 <= stats["decodes_per_sample"] < 0.1
+    random_stats = thelper.data.samplers.get_sampling_locality_stats(np.random.permutation(1000), block_ids, cache_size=5)
+    assert random_stats["decodes_per_sample"] > 0.5 and random_stats["block_spread"] > 0.9 > stats["block_spread"]
+    wide_stats = thelper.data.BlockShuffleSampler(indices, window=20, block_size=50, seeds={"torch": 13}).get_stats()
+    assert wide_stats["block_spread"] > stats["block_spread"]
+
+
+def test_block_shuffle_sampler_dataset():
+    class FakeBlockDataset:
+        def __init__(self, size):
+            self.size, self.cache_size = size, 1
+
+        def __len__(self):
+            return self.size
+
+        def get_block_boundaries(self):
+            return np.append(np.arange(0, self.size, 10), self.size)
+
+        def reserve_block_cache(self, count):
+            self.cache_size = max(self.cache_size, count)
+
+    datasets = [FakeBlockDataset(95), FakeBlockDataset(40)]
+    concat_dataset = thelper.data.samplers.torch.utils.data.ConcatDataset(datasets)
+    boundaries = thelper.data.samplers.get_dataset_block_boundaries(concat_dataset)
+    assert boundaries.tolist() == list(range(0, 95, 10)) + list(range(95, 135, 10)) + [135]
+    sampler = thelper.data.BlockShuffleSampler(list(range(135)), window=3, dataset=concat_dataset, scale=2.0)
+    assert all([dataset.cache_size == 4 for dataset in datasets])
+    indices = list(sampler)
+    assert len(indices) == len(sampler) == 270 and sorted(set(indices)) == list(range(135))
@@ -0,0 +1,146 @@
+import os
+
+import numpy as np
+import pytest
+
+import thelper
+
+
+class DummyStatsDataset(thelper.data.Dataset):
+    def __init__(self, nb_samples, nb_classes, segm=False):
+        super().__init__()
+        rng = np.random.RandomState(0)
+        self.samples = []
+        for idx in range(nb_samples):
+            label = rng.randint(-1, nb_classes, size=(8, 8)) if segm else int(rng.randint(nb_classes))
+            self.samples.append({"input": rng.rand(8, 8, 3) * (idx + 1), "label": label, "idx": idx})
+        class_names = [str(idx) for idx in range(nb_classes)]
+        if segm:
+            self.task = thelper.tasks.Segmentation(class_names, "input", "label", meta_keys=["idx"], dontcare=-1)
+        else:
+            self.task = thelper.tasks.Classification(class_names, "input", "label", meta_keys=["idx"])
+
+    def __getitem__(self, idx):
+        return self.transforms(self.samples[idx]) if self.transforms else self.samples[idx]
+
+
+def _scale_inputs(sample):
+    return {**sample, "input": sample["input"] * 2}
+
+
+@pytest.mark.parametrize("segm", [False, True])
+def test_dataset_stats(segm):
+    dataset = DummyStatsDataset(50, 4, segm=segm)
+    stats = thelper.data.stats.compute_dataset_stats(dataset, shard_size=7)
+    assert stats.sample_count == len(dataset)
+    assert stats.get_class_sizes() == dataset.task.get_class_sizes(dataset)
+    inputs = np.stack([sample["input"] for sample in dataset.samples]).reshape(-1, 3)
+    assert np.allclose(stats.band_mean, inputs.mean(axis=0)) and np.allclose(stats.band_std, inputs.std(axis=0))
+    norm_params = stats.get_normalization_params()
+    normalize = thelper.transforms.NormalizeZeroMeanUnitVar(**norm_params)
+    assert np.allclose(normalize(inputs).mean(axis=0), 0, atol=1e-4)
+    if segm:
+        assert stats.unknown_count == 0 and stats.dontcare_count > 0
+        assert (stats.class_counts <= len(dataset)).all() and (stats.class_counts > 0).all()
+
+
+def test_dataset_stats_multilabel():
+    dataset = DummyStatsDataset(20, 3)
+    dataset.task = thelper.tasks.Classification(["0", "1", "2"], "input", "label", multi_label=True)
+    for sample in dataset.samples:
+        sample["label"] = [1, 0, 1] if sample["idx"] % 2 else ["1"]
+    stats = thelper.data.stats.compute_dataset_stats(dataset)
+    assert stats.get_class_sizes() == {"0": 10, "1": 10, "2": 10}
+
+
+def test_dataset_stats_cache(tmpdir):
+    dataset = DummyStatsDataset(30, 3)
+    cache_path = os.path.join(str(tmpdir), "stats.json")
+    stats = thelper.data.stats.get_dataset_stats(dataset, cache_path=cache_path, force=True, progress_bar=False)
+    assert os.path.isfile(cache_path) and stats.key is not None
+    assert thelper.data.stats.get_dataset_stats(dataset, cache_path=cache_path) is stats
+    thelper.data.stats._stats_cache.clear()
+    reloaded = thelper.data.stats.get_dataset_stats(dataset, cache_path=cache_path)
+    assert reloaded is not stats and reloaded.get_class_sizes() == stats.get_class_sizes()
+    assert np.allclose(reloaded.band_mean, stats.band_mean) and np.allclose(reloaded.band_std, stats.band_std)
+    weights = reloaded.get_class_weights("linear", norm=True)
+    assert weights == thelper.data.utils.get_class_weights(dataset.task.get_class_sizes(dataset), "linear")
+    class_stats = thelper.data.stats.get_dataset_stats(dataset, cache_path=cache_path, band_stats=False)
+    assert class_stats is not reloaded and class_stats.band_mean is None and class_stats.band_sketch is None
+    assert class_stats.get_class_sizes() == stats.get_class_sizes()
+    # statistics are computed on raw samples, so the transforms should not affect them (or their key)
+    dataset.transforms = _scale_inputs
+    assert thelper.data.stats.get_dataset_stats_key(dataset) == stats.key
+    raw_stats = thelper.data.stats.compute_dataset_stats(dataset, num_workers=2, shard_size=8)
+    assert dataset.transforms is _scale_inputs and np.allclose(raw_stats.band_mean, stats.band_mean)
+    assert not np.allclose(dataset[0]["input"], dataset.samples[0]["input"])
+    # the key should change whenever the data files are modified
+    data_path = os.path.join(str(tmpdir), "data.bin")
+    with open(data_path, "wb") as fd:
+        fd.write(b"0000")
+    dataset.root = data_path
+    key = thelper.data.stats.get_dataset_stats_key(dataset)
+    assert key != stats.key and thelper.data.stats.get_dataset_stats_key(dataset) == key
+    with open(data_path, "wb") as fd:
+        fd.write(b"00000000")
+    assert thelper.data.stats.get_dataset_stats_key(dataset) != key
+    # saving the statistics next to the data (in the root directory) should not invalidate them
+    dataset.root = str(tmpdir)
+    stats = thelper.data.stats.get_dataset_stats(dataset, force=True, progress_bar=False)
+    assert os.path.isfile(thelper.data.stats.get_default_stats_path(dataset, stats.key))
+    assert thelper.data.stats.get_dataset_stats_key(dataset) == stats.key
+
+
+def test_dataset_stats_workers():
+    dataset = DummyStatsDataset(40, 3, segm=True)
+    serial_stats = thelper.data.stats.compute_dataset_stats(dataset)
+    parallel_stats = thelper.data.stats.compute_dataset_stats(dataset, num_workers=2, shard_size=8)
+    assert parallel_stats.get_class_sizes() == serial_stats.get_class_sizes()
+    assert np.array_equal(parallel_stats.class_counts, serial_stats.class_counts)
+    assert np.allclose(parallel_stats.band_mean, serial_stats.band_mean)
+    assert np.allclose(parallel_stats.band_m2, serial_stats.band_m2)
+
+
+def test_quantile_sketch():
+    rng = np.random.RandomState(0)
+    data = np.stack([rng.rand(20000), rng.randn(20000) * 10 + 5], axis=1)
+    sketches = [thelper.data.stats.QuantileSketch(256) for _ in range(4)]
+    for chunk_idx, chunk in enumerate(np.array_split(data, 40)):
+        sketches[chunk_idx % 4].update(chunk)
+    sketch = sketches[0]
+    for other in sketches[1:]:
+        sketch.merge(other)
+    assert sum([len(items) * 2 ** level for level, items in enumerate(sketch.levels) if items is not None]) == len(data)
+    assert sum([len(items) for items in sketch.levels if items is not None]) < 2000
+    quantiles = [0.01, 0.25, 0.5, 0.75, 0.99]
+    estimates = sketch.get_quantiles(quantiles)
+    assert estimates.shape == (5, 2)
+    for band_idx in range(2):
+        # compare the ranks of the estimates with the expected ranks (rank error should be in the order of 1/size)
+        ranks = np.searchsorted(np.sort(data[:, band_idx]), estimates[:, band_idx]) / len(data)
+        assert np.allclose(ranks, quantiles, atol=0.03)
+    reloaded = thelper.data.stats.QuantileSketch().load_state_dict(sketch.state_dict())
+    assert np.array_equal(reloaded.get_quantiles(quantiles), estimates)
+
+
+def test_band_stats(tmpdir):
+    dataset = DummyStatsDataset(30, 3)
+    dataset.task = None  # band statistics should be available for any dataset with an input key
+    with pytest.raises(AssertionError):
+        _ = thelper.data.stats.compute_dataset_stats(dataset)
+    stats = thelper.data.stats.compute_dataset_stats(dataset, input_key="input", num_workers=2, shard_size=4,
+                                                     sketch_size=512)
+    inputs = np.stack([sample["input"] for sample in dataset.samples]).reshape(-1, 3)
+    assert np.allclose(stats.band_min, inputs.min(axis=0)) and np.allclose(stats.band_max, inputs.max(axis=0))
+    percentiles = stats.get_band_percentiles([0, 50, 100])
+    assert np.array_equal(percentiles[0], stats.band_min) and np.array_equal(percentiles[2], stats.band_max)
+    ranks = [np.searchsorted(np.sort(inputs[:, idx]), percentiles[1, idx]) / len(inputs) for idx in range(3)]
+    assert np.allclose(ranks, 0.5, atol=0.03)
+    stats_path = os.path.join(str(tmpdir), "band_stats.json")
+    stats.save_band_stats(stats_path, percentiles=(1, 99))
+    band_stats = thelper.data.stats.load_band_stats(stats_path)
+    assert band_stats["count"] == len(inputs) and sorted(band_stats["percentiles"].keys()) == ["1", "99"]
+    normalize = thelper.transforms.NormalizeZeroMeanUnitVar(stats_path=stats_path)
+    assert np.allclose(normalize.mean, stats.band_mean) and np.allclose(normalize.std, stats.band_std)
+    with pytest.raises(AssertionError):
+        _ = thelper.transforms.NormalizeZeroMeanUnitVar(mean=[0, 0, 0], std=[1, 1, 1], stats_path=stats_path)
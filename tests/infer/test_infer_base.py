@@ -1,5 +1,10 @@
+import logging
+
+import torch
+
 import thelper.utils
 from thelper.infer.base import Tester
+from thelper.train.classif import ImageClassifTrainer
 
 from tests.train.train_utils import (  # noqa: F401 isort:skip
     mnist_config, test_classif_mnist_ft_path, test_classif_mnist_name,
@@ -23,3 +28,89 @@ def test_infer_base_tester_cannot_run_train(config):
             "RuntimeError was raised, but not the expected one"
     else:
         raise AssertionError("Tester.train should not be allowed to be called")
+
+
+class DummyPredRecorder:
+    def __init__(self):
+        self.preds, self.targets, self.iter_idxs = [], [], []
+
+    def update(self, pred, target, iter_idx, **kwargs):
+        self.preds.append(pred)
+        self.targets.append(target)
+        self.iter_idxs.append(iter_idx)
+
+
+class DummyLogHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class DummyClassifTester(ImageClassifTrainer, Tester):
+    pass
+
+
+class DummyCustomEpochTester(DummyClassifTester):
+    def eval_epoch(self, model, epoch, dev, loader, metrics, output_path):
+        self.custom_eval_calls = getattr(self, "custom_eval_calls", 0) + 1
+        return super().eval_epoch(model, epoch, dev, loader, metrics, output_path)
+
+
+def _create_dummy_tester(tmpdir, runner_config, tester_type=DummyClassifTester):
+    torch.manual_seed(0)
+    samples = [{"input": torch.randn(3, 8, 8), "label": idx % 3} for idx in range(10)]
+    loader = torch.utils.data.DataLoader(samples, batch_size=4)
+    task = thelper.tasks.Classification(["0", "1", "2"], "input", "label")
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), torch.nn.Flatten(), torch.nn.Linear(4 * 6 * 6, 3))
+    model.eval()
+    config = {"name": "test-tester", "tester": runner_config}
+    return tester_type("test-tester", str(tmpdir), model, task, (None, None, loader), config), model, loader
+
+
+def test_infer_base_tester_eval_with_tta(tmpdir):
+    tta_config = {"views": ["identity", "hflip"], "reduction": "mean"}
+    tester, model, loader = _create_dummy_tester(tmpdir, {"tta": tta_config})
+    assert len(tester.tta_views) == 2 and tester.tta_reduction == "mean"
+    recorder = DummyPredRecorder()
+    tester.eval_epoch(model, 0, tester.devices, loader, {"recorder": recorder}, str(tmpdir))
+    assert recorder.iter_idxs == list(range(len(loader)))
+    with torch.no_grad():
+        for pred, sample in zip(recorder.preds, loader):
+            expected = (model(sample["input"]) + model(sample["input"].flip(-1))) / 2
+            assert torch.allclose(pred, expected, atol=1e-6)
+            assert not torch.allclose(pred, model(sample["input"]))
+
+
+def test_infer_base_tester_eval_pipelined(tmpdir):
+    outputs = {}
+    for pipeline_config in [None, {"prefetch": 1, "max_in_flight": 1, "consumer_threads": 2}]:
+        tester, model, loader = _create_dummy_tester(tmpdir, {"pipeline": pipeline_config})
+        assert tester.supports_eval_batch() and tester.pipeline_config == pipeline_config
+        recorders = {"recorder1": DummyPredRecorder(), "recorder2": DummyPredRecorder()}
+        log_handler = DummyLogHandler()
+        tester.logger.addHandler(log_handler)
+        try:
+            tester._run_eval_epoch(model, loader, {**tester.test_metrics, **recorders}, str(tmpdir))
+        finally:
+            tester.logger.removeHandler(log_handler)
+        iter_logs = [message for message in log_handler.messages if "test epoch#0" in message]
+        assert len(iter_logs) == len(loader)
+        assert all([f"batch: {idx + 1}/{len(loader)}" in log for idx, log in enumerate(iter_logs)])
+        for recorder in recorders.values():
+            assert recorder.iter_idxs == list(range(len(loader)))
+        outputs[pipeline_config is not None] = recorders["recorder1"]
+    for pred, pipelined_pred in zip(outputs[False].preds, outputs[True].preds):
+        assert torch.equal(pred, pipelined_pred)
+    for target, pipelined_target in zip(outputs[False].targets, outputs[True].targets):
+        assert torch.equal(target, pipelined_target)
+
+
+def test_infer_base_tester_custom_eval_epoch(tmpdir):
+    tester, model, loader = _create_dummy_tester(tmpdir, {"pipeline": True}, DummyCustomEpochTester)
+    assert not tester.supports_eval_batch()
+    recorder = DummyPredRecorder()
+    tester._run_eval_epoch(model, loader, {"recorder": recorder}, str(tmpdir))
+    assert tester.custom_eval_calls == 1 and recorder.iter_idxs == list(range(len(loader)))
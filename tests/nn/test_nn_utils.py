@@ -0,0 +1,59 @@
+import pytest
+import torch
+
+import thelper
+
+
+class BatchSizeDependentModel(torch.nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.fc = torch.nn.Linear(4, 2)
+
+    def forward(self, x):
+        # the batch size gets baked into traced graphs as a constant here
+        return self.fc(x.view(x.shape[0], -1)).reshape(int(x.shape[0]), 2)
+
+
+@pytest.mark.parametrize("backend", ["eager", "script", "trace"])
+def test_deferred_compiled_model(backend):
+    model = BatchSizeDependentModel().eval()
+    deferred_model = thelper.nn.utils.DeferredCompiledModel(model, backend)
+    assert deferred_model.compiled_model is None  # nothing is prepared until the first input is received
+    inputs = [torch.randn(8, 2, 2), torch.randn(8, 2, 2), torch.randn(3, 2, 2)]  # smaller last batch
+    with torch.no_grad():
+        for input in inputs:
+            assert torch.allclose(deferred_model(input), model(input), atol=1e-5)
+    assert deferred_model.compiled_model is not None
+
+
+def _has_quantization_engine():
+    return any([name in torch.backends.quantized.supported_engines for name in ["x86", "fbgemm", "qnnpack"]])
+
+
+@pytest.mark.skipif(not _has_quantization_engine(), reason="no quantized CPU kernel backend available")
+def test_static_int8_quantization():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(
+        torch.nn.Conv2d(3, 8, kernel_size=3, padding=1),
+        torch.nn.ReLU(),
+        torch.nn.Conv2d(8, 8, kernel_size=3, padding=1),
+        torch.nn.ReLU(),
+        torch.nn.AdaptiveAvgPool2d(1),
+        torch.nn.Flatten(),
+        torch.nn.Linear(8, 4),
+    ).eval()
+    calib_inputs = [torch.rand(4, 3, 16, 16) for _ in range(4)]
+    quant_model = thelper.nn.utils.quantize_model(model, "static_int8", calib_inputs=calib_inputs)
+    assert all([param.dtype == torch.float32 for param in model.parameters()])  # original model is untouched
+    assert any(["quantized" in type(module).__module__ for module in quant_model.modules()])
+    inputs = [torch.rand(4, 3, 16, 16) for _ in range(2)]
+    max_diff = 0.
+    with torch.no_grad():
+        for input in inputs:
+            expected, output = model(input), quant_model(input)
+            assert output.shape == expected.shape and output.dtype == torch.float32
+            assert (output - expected).abs().max() <= 0.05 * expected.abs().max() + 1e-2
+            max_diff = max(max_diff, float((output - expected).abs().max()))
+    report = thelper.nn.utils.compare_quantized_model(model, quant_model, inputs)
+    assert report["batches"] == 2 and report["max_abs_diff"] == pytest.approx(max_diff)
@@ -0,0 +1,62 @@
+import os
+
+import pytest
+import torch
+
+import thelper
+import thelper.session.checkpoint
+
+
+def test_snapshot_state():
+    weights = torch.randn(4, 4)
+    state = {"model": {"weights": weights}, "outputs": {0: [1, 2]}, "epoch": 0}
+    snapshot = thelper.session.checkpoint.snapshot_state(state)
+    weights.add_(1)
+    state["outputs"][1] = [3, 4]
+    assert not torch.equal(snapshot["model"]["weights"], weights)
+    assert list(snapshot["outputs"].keys()) == [0]
+    assert snapshot["epoch"] == 0
+
+
+@pytest.mark.parametrize("async_write", [True, False])
+def test_checkpoint_writer(tmpdir, async_write):
+    writer = thelper.session.checkpoint.CheckpointWriter(str(tmpdir), keep_last=2, async_write=async_write)
+    assert repr(writer)
+    for epoch in range(4):
+        writer.save({"epoch": epoch, "model": {"w": torch.full((2, 2), float(epoch))}},
+                    f"ckpt.{epoch:04d}.host-20200101-00000{epoch}.pth", save_best=(epoch == 1))
+    writer.flush()
+    filenames = sorted(os.listdir(str(tmpdir)))
+    assert filenames == ["ckpt.0002.host-20200101-000002.pth", "ckpt.0003.host-20200101-000003.pth",
+                         "ckpt.best.pth", "manifest.json"]
+    assert torch.load(os.path.join(str(tmpdir), "ckpt.best.pth"))["epoch"] == 1
+    latest = torch.load(os.path.join(str(tmpdir), filenames[1]))
+    assert latest["epoch"] == 3 and torch.equal(latest["model"]["w"], torch.full((2, 2), 3.))
+    ckptdata = thelper.utils.load_checkpoint(str(tmpdir), always_load_latest=True, check_version=False)
+    assert ckptdata["epoch"] == 3
+
+
+def test_checkpoint_epoch_stamp():
+    get_stamp = thelper.session.checkpoint.get_checkpoint_epoch_stamp
+    assert get_stamp("ckpt.best.pth") is None
+    assert get_stamp("ckpt.0012.my.host-name-20200101-123456.pth") == (12, 20200101, 123456)
+    assert get_stamp("ckpt.0003.pth") == (3, 0, 0)
+
+
+def test_split_checkpoint_layout(tmpdir):
+    writer = thelper.session.checkpoint.CheckpointWriter(str(tmpdir), keep_last=1, layout="split")
+    for epoch in range(3):
+        writer.save({"epoch": epoch, "version": thelper.__version__, "model": {"w": torch.full((2, 2), float(epoch))},
+                     "optimizer": {"state": {}, "lr": epoch}}, f"ckpt.{epoch:04d}.host-20200101-00000{epoch}.pth",
+                    save_best=(epoch == 1))
+    writer.flush()
+    assert sorted(os.listdir(str(tmpdir))) == [
+        "ckpt.0002.host-20200101-000002.pth", "ckpt.best.pth", "manifest.json", "optim.0002.host-20200101-000002.pth",
+        "optim.best.pth", "weights.0002.host-20200101-000002.pth", "weights.best.pth"]
+    assert thelper.session.checkpoint.find_checkpoint(str(tmpdir)) == os.path.join(str(tmpdir), "ckpt.best.pth")
+    latest = thelper.utils.load_checkpoint(str(tmpdir), always_load_latest=True)
+    assert latest["epoch"] == 2 and latest["optimizer"]["lr"] == 2
+    assert torch.equal(latest["model"]["w"], torch.full((2, 2), 2.))
+    best = thelper.utils.load_checkpoint(str(tmpdir), model_only=True)
+    assert best["epoch"] == 1 and best["optimizer"] is None
+    assert torch.equal(best["model"]["w"], torch.full((2, 2), 1.))
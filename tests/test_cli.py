@@ -438,3 +438,21 @@ def test_export_model_weights(export_config):
     ckptdata = thelper.utils.load_checkpoint(export_ckpt_path)
     model = thelper.nn.create_model(config=None, task=None, ckptdata=ckptdata)
     assert model(torch.rand(1, 3, 224, 224)).shape == (1, 10)
+
+
+@pytest.mark.parametrize("quant_mode", ["dynamic_int8", "fp16"])
+def test_export_model_quantized(export_config, quant_mode):
+    export_config = copy.deepcopy(export_config)
+    trace_input = eval(export_config["export"]["trace_input"])
+    del export_config["export"]["trace_input"]
+    del export_config["export"]["trace_name"]
+    export_config["export"]["quantization"] = {"mode": quant_mode}
+    thelper.cli.export_model(export_config, test_save_path)
+    export_ckpt_path = os.path.join(test_create_simple_path, export_config["export"]["ckpt_name"])
+    ckptdata = thelper.utils.load_checkpoint(export_ckpt_path)
+    assert ckptdata["quantization"]["mode"] == quant_mode
+    model = thelper.nn.create_model(config=None, task=None, ckptdata=ckptdata)
+    assert model.eval()(trace_input).shape == (1, 1000)
+    fp32_model = thelper.nn.create_model(export_config, task=thelper.tasks.create_task(ckptdata["task"]))
+    report = thelper.nn.utils.compare_quantized_model(fp32_model, model, [trace_input])
+    assert report["batches"] == 1 and report["fp32_latency_ms"] > 0 and report["max_abs_diff"] >= 0
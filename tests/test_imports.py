@@ -0,0 +1,48 @@
+import importlib
+import subprocess
+import sys
+
+import pytest
+
+import thelper
+
+lazy_package_names = [
+    "thelper",
+    "thelper.data",
+    "thelper.gui",
+    "thelper.infer",
+    "thelper.optim",
+    "thelper.train",
+    "thelper.transforms",
+    "thelper.viz",
+]
+
+
+def test_lazy_import():
+    code = "import sys; import thelper; import thelper.cli; print(' '.join(sorted(sys.modules)))"
+    res = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    module_names = res.stdout.split()
+    assert "thelper" in module_names and "thelper.cli" in module_names
+    for heavy_name in ["torch", "sklearn", "matplotlib", "cv2", "thelper.data", "thelper.train", "thelper.utils"]:
+        assert heavy_name not in module_names
+
+
+@pytest.mark.parametrize("package_name", lazy_package_names)
+def test_lazy_attributes(package_name):
+    package = importlib.import_module(package_name)
+    for attr_name in package.__all__:
+        if attr_name == "geo" and not thelper.utils.check_installed("gdal"):
+            continue
+        assert getattr(package, attr_name) is not None
+        assert attr_name in dir(package)
+    with pytest.raises(AttributeError):
+        _ = getattr(package, "this_attribute_does_not_exist")
+
+
+def test_lazy_reexports():
+    from thelper.data import Dataset
+    from thelper.train import ImageClassifTrainer
+    assert Dataset is thelper.data.parsers.Dataset
+    assert ImageClassifTrainer is thelper.train.classif.ImageClassifTrainer
+    assert thelper.optim.Accuracy is thelper.optim.metrics.Accuracy
+    assert thelper.data.BoundingBox is thelper.tasks.detect.BoundingBox
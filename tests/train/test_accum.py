@@ -0,0 +1,48 @@
+import torch
+
+import thelper
+
+
+def test_split_batch():
+    sample = {"input": torch.randn(5, 3), "gt": torch.arange(5), "idx": list(range(5)), "meta": "dummy"}
+    micro_batches = thelper.train.utils.split_batch(sample, 2, "input")
+    assert [size for _, size in micro_batches] == [2, 2, 1]
+    assert torch.equal(torch.cat([mb["input"] for mb, _ in micro_batches]), sample["input"])
+    assert [mb["idx"] for mb, _ in micro_batches] == [[0, 1], [2, 3], [4]]
+    assert all([mb["meta"] == "dummy" for mb, _ in micro_batches])
+    augm_sample = {"input": [torch.randn(4, 3), torch.randn(4, 3)], "gt": [torch.arange(4), torch.arange(4)]}
+    micro_batches = thelper.train.utils.split_batch(augm_sample, 3, "input")
+    assert [size for _, size in micro_batches] == [3, 1]
+    assert len(micro_batches[0][0]["input"]) == 2 and micro_batches[0][0]["input"][1].shape == (3, 3)
+    assert torch.equal(micro_batches[1][0]["gt"][0], torch.LongTensor([3]))
+    assert thelper.train.utils.split_batch(sample, 8, "input")[0][0] is sample
+
+
+def test_grad_accumulation():
+    torch.manual_seed(0)
+    data = [{"input": torch.randn(4), "gt": torch.randn(1)} for _ in range(10)]
+
+    def train(batch_size, accum_steps, micro_batch_size):
+        model = torch.nn.Linear(4, 1)
+        model.weight.data.fill_(0.1)
+        model.bias.data.zero_()
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        loader = torch.utils.data.DataLoader(data, batch_size=batch_size)
+        if accum_steps > 1 or micro_batch_size > 0:
+            optimizer = thelper.train.utils.GradientAccumulator(optimizer, accum_steps, micro_batch_size, "input")
+            loader = optimizer.wrap_loader(loader)
+        iter_count = 0
+        for sample in loader:
+            optimizer.zero_grad()
+            loss = torch.nn.functional.mse_loss(model(sample["input"]), sample["gt"])
+            loss.backward()
+            optimizer.step()
+            iter_count += 1
+        assert iter_count == len(loader)
+        return model.weight.detach().clone()
+
+    expected = train(10, 1, 0)  # single step over the full dataset
+    assert torch.allclose(train(10, 1, 3), expected)  # uneven micro-batches: 3, 3, 3, 1
+    assert torch.allclose(train(5, 2, 0), expected)
+    assert torch.allclose(train(4, 3, 3), expected)  # batches: 4, 4, 2, micro-batches: 3, 1, 3, 1, 2
+    assert not torch.allclose(train(5, 1, 0), expected)
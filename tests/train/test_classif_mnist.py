@@ -3,6 +3,7 @@ import os
 from typing import Any, AnyStr, Optional  # noqa: F401
 
 import numpy as np
+import pytest
 import torch
 
 import thelper
@@ -128,3 +129,57 @@ def test_callbacks(config, mocker):
     assert thelper.cli.create_session(override_config, test_save_path)
     assert fake_draw.call_count > 0
     assert callback_kwargs["hello"][0] == "bye"
+
+
+def test_mixed_precision(config):
+    override_config = copy.deepcopy(config)
+    override_config["trainer"]["device"] = "cpu"
+    override_config["trainer"]["mixed_precision"] = "bf16"
+    train_outputs = thelper.cli.create_session(override_config, test_save_path)
+    assert len(train_outputs) == 2
+    assert train_outputs[0]["train/metrics"]["accuracy"] < train_outputs[1]["train/metrics"]["accuracy"]
+    ckptdata = thelper.utils.load_checkpoint(test_classif_mnist_path, always_load_latest=True)
+    assert all([v.dtype == torch.float32 for v in ckptdata["model"].values() if v.is_floating_point()])
+    eval_outputs = thelper.cli.resume_session(ckptdata, save_dir=test_save_path, eval_only=True)
+    assert any(["test/metrics" in v for v in eval_outputs.values()])
+    override_config["trainer"]["mixed_precision"] = "fp16"
+    with pytest.raises(AssertionError):
+        _ = thelper.cli.create_session(override_config, test_save_path)
+
+
+def test_eval_backend(config):
+    assert thelper.cli.create_session(config, test_save_path)
+    ckptdata = thelper.utils.load_checkpoint(test_classif_mnist_path)
+    override_config = copy.deepcopy(ckptdata["config"])
+    override_config["trainer"]["backend"] = "trace"
+    eval_outputs = thelper.cli.resume_session(ckptdata, save_dir=test_save_path, config=override_config, eval_only=True)
+    assert any(["test/metrics" in v for v in eval_outputs.values()])
+
+
+def test_eval_pipelined(config):
+    assert thelper.cli.create_session(config, test_save_path)
+    ckptdata = thelper.utils.load_checkpoint(test_classif_mnist_path)
+    eval_outputs = thelper.cli.resume_session(ckptdata, save_dir=test_save_path, eval_only=True)
+    override_config = copy.deepcopy(ckptdata["config"])
+    override_config["trainer"]["pipeline"] = {"prefetch": 3, "max_in_flight": 2, "consumer_threads": 2}
+    pipelined_outputs = thelper.cli.resume_session(ckptdata, save_dir=test_save_path,
+                                                   config=override_config, eval_only=True)
+    accuracy = [v["test/metrics"]["accuracy"] for v in eval_outputs.values() if "test/metrics" in v]
+    pipelined_accuracy = [v["test/metrics"]["accuracy"] for v in pipelined_outputs.values() if "test/metrics" in v]
+    assert accuracy and pipelined_accuracy and accuracy[-1] == pytest.approx(pipelined_accuracy[-1])
+
+
+def test_eval_sharded(config):
+    assert thelper.cli.create_session(config, test_save_path)
+    ckptdata = thelper.utils.load_checkpoint(test_classif_mnist_path)
+    override_config = copy.deepcopy(ckptdata["config"])
+    override_config["trainer"]["device"] = "cpu"
+    eval_outputs = thelper.cli.resume_session(ckptdata, save_dir=test_save_path,
+                                              config=copy.deepcopy(override_config), eval_only=True)
+    override_config["trainer"]["shards"] = 2
+    override_config["trainer"]["shard_threads"] = 1
+    sharded_outputs = thelper.cli.resume_session(ckptdata, save_dir=test_save_path,
+                                                 config=override_config, eval_only=True)
+    accuracy = [v["test/metrics"]["accuracy"] for v in eval_outputs.values() if "test/metrics" in v]
+    sharded_accuracy = [v["test/metrics"]["accuracy"] for v in sharded_outputs.values() if "test/metrics" in v]
+    assert accuracy and sharded_accuracy and accuracy[-1] == pytest.approx(sharded_accuracy[-1])
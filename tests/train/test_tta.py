@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+import thelper
+
+
+def test_tta_views_parsing():
+    views = thelper.train.utils.parse_tta_views(["identity", "hflip", {"vflip": True, "shift": [2, -1]}])
+    assert views[0] == {"hflip": False, "vflip": False, "shift": (0, 0)}
+    assert views[1] == {"hflip": True, "vflip": False, "shift": (0, 0)}
+    assert views[2] == {"hflip": False, "vflip": True, "shift": (2, -1)}
+    with pytest.raises(AssertionError):
+        _ = thelper.train.utils.parse_tta_views(["rot90"])
+    with pytest.raises(AssertionError):
+        _ = thelper.train.utils.parse_tta_views([{"shift": [1.5, 0]}])
+
+
+def test_tta_view_inversion():
+    inputs = torch.randn(2, 3, 8, 10)
+    views = thelper.train.utils.parse_tta_views(["hflip", "vflip", {"hflip": True, "vflip": True, "shift": [3, 2]}])
+    for view in views:
+        outputs, valid = thelper.train.utils.invert_tta_view(thelper.train.utils.apply_tta_view(inputs, view), view)
+        assert outputs.shape == inputs.shape and valid.shape == inputs.shape[-2:]
+        assert torch.equal(outputs[..., valid], inputs[..., valid])
+        assert (outputs[..., ~valid] == 0).all()
+    # shifts are rescaled when the prediction maps are smaller than the inputs
+    outputs, valid = thelper.train.utils.invert_tta_view(torch.ones(1, 1, 4, 5), views[2], input_size=(8, 10))
+    assert valid.sum() == (4 - 1) * (5 - 2)
+
+
+def test_tta_reductions():
+    preds = torch.randn(3, 4, 5)
+    assert torch.allclose(thelper.train.utils.reduce_tta_preds(preds, "mean"), preds.mean(dim=0))
+    assert torch.equal(thelper.train.utils.reduce_tta_preds(preds, "max"), preds.max(dim=0)[0])
+    gmean = thelper.train.utils.reduce_tta_preds(preds, "gmean")
+    assert torch.allclose(gmean, torch.log_softmax(preds, dim=2).mean(dim=0))
+    assert torch.equal(gmean.argmax(dim=1), torch.exp(gmean).argmax(dim=1))
+    valid = torch.tensor([True, False, True]).view(3, 1, 1)
+    assert torch.allclose(thelper.train.utils.reduce_tta_preds(preds, "mean", valid), preds[[0, 2]].mean(dim=0))
+    assert torch.equal(thelper.train.utils.reduce_tta_preds(preds, "max", valid), preds[[0, 2]].max(dim=0)[0])
+    with pytest.raises(AssertionError):
+        _ = thelper.train.utils.reduce_tta_preds(preds, "median")
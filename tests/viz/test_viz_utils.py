@@ -0,0 +1,122 @@
+import numpy as np
+import torch
+
+import thelper
+
+
+def _create_dummy_model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(
+        torch.nn.Flatten(),
+        torch.nn.Linear(12, 6),
+        torch.nn.ReLU(),
+        torch.nn.Linear(6, 3),
+    ).eval()
+
+
+def test_reservoir_size_bounds():
+    reservoir = thelper.viz.utils.EmbeddingReservoir(10, meta_keys=["idx"])
+    assert len(reservoir) == 0 and reservoir.get()[0].shape == (0, 0)
+    reservoir.add(np.zeros((4, 2)), meta={"idx": list(range(4))})
+    assert len(reservoir) == 4 and reservoir.get()[0].shape == (4, 2) and reservoir.get()[4]["idx"] == [0, 1, 2, 3]
+    reservoir.add(np.ones((25, 2)), meta={"idx": list(range(4, 29))})
+    embeddings, labels, preds, idxs, meta = reservoir.get()
+    assert len(reservoir) == 10 and reservoir.seen_count == 29
+    assert embeddings.shape == (10, 2) and labels.shape == preds.shape == idxs.shape == (10,)
+    assert len(meta["idx"]) == 10
+
+
+def test_reservoir_dedup():
+    # batches larger than the reservoir often assign the same slot to several samples
+    reservoir = thelper.viz.utils.EmbeddingReservoir(8, meta_keys=["idx"], seed=1)
+    for start in range(0, 300, 50):
+        stream_idxs = np.arange(start, start + 50)
+        reservoir.add(np.stack([stream_idxs, -stream_idxs], axis=1), labels=stream_idxs % 3,
+                      preds=stream_idxs % 5, meta={"idx": stream_idxs.tolist()})
+    embeddings, labels, preds, idxs, meta = reservoir.get()
+    assert len(np.unique(idxs)) == len(idxs) == 8
+    # each slot should hold all the data of a single sample of the stream
+    assert np.array_equal(embeddings[:, 0], idxs) and np.array_equal(embeddings[:, 1], -idxs)
+    assert np.array_equal(labels, idxs % 3) and np.array_equal(preds, idxs % 5) and meta["idx"] == idxs.tolist()
+
+
+def test_reservoir_uniform_sampling():
+    def sample(seed, stream_size=100, batch_size=7):
+        reservoir = thelper.viz.utils.EmbeddingReservoir(10, seed=seed)
+        for start in range(0, stream_size, batch_size):
+            stream_idxs = np.arange(start, min(start + batch_size, stream_size))
+            reservoir.add(stream_idxs.reshape(-1, 1).astype(np.float32))
+        return reservoir.get()[3]
+    assert np.array_equal(sample(0), sample(0))  # fixed seed = same subset
+    assert not np.array_equal(sample(0), sample(1))
+    counts = np.zeros(100)
+    nb_trials = 2000
+    for seed in range(nb_trials):
+        counts[sample(seed)] += 1
+    # every sample of the stream should be kept with a probability of 10/100 (binomial std is about 0.0067)
+    assert np.allclose(counts / nb_trials, 0.1, atol=0.035)
+    assert abs(counts[:50].sum() - counts[50:].sum()) / nb_trials < 0.5
+
+
+def test_extractor_hooks():
+    model = _create_dummy_model()
+    inputs = torch.randn(5, 3, 2, 2)
+    with thelper.viz.utils.EmbeddingExtractor(model) as extractor:
+        assert extractor.layer_name == "3"  # the input of the last linear layer is captured by default
+        preds, embeddings = extractor(inputs)
+    assert torch.allclose(preds, model(inputs)) and torch.allclose(embeddings, model[:3](inputs))
+    with thelper.viz.utils.EmbeddingExtractor(model, layer="1") as extractor:
+        preds, embeddings = extractor(inputs)
+        assert len(model[1]._forward_hooks) == 1
+    assert len(model[1]._forward_hooks) == 0  # the hook should be removed on exit
+    assert torch.allclose(preds, model(inputs)) and torch.allclose(embeddings, model[:2](inputs))
+    with thelper.viz.utils.EmbeddingExtractor(model, layer="0") as extractor:
+        _, embeddings = extractor(inputs)
+    assert embeddings.shape == (5, 12)
+
+
+class DummyEmbeddingModel(torch.nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.body = _create_dummy_model()
+
+    def forward(self, x):
+        return self.body(x)
+
+    def get_embedding(self, x):
+        return self.body[:2](x)
+
+
+def test_extractor_get_embedding():
+    model = DummyEmbeddingModel().eval()
+    inputs = torch.randn(5, 3, 2, 2)
+    with thelper.viz.utils.EmbeddingExtractor(model) as extractor:
+        assert extractor.layer_name is None  # the model's own embedding function should be used by default
+        preds, embeddings = extractor(inputs)
+    assert torch.allclose(preds, model(inputs)) and torch.allclose(embeddings, model.get_embedding(inputs))
+    with thelper.viz.utils.EmbeddingExtractor(model, layer="body.3") as extractor:
+        _, embeddings = extractor(inputs)
+    assert torch.allclose(embeddings, model(inputs))
+
+
+def test_extract_embeddings():
+    model = _create_dummy_model()
+    task = thelper.tasks.Classification(["a", "b", "c"], "input", "label", meta_keys=["idx"])
+    rng = np.random.RandomState(0)
+    loader = []
+    for batch_idx in range(6):
+        idxs = list(range(batch_idx * 4, batch_idx * 4 + 4))
+        loader.append({"input": torch.from_numpy(rng.randn(4, 3, 2, 2).astype(np.float32)),
+                       "label": torch.from_numpy(rng.randint(3, size=4)), "idx": idxs})
+    embeddings, labels, preds, idxs, meta = thelper.viz.utils.extract_embeddings(
+        model, task, loader, max_points=10, return_meta=["idx"], seed=0)
+    assert embeddings.shape == (10, 6) and len(np.unique(idxs)) == 10 and meta["idx"] == idxs.tolist()
+    inputs = torch.cat([batch["input"] for batch in loader])
+    with torch.no_grad():
+        outputs = model(inputs)
+        expected_embeddings = model[:3](inputs)
+    expected_labels = torch.cat([batch["label"] for batch in loader]).numpy()
+    assert np.allclose(embeddings, expected_embeddings.numpy()[idxs], atol=1e-6)
+    assert np.array_equal(labels, expected_labels[idxs])
+    assert np.array_equal(preds, outputs.argmax(dim=1).numpy()[idxs])
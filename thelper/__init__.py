@@ -1,24 +1,34 @@
 """Top-level package for the 'thelper' framework.
 
-Running ``import thelper`` will recursively import all important subpackages and modules.
+Running ``import thelper`` will not import any subpackage or module right away; these (and their heavy
+dependencies) are only imported once accessed as attributes, e.g. ``thelper.data.create_loaders(...)``.
 """
 
 import logging
 
-import thelper.cli  # noqa: F401
-import thelper.concepts  # noqa: F401
-import thelper.data  # noqa: F401
-import thelper.draw  # noqa: F401
-import thelper.ifaces  # noqa: F401
-import thelper.infer  # noqa: F401
-import thelper.nn  # noqa: F401
-import thelper.optim  # noqa: F401
-import thelper.tasks  # noqa: F401
-import thelper.train  # noqa: F401
-import thelper.transforms  # noqa: F401
-import thelper.typedefs  # noqa: F401
-import thelper.utils  # noqa: F401
-import thelper.viz  # noqa: F401
+import thelper.lazy
+
+__getattr__, __dir__, __all__ = thelper.lazy.attach(
+    __name__,
+    submodules=[
+        "cli",
+        "concepts",
+        "data",
+        "draw",
+        "gui",
+        "ifaces",
+        "infer",
+        "nn",
+        "optim",
+        "session",
+        "tasks",
+        "train",
+        "transforms",
+        "typedefs",
+        "utils",
+        "viz",
+    ],
+)
 
 logger = logging.getLogger("thelper")
 
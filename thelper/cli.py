@@ -14,9 +14,6 @@ import logging
 import os
 from typing import Any, Union
 
-import torch
-import tqdm
-
 import thelper
 
 TASK_COMPAT_CHOICES = frozenset(["old", "new", "compat"])
@@ -175,6 +172,7 @@ def visualize_data(config):
         | :func:`thelper.data.utils.create_loaders`
         | :func:`thelper.data.utils.create_parsers`
     """
+    import tqdm
     logger = thelper.utils.get_func_logger()
     logger.info("creating visualization session...")
     thelper.utils.setup_globals(config)
@@ -298,7 +296,7 @@ def split_data(config, save_dir):
     logger.debug("all done")
 
 
-def inference_session(config, save_dir=None, ckpt_path=None):
+def inference_session(config, save_dir=None, ckpt_path=None, shards=None, shard_threads=None):
     """Executes an inference session on samples with a trained model checkpoint.
 
     In order to run inference, a model is mandatory and therefore expected to be provided in the configuration.
@@ -316,6 +314,9 @@ def inference_session(config, save_dir=None, ckpt_path=None):
             configuration path or the configuration dictionary itself.
         ckpt_path: explicit checkpoint path to use for loading a model to execute inference. Otherwise look for a
             model definition in the configuration.
+        shards: number of CPU worker processes over which to spread inference batches (overrides the ``shards``
+            value of the tester configuration, if provided). See :func:`thelper.infer.sharding.run_sharded_eval`.
+        shard_threads: number of intra-op threads to use in each worker process when inference is sharded.
 
     .. seealso::
         | :func:`thelper.data.geo.utils.prepare_raster_metadata`
@@ -347,7 +348,7 @@ def inference_session(config, save_dir=None, ckpt_path=None):
     if not os.path.exists(ckpt_path):
         logger.fatal(f"Model not found: {ckpt_path}")
         raise AssertionError("Model checkpoint missing to run inference")
-    ckptdata = thelper.utils.load_checkpoint(ckpt_path, map_location=None, always_load_latest=False)
+    ckptdata = thelper.utils.load_checkpoint(ckpt_path, map_location=None, always_load_latest=False, model_only=True)
     if "task" not in ckptdata or not isinstance(ckptdata["task"], (thelper.tasks.Task, str)):
         raise AssertionError("invalid checkpoint, cannot reload model task")
     task = ckptdata["task"]
@@ -393,6 +394,11 @@ def inference_session(config, save_dir=None, ckpt_path=None):
 
     model = thelper.nn.create_model(config, task, save_dir=save_dir, ckptdata=ckptdata)
     loaders = (None, None, test_loader)
+    runner_config = config.get("tester", config.get("runner", config.get("trainer")))
+    if isinstance(runner_config, dict) and shards is not None:
+        runner_config["shards"] = shards
+    if isinstance(runner_config, dict) and shard_threads is not None:
+        runner_config["shard_threads"] = shard_threads
     # Avoid passing any checkpoint data so that any argument don't get incorrectly used by the session runner.
     # Since we only call test/eval, these values don't matter but they still get generated otherwise and this leads
     # to weird internal values such as test starting at 'current_epoch' == 'best_epoch' from checkpoint training or
@@ -430,6 +436,27 @@ def export_model(config, save_dir):
 
     The exported checkpoint containing the model will be saved in the session's output directory.
 
+    The model can also be quantized for CPU inference at export time by adding a ``quantization`` section (or mode
+    name) to the 'export' section. Its ``mode`` can be ``dynamic_int8``, ``static_int8``, or ``fp16`` (see
+    :func:`thelper.nn.utils.quantize_model`). Static quantization is calibrated with ``calib_batches`` batches
+    (default=10) of the first available loader (if 'datasets' and 'loaders' sections are provided), or with the
+    trace input, and the result is always exported as a trace. Unless ``report`` is false, the quantized model is
+    then compared with the fp32 model on CPU using ``report_batches`` other batches (default=10), and the resulting
+    accuracy/latency report is saved as ``<session_name>.quant-report.json`` next to the exported checkpoint.
+
+    Usage example inside a session configuration file::
+
+        # ...
+        "export": {
+            "ckpt_name": "model.int8.pth",
+            "trace_input": "torch.rand(1, 3, 224, 224)",
+            "quantization": {
+                "mode": "static_int8",
+                "calib_batches": 20
+            }
+        },
+        # ...
+
     Args:
         config: a dictionary that provides all required data configuration parameters; see
             :func:`thelper.nn.utils.create_model` for more information.
@@ -440,6 +467,7 @@ def export_model(config, save_dir):
     .. seealso::
         | :func:`thelper.nn.utils.create_model`
     """
+    import torch  # note: also needed when evaluating the trace input string below
     logger = thelper.utils.get_func_logger()
     session_name = thelper.utils.get_config_session_name(config)
     assert session_name is not None, "config missing 'name' field required for output directory"
@@ -463,6 +491,10 @@ def export_model(config, save_dir):
     save_dir = thelper.utils.get_save_dir(save_dir, session_name, config)
     logger.debug("exported checkpoint will be saved at '%s'" % os.path.abspath(save_dir).replace("\\", "/"))
     model = thelper.nn.create_model(config, task, save_dir=save_dir)
+    quant_config = thelper.utils.get_key_def("quantization", export_config, default=None)
+    if isinstance(quant_config, str):
+        quant_config = {"mode": quant_config}
+    assert quant_config is None or isinstance(quant_config, dict), "unexpected quantization config type"
     log_stamp = thelper.utils.get_log_stamp()
     model_type = model.get_name()
     model_params = model.config if model.config else {}
@@ -477,6 +509,13 @@ def export_model(config, save_dir):
         "model_params": model_params,
         "config": config
     }
+    if quant_config:
+        model, trace_input = _quantize_export_model(model, task, config, save_dir, quant_config, trace_input)
+        export_state["quantization"] = {
+            "mode": quant_config["mode"],
+            "backend": thelper.nn.utils.get_quantization_backend(quant_config.get("backend"))
+            if quant_config["mode"] != "fp16" else None,
+        }
     if trace_input is not None:
         trace_path = os.path.join(save_dir, trace_name)
         torch.jit.trace(model, trace_input).save(trace_path)
@@ -487,6 +526,49 @@ def export_model(config, save_dir):
     logger.debug("all done")
 
 
+def _quantize_export_model(model, task, config, save_dir, quant_config, trace_input=None):
+    """Quantizes a model for export, and saves a report comparing it to the original model (if requested).
+
+    Returns the quantized model along with the input to use to trace it (if the model should be exported as a trace).
+    """
+    import torch
+    logger = thelper.utils.get_func_logger()
+    quant_mode = thelper.utils.get_key("mode", quant_config, msg="missing quantization mode in export config")
+    assert quant_mode in thelper.nn.utils.QUANTIZATION_MODES, f"unknown quantization mode '{quant_mode}'"
+    calib_count = int(thelper.utils.get_key_def("calib_batches", quant_config, 10))
+    report_count = int(thelper.utils.get_key_def("report_batches", quant_config, 10))
+    inputs, targets = [], []
+    if "datasets" in config and "loaders" in config:
+        _, train_loader, valid_loader, test_loader = thelper.data.create_loaders(config, save_dir)
+        loader = test_loader or valid_loader or train_loader
+        gt_key = getattr(task, "gt_key", None)
+        for sample in (loader or []):
+            if len(inputs) >= calib_count + report_count:
+                break
+            if isinstance(sample[task.input_key], torch.Tensor):
+                inputs.append(sample[task.input_key])
+                targets.append(sample[gt_key] if gt_key in sample else None)
+    elif trace_input is not None:
+        inputs, targets = [trace_input], [None]
+    calib_inputs = inputs[:calib_count]
+    report_inputs, report_targets = inputs[calib_count:] or calib_inputs, targets[calib_count:] or targets[:calib_count]
+    logger.info(f"quantizing model with '{quant_mode}' mode ({len(calib_inputs)} calibration batches)...")
+    quant_model = thelper.nn.utils.quantize_model(model, quant_mode, calib_inputs, quant_config.get("backend"))
+    if thelper.utils.str2bool(thelper.utils.get_key_def("report", quant_config, True)) and report_inputs:
+        report = thelper.nn.utils.compare_quantized_model(model, quant_model, report_inputs, report_targets)
+        report["mode"] = quant_mode
+        session_name = thelper.utils.get_config_session_name(config)
+        report_path = os.path.join(save_dir, session_name + ".quant-report.json")
+        with open(report_path, "w") as fd:
+            json.dump(report, fd, indent=4)
+        logger.info("quantization report:\n" + "\n".join([f"\t{key}: {val}" for key, val in report.items()]))
+    if quant_mode == "static_int8" and trace_input is None:
+        trace_input = calib_inputs[0]  # statically quantized models can only be reloaded from a trace
+    if quant_mode == "fp16" and trace_input is not None:
+        trace_input = trace_input.half()
+    return quant_model, trace_input
+
+
 def make_argparser():
     # type: () -> argparse.ArgumentParser
     """Creates the (default) argument parser to use for the main entrypoint.
@@ -531,6 +613,8 @@ def make_argparser():
                                                         "(otherwise uses model checkpoint from configuration)")
     infer_ap.add_argument("-c", "--config", type=str, help="path to the session configuration file (or session directory)")
     infer_ap.add_argument("-d", "--save-dir", type=str, help="path to the session output root directory")
+    infer_ap.add_argument("--shards", type=int, default=None, help="number of cpu worker processes to spread inference over")
+    infer_ap.add_argument("--shard-threads", type=int, default=None, help="number of threads for each inference worker")
     return ap
 
 
@@ -591,7 +675,8 @@ def main(args=None, argparser=None):
         ckptdata = None
         if args.ckpt_path is not None:
             ckptdata = thelper.utils.load_checkpoint(args.ckpt_path, map_location=args.map_location,
-                                                     always_load_latest=(not args.eval_only))
+                                                     always_load_latest=(not args.eval_only),
+                                                     model_only=args.eval_only)
         override_config = None
         if args.override_config:
             thelper.logger.debug(f"parsing override config at: {args.override_config}")
@@ -605,7 +690,8 @@ def main(args=None, argparser=None):
     elif args.mode == "infer":
         thelper.logger.debug(f"parsing config at: {args.config}")
         config = thelper.utils.load_config(args.config)
-        inference_session(config, save_dir=args.save_dir, ckpt_path=args.ckpt_path)
+        inference_session(config, save_dir=args.save_dir, ckpt_path=args.ckpt_path,
+                          shards=args.shards, shard_threads=args.shard_threads)
     else:
         thelper.logger.debug("parsing config at '%s'" % args.config)
         config = thelper.utils.load_config(args.config)
@@ -9,31 +9,57 @@ for dataset parsers.
 import logging
 import os
 
-import thelper.data.loaders  # noqa: F401
-import thelper.data.parsers  # noqa: F401
-import thelper.data.pascalvoc  # noqa: F401
-import thelper.data.samplers  # noqa: F401
-import thelper.data.utils  # noqa: F401
-from thelper.data.loaders import DataLoader  # noqa: F401
-from thelper.data.loaders import DataLoaderWrapper  # noqa: F401
-from thelper.data.loaders import default_collate  # noqa: F401
-from thelper.data.parsers import ClassificationDataset  # noqa: F401
-from thelper.data.parsers import Dataset  # noqa: F401
-from thelper.data.parsers import ExternalDataset  # noqa: F401
-from thelper.data.parsers import HDF5Dataset  # noqa: F401
-from thelper.data.parsers import ImageDataset  # noqa: F401
-from thelper.data.parsers import ImageFolderDataset  # noqa: F401
-from thelper.data.parsers import SegmentationDataset  # noqa: F401
-from thelper.data.parsers import SuperResFolderDataset  # noqa: F401
-from thelper.data.pascalvoc import PASCALVOC  # noqa: F401
-from thelper.data.samplers import SubsetRandomSampler  # noqa: F401
-from thelper.data.samplers import SubsetSequentialSampler  # noqa: F401
-from thelper.data.samplers import WeightedSubsetRandomSampler  # noqa: F401
-from thelper.data.utils import create_hdf5  # noqa: F401
-from thelper.data.utils import create_loaders  # noqa: F401
-from thelper.data.utils import create_parsers  # noqa: F401
-from thelper.data.utils import get_class_weights  # noqa: F401
-from thelper.tasks.detect import BoundingBox  # noqa: F401
+import thelper.lazy
+
+__getattr__, __dir__, __all__ = thelper.lazy.attach(
+    __name__,
+    submodules=[
+        "codecs",
+        "geo",
+        "loaders",
+        "parsers",
+        "pascalvoc",
+        "preload",
+        "samplers",
+        "stats",
+        "utils",
+    ],
+    attributes={
+        "thelper.data.loaders": [
+            "DataLoader",
+            "DataLoaderWrapper",
+            "default_collate",
+        ],
+        "thelper.data.parsers": [
+            "ClassificationDataset",
+            "Dataset",
+            "ExternalDataset",
+            "HDF5Dataset",
+            "ImageDataset",
+            "ImageFolderDataset",
+            "SegmentationDataset",
+            "SuperResFolderDataset",
+        ],
+        "thelper.data.pascalvoc": [
+            "PASCALVOC",
+        ],
+        "thelper.data.samplers": [
+            "BlockShuffleSampler",
+            "SubsetRandomSampler",
+            "SubsetSequentialSampler",
+            "WeightedSubsetRandomSampler",
+        ],
+        "thelper.data.utils": [
+            "create_hdf5",
+            "create_loaders",
+            "create_parsers",
+            "get_class_weights",
+        ],
+        "thelper.tasks.detect": [
+            "BoundingBox",
+        ],
+    },
+)
 
 logger = logging.getLogger("thelper.data")
 
@@ -0,0 +1,336 @@
+"""Sample codec registry module.
+
+This module contains the registry of codecs used to encode and decode individual samples (numpy arrays) in
+HDF5 archives and elsewhere (see :func:`thelper.utils.encode_data` and :func:`thelper.utils.decode_data`).
+Each codec provides factories that resolve their parameters (module imports, OpenCV flags, compression
+dictionaries, ...) once, and return plain encoder/decoder callables that can then be applied to many samples.
+Bound encoders and decoders are cached based on their parameters, so the one-shot encoding/decoding functions
+do not pay for this resolution more than once. Decoders can also write their output into a caller-provided
+buffer instead of allocating a new one.
+
+The built-in codecs are ``none``, ``lz4``, ``zstd`` (with optional dictionaries), ``blosc`` (with byte or bit
+shuffling, which works well on multispectral uint16 data), ``jpg``, ``png``, ``webp``, and ``webp_lossless``. Their
+optional dependencies are only imported when they are first used. New codecs can be added with
+:func:`register_codec`, and :func:`benchmark_codecs` can be used to compare them on sample data.
+"""
+
+import logging
+import threading
+import time
+
+import numpy as np
+
+import thelper.utils
+
+logger = logging.getLogger(__name__)
+
+_codec_factories = {}
+"""Map of codec names (and aliases) to the functions that create the codec objects (on first use)."""
+
+_codec_names = []
+"""List of the main names of the registered codecs (i.e. without their aliases)."""
+
+_codecs = {}
+"""Map of codec names to the codec objects that have already been created."""
+
+_bound_cache = {}
+"""Map of (direction, codec name, parameters) tuples to bound encoder/decoder callables."""
+
+
+class Codec:
+    """Sample codec definition, i.e. a pair of encoder/decoder factories.
+
+    The encoder factory receives the encoding parameters (if any), and returns a callable that converts a numpy
+    array into a buffer. The decoder factory receives the decoding parameters (if any), and returns a callable
+    that converts a buffer back into an array (or into raw bytes, for codecs that do not store the array type
+    and shape), optionally writing the result into a provided contiguous ``out`` array.
+
+    Attributes:
+        name: name of the codec in the registry.
+        make_encoder: factory that returns an encoder callable for a set of encoding parameters.
+        make_decoder: factory that returns a decoder callable for a set of decoding parameters.
+        lossless: specifies whether decoded arrays are always identical to the original ones.
+    """
+
+    def __init__(self, name, make_encoder, make_decoder, lossless=True):
+        """Receives the codec name, its encoder/decoder factories, and whether it is lossless."""
+        self.name = name
+        self.make_encoder = make_encoder
+        self.make_decoder = make_decoder
+        self.lossless = lossless
+
+    def __repr__(self):
+        return self.__class__.__module__ + "." + self.__class__.__qualname__ + \
+            f"(name={repr(self.name)}, lossless={self.lossless})"
+
+
+def _copy_into(data, out):
+    """Copies the bytes of a decoded buffer or array into a contiguous output array, and returns the latter."""
+    assert isinstance(out, np.ndarray) and out.flags.c_contiguous, "output buffer must be a contiguous array"
+    data = np.frombuffer(np.ascontiguousarray(data) if isinstance(data, np.ndarray) else data, dtype=np.uint8)
+    out_bytes = out.reshape(-1).view(np.uint8)
+    assert data.size == out_bytes.size, f"output buffer size mismatch ({out_bytes.size} vs {data.size} bytes)"
+    np.copyto(out_bytes, data)
+    return out
+
+
+def _as_bytes_view(data):
+    """Returns a flat byte view of an array (or other buffer) so that its length is its byte count."""
+    if isinstance(data, np.ndarray):
+        return memoryview(np.ascontiguousarray(data)).cast("B")
+    return data
+
+
+def register_codec(name, factory, aliases=None, override=False):
+    """Registers a codec factory under a given name (and aliases).
+
+    The factory is only called (without arguments) when the codec is first requested, and it must return a
+    :class:`Codec` instance; this allows codecs to import their dependencies lazily.
+    """
+    names = [name, *(aliases or [])]
+    assert override or not any([n in _codec_factories for n in names]), f"codec '{name}' already registered"
+    if name not in _codec_names:
+        _codec_names.append(name)
+    for n in names:
+        _codec_factories[n] = factory
+        _codecs.pop(n, None)
+    for key in [key for key in _bound_cache if key[1] in names]:
+        del _bound_cache[key]
+
+
+def get_codec_names(aliases=False):
+    """Returns the sorted list of registered codec names (including their aliases, if needed)."""
+    return sorted(_codec_factories.keys() if aliases else _codec_names)
+
+
+def get_codec(name):
+    """Returns the codec registered under a given name, creating it if needed."""
+    if name in thelper.utils.no_compression_flags:
+        name = "none"
+    assert name in _codec_factories, f"unexpected codec '{name}' (should be one of {get_codec_names(aliases=True)})"
+    if name not in _codecs:
+        codec = _codec_factories[name]()
+        assert isinstance(codec, Codec), "codec factory should return a Codec instance"
+        _codecs[name] = codec
+    return _codecs[name]
+
+
+def _get_bound(direction, name, kwargs):
+    """Returns a (cached, if the parameters are hashable) encoder or decoder bound to a set of parameters."""
+    if name in thelper.utils.no_compression_flags:
+        name = "none"
+    try:
+        cache_key = (direction, name, tuple(sorted(kwargs.items())))
+        hash(cache_key)
+    except TypeError:
+        cache_key = None  # unhashable parameters (e.g. lists) cannot be cached
+    if cache_key is not None and cache_key in _bound_cache:
+        return _bound_cache[cache_key]
+    codec = get_codec(name)
+    bound = codec.make_encoder(**kwargs) if direction == "encode" else codec.make_decoder(**kwargs)
+    if cache_key is not None:
+        _bound_cache[cache_key] = bound
+    return bound
+
+
+def get_encoder(name, **kwargs):
+    """Returns the encoder callable of a codec bound to a set of encoding parameters."""
+    return _get_bound("encode", name, kwargs)
+
+
+def get_decoder(name, **kwargs):
+    """Returns the decoder callable of a codec bound to a set of decoding parameters."""
+    return _get_bound("decode", name, kwargs)
+
+
+def _make_none_codec():
+    def make_encoder():
+        return lambda data: data
+
+    def make_decoder():
+        return lambda data, out=None: data if out is None else _copy_into(data, out)
+
+    return Codec("none", make_encoder, make_decoder)
+
+
+def _make_lz4_codec():
+    import lz4.frame
+
+    def make_encoder(**kwargs):
+        return lambda data: lz4.frame.compress(data, **kwargs)
+
+    def make_decoder(**kwargs):
+        def decode(data, out=None):
+            data = lz4.frame.decompress(data, **kwargs)
+            return data if out is None else _copy_into(data, out)
+        return decode
+
+    return Codec("lz4", make_encoder, make_decoder)
+
+
+def train_zstd_dictionary(samples, dict_size=112640):
+    """Trains a zstd compression dictionary on a list of sample arrays, and returns it as bytes.
+
+    Dictionaries greatly improve the compression of small samples that share a lot of structure. The returned
+    bytes should be saved to a file, whose path can then be given as the ``dictionary`` parameter of the ``zstd``
+    codec's encoder and decoder.
+    """
+    import zstandard
+    samples = [bytes(_as_bytes_view(sample)) for sample in samples]
+    return zstandard.train_dictionary(dict_size, samples).as_bytes()
+
+
+def _make_zstd_codec():
+    import zstandard
+
+    def load_dictionary(dictionary):
+        if dictionary is None:
+            return None
+        if isinstance(dictionary, str):
+            with open(dictionary, "rb") as fd:
+                dictionary = fd.read()
+        return zstandard.ZstdCompressionDict(dictionary)
+
+    def make_encoder(level=3, dictionary=None):
+        dict_data, local = load_dictionary(dictionary), threading.local()
+
+        def encode(data):
+            if not hasattr(local, "ctx"):  # compression contexts cannot be shared across threads
+                local.ctx = zstandard.ZstdCompressor(level=level, dict_data=dict_data)
+            return local.ctx.compress(_as_bytes_view(data))
+        return encode
+
+    def make_decoder(dictionary=None):
+        dict_data, local = load_dictionary(dictionary), threading.local()
+
+        def decode(data, out=None):
+            if not hasattr(local, "ctx"):
+                local.ctx = zstandard.ZstdDecompressor(dict_data=dict_data)
+            data = local.ctx.decompress(_as_bytes_view(data))
+            return data if out is None else _copy_into(data, out)
+        return decode
+
+    return Codec("zstd", make_encoder, make_decoder)
+
+
+def _make_blosc_codec():
+    import blosc
+    shuffle_modes = {"none": blosc.NOSHUFFLE, "byte": blosc.SHUFFLE, "bit": blosc.BITSHUFFLE}
+
+    def make_encoder(cname="lz4", clevel=5, shuffle="byte", typesize=None):
+        assert shuffle in shuffle_modes, f"unexpected blosc shuffle mode '{shuffle}'"
+
+        def encode(data):
+            # note: the shuffle works on elements of 'typesize' bytes, i.e. 2 bytes for uint16 bands
+            item_size = typesize or (data.dtype.itemsize if isinstance(data, np.ndarray) else 1)
+            return blosc.compress(_as_bytes_view(data), typesize=item_size, clevel=clevel,
+                                  shuffle=shuffle_modes[shuffle], cname=cname)
+        return encode
+
+    def make_decoder():
+        def decode(data, out=None):
+            data = _as_bytes_view(data)
+            if out is None:
+                return blosc.decompress(data)
+            assert isinstance(out, np.ndarray) and out.flags.c_contiguous, "output buffer must be a contiguous array"
+            assert blosc.get_cbuffer_sizes(data)[0] == out.nbytes, "output buffer size mismatch"
+            blosc.decompress_ptr(data, out.ctypes.data)  # decompresses directly into the output buffer
+            return out
+        return decode
+
+    return Codec("blosc", make_encoder, make_decoder)
+
+
+def _make_opencv_codec(name, extension, lossless, quality_flag=None, default_quality=None):
+    import cv2 as cv
+
+    def resolve_flags(flags):
+        # note: flags can be given as strings (e.g. "cv.IMREAD_COLOR | cv.IMREAD_ANYDEPTH") in configs
+        if isinstance(flags, str):
+            flag_names = [flag.strip().rsplit(".", 1)[-1] for flag in flags.split("|")]
+            assert all([flag_name.startswith("IMREAD_") for flag_name in flag_names]), f"invalid flags: {flags}"
+            return int(np.bitwise_or.reduce([getattr(cv, flag_name) for flag_name in flag_names]))
+        return flags
+
+    def make_encoder(quality=default_quality, **kwargs):
+        if quality is not None:
+            assert quality_flag is not None, f"codec '{name}' does not support a quality parameter"
+            kwargs["params"] = [*kwargs.get("params", []), getattr(cv, quality_flag), quality]
+
+        def encode(data):
+            ret, buf = cv.imencode(extension, data, **kwargs)
+            assert ret, "failed to encode data"
+            return buf
+        return encode
+
+    def make_decoder(flags=cv.IMREAD_UNCHANGED, **kwargs):
+        flags = resolve_flags(flags)
+
+        def decode(data, out=None):
+            if not isinstance(data, np.ndarray):
+                data = np.frombuffer(data, dtype=np.uint8)
+            image = cv.imdecode(data, flags=flags, **kwargs)
+            return image if out is None else _copy_into(image, out)
+        return decode
+
+    return Codec(name, make_encoder, make_decoder, lossless=lossless)
+
+
+register_codec("none", _make_none_codec)
+register_codec("lz4", _make_lz4_codec)
+register_codec("zstd", _make_zstd_codec)
+register_codec("blosc", _make_blosc_codec)
+register_codec("jpg", lambda: _make_opencv_codec("jpg", ".jpg", lossless=False, quality_flag="IMWRITE_JPEG_QUALITY"),
+               aliases=["jpeg"])
+register_codec("png", lambda: _make_opencv_codec("png", ".png", lossless=True))
+register_codec("webp", lambda: _make_opencv_codec("webp", ".webp", lossless=False, quality_flag="IMWRITE_WEBP_QUALITY",
+                                                  default_quality=90))
+# note: OpenCV uses lossless WebP compression when the quality is above 100
+register_codec("webp_lossless", lambda: _make_opencv_codec("webp_lossless", ".webp", lossless=True,
+                                                           quality_flag="IMWRITE_WEBP_QUALITY", default_quality=101))
+
+
+def benchmark_codecs(samples, codecs=None, repeats=3):
+    """Returns the compression ratio and throughput of codecs on a list of sample arrays.
+
+    Each codec is given as a name, or as a (name, encoding parameters, decoding parameters) tuple; by default,
+    all registered codecs (without aliases) are tested with their default parameters. Codecs whose dependencies
+    are missing, or that cannot encode the samples (e.g. image codecs with multispectral data), are reported with
+    an error message instead of measurements. Throughputs are given in megabytes of raw data per second.
+
+    Returns:
+        A dictionary of codec names (or name-parameters strings) to dictionaries with the ``ratio`` (raw over
+        encoded size), ``encode_mbps`` and ``decode_mbps`` throughputs, and ``exact`` (whether all decoded samples
+        matched the original ones) fields.
+    """
+    assert len(samples) > 0 and all([isinstance(s, np.ndarray) for s in samples]), "expected list of arrays"
+    if codecs is None:
+        codecs = get_codec_names()
+    raw_bytes = sum([s.nbytes for s in samples])
+    results = {}
+    for codec in codecs:
+        name, encode_kwargs, decode_kwargs = (codec, {}, {}) if isinstance(codec, str) else codec
+        result_name = name if isinstance(codec, str) else f"{name}{encode_kwargs}"
+        try:
+            encoder, decoder = get_encoder(name, **encode_kwargs), get_decoder(name, **decode_kwargs)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                buffers = [encoder(s) for s in samples]
+            encode_time = (time.perf_counter() - start) / repeats
+            outputs = [np.empty_like(s) for s in samples]
+            start = time.perf_counter()
+            for _ in range(repeats):
+                for buffer, out in zip(buffers, outputs):
+                    decoder(buffer, out=out)
+            decode_time = (time.perf_counter() - start) / repeats
+        except Exception as e:
+            results[result_name] = {"error": f"{type(e).__name__}: {e}"}
+            continue
+        encoded_bytes = sum([b.nbytes if isinstance(b, np.ndarray) else len(b) for b in buffers])
+        results[result_name] = {
+            "ratio": raw_bytes / max(encoded_bytes, 1),
+            "encode_mbps": raw_bytes / (2 ** 20) / max(encode_time, 1e-9),
+            "decode_mbps": raw_bytes / (2 ** 20) / max(decode_time, 1e-9),
+            "exact": all([np.array_equal(s, out) for s, out in zip(samples, outputs)]),
+        }
+    return results
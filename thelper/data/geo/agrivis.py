@@ -10,6 +10,7 @@ import logging
 import os
 import pprint
 import shutil
+import time
 import typing
 
 import h5py
@@ -48,6 +49,78 @@ approx_weight_map = {
 
 dontcare = 255
 
+# maps the bit-packed label flags of a pixel to its class index (the highest set bit wins, as does the last label)
+_packed_label_lut = np.asarray([flags.bit_length() for flags in range(256)], dtype=np.int16)
+
+
+def decode_label_stack(label_stack: np.ndarray, mask: typing.Optional[np.ndarray] = None) -> np.ndarray:
+    """Converts a stack of binary label maps (legacy layout, without background) into an int16 class index map.
+
+    The label stack is expected to have the per-class binary maps in its last dimension, in the same order as the
+    non-background class names; any number of leading (e.g. batch) dimensions is supported. With up to 8 classes,
+    the binary flags of each pixel are bit-packed into a single byte, which is then mapped to a class index with a
+    lookup table; with more classes, the index of the last set flag is found with an argmax instead. In both cases,
+    the highest class index wins when labels overlap. Pixels outside the (optional) mask are set to dontcare.
+    """
+    assert label_stack.ndim >= 1 and 0 < label_stack.shape[-1] < dontcare, "unexpected label stack channel count"
+    label_flags = label_stack != 0
+    if label_flags.shape[-1] <= 8:
+        label_map = _packed_label_lut.take(np.packbits(label_flags, axis=-1, bitorder="little")[..., 0])
+    else:
+        last_idxs = label_flags.shape[-1] - np.argmax(label_flags[..., ::-1], axis=-1)
+        label_map = np.where(label_flags.any(axis=-1), last_idxs, 0).astype(np.int16)
+    if mask is not None:
+        assert mask.shape == label_map.shape, "unexpected mask shape"
+        label_map[mask == 0] = dontcare
+    return label_map
+
+
+def _decode_label_stack_loop(label_stack: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Converts a stack of binary label maps into a class index map with one pass per class (reference impl)."""
+    # note: we might squish some overlapping labels, but these are very rare... (<0.07%)
+    out_label_map = np.zeros(label_stack.shape[:-1], dtype=np.int16)
+    for label_idx in range(1, label_stack.shape[-1] + 1):
+        curr_label_map = label_stack[..., label_idx - 1]
+        out_label_map = np.where(curr_label_map, np.int16(label_idx), out_label_map)
+    return np.where(mask, out_label_map, np.int16(dontcare))
+
+
+def pack_label_maps(
+        hdf5_path: typing.AnyStr,
+        group_names: typing.Optional[typing.List[str]] = None,
+        batch_size: int = 32,
+        progress_bar: bool = True,
+):
+    """Decodes the label stacks and boundary masks of an AgriVis HDF5 archive offline, and stores them in-place.
+
+    For each group (all groups by default), an int16 ``mask`` dataset and (for labeled groups) an int16 ``label_map``
+    dataset that already contains the class indices and dontcare values are added next to the original datasets.
+    :class:`Hdf5AgricultureDataset` reads these directly instead of decoding the label stacks for every sample.
+    """
+    assert batch_size > 0, "batch size should be strictly positive"
+    with h5py.File(hdf5_path, "a") as archive:
+        for group_name in group_names if group_names is not None else list(archive.keys()):
+            group = archive[group_name]
+            boundaries = group["boundaries"]
+            sample_count, map_shape = len(boundaries), boundaries.shape[1:3]
+            for dset_name in ["mask", "label_map"]:
+                if dset_name in group:
+                    del group[dset_name]
+            mask_dset = group.create_dataset("mask", shape=(sample_count, *map_shape),
+                                             dtype=np.int16, chunks=(1, *map_shape))
+            label_dset = None
+            if "labels" in group:
+                label_dset = group.create_dataset("label_map", shape=(sample_count, *map_shape),
+                                                  dtype=np.int16, chunks=(1, *map_shape))
+            batch_starts = range(0, sample_count, batch_size)
+            for start in tqdm.tqdm(batch_starts, desc=f"packing {group_name} labels", disable=not progress_bar):
+                end = min(start + batch_size, sample_count)
+                masks = boundaries[start:end].astype(np.int16)
+                mask_dset[start:end] = masks
+                if label_dset is not None:
+                    label_dset[start:end] = decode_label_stack(group["labels"][start:end], masks)
+            group.attrs["packed_labels"] = True
+
 
 class Hdf5AgricultureDataset(Dataset):
 
@@ -60,6 +133,7 @@ class Hdf5AgricultureDataset(Dataset):
             keep_file_open: bool = False,
             load_meta_keys: bool = False,
             copy_to_slurm_tmpdir: bool = False,
+            norm_stats_path: typing.Optional[typing.AnyStr] = None,
     ):
         super().__init__(transforms, deepcopy=False)
         if copy_to_slurm_tmpdir:
@@ -91,6 +165,9 @@ class Hdf5AgricultureDataset(Dataset):
                 meta_iter = zip(dataset["keys"], dataset["n_labelled_pixels"])
             else:
                 meta_iter = zip(dataset["keys"], [None] * len(dataset["keys"]))
+            self.packed = "mask" in dataset and (group_name == "test" or "label_map" in dataset)
+            self.image_shape = dataset["features"].shape[1:]
+            self.image_dtype = dataset["features"].dtype
             self.samples = [{  # list pre-fill
                 "image": None,
                 "label_map": None,
@@ -98,7 +175,8 @@ class Hdf5AgricultureDataset(Dataset):
                 "mask": None,
                 "pxcounts": pxcounts,
             } for key, pxcounts in meta_iter]
-        logger.info(f"loaded metadata for {len(self.samples)} patches")
+        logger.info(f"loaded metadata for {len(self.samples)} patches" +
+                    (" (with packed label maps)" if self.packed else ""))
         self.task = thelper.tasks.Segmentation(
             class_names=class_names, input_key="image", label_map_key="label_map",
             meta_keys=["key", "mask", "pxcounts"], dontcare=dontcare,
@@ -116,44 +194,70 @@ class Hdf5AgricultureDataset(Dataset):
             45.04215840534553,
             44.53299631408866,
         ], dtype=np.float32)
-        self.hdf5_handle = h5py.File(self.hdf5_path, "r") if keep_file_open else None
-        # self.squished = 0
+        if norm_stats_path is not None:  # e.g. saved by thelper.data.stats.DatasetStatistics.save_band_stats
+            norm_stats = thelper.data.stats.load_band_stats(norm_stats_path)
+            assert len(norm_stats["mean"]) == len(self.image_mean), "unexpected band count in normalization stats"
+            self.image_mean = norm_stats["mean"].astype(np.float32)
+            self.image_stddev = norm_stats["std"].astype(np.float32)
+        self.keep_file_open = keep_file_open
+        self.hdf5_handle, self.hdf5_handle_pid = None, None
+        self.read_buffer = None  # reused across reads in the same process; never returned directly
+        if keep_file_open:
+            self._get_group()
+
+    def __getstate__(self):
+        # the file handle and read buffer are (re)created on demand in each process
+        state = dict(self.__dict__)
+        state["hdf5_handle"], state["hdf5_handle_pid"], state["read_buffer"] = None, None, None
+        return state
 
     def __len__(self):
         return len(self.samples)
 
+    def _get_group(self):
+        """Returns the HDF5 group of the dataset, opening the archive once per process (handles are not fork-safe)."""
+        if self.hdf5_handle is None or self.hdf5_handle_pid != os.getpid():
+            self.hdf5_handle = h5py.File(self.hdf5_path, "r")
+            self.hdf5_handle_pid = os.getpid()
+            self.read_buffer = None
+        return self.hdf5_handle[self.group_name]
+
+    def _read_image(self, group, idx):
+        """Reads an image into the reusable buffer, and returns a (normalized, if needed) copy of it."""
+        if self.read_buffer is None:
+            self.read_buffer = np.empty(self.image_shape, dtype=self.image_dtype)
+        group["features"].read_direct(self.read_buffer, source_sel=np.s_[idx])
+        if not self.use_global_normalization:
+            return self.read_buffer.copy()
+        image = np.subtract(self.read_buffer, self.image_mean, dtype=np.float32)
+        image /= self.image_stddev
+        return image
+
+    def _read_sample(self, group, idx):
+        """Reads the image, mask, and (decoded) label map of a sample from the HDF5 group of the dataset."""
+        image = self._read_image(group, idx)
+        label_map = None
+        if self.packed:
+            mask = group["mask"][idx]
+            if self.group_name != "test":
+                label_map = group["label_map"][idx]
+        else:
+            mask = group["boundaries"][idx].astype(np.int16)
+            if self.group_name != "test":
+                label_map = decode_label_stack(group["labels"][idx], mask)
+        return image, mask, label_map
+
     def __getitem__(self, idx):
         if isinstance(idx, slice):
             return self._getitems(idx)
         assert idx < len(self.samples), "sample index is out-of-range"
         if idx < 0:
             idx = len(self.samples) + idx
-        label_map = None
-        if self.hdf5_handle is not None:
-            image = self.hdf5_handle[self.group_name]["features"][idx]
-            mask = self.hdf5_handle[self.group_name]["boundaries"][idx]
-            if self.group_name != "test":
-                label_map = self.hdf5_handle[self.group_name]["labels"][idx]
+        if self.keep_file_open:
+            image, mask, label_map = self._read_sample(self._get_group(), idx)
         else:
             with h5py.File(self.hdf5_path, mode="r") as archive:
-                image = archive[self.group_name]["features"][idx]
-                mask = archive[self.group_name]["boundaries"][idx]
-                if self.group_name != "test":
-                    label_map = archive[self.group_name]["labels"][idx]
-        if self.use_global_normalization:
-            image = (image.astype(np.float32) - self.image_mean) / self.image_stddev
-        mask = mask.astype(np.int16)
-        if label_map is not None:
-            # note: we might squish some overlapping labels, but these are very rare... (<0.07%)
-            out_label_map = np.zeros((image.shape[0], image.shape[1]), dtype=np.int16)
-            for label_idx in range(1, len(class_names)):
-                orig_label_map_idx = label_idx - 1
-                curr_label_map = label_map[..., orig_label_map_idx]
-                # overlap = np.logical_and(out_label_map != 0, curr_label_map)
-                # self.squished += np.count_nonzero(overlap)
-                out_label_map = np.where(curr_label_map, np.int16(label_idx), out_label_map)
-            label_map = out_label_map
-            label_map = np.where(mask, label_map, np.int16(dontcare))
+                image, mask, label_map = self._read_sample(archive[self.group_name], idx)
         sample = {
             "image": image,
             "label_map": label_map,
@@ -167,29 +271,28 @@ class Hdf5AgricultureDataset(Dataset):
         return sample
 
 
-def _compute_statistics(dataset) -> typing.Dict:
-    array_alloc_size = len(dataset)
-    stat_arrays = [
-        # alloc three vals per item: px-wise sum, px-wise sqsum, px count
-        np.zeros((array_alloc_size, 3), dtype=np.float64) for band in range(4)
-    ]
-    for batch_idx, sample in enumerate(tqdm.tqdm(dataset)):
-        image = sample["image"]
-        assert image.ndim == 3 and image.shape[-1] == 4
-        for ch_idx in range(4):
-            image_ch = image[..., ch_idx]
-            stat_arrays[ch_idx][batch_idx] = (
-                np.sum(image_ch, dtype=np.float64),
-                np.sum(np.square(image_ch, dtype=np.float64)),
-                np.float64(image_ch.size),
-            )
-    stat_map = {}
-    for band_idx, band_array in enumerate(stat_arrays):
-        tot_size = np.sum(band_array[:, 2])
-        mean = np.sum(band_array[:, 0]) / tot_size
-        stddev = np.sqrt(np.sum(band_array[:, 1]) / tot_size - np.square(mean))
-        stat_map[band_idx] = {"mean": mean, "stddev": stddev}
-    return stat_map
+def _benchmark_label_decoding(dataset: Hdf5AgricultureDataset, sample_count: int = 100) -> typing.Dict:
+    """Returns the samples/sec of the per-class loop and bit-packed label decoders on the legacy label stacks."""
+    assert dataset.group_name != "test", "cannot benchmark label decoding on unlabeled data"
+    sample_count = min(sample_count, len(dataset))
+    with h5py.File(dataset.hdf5_path, mode="r") as archive:
+        group = archive[dataset.group_name]
+        stacks = [group["labels"][idx] for idx in range(sample_count)]
+        masks = [group["boundaries"][idx].astype(np.int16) for idx in range(sample_count)]
+    results = {}
+    for name, decoder in [("loop", _decode_label_stack_loop), ("packed", decode_label_stack)]:
+        start = time.perf_counter()
+        label_maps = [decoder(stack, mask) for stack, mask in zip(stacks, masks)]
+        results[name] = sample_count / max(time.perf_counter() - start, 1e-9)
+        if name == "loop":
+            ref_label_maps = label_maps
+        else:
+            assert all([np.array_equal(a, b) for a, b in zip(label_maps, ref_label_maps)]), "decoder mismatch"
+    start = time.perf_counter()
+    for idx in range(sample_count):
+        _ = dataset[idx]
+    results["getitem"] = sample_count / max(time.perf_counter() - start, 1e-9)
+    return results
 
 
 def _compute_class_weights(dataset) -> typing.Dict:
@@ -223,7 +326,6 @@ if __name__ == "__main__":
             keep_file_open=True,
         ) for group_name in ["train", "val", "test"]
     ])
-    # out_map = _compute_statistics(dataset)
     out_map = _compute_class_weights(dataset)
     logging.info(f"out_map =\n{pprint.pformat(out_map, indent=4)}")
     print("all done")
@@ -1,3 +1,5 @@
+import collections
+import concurrent.futures
 import dataclasses
 import datetime
 import json
@@ -25,6 +27,11 @@ logger = logging.getLogger(__name__)
 # Blue = B2, Green = B3, Red = B4, NIR = B8
 bgrnir_band_names = ["B02", "B03", "B04", "B08"]  # all should be 10m resolution (120x120)
 
+# columns of the structured metadata table exported by the compactor (see `_get_patch_table`)
+patch_table_str_columns = ["mission_id", "tile_source", "acquisition_date", "projection", "root_path"]
+patch_table_coord_keys = ["ulx", "uly", "lrx", "lry"]
+patch_table_list_sep = "|"  # used to join band file names and labels into single strings
+
 
 @dataclasses.dataclass
 class BigEarthNetPatch:
@@ -92,13 +99,151 @@ class BigEarthNetPatch:
                     if band.shape[0] != target_size:
                         band = cv.resize(band, (target_size, target_size), interpolation=cv.INTER_CUBIC)
                     if norm_meanstddev is not None and len(norm_meanstddev) > 0:
-                        band = (band.astype(np.float) - norm_meanstddev[0]) / norm_meanstddev[1]
+                        band = (band.astype(np.float64) - norm_meanstddev[0]) / norm_meanstddev[1]
                     if band.dtype != target_dtype:
                         band = band.astype(target_dtype)
                     image[band_idx] = band
         return image
 
 
+def _parse_patch_folder(root: typing.AnyStr, patch_folder: typing.AnyStr) -> typing.Optional[BigEarthNetPatch]:
+    """Parses the metadata of a single patch folder; returns ``None`` if the folder is not a patch folder."""
+    name_pattern = re.compile(r"^([\w\d]+)_MSIL2A_(\d{8}T\d{6})_(\d+)_(\d+)$")
+    match_res = re.match(name_pattern, patch_folder)
+    patch_folder_path = os.path.join(root, patch_folder)
+    if not match_res or not os.path.isdir(patch_folder_path):
+        return None
+    patch_files = os.listdir(patch_folder_path)
+    band_files = [p for p in patch_files if p.endswith(".tif")]
+    metadata_files = [p for p in patch_files if p.endswith(".json")]
+    assert len(band_files) == 12 and len(metadata_files) == 1
+    metadata_path = os.path.join(patch_folder_path, metadata_files[0])
+    with open(metadata_path, "r") as fd:
+        patch_metadata = json.load(fd)
+    expected_meta_keys = ["labels", "coordinates", "projection", "tile_source", "acquisition_date"]
+    assert all([key in patch_metadata for key in expected_meta_keys])
+    acquisition_timestamp = datetime.datetime.strptime(patch_metadata["acquisition_date"], "%Y-%m-%d %H:%M:%S")
+    file_timestamp = datetime.datetime.strptime(match_res.group(2), "%Y%m%dT%H%M%S")
+    assert acquisition_timestamp == file_timestamp
+    return BigEarthNetPatch(
+        root_path=os.path.abspath(patch_folder_path),
+        mission_id=match_res.group(1),
+        tile_col=int(match_res.group(3)),
+        tile_row=int(match_res.group(4)),
+        band_files=sorted(band_files),
+        **patch_metadata,
+    )
+
+
+def _load_patch_slab(patches: typing.List[BigEarthNetPatch],
+                     target_size: int,
+                     target_bands: typing.List[str],
+                     target_dtype: np.dtype,
+                     norm_meanstddev: typing.Optional[typing.Tuple[int, int]],
+                     image_compression: typing.Optional[typing.Any],
+                     ):
+    """Loads a slab of consecutive patches; runs in the export worker processes.
+
+    For chunked or uncompressed image datasets, the slab is returned as a single array of stacked patches that can
+    be written in one call; for flattened datasets, each patch is encoded here and the list of buffers is returned.
+    The image compression can be given as a codec name, or as a (codec name, encoder parameters) pair.
+    """
+    slab = np.stack([patch.load_array(target_size=target_size, target_bands=target_bands,
+                                      target_dtype=target_dtype, norm_meanstddev=norm_meanstddev)
+                     for patch in patches])
+    assert slab.shape[1:] == (len(target_bands), target_size, target_size)
+    image_codec, codec_kwargs = image_compression, {}
+    if isinstance(image_compression, (tuple, list)) and len(image_compression) == 2:
+        image_codec, codec_kwargs = image_compression
+    if image_codec in thelper.utils.chunk_compression_flags or image_codec in thelper.utils.no_compression_flags:
+        return slab
+    return [np.frombuffer(thelper.utils.encode_data(patch, image_codec, **codec_kwargs), dtype=np.uint8)
+            for patch in slab]
+
+
+def _iter_patch_slabs(patches: typing.List[BigEarthNetPatch],
+                      slab_size: int,
+                      num_workers: int,
+                      **load_kwargs,
+                      ):
+    """Yields the (start index, loaded slab) pairs of a list of patches, in order, using a pool of processes.
+
+    At most two slabs per worker are pending at any time, so memory usage stays bounded even if writing the slabs
+    is slower than loading them.
+    """
+    slab_starts = range(0, len(patches), slab_size)
+    if num_workers <= 1:
+        for start in slab_starts:
+            yield start, _load_patch_slab(patches[start:start + slab_size], **load_kwargs)
+        return
+    pending = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for start in slab_starts:
+            pending.append((start, executor.submit(_load_patch_slab, patches[start:start + slab_size], **load_kwargs)))
+            while len(pending) >= 2 * num_workers:
+                start, future = pending.popleft()
+                yield start, future.result()
+        while pending:
+            start, future = pending.popleft()
+            yield start, future.result()
+
+
+def _get_patch_table(patches: typing.List[BigEarthNetPatch],
+                     class_names: typing.List[str],
+                     ) -> typing.Dict[typing.AnyStr, np.ndarray]:
+    """Returns the columns of the structured metadata table used to store patch metadata in HDF5 archives.
+
+    String fields are stored as variable-length string columns, list fields are joined into single strings,
+    coordinates are stored as an (N, 4) float64 array, and labels are also stored as an (N, C) multi-hot matrix.
+    """
+    class_idxs = {class_name: class_idx for class_idx, class_name in enumerate(class_names)}
+    label_matrix = np.zeros((len(patches), len(class_names)), dtype=np.uint8)
+    for patch_idx, patch in enumerate(patches):
+        label_matrix[patch_idx, [class_idxs[label] for label in patch.labels]] = 1
+    return {
+        **{key: np.asarray([getattr(p, key) for p in patches], dtype=object) for key in patch_table_str_columns},
+        "band_files": np.asarray([patch_table_list_sep.join(p.band_files) for p in patches], dtype=object),
+        "labels": np.asarray([patch_table_list_sep.join(p.labels) for p in patches], dtype=object),
+        "tile_row": np.asarray([p.tile_row for p in patches], dtype=np.int32),
+        "tile_col": np.asarray([p.tile_col for p in patches], dtype=np.int32),
+        "coordinates": np.asarray([[p.coordinates[key] for key in patch_table_coord_keys] for p in patches],
+                                  dtype=np.float64),
+        "label_matrix": label_matrix,
+    }
+
+
+def _read_str_column(dset: h5py.Dataset) -> typing.List[str]:
+    """Reads a whole variable-length string column at once (h5py>=3 returns bytes unless asked for strings)."""
+    return (dset.asstr()[()] if hasattr(dset, "asstr") else dset[()]).tolist()
+
+
+def _get_patches_from_table(group: h5py.Group) -> typing.List[BigEarthNetPatch]:
+    """Rebuilds the list of patch metadata objects from a structured metadata table (see `_get_patch_table`)."""
+    str_columns = {key: _read_str_column(group[key]) for key in [*patch_table_str_columns, "band_files", "labels"]}
+    tile_rows, tile_cols = group["tile_row"][()].tolist(), group["tile_col"][()].tolist()
+    coordinates = group["coordinates"][()].tolist()
+    return [
+        BigEarthNetPatch(
+            **{key: str_columns[key][idx] for key in patch_table_str_columns},
+            coordinates=dict(zip(patch_table_coord_keys, coordinates[idx])),
+            tile_row=tile_rows[idx],
+            tile_col=tile_cols[idx],
+            band_files=str_columns["band_files"][idx].split(patch_table_list_sep),
+            labels=str_columns["labels"][idx].split(patch_table_list_sep) if str_columns["labels"][idx] else [],
+        ) for idx in range(len(tile_rows))
+    ]
+
+
+def _get_label_matrix(patches: typing.List[BigEarthNetPatch]) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """Returns the sorted array of class names found in a list of patches, and the (N, C) multi-hot label matrix."""
+    class_names = np.unique([label for patch in patches for label in patch.labels])
+    label_counts = [len(patch.labels) for patch in patches]
+    label_idxs = np.searchsorted(class_names, [label for patch in patches for label in patch.labels])
+    label_matrix = np.zeros((len(patches), len(class_names)), dtype=np.uint8)
+    label_matrix[np.repeat(np.arange(len(patches)), label_counts), label_idxs] = 1
+    return class_names, label_matrix
+
+
 class BigEarthNet(Dataset):
 
     def __init__(self,
@@ -108,6 +253,7 @@ class BigEarthNet(Dataset):
                  meta_keys: typing.Optional[typing.List[str]] = None,
                  use_global_normalization: bool = True,
                  keep_file_open: bool = False,
+                 norm_stats_path: typing.Optional[typing.AnyStr] = None,
                  ):
         super().__init__(transforms, deepcopy=False)
         logger.info(f"reading BigEarthNet data from: {hdf5_path}")
@@ -120,26 +266,28 @@ class BigEarthNet(Dataset):
             self.target_dtype = np.dtype(hdf5.attrs["target_dtype"])
             self.norm_meanstddev = hdf5.attrs["norm_meanstddev"]
             patch_count = hdf5.attrs["patch_count"]
-            metadata_dataset = hdf5["metadata"]
             self.samples = []
             if self.metadata_cache is not None and os.path.exists(self.metadata_cache):
                 logger.debug(f"parsing metadata from cache file: {self.metadata_cache}")
                 with open(self.metadata_cache, "rb") as cache:
                     self.samples = pickle.load(cache)
                 assert len(self.samples) == patch_count, "unexpected metadata sample count"
+            elif "metadata_table" in hdf5:
+                logger.debug("parsing metadata from structured table")
+                self.samples = _get_patches_from_table(hdf5["metadata_table"])
             else:
+                # legacy archives store metadata as one repr string per patch (slow to parse)
+                metadata_dataset = hdf5["metadata"]
                 for sample_idx in tqdm.tqdm(range(patch_count), desc="parsing metadata"):
                     meta_str = thelper.utils.fetch_hdf5_sample(metadata_dataset, sample_idx)
                     assert meta_str.startswith("BigEarthNetPatch(")
                     self.samples.append(eval(meta_str))
-                if self.metadata_cache:
-                    with open(self.metadata_cache, "wb") as cache:
-                        pickle.dump(self.samples, cache)
+            if self.metadata_cache and not os.path.exists(self.metadata_cache):
+                with open(self.metadata_cache, "wb") as cache:
+                    pickle.dump(self.samples, cache)
         assert len(self.samples) > 0, "could not load any bigearthnet samples"
-        class_names = []
-        for sample in self.samples:
-            class_names.extend(sample.labels)
-        self.class_names, self.class_counts = np.unique(class_names, return_counts=True)
+        self.class_names, self.label_matrix = _get_label_matrix(self.samples)
+        self.class_counts = self.label_matrix.sum(axis=0, dtype=np.int64)
         class_map_str = pprint.pformat({n: c for n, c in
                                         zip(self.class_names, self.class_counts)}, indent=2)
         logger.debug(f"bigearthnet class sample split:\n{class_map_str}")
@@ -162,6 +310,11 @@ class BigEarthNet(Dataset):
             1452.286444583796,  # B04
             1702.876207365026,  # B08
         ], dtype=np.float32)
+        if norm_stats_path is not None:  # e.g. saved by thelper.data.stats.DatasetStatistics.save_band_stats
+            norm_stats = thelper.data.stats.load_band_stats(norm_stats_path)
+            assert len(norm_stats["mean"]) == len(self.image_mean), "unexpected band count in normalization stats"
+            self.image_mean = norm_stats["mean"].astype(np.float32)
+            self.image_stddev = norm_stats["std"].astype(np.float32)
         self.hdf5_handle = h5py.File(self.hdf5_path, "r") if keep_file_open else None
 
     def __len__(self):
@@ -183,10 +336,9 @@ class BigEarthNet(Dataset):
         image = np.transpose(image, (1, 2, 0))
         if self.use_global_normalization:
             image = (image.astype(np.float32) - self.image_mean) / self.image_stddev
-        labels = np.asarray([label in self.samples[idx].labels for label in self.class_names])
         sample = {
             "image": image,
-            "labels": labels.astype(np.int32),
+            "labels": self.label_matrix[idx].astype(np.int32),
             **{meta_key: getattr(self.samples[idx], meta_key) for meta_key in self.meta_keys}
         }
         if self.transforms:
@@ -196,8 +348,9 @@ class BigEarthNet(Dataset):
 
 class HDF5Compactor:
 
-    def __init__(self, root: typing.AnyStr):
+    def __init__(self, root: typing.AnyStr, num_workers: typing.Optional[int] = None):
         assert os.path.isdir(root), f"invalid big earth net root directory path ({root})"
+        self.num_workers = num_workers if num_workers is not None else (os.cpu_count() or 1)
         metadata_cache_path = os.path.join(root, "patches_metadata.pkl")
         if os.path.exists(metadata_cache_path):
             logger.info(f"loading patch metadata from cache: {metadata_cache_path}")
@@ -205,7 +358,7 @@ class HDF5Compactor:
                 self.patches = pickle.load(fd)
         else:
             logger.info(f"loading patch metadata from directory: {os.path.abspath(root)}")
-            self.patches = self._load_patch_metadata(root)
+            self.patches = self._load_patch_metadata(root, num_workers=self.num_workers)
             assert len(self.patches) > 0
             with open(metadata_cache_path, "wb") as fd:
                 pickle.dump(self.patches, fd)
@@ -216,37 +369,21 @@ class HDF5Compactor:
         logger.debug(f"class weights:\n{pprint.PrettyPrinter(indent=2).pformat(self.class_weights)}")
 
     @staticmethod
-    def _load_patch_metadata(root: typing.AnyStr, progress_bar: bool = True):
+    def _load_patch_metadata(root: typing.AnyStr, progress_bar: bool = True, num_workers: int = 1):
         assert os.path.isdir(root), f"invalid big earth net root directory path ({root})"
-        name_pattern = re.compile(r"^([\w\d]+)_MSIL2A_(\d{8}T\d{6})_(\d+)_(\d+)$")
-        patches = []
         patch_folders = os.listdir(root)
-        patch_iter = tqdm.tqdm(patch_folders) if progress_bar else patch_folders
-        for patch_folder in patch_iter:
-            match_res = re.match(name_pattern, patch_folder)
-            patch_folder_path = os.path.join(root, patch_folder)
-            if match_res and os.path.isdir(patch_folder_path):
-                patch_files = os.listdir(patch_folder_path)
-                band_files = [p for p in patch_files if p.endswith(".tif")]
-                metadata_files = [p for p in patch_files if p.endswith(".json")]
-                assert len(band_files) == 12 and len(metadata_files) == 1
-                metadata_path = os.path.join(patch_folder_path, metadata_files[0])
-                with open(metadata_path, "r") as fd:
-                    patch_metadata = json.load(fd)
-                expected_meta_keys = ["labels", "coordinates", "projection", "tile_source", "acquisition_date"]
-                assert all([key in patch_metadata for key in expected_meta_keys])
-                acquisition_timestamp = datetime.datetime.strptime(patch_metadata["acquisition_date"],
-                                                                   "%Y-%m-%d %H:%M:%S")
-                file_timestamp = datetime.datetime.strptime(match_res.group(2), "%Y%m%dT%H%M%S")
-                assert acquisition_timestamp == file_timestamp
-                patches.append(BigEarthNetPatch(
-                    root_path=os.path.abspath(patch_folder_path),
-                    mission_id=match_res.group(1),
-                    tile_col=int(match_res.group(3)),
-                    tile_row=int(match_res.group(4)),
-                    band_files=sorted(band_files),
-                    **patch_metadata,
-                ))
+        if num_workers > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+            patch_iter = executor.map(_parse_patch_folder, [root] * len(patch_folders), patch_folders, chunksize=256)
+        else:
+            executor, patch_iter = None, (_parse_patch_folder(root, folder) for folder in patch_folders)
+        if progress_bar:
+            patch_iter = tqdm.tqdm(patch_iter, total=len(patch_folders))
+        try:
+            patches = [patch for patch in patch_iter if patch is not None]
+        finally:
+            if executor is not None:
+                executor.shutdown()
         return patches
 
     @staticmethod
@@ -269,10 +406,24 @@ class HDF5Compactor:
                metadata_compression: typing.Optional[typing.Any] = None,
                image_compression: typing.Optional[typing.Any] = "chunk_lz4",
                progress_bar: bool = True,
+               num_workers: typing.Optional[int] = None,
+               slab_size: int = 64,
                ):
+        """Exports the patches to an HDF5 archive, loading and resampling them in a pool of worker processes.
+
+        Patches are loaded in slabs of ``slab_size`` consecutive patches by ``num_workers`` processes (by default,
+        the worker count given to the constructor), and each slab is written in a single call. Since image datasets
+        are chunked one patch at a time, slabs are always chunk-aligned. The patch metadata is stored in the
+        ``metadata_table`` group as a structured table (one column per field; see ``_get_patch_table``), which can
+        be read back in bulk instead of parsing one string per patch.
+        """
         logger.info(f"exporting BigEarthNet to {output_hdf5_path}")
         if isinstance(target_bands, str) and target_bands == "bgrnir":
             target_bands = bgrnir_band_names
+        num_workers = num_workers if num_workers is not None else self.num_workers
+        assert slab_size > 0, "slab size should be strictly positive"
+        assert metadata_compression in [None, *thelper.utils.no_compression_flags, "gzip", "lzf"], \
+            f"unsupported metadata table compression '{metadata_compression}'"
         pretty = pprint.PrettyPrinter(indent=2)
         with h5py.File(output_hdf5_path, "w") as fd:
             fd.attrs["source"] = thelper.utils.get_log_stamp()
@@ -287,58 +438,45 @@ class HDF5Compactor:
             fd.attrs["patch_count"] = len(self.patches)
             logger.debug("dataset attributes: \n" +
                          pretty.pformat({key: val for key, val in fd.attrs.items()}))
-            logger.debug("generating meta packets...")
-            patch_meta_strs = np.asarray([repr(p) for p in self.patches])
-            logger.debug("creating datasets...")
-            assert metadata_compression not in thelper.utils.chunk_compression_flags
-            metadata = thelper.utils.create_hdf5_dataset(
-                fd=fd, name="metadata", max_len=len(patch_meta_strs),
-                batch_like=patch_meta_strs, compression=metadata_compression)
+            logger.debug("exporting metadata table...")
+            class_names = sorted(self.class_map.keys())
+            metadata_table = fd.create_group("metadata_table")
+            metadata_table.attrs["class_names"] = class_names
+            metadata_table.attrs["coordinate_keys"] = patch_table_coord_keys
+            table_compression = metadata_compression if metadata_compression in ["gzip", "lzf"] else None
+            for column_name, column in _get_patch_table(self.patches, class_names).items():
+                metadata_table.create_dataset(
+                    name=column_name, data=column, compression=table_compression,
+                    dtype=h5py.special_dtype(vlen=str) if column.dtype == object else column.dtype)
+            logger.debug("creating image dataset...")
             target_tensor_shape = (len(target_bands), target_size, target_size)
             fake_batch = np.zeros((1, *target_tensor_shape), dtype=target_dtype)
-            if image_compression in thelper.utils.chunk_compression_flags or \
-                    image_compression in thelper.utils.no_compression_flags:
-                imgdata = thelper.utils.create_hdf5_dataset(
-                    fd=fd,
-                    name="imgdata",
-                    max_len=len(self.patches),
-                    batch_like=fake_batch,
-                    compression=image_compression,
-                    chunk_size=(1, *target_tensor_shape),
-                    flatten=False
-                )
-            else:
-                imgdata = thelper.utils.create_hdf5_dataset(
-                    fd=fd,
-                    name="imgdata",
-                    max_len=len(self.patches),
-                    batch_like=fake_batch,
-                    compression=image_compression,
-                    chunk_size=None,
-                    flatten=True
-                )
-            logger.debug("exporting metadata...")
-            if progress_bar:
-                patch_meta_iter = tqdm.tqdm(patch_meta_strs, desc="exporting metadata")
-            else:
-                patch_meta_iter = patch_meta_strs
-            for sample_idx, patch_meta_str in enumerate(patch_meta_iter):
-                thelper.utils.fill_hdf5_sample(
-                    metadata, sample_idx, sample_idx, patch_meta_strs, None)
-            logger.debug("exporting image data...")
-            if progress_bar:
-                patch_iter = tqdm.tqdm(self.patches, desc="exporting image data")
-            else:
-                patch_iter = self.patches
-            for sample_idx, patch in enumerate(patch_iter):
-                patch_array = patch.load_array(
-                    target_size=target_size,
-                    target_bands=target_bands,
-                    norm_meanstddev=norm_meanstddev
-                )
-                assert patch_array.shape == (len(target_bands), target_size, target_size)
-                thelper.utils.fill_hdf5_sample(
-                    imgdata, sample_idx, 0, patch_array.reshape((1, *target_tensor_shape)))
+            image_codec = image_compression[0] if isinstance(image_compression, (tuple, list)) else image_compression
+            flatten = image_codec not in thelper.utils.chunk_compression_flags and \
+                image_codec not in thelper.utils.no_compression_flags
+            imgdata = thelper.utils.create_hdf5_dataset(
+                fd=fd,
+                name="imgdata",
+                max_len=len(self.patches),
+                batch_like=fake_batch,
+                compression=image_compression,
+                chunk_size=None if flatten else (1, *target_tensor_shape),
+                flatten=flatten
+            )
+            logger.debug(f"exporting image data with {num_workers} worker(s)...")
+            slab_iter = _iter_patch_slabs(
+                self.patches, slab_size, num_workers, target_size=target_size, target_bands=target_bands,
+                target_dtype=target_dtype, norm_meanstddev=norm_meanstddev, image_compression=image_compression)
+            progress = tqdm.tqdm(total=len(self.patches), desc="exporting image data", disable=not progress_bar)
+            with progress:
+                for slab_start, slab in slab_iter:
+                    if flatten:
+                        flat_slab = np.empty((len(slab),), dtype=object)
+                        for patch_idx, patch_buffer in enumerate(slab):
+                            flat_slab[patch_idx] = patch_buffer
+                        slab = flat_slab
+                    imgdata[slab_start:slab_start + len(slab)] = slab
+                    progress.update(len(slab))
 
     def _test_close_vals(self, input_hdf5_path: typing.AnyStr):
         assert os.path.isfile(input_hdf5_path), f"invalid input hdf5 file path: {input_hdf5_path}"
@@ -349,11 +487,14 @@ class HDF5Compactor:
             norm_meanstddev = fd.attrs["norm_meanstddev"]
             patch_count = fd.attrs["patch_count"]
             assert patch_count == len(self.patches)
-            patch_meta_strs = np.asarray([repr(p) for p in self.patches])
-            metadata_dataset = fd["metadata"]
-            for sample_idx in range(patch_count):
-                loaded_meta_str = thelper.utils.fetch_hdf5_sample(metadata_dataset, sample_idx)
-                assert patch_meta_strs[sample_idx] == loaded_meta_str
+            if "metadata_table" in fd:
+                assert _get_patches_from_table(fd["metadata_table"]) == self.patches
+            else:
+                patch_meta_strs = np.asarray([repr(p) for p in self.patches])
+                metadata_dataset = fd["metadata"]
+                for sample_idx in range(patch_count):
+                    loaded_meta_str = thelper.utils.fetch_hdf5_sample(metadata_dataset, sample_idx)
+                    assert patch_meta_strs[sample_idx] == loaded_meta_str
             random_sample_idxs = np.random.randint(low=0, high=patch_count, size=(100,))
             image_dataset = fd["imgdata"]
             for sample_idx in random_sample_idxs:
@@ -367,31 +508,6 @@ class HDF5Compactor:
                 assert np.isclose(generated_array, loaded_array).all()
 
 
-def _compute_statistics(dset: BigEarthNet) -> typing.Dict:
-    array_alloc_size = len(dset)
-    stat_map = {
-        # alloc three vals per item: px-wise sum, px-wise sqsum, px count
-        band: np.zeros((array_alloc_size, 3), dtype=np.float64)
-        for band in bgrnir_band_names
-    }
-    for batch_idx, sample in enumerate(tqdm.tqdm(dataset)):
-        image = sample["image"]
-        assert image.ndim == 3 and image.shape[-1] == len(bgrnir_band_names)
-        for ch_idx, ch in enumerate(bgrnir_band_names):
-            image_ch = image[..., ch_idx]
-            stat_map[ch][batch_idx] = (
-                np.sum(image_ch, dtype=np.float64),
-                np.sum(np.square(image_ch, dtype=np.float64)),
-                np.float64(image_ch.size),
-            )
-    for key, array in stat_map.items():
-        tot_size = np.sum(array[:, 2])
-        mean = np.sum(array[:, 0]) / tot_size
-        stddev = np.sqrt(np.sum(array[:, 1]) / tot_size - np.square(mean))
-        stat_map[key] = {"mean": mean, "stddev": stddev}
-    return stat_map
-
-
 if __name__ == "__main__":
     # @@@@ TODO: CONVERT TO PROPER TEST
     logging.basicConfig()
@@ -403,8 +519,13 @@ if __name__ == "__main__":
     dataset = BigEarthNet(
         hdf5_path="/shared/data_sfast/datasets/bigearthnet/bigearthnet-thelper.hdf5",
         cache_path="data/cache",
+        use_global_normalization=False,
         keep_file_open=True,
     )
-    stat_map = _compute_statistics(dataset)
+    stats = thelper.data.stats.compute_dataset_stats(dataset, num_workers=8, sketch_size=512, progress_bar=True)
+    stats.save_band_stats("data/cache/bigearthnet-band-stats.json")
+    norm_params = stats.get_normalization_params()
+    stat_map = {band: {"mean": mean, "stddev": std}
+                for band, mean, std in zip(bgrnir_band_names, norm_params["mean"], norm_params["std"])}
     logging.info(f"stat_map =\n{pprint.pformat(stat_map, indent=4)}")
     print("all done")
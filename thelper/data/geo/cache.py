@@ -0,0 +1,341 @@
+"""Columnar cache format for parsed geospatial features and crops.
+
+This module contains the utilities used to store lists of records (i.e. dictionaries of features or of crop
+samples) in a columnar format instead of pickling them. Each record key becomes a column: geometries are stored
+as WKB in a single byte buffer, numeric fields of a single type are stored as (possibly ragged) arrays, references
+to other records are stored as indices, and everything else is stored as JSON (with tags for the types that JSON
+cannot represent, so that all values are decoded with their original types). Each column is saved as a numpy
+array file in a cache directory, and these are memory-mapped when loaded. Records are then accessed through
+lightweight dictionary-like views that only decode their values when these are actually requested.
+"""
+
+import collections.abc
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import shapely.geometry.base
+import shapely.wkb
+
+import thelper.tasks
+
+logger = logging.getLogger(__name__)
+
+CACHE_FORMAT_VERSION = 2
+
+_MISSING = object()  # sentinel used in record views for deleted keys
+
+
+def _to_json(value):
+    """Converts containers to json-compatible ones, tagging those that json cannot represent (tuples, non-str keys)."""
+    if isinstance(value, tuple):
+        return {"__tuple__": [_to_json(v) for v in value]}
+    if isinstance(value, list):
+        return [_to_json(v) for v in value]
+    if isinstance(value, dict):
+        if all([isinstance(k, str) and not k.startswith("__") for k in value]):
+            return {k: _to_json(v) for k, v in value.items()}
+        return {"__dict__": [[_to_json(k), _to_json(v)] for k, v in value.items()]}
+    return value
+
+
+def _json_default(value):
+    # note: geometries, bboxes and arrays can be nested anywhere in json-encoded values, and are tagged for decoding
+    if isinstance(value, shapely.geometry.base.BaseGeometry):
+        return {"__wkb__": value.wkb_hex}
+    if isinstance(value, thelper.tasks.detect.BoundingBox):
+        return {"__bbox__": {"class_id": value.class_id, "bbox": value.tolist(), "include_margin": value.include_margin,
+                             "difficult": value.difficult, "occluded": value.occluded, "truncated": value.truncated,
+                             "iscrowd": value.iscrowd, "confidence": value.confidence, "image_id": value.image_id}}
+    if isinstance(value, np.ndarray):
+        return {"__ndarray__": _to_json(value.ravel().tolist()), "dtype": value.dtype.str, "shape": value.shape}
+    if isinstance(value, np.generic):
+        return {"__generic__": value.item(), "dtype": value.dtype.str}
+    raise TypeError(f"cannot encode object of type '{type(value)}' in columnar cache")
+
+
+def _json_object_hook(obj):
+    if "__wkb__" in obj:
+        return shapely.wkb.loads(obj["__wkb__"], hex=True)
+    if "__bbox__" in obj:
+        return thelper.tasks.detect.BoundingBox(**obj["__bbox__"])
+    if "__ndarray__" in obj:
+        array = np.empty(len(obj["__ndarray__"]), dtype=np.dtype(obj["dtype"]))
+        for idx, item in enumerate(obj["__ndarray__"]):
+            array[idx] = item  # note: this also works for object arrays that contain containers
+        return array.reshape(obj["shape"])
+    if "__generic__" in obj:
+        return np.dtype(obj["dtype"]).type(obj["__generic__"])
+    if "__tuple__" in obj:
+        return tuple(obj["__tuple__"])
+    if "__dict__" in obj:
+        return {k: v for k, v in obj["__dict__"]}
+    return obj
+
+
+def _is_number(value):
+    return isinstance(value, (bool, int, float, np.bool_, np.number))
+
+
+def _get_column_kind(values, link_ids):
+    """Returns the storage kind and python type that should be used for a list of column values.
+
+    Values are only stored as arrays if they can be decoded back with their original types, i.e. if they are all
+    scalars of the same type, arrays of the same dtype, or flat lists/tuples of python scalars of the same type.
+    Everything else (e.g. mixed ints and floats, ``None`` values, or nested containers) is stored as json.
+    """
+    if values and all([isinstance(v, shapely.geometry.base.BaseGeometry) for v in values]):
+        return "wkb", None
+    if link_ids is not None and values and all([id(v) in link_ids for v in values]):
+        return "link", None
+    if link_ids is not None and all([isinstance(v, list) for v in values]) and any(values) and \
+            all([id(i) in link_ids for v in values for i in v]):
+        return "links", None
+    if not values or len(set([type(v) for v in values])) != 1:
+        return "json", None
+    if _is_number(values[0]):
+        try:
+            if np.asarray(values).dtype.kind not in "biuf":
+                return "json", None
+        except OverflowError:
+            return "json", None  # e.g. python ints that do not fit in 64 bits
+        return "array", "scalar" if type(values[0]) in [bool, int, float] else "generic"
+    if isinstance(values[0], np.ndarray):
+        arrays = values
+        if any([a.dtype != arrays[0].dtype or a.dtype.kind not in "biuf" for a in arrays]):
+            return "json", None
+        pytype = "ndarray"
+    elif isinstance(values[0], (list, tuple)):
+        items = [i for v in values for i in v]
+        if len(set([type(i) for i in items])) > 1 or (items and type(items[0]) not in [bool, int, float]):
+            return "json", None
+        arrays = [np.asarray(v, dtype=type(items[0]) if items else None) for v in values]
+        if any([a.dtype.kind not in "biuf" for a in arrays]):
+            return "json", None
+        pytype = type(values[0]).__name__
+    else:
+        return "json", None
+    if all([a.shape == arrays[0].shape for a in arrays]):
+        return "array", pytype
+    if all([a.ndim == 1 for a in arrays]):
+        return "ragged", pytype
+    return "json", None
+
+
+def _pack_buffer(chunks):
+    """Packs a list of byte strings into a single buffer and returns it along with the chunk offsets."""
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(c) for c in chunks])
+    return np.frombuffer(b"".join(chunks), dtype=np.uint8), offsets
+
+
+def write_columnar_cache(path, records, links=None):
+    """Writes a list of records (i.e. dictionaries) to a columnar cache directory.
+
+    Args:
+        path: path to the cache directory to create; it will be replaced if it already exists.
+        records: list of dictionaries to store in the cache. These do not need to have identical keys.
+        links: optional list of records (e.g. features) that may be referenced by the stored records (e.g. crops).
+            These references will be stored as indices in this list, and must be provided again at load time.
+    """
+    assert isinstance(records, list) and all([isinstance(r, collections.abc.Mapping) for r in records]), \
+        "records should be given as a list of dictionaries"
+    link_ids = {id(r): idx for idx, r in enumerate(links)} if links is not None else None
+    keys = list(dict.fromkeys([k for r in records for k in r]))  # keeps the key order of the records
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    columns = {}
+    for col_idx, key in enumerate(keys):
+        assert isinstance(key, str), "record keys should be strings"
+        present = np.asarray([key in r for r in records], dtype=bool)
+        values = [r[key] if key in r else None for r in records]
+        kind, pytype = _get_column_kind(values, link_ids) if present.all() else ("json", None)
+        column = {"kind": kind, "pytype": pytype, "file": str(col_idx)}
+        prefix = os.path.join(tmp_path, str(col_idx))
+        if not present.all():
+            column["sparse"] = True
+            np.save(prefix + ".present.npy", present)
+        if kind == "wkb":
+            data, offsets = _pack_buffer([v.wkb for v in values])
+            np.save(prefix + ".data.npy", data)
+            np.save(prefix + ".offsets.npy", offsets)
+        elif kind == "link":
+            np.save(prefix + ".data.npy", np.asarray([link_ids[id(v)] for v in values], dtype=np.int64))
+        elif kind in ["links", "ragged"]:
+            arrays = [np.asarray([link_ids[id(i)] for i in v], dtype=np.int64) for v in values] \
+                if kind == "links" else [np.asarray(v) for v in values]
+            offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(a) for a in arrays])
+            arrays = [a for a in arrays if len(a)]  # empty arrays might not have the right dtype
+            np.save(prefix + ".data.npy", np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64))
+            np.save(prefix + ".offsets.npy", offsets)
+        elif kind == "array":
+            np.save(prefix + ".data.npy", np.asarray(values))
+        else:
+            encoded = [json.dumps(_to_json(v), default=_json_default).encode() for v in values]
+            if encoded and all([e == encoded[0] for e in encoded]):
+                column["const"] = encoded[0].decode()  # no need to store the same value N times
+            else:
+                data, offsets = _pack_buffer(encoded)
+                np.save(prefix + ".data.npy", data)
+                np.save(prefix + ".offsets.npy", offsets)
+        columns[key] = column
+    with open(os.path.join(tmp_path, "meta.json"), "w") as fd:
+        json.dump({"version": CACHE_FORMAT_VERSION, "count": len(records), "keys": keys, "columns": columns}, fd)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def is_columnar_cache(path):
+    """Returns whether a directory contains a columnar cache that can be loaded with the current format version."""
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path) as fd:
+        return json.load(fd).get("version") == CACHE_FORMAT_VERSION
+
+
+class ColumnarTable(collections.abc.Sequence):
+    """Read-only table of records loaded (and memory-mapped) from a columnar cache directory.
+
+    Indexing this table returns :class:`RecordView` objects, which behave like the original record dictionaries,
+    but which decode their values lazily. If the records referenced other records (e.g. crops that reference
+    features) when they were written, the list of referenced records must be provided via ``links``.
+
+    .. seealso::
+        | :func:`thelper.data.geo.cache.write_columnar_cache`
+    """
+
+    def __init__(self, path, links=None):
+        meta_path = os.path.join(path, "meta.json")
+        assert os.path.isfile(meta_path), f"invalid columnar cache directory '{path}'"
+        with open(meta_path) as fd:
+            meta = json.load(fd)
+        assert meta["version"] == CACHE_FORMAT_VERSION, f"unsupported columnar cache version in '{path}'"
+        self.path = path
+        self.links = links
+        self.count = meta["count"]
+        self.keys = meta["keys"]
+        self.columns = meta["columns"]
+        assert links is not None or not any([c["kind"] in ["link", "links"] for c in self.columns.values()]), \
+            "missing list of linked records to decode references"
+        self.arrays = {}
+        for key, column in self.columns.items():
+            for suffix in ["present", "data", "offsets"]:
+                file_path = os.path.join(path, f"{column['file']}.{suffix}.npy")
+                if os.path.isfile(file_path):
+                    self.arrays[(key, suffix)] = np.load(file_path, mmap_mode="r", allow_pickle=False)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx = len(self) + idx
+        if not 0 <= idx < len(self):
+            raise IndexError("record index is out-of-range")
+        return RecordView(self, idx)
+
+    def __getstate__(self):
+        # note: memory maps are reopened when unpickled (e.g. in loader workers) instead of being copied
+        return {"path": self.path, "links": self.links}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def has_value(self, key, idx):
+        """Returns whether a record possesses a value for the given key."""
+        if key not in self.columns:
+            return False
+        return not self.columns[key].get("sparse", False) or bool(self.arrays[(key, "present")][idx])
+
+    def get_value(self, key, idx):
+        """Decodes and returns the value of a record for a given key."""
+        column = self.columns[key]
+        kind, pytype = column["kind"], column["pytype"]
+        if kind == "json" and "const" in column:
+            return json.loads(column["const"], object_hook=_json_object_hook)
+        data = self.arrays[(key, "data")]
+        if kind == "link":
+            return self.links[int(data[idx])]
+        if kind == "array":
+            value = data[idx]
+            if pytype == "scalar":
+                return value.item()
+            if pytype == "generic":
+                return value[()]
+            return np.array(value) if pytype == "ndarray" else (tuple if pytype == "tuple" else list)(value.tolist())
+        begin, end = self.arrays[(key, "offsets")][idx:idx + 2]
+        if kind == "wkb":
+            return shapely.wkb.loads(data[begin:end].tobytes())
+        if kind == "links":
+            return [self.links[int(i)] for i in data[begin:end]]
+        if kind == "ragged":
+            value = data[begin:end]
+            return np.array(value) if pytype == "ndarray" else (tuple if pytype == "tuple" else list)(value.tolist())
+        return json.loads(data[begin:end].tobytes().decode(), object_hook=_json_object_hook)
+
+
+class RecordView(collections.abc.MutableMapping):
+    """Lightweight dictionary-like view of a single record stored in a :class:`ColumnarTable`.
+
+    Values are decoded on first access and kept in the view afterwards. Values can also be overwritten or added
+    to the view (e.g. by feature cleaners); these modifications only exist in the view, and not in the table.
+    """
+
+    __slots__ = ("table", "idx", "values")
+
+    def __init__(self, table, idx):
+        self.table = table
+        self.idx = idx
+        self.values = {}
+
+    def __getitem__(self, key):
+        if key not in self.values:
+            if not self.table.has_value(key, self.idx):
+                raise KeyError(key)
+            self.values[key] = self.table.get_value(key, self.idx)
+        value = self.values[key]
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.values[key] = _MISSING
+
+    def __contains__(self, key):
+        if key in self.values:
+            return self.values[key] is not _MISSING
+        return self.table.has_value(key, self.idx)
+
+    def __iter__(self):
+        for key in self.table.keys:
+            if key in self:
+                yield key
+        for key, value in self.values.items():
+            if key not in self.table.columns and value is not _MISSING:
+                yield key
+
+    def __len__(self):
+        return sum([1 for _ in self])
+
+    def __getstate__(self):
+        return self.table, self.idx, self.values
+
+    def __setstate__(self, state):
+        self.table, self.idx, self.values = state
+
+    def __repr__(self):
+        return f"RecordView(idx={self.idx}, keys={list(self)})"
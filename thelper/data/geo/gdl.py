@@ -8,7 +8,9 @@ The classes and functions defined here were used for the exploration of research
 for the validation and testing of new software components.
 """
 
+import ast
 import collections
+import json
 import logging
 import os
 
@@ -21,8 +23,46 @@ from thelper.data.parsers import SegmentationDataset as BaseSegmentationDataset
 logger = logging.getLogger(__name__)
 
 
+def _literal_eval_metadata(node):
+    """Evaluates a metadata expression node made of literals and (nested) ``OrderedDict`` constructor calls only."""
+    if isinstance(node, ast.Expression):
+        return _literal_eval_metadata(node.body)
+    if isinstance(node, ast.Call):
+        func_name = node.func.attr if isinstance(node.func, ast.Attribute) else getattr(node.func, "id", None)
+        assert func_name in ["OrderedDict", "ordereddict"] and not node.keywords and len(node.args) <= 1, \
+            "unexpected call in metadata string (only OrderedDict constructors are supported)"
+        return collections.OrderedDict(_literal_eval_metadata(node.args[0]) if node.args else [])
+    if isinstance(node, ast.List):
+        return [_literal_eval_metadata(elem) for elem in node.elts]
+    if isinstance(node, ast.Tuple):
+        return tuple(_literal_eval_metadata(elem) for elem in node.elts)
+    if isinstance(node, ast.Dict):
+        return {_literal_eval_metadata(key): _literal_eval_metadata(val) for key, val in zip(node.keys, node.values)}
+    return ast.literal_eval(node)
+
+
+def decode_metadata(metadata):
+    """Decodes a metadata entry read from a GDL HDF5 archive (stringified OrderedDicts are parsed without eval)."""
+    if isinstance(metadata, np.ndarray) and len(metadata) == 1:
+        metadata = metadata[0]
+    if isinstance(metadata, bytes):
+        metadata = metadata.decode()
+    if isinstance(metadata, str):
+        if "ordereddict" in metadata:
+            metadata = metadata.replace("ordereddict", "collections.OrderedDict")
+        if metadata.startswith("collections.OrderedDict"):
+            metadata = _literal_eval_metadata(ast.parse(metadata, mode="eval"))
+    return metadata
+
+
 class SegmentationDataset(BaseSegmentationDataset):
-    """Semantic segmentation dataset interface for GDL-based HDF5 parsing."""
+    """Semantic segmentation dataset interface for GDL-based HDF5 parsing.
+
+    The HDF5 archive is opened once per process (e.g. in each data loader worker) and kept open. Samples requested
+    together (via slicing or via ``__getitems__``, which PyTorch data loaders use to fetch whole batches) are read
+    with a single call per contiguous run of indices. The metadata entries are decoded once, and cached in a JSON
+    file next to the archive when they can be stored in that format without loss.
+    """
 
     def __init__(self, class_names, work_folder, dataset_type, max_sample_count=None,
                  dontcare=None, transforms=None):
@@ -39,22 +79,52 @@ class SegmentationDataset(BaseSegmentationDataset):
         self.dataset_type = dataset_type
         self.metadata = []
         self.hdf5_path = os.path.join(self.work_folder, self.dataset_type + "_samples.hdf5")
+        self.metadata_cache_path = os.path.join(self.work_folder, self.dataset_type + "_samples.metadata.json")
+        self.hdf5_handle, self.hdf5_handle_pid = None, None
         with h5py.File(self.hdf5_path, "r") as hdf5_file:
             if "metadata" in hdf5_file:
-                for i in range(hdf5_file["metadata"].shape[0]):
-                    metadata = hdf5_file["metadata"][i, ...]
-                    if isinstance(metadata, np.ndarray) and len(metadata) == 1:
-                        metadata = metadata[0]
-                    if isinstance(metadata, str):
-                        if "ordereddict" in metadata:
-                            metadata = metadata.replace("ordereddict", "collections.OrderedDict")
-                        if metadata.startswith("collections.OrderedDict"):
-                            metadata = eval(metadata)
-                    self.metadata.append(metadata)
+                self.metadata = self._load_metadata(hdf5_file["metadata"])
+            self.meta_idxs = hdf5_file["meta_idx"][()].astype(np.int64) if "meta_idx" in hdf5_file else None
             if self.max_sample_count is None:
                 self.max_sample_count = hdf5_file["sat_img"].shape[0]
             self.samples = [{}] * self.max_sample_count
 
+    def __getstate__(self):
+        # the file handle is reopened on demand in each process (h5py handles cannot be pickled or forked)
+        state = dict(self.__dict__)
+        state["hdf5_handle"], state["hdf5_handle_pid"] = None, None
+        return state
+
+    def _get_archive(self):
+        """Returns the HDF5 archive handle of the current process, opening it if needed."""
+        if self.hdf5_handle is None or self.hdf5_handle_pid != os.getpid():
+            self.hdf5_handle = h5py.File(self.hdf5_path, "r")
+            self.hdf5_handle_pid = os.getpid()
+        return self.hdf5_handle
+
+    def _load_metadata(self, metadata_dset):
+        """Returns the decoded metadata entries of the archive, using (or creating) the JSON cache if possible."""
+        source_stamp = [os.path.getsize(self.hdf5_path), os.path.getmtime(self.hdf5_path)]
+        if os.path.isfile(self.metadata_cache_path):
+            try:
+                with open(self.metadata_cache_path, "r") as fd:
+                    cache = json.load(fd, object_pairs_hook=collections.OrderedDict)
+                if cache["source_stamp"] == source_stamp and len(cache["metadata"]) == metadata_dset.shape[0]:
+                    return cache["metadata"]
+            except (OSError, ValueError, KeyError):
+                pass
+            logger.debug(f"ignoring outdated metadata cache at {self.metadata_cache_path}")
+        metadata = [decode_metadata(entry) for entry in metadata_dset[()]]
+        try:
+            json_metadata = json.dumps(metadata)
+            assert json.loads(json_metadata, object_pairs_hook=collections.OrderedDict) == metadata
+            with open(self.metadata_cache_path + ".tmp", "w") as fd:
+                fd.write(f'{{"source_stamp": {json.dumps(source_stamp)}, "metadata": {json_metadata}}}')
+            os.replace(self.metadata_cache_path + ".tmp", self.metadata_cache_path)
+        except (AssertionError, OSError, TypeError, ValueError):
+            logger.debug("could not cache metadata (not JSON-compatible, or read-only folder)")
+        return metadata
+
     def _remap_labels(self, map_img):
         # note: will do nothing if 'dontcare' remap mode is not activated in constructor
         if not isinstance(self.dontcare, (tuple, list)):
@@ -62,25 +132,48 @@ class SegmentationDataset(BaseSegmentationDataset):
         # for now, the current implementation only handles the original 'dontcare' as zero
         assert self.dontcare[0] == 0, "missing implementation for non-zero original dontcare value"
         # to keep the impl simple, we just reduce all indices by one and replace -1 by the new value
+        # (this works in-place on single maps or on whole batches of maps)
         assert map_img.dtype == np.int8 or map_img.dtype == np.int16 or map_img.dtype == np.int32
-        map_img -= 1
+        np.subtract(map_img, 1, out=map_img, casting="unsafe")
         if self.dontcare[1] != -1:
-            map_img[map_img == -1] = self.dontcare[1]
+            np.putmask(map_img, map_img == -1, self.dontcare[1])
         return map_img
 
-    def __getitem__(self, index):
-        with h5py.File(self.hdf5_path, "r") as hdf5_file:
-            sat_img = hdf5_file["sat_img"][index, ...]
-            map_img = self._remap_labels(hdf5_file["map_img"][index, ...])
-            meta_idx = int(hdf5_file["meta_idx"][index]) if "meta_idx" in hdf5_file else -1
-            metadata = None
-            if meta_idx != -1:
-                metadata = self.metadata[meta_idx]
-        sample = {"sat_img": sat_img, "map_img": map_img, "metadata": metadata}
+    def _get_metadata(self, index):
+        """Returns the metadata entry of a sample (or ``None`` if it has none)."""
+        meta_idx = int(self.meta_idxs[index]) if self.meta_idxs is not None else -1
+        return self.metadata[meta_idx] if meta_idx != -1 else None
+
+    def _create_sample(self, index, sat_img, map_img):
+        """Creates a sample dictionary from its loaded image and label map, and transforms it."""
+        sample = {"sat_img": sat_img, "map_img": map_img, "metadata": self._get_metadata(index)}
         if self.transforms:
             sample = self.transforms(sample)
         return sample
 
+    def __getitems__(self, indices):
+        """Returns the list of samples at the given indices, reading each contiguous run of indices at once."""
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        assert ((indices >= 0) & (indices < len(self))).all(), "sample index is out-of-range"
+        archive = self._get_archive()
+        order = np.argsort(indices, kind="stable")
+        sorted_indices = indices[order]
+        run_splits = np.flatnonzero(np.diff(sorted_indices) != 1) + 1
+        samples = [None] * len(indices)
+        for run_positions in np.split(order, run_splits):
+            start, stop = int(indices[run_positions[0]]), int(indices[run_positions[-1]]) + 1
+            sat_imgs = archive["sat_img"][start:stop, ...]
+            map_imgs = self._remap_labels(archive["map_img"][start:stop, ...])
+            for run_idx, pos in enumerate(run_positions):
+                samples[pos] = self._create_sample(start + run_idx, sat_imgs[run_idx], map_imgs[run_idx])
+        return samples
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.__getitems__(range(*index.indices(len(self))))
+        return self.__getitems__([index])[0]
+
 
 class MetaSegmentationDataset(SegmentationDataset):
     """Semantic segmentation dataset interface that appends metadata under new tensor layers."""
@@ -97,6 +190,8 @@ class MetaSegmentationDataset(SegmentationDataset):
         assert all([isinstance(m, (dict, collections.OrderedDict)) for m in self.metadata]), \
             "cannot use provided metadata object type with meta-mapping dataset interface"
         self.meta_map = meta_map
+        self.meta_values = {}  # meta_idx-to-mapped-values cache, filled on first use
+        self.coords_maps = {}  # (height, width)-to-coords-layers cache, filled on first use
 
     @staticmethod
     def get_meta_value(map, key):
@@ -109,25 +204,39 @@ class MetaSegmentationDataset(SegmentationDataset):
             return MetaSegmentationDataset.get_meta_value(val, key[1:])
         return val
 
-    def __getitem__(self, index):
-        with h5py.File(self.hdf5_path, "r") as hdf5_file:
-            sat_img = hdf5_file["sat_img"][index, ...]
-            map_img = self._remap_labels(hdf5_file["map_img"][index, ...])
-            meta_idx = int(hdf5_file["meta_idx"][index]) if "meta_idx" in hdf5_file else -1
-            assert meta_idx != -1, f"metadata unvailable in sample #{index}"
-            metadata = self.metadata[meta_idx]
-            assert isinstance(metadata, (dict, collections.OrderedDict)), "unexpected metadata type"
-        for meta_key, mode in self.meta_map.items():
-            meta_val = self.get_meta_value(metadata, meta_key)
+    def _get_coords_map(self, height, width):
+        """Returns the HxWx2 intrinsic coordinates layers for a given image size."""
+        if (height, width) not in self.coords_maps:
+            coords_map = thelper.nn.coordconv.get_coords_map(height, width).numpy()
+            self.coords_maps[(height, width)] = np.moveaxis(coords_map, 0, 2)
+        return self.coords_maps[(height, width)]
+
+    def _create_sample(self, index, sat_img, map_img):
+        meta_idx = int(self.meta_idxs[index]) if self.meta_idxs is not None else -1
+        assert meta_idx != -1, f"metadata unvailable in sample #{index}"
+        metadata = self.metadata[meta_idx]
+        assert isinstance(metadata, (dict, collections.OrderedDict)), "unexpected metadata type"
+        if meta_idx not in self.meta_values:
+            self.meta_values[meta_idx] = [self.get_meta_value(metadata, key) for key in self.meta_map]
+        layers = []
+        for mode, meta_val in zip(self.meta_map.values(), self.meta_values[meta_idx]):
             if mode == "const_channel":
                 assert np.isscalar(meta_val), "constant channel-wise assignment requires scalar value"
-                layer = np.full(sat_img.shape[0:2], meta_val, dtype=np.float32)
-                sat_img = np.insert(sat_img, sat_img.shape[2], layer, axis=2)
+                layers.append(np.full((*sat_img.shape[0:2], 1), meta_val, dtype=np.float32))
             elif mode == "scaled_channel":
                 assert np.isscalar(meta_val), "scaled channel-wise coords assignment requires scalar value"
-                layers = thelper.nn.coordconv.get_coords_map(sat_img.shape[0], sat_img.shape[1]) * meta_val
-                sat_img = np.insert(sat_img, sat_img.shape[2], layers, axis=2)
+                layers.append(self._get_coords_map(sat_img.shape[0], sat_img.shape[1]) * meta_val)
             #else...
+        if layers:
+            # all layers are appended in a single allocation (values are cast to the image type, as with np.insert)
+            out_img = np.empty((*sat_img.shape[0:2], sat_img.shape[2] + sum([layer.shape[2] for layer in layers])),
+                               dtype=sat_img.dtype)
+            out_img[..., :sat_img.shape[2]] = sat_img
+            channel_idx = sat_img.shape[2]
+            for layer in layers:
+                out_img[..., channel_idx:channel_idx + layer.shape[2]] = layer
+                channel_idx += layer.shape[2]
+            sat_img = out_img
         sample = {"sat_img": sat_img, "map_img": map_img, "metadata": metadata}
         if self.transforms:
             sample = self.transforms(sample)
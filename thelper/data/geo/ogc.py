@@ -35,7 +35,8 @@ class TB15D104Dataset(VectorCropDataset):
                  lake_river_max_dist=float("inf"), feature_buffer=1000,
                  master_roi=None, focus_lakes=True, srs_target="3857", force_parse=False,
                  reproj_rasters=False, reproj_all_cpus=True, display_debug=False,
-                 keep_rasters_open=True, parallel=False, transforms=None):
+                 keep_rasters_open=True, parallel=False, fast_crops=False, cache_crops=False,
+                 cache_format="columnar", raster_mosaic=False, transforms=None):
         assert isinstance(lake_river_max_dist, (float, int)) and lake_river_max_dist >= 0, "unexpected dist type"
         self.lake_river_max_dist = float(lake_river_max_dist)
         assert isinstance(focus_lakes, bool), "unexpected flag type"
@@ -57,7 +58,9 @@ class TB15D104Dataset(VectorCropDataset):
                          feature_buffer=feature_buffer, master_roi=master_roi, srs_target=srs_target,
                          raster_key="lidar", mask_key="hydro", cleaner=cleaner, cropper=cropper,
                          force_parse=force_parse, reproj_rasters=reproj_rasters, reproj_all_cpus=reproj_all_cpus,
-                         keep_rasters_open=keep_rasters_open, transforms=transforms)
+                         keep_rasters_open=keep_rasters_open, fast_crops=fast_crops, cache_crops=cache_crops,
+                         cache_format=cache_format, raster_mosaic=raster_mosaic, parallel=parallel,
+                         transforms=transforms)
         meta_keys = self.task.meta_keys
         if "bboxes" in meta_keys:
             del meta_keys[meta_keys.index("bboxes")]  # placed in meta list by base class constr, moved to detect target below
@@ -65,9 +68,11 @@ class TB15D104Dataset(VectorCropDataset):
                                             input_key="input", bboxes_key="bboxes",
                                             meta_keys=meta_keys, background=0, color_map={"lake": [255, 0, 0]})
         # update all already-created bboxes with new task ref
-        for s in self.samples:
-            for b in s["bboxes"]:
-                b.task = self.task
+        # note: cached samples are views that decode bboxes on the fly, so these get updated in __getitem__ instead
+        if isinstance(self.samples, list):
+            for s in self.samples:
+                for b in s["bboxes"]:
+                    b.task = self.task
         self.display_debug = display_debug
         self.parallel = parallel
 
@@ -77,71 +82,70 @@ class TB15D104Dataset(VectorCropDataset):
         # note: we use a flag here instead of removing bad features so that end-users can still use them if needed
         for f in features:
             f["clean"] = False  # flag every as 'bad' by default, clear just the ones of interest below
+        import thelper.data.geo as geo
         rivers = [f for f in features if f["properties"]["TYPECE"] == TB15D104.TYPECE_RIVER]
         lakes = [f for f in features if f["properties"]["TYPECE"] == TB15D104.TYPECE_LAKE]
         logger.info(f"labeling and cleaning {len(lakes)} lakes...")
-
-        def clean_lake(lake):
-            if area_min <= lake["geometry"].area <= area_max:
-                if lake_river_max_dist == float("inf"):
-                    return True
-                else:
-                    for river in rivers:
-                        # note: distance check below seems to be "intelligent", i.e. it will
-                        # first check bbox distance, then check chull distance, and finally use
-                        # the full geometries (doing these steps here explicitly makes it slower)
-                        if lake["geometry"].distance(river["geometry"]) < lake_river_max_dist:
-                            return True
-            return False
-
-        if parallel:
-            if not isinstance(parallel, int):
-                import multiprocessing
-                parallel = multiprocessing.cpu_count()
-            assert parallel > 0, "unexpected min core count"
-            import joblib
-            flags = joblib.Parallel(n_jobs=parallel)(joblib.delayed(
-                clean_lake)(lake) for lake in tqdm.tqdm(lakes, desc="labeling + cleaning lakes"))
-            for flag, lake in zip(flags, lakes):
-                lake["clean"] = flag
-        else:
-            for lake in tqdm.tqdm(lakes, desc="labeling + cleaning lakes"):
-                lake["clean"] = clean_lake(lake)
+        # note: the spatial index only tests the distance to rivers whose bbox is close enough to the lake
+        river_index = geo.utils.SpatialIndex([river["geometry"] for river in rivers]) \
+            if lake_river_max_dist != float("inf") else None
+        # note: the river index is only sent once to each worker process (if any)
+        flags = geo.utils.map_chunks(TB15D104Dataset._clean_lakes, [lake["geometry"] for lake in lakes],
+                                     parallel=parallel, desc="labeling + cleaning lakes", area_min=area_min,
+                                     area_max=area_max, lake_river_max_dist=lake_river_max_dist,
+                                     river_index=river_index)
+        for flag, lake in zip(flags, lakes):
+            lake["clean"] = flag
         return features
 
+    @staticmethod
+    def _clean_lakes(lake_geoms, area_min, area_max, lake_river_max_dist, river_index):
+        """Returns whether each lake geometry is 'clean' (see :func:`lake_cleaner`)."""
+        flags = []
+        for lake_geom in lake_geoms:
+            flag = area_min <= lake_geom.area <= area_max
+            if flag and lake_river_max_dist != float("inf"):
+                flag = len(river_index.within_distance(lake_geom, lake_river_max_dist)) > 0
+            flags.append(flag)
+        return flags
+
     @staticmethod
     def lake_cropper(features, rasters_data, coverage, srs_target, px_size, skew, feature_buffer, parallel=False):
         """Returns the ROI information for a given feature (may be modified in derived classes)."""
-        srs_target_wkt = srs_target.ExportToWkt()
+        import thelper.data.geo as geo
+        # note: only the raster index is passed to workers, as raster metadata cannot be pickled
+        # note: the feature list and indices are only sent once to each worker process (if any)
+        clean_feat_idxs = [idx for idx, f in enumerate(features) if f["clean"]]
+        samples = geo.utils.map_chunks(TB15D104Dataset._crop_lakes, clean_feat_idxs, parallel=parallel,
+                                       desc="preparing crop regions", features=features,
+                                       feature_index=geo.utils.SpatialIndex([f["geometry"] for f in features]),
+                                       raster_index=rasters_data.index, px_size=px_size, skew=skew,
+                                       feature_buffer=feature_buffer, srs_target_wkt=srs_target.ExportToWkt())
+        return samples
 
-        def crop_feature(feature):
-            import thelper.data.geo as geo
+    @staticmethod
+    def _crop_lakes(lake_idxs, features, feature_index, raster_index, px_size, skew, feature_buffer, srs_target_wkt):
+        """Returns the crop sample of each (clean) lake feature, given by index (see :func:`lake_cropper`)."""
+        import thelper.data.geo as geo
+        samples = []
+        for feature in [features[idx] for idx in lake_idxs]:
             assert feature["clean"]  # should not get here with bad features
             roi, roi_tl, roi_br, crop_width, crop_height = \
                 geo.utils.get_feature_roi(feature["geometry"], px_size, skew, feature_buffer)
             roi_geotransform = (roi_tl[0], px_size[0], skew[0],
                                 roi_tl[1], skew[1], px_size[1])
             # test all raster regions that touch the selected feature
-            raster_hits = []
-            for raster_idx, raster_data in enumerate(rasters_data):
-                if raster_data["target_roi"].intersects(roi):
-                    raster_hits.append(raster_idx)
+            raster_hits = raster_index.intersects(roi)
             # make list of all other features that may be included in the roi
-            roi_centroid = feature["centroid"]
-            roi_radius = np.linalg.norm(np.asarray(roi_tl) - np.asarray(roi_br)) / 2
             roi_features, bboxes = [], []
             # note: the 'image id' is in fact the id of the focal feature in the crop
             image_id = int(feature["properties"]["OBJECTID"])
-            for f in features:
+            for f in [features[idx] for idx in feature_index.intersects(roi)]:
                 # note: here, f may not be 'clean', test anyway
-                if f["geometry"].distance(roi_centroid) > roi_radius:
-                    continue
-                inters = f["geometry"].intersection(roi)
-                if inters.is_empty:
-                    continue
                 roi_features.append(f)
                 if f["properties"]["TYPECE"] == TB15D104.TYPECE_RIVER:
                     continue
+                inters = f["geometry"].intersection(roi)
                 # only lakes can generate bboxes; make sure to clip them to the roi bounds
                 clip = f["clipped"] or not inters.equals(f["geometry"])
                 if clip:
@@ -171,7 +175,7 @@ class TB15D104Dataset(VectorCropDataset):
                                                                    truncated=clip,
                                                                    image_id=image_id))
             # prepare actual 'sample' for crop generation at runtime
-            return {
+            samples.append({
                 "features": roi_features,
                 "bboxes": bboxes,
                 "focal": feature,
@@ -184,22 +188,8 @@ class TB15D104Dataset(VectorCropDataset):
                 "crop_height": crop_height,
                 "geotransform": np.asarray(roi_geotransform),
                 "srs": srs_target_wkt,
-            }
-
-        clean_feats = [f for f in features if f["clean"]]
-        if parallel:
-            if not isinstance(parallel, int):
-                import multiprocessing
-                parallel = multiprocessing.cpu_count()
-            assert parallel > 0, "unexpected min core count"
-            import joblib
-            samples = joblib.Parallel(n_jobs=parallel)(joblib.delayed(
-                crop_feature)(feat) for feat in tqdm.tqdm(clean_feats, desc="preparing crop regions"))
-        else:
-            samples = []
-            for feature in tqdm.tqdm(clean_feats, desc="validating crop candidates"):
-                samples.append(crop_feature(feature))
-        return [s for s in samples if s is not None]
+            })
+        return samples
 
     def _show_stats_plots(self, show=False, block=False):
         """Draws and returns feature stats histograms using pyplot."""
@@ -234,7 +224,7 @@ class TB15D104Dataset(VectorCropDataset):
         if idx < 0:
             idx = len(self.samples) + idx
         sample = self.samples[idx]
-        crop, mask = self._process_crop(sample)
+        crop, mask = self._process_crop(sample, idx)
         assert crop.shape[2] == 1, "unexpected lidar raster band count"
         crop = crop[:, :, 0]
         dmap = cv.distanceTransform(np.where(mask, np.uint8(0), np.uint8(255)), cv.DIST_L2, cv.DIST_MASK_PRECISE)
@@ -253,6 +243,8 @@ class TB15D104Dataset(VectorCropDataset):
             "hydro": mask,
             **sample
         }
+        for b in sample["bboxes"]:
+            b.task = self.task
         if self.transforms:
             sample = self.transforms(sample)
         return sample
@@ -265,7 +257,8 @@ class TB15D104TileDataset(TileDataset):
                  px_size=None, allow_outlying_vectors=True, clip_outlying_vectors=True,
                  lake_area_min=0.0, lake_area_max=float("inf"), master_roi=None, srs_target="3857",
                  force_parse=False, reproj_rasters=False, reproj_all_cpus=True, display_debug=False,
-                 keep_rasters_open=True, parallel=False, transforms=None):
+                 keep_rasters_open=True, parallel=False, fast_crops=False, cache_crops=False,
+                 cache_format="columnar", raster_mosaic=False, transforms=None):
         assert px_size is None or isinstance(px_size, (float, int)), "pixel size (resolution) must be float/int"
         px_size = (1.0, 1.0) if px_size is None else (float(px_size), float(px_size))
         # note: we wrap partial static functions for caching to see when internal parameters are changing
@@ -278,7 +271,9 @@ class TB15D104TileDataset(TileDataset):
                          vector_area_max=lake_area_max, vector_target_prop=None, master_roi=master_roi,
                          srs_target=srs_target, raster_key="lidar", mask_key="hydro", cleaner=cleaner,
                          force_parse=force_parse, reproj_rasters=reproj_rasters, reproj_all_cpus=reproj_all_cpus,
-                         keep_rasters_open=keep_rasters_open, transforms=transforms)
+                         keep_rasters_open=keep_rasters_open, fast_crops=fast_crops, cache_crops=cache_crops,
+                         cache_format=cache_format, raster_mosaic=raster_mosaic, parallel=parallel,
+                         transforms=transforms)
         meta_keys = self.task.meta_keys
         self.task = thelper.tasks.Detection(class_names={"background": TB15D104.BACKGROUND_ID, "lake": TB15D104.LAKE_ID},
                                             input_key="input", bboxes_key="bboxes",
@@ -295,7 +290,7 @@ class TB15D104TileDataset(TileDataset):
         if idx < 0:
             idx = len(self.samples) + idx
         sample = self.samples[idx]
-        crop, mask = self._process_crop(sample)
+        crop, mask = self._process_crop(sample, idx)
         assert crop.shape[2] == 1, "unexpected lidar raster band count"
         crop = crop[:, :, 0]
         dmap = cv.distanceTransform(np.where(mask, np.uint8(0), np.uint8(255)), cv.DIST_L2, cv.DIST_MASK_PRECISE)
@@ -10,7 +10,6 @@ import pickle
 import cv2 as cv
 import gdal
 import numpy as np
-import ogr
 import osr
 import shapely
 import torch
@@ -25,7 +24,22 @@ logger = logging.getLogger(__name__)
 
 
 class VectorCropDataset(Dataset):
-    """Abstract dataset used to combine geojson vector data and rasters."""
+    """Abstract dataset used to combine geojson vector data and rasters.
+
+    With ``fast_crops=True``, feature masks made of polygons are rasterized with OpenCV instead of GDAL (this
+    approximates GDAL's ``ALL_TOUCHED`` rasterization), and rasters that are already aligned with the crop grid
+    (same SRS and pixel size, no skew) are read via windowed reads instead of being warped. With
+    ``cache_crops=True``, all crops and masks are precomputed once and stored in a chunked HDF5 archive next to
+    the vector file so that no GDAL operation is needed at runtime (i.e. in loader workers).
+
+    Parsed features and crops are cached next to the vector file as well; by default, the columnar format of
+    :mod:`thelper.data.geo.cache` is used, and the samples are then memory-mapped views that decode lazily.
+
+    Rasters are kept in a catalogue (see :class:`thelper.data.geo.utils.RasterCatalog`) that indexes their
+    footprints; their metadata is cached next to the vector file, and can be read in parallel (``parallel``).
+    With ``raster_mosaic=True``, a GDAL VRT mosaic of all rasters is also built so that crops which touch
+    several rasters can be read (or warped) once from the mosaic instead of once per raster.
+    """
 
     def __init__(self, raster_path, vector_path, px_size=None, skew=None,
                  allow_outlying_vectors=True, clip_outlying_vectors=True,
@@ -34,11 +48,15 @@ class VectorCropDataset(Dataset):
                  srs_target="3857", raster_key="raster", mask_key="mask",
                  cleaner=None, cropper=None, force_parse=False,
                  reproj_rasters=False, reproj_all_cpus=True,
-                 keep_rasters_open=True, transforms=None):
+                 keep_rasters_open=True, fast_crops=False, cache_crops=False,
+                 cache_format="columnar", raster_mosaic=False, parallel=False, transforms=None):
         import thelper.data.geo as geo
         # before anything else, create a hash to cache parsed data
-        cache_hash = thelper.utils.get_params_hash(
-            {k: v for k, v in vars().items() if not k.startswith("_") and k != "self"}) if not force_parse else None
+        # note: runtime-only flags do not change the parsed data, so they are kept out of the hash
+        params_hash = thelper.utils.get_params_hash(
+            {k: v for k, v in vars().items() if not k.startswith("_") and
+             k not in ["self", "fast_crops", "cache_crops", "cache_format", "raster_mosaic", "parallel"]})
+        cache_hash = params_hash if not force_parse else None
         assert isinstance(raster_path, str), "raster file/folder path should be given as string"
         assert isinstance(vector_path, str), "vector file/folder path should be given as string"
         self.raster_path = raster_path
@@ -59,12 +77,18 @@ class VectorCropDataset(Dataset):
         assert isinstance(reproj_rasters, bool), "unexpected flag type"
         assert isinstance(reproj_all_cpus, bool), "unexpected flag type"
         assert isinstance(keep_rasters_open, bool), "unexpected flag type"
+        assert isinstance(fast_crops, bool), "unexpected flag type"
+        assert isinstance(cache_crops, bool), "unexpected flag type"
+        assert cache_format in ["columnar", "pickle"], f"unexpected cache format '{cache_format}'"
+        assert isinstance(raster_mosaic, bool), "unexpected flag type"
         self.allow_outlying = allow_outlying_vectors
         self.clip_outlying = clip_outlying_vectors
         self.force_parse = force_parse
         self.reproj_rasters = reproj_rasters
         self.reproj_all_cpus = reproj_all_cpus
         self.keep_rasters_open = keep_rasters_open
+        self.fast_crops = fast_crops
+        self.cache_format = cache_format
         assert isinstance(vector_area_min, (float, int)) and vector_area_min >= 0, \
             "min surface filter value must be > 0"
         assert isinstance(vector_area_max, (float, int)) and vector_area_max >= vector_area_min, \
@@ -96,18 +120,34 @@ class VectorCropDataset(Dataset):
         assert isinstance(mask_key, str), "mask key must be given as string"
         self.mask_key = mask_key
         super().__init__(transforms=transforms)
-        self.rasters_data, self.coverage = self._parse_rasters(self.raster_path, self.srs_target, reproj_rasters)
+        cache_dir = os.path.dirname(self.vector_path)
+        self.rasters_data, self.coverage = self._parse_rasters(self.raster_path, self.srs_target, reproj_rasters,
+                                                               cache_dir=cache_dir if not force_parse else None,
+                                                               parallel=parallel)
+        if raster_mosaic:
+            raster_paths = [r["file_path"] for r in self.rasters_data]
+            vrt_path = os.path.join(cache_dir, thelper.utils.get_params_hash(
+                [os.path.abspath(p) for p in raster_paths], [os.path.getmtime(p) for p in raster_paths],
+                reproj_rasters) + ".mosaic.vrt")
+            if force_parse and os.path.exists(vrt_path):
+                os.remove(vrt_path)
+            self.rasters_data.mosaic = geo.utils.build_vrt_mosaic(self.rasters_data, vrt_path, self.srs_target)
         if self.master_roi is not None:
             self.coverage = self.coverage.intersection(self.master_roi)
         if cleaner is None:
             cleaner = functools.partial(self._default_feature_cleaner, area_min=self.area_min,
                                         area_max=self.area_max, target_prop=self.target_prop)
         self.features = self._parse_features(self.vector_path, self.srs_target, self.coverage, cache_hash,
-                                             self.allow_outlying, self.clip_outlying, cleaner)
+                                             self.allow_outlying, self.clip_outlying, cleaner, cache_format)
         if cropper is None:
             cropper = functools.partial(self._default_feature_cropper, px_size=self.px_size,
                                         skew=self.skew, feature_buffer=self.feature_buffer)
         self.samples = self._parse_crops(cropper, self.vector_path, cache_hash)
+        self.crop_cache_path, self.crop_cache_offsets = None, None
+        self.crop_cache_handle, self.crop_cache_pid = None, None
+        if cache_crops:
+            self.crop_cache_path = os.path.join(os.path.dirname(self.vector_path), params_hash + ".crops.h5")
+            self.crop_cache_offsets = self._cache_crops(self.crop_cache_path, force_parse)
         # all keys already in sample dicts should be 'meta'; mask & raster will be added later
         meta_keys = list(set([k for s in self.samples for k in s]))
         if self.mask_key not in meta_keys:
@@ -138,19 +178,17 @@ class VectorCropDataset(Dataset):
         samples = []
         clean_feats = [f for f in features if f["clean"]]
         srs_target_wkt = srs_target.ExportToWkt()
+        feature_index = geo.utils.SpatialIndex([f["geometry"] for f in features])
         for feature in tqdm.tqdm(clean_feats, desc="validating crop candidates"):
             assert feature["clean"]  # should not get here with bad features
             roi, roi_tl, roi_br, crop_width, crop_height = \
                 geo.utils.get_feature_roi(feature["geometry"], px_size, skew, feature_buffer)
             # test all raster regions that touch the selected feature
-            raster_hits = []
-            for raster_idx, raster_data in enumerate(rasters_data):
-                if raster_data["target_roi"].intersects(roi):
-                    raster_hits.append(raster_idx)
+            raster_hits = rasters_data.intersects(roi)
             # make list of all other features that may be included in the roi
             roi_radius = np.linalg.norm(np.asarray(roi_tl) - np.asarray(roi_br)) / 2
-            roi_features = [f for f in features if feature["centroid"].distance(f["centroid"]) <= roi_radius and
-                            f["geometry"].intersects(roi)]
+            roi_features = [features[idx] for idx in feature_index.intersects(roi)
+                            if feature["centroid"].distance(features[idx]["centroid"]) <= roi_radius]
             # prepare actual 'sample' for crop generation at runtime
             samples.append({
                 "features": roi_features,
@@ -168,12 +206,17 @@ class VectorCropDataset(Dataset):
         return samples
 
     @staticmethod
-    def _parse_rasters(path, srs, reproj_rasters):
-        """Parses rasters (geotiffs) and returns metadata/coverage information."""
+    def _parse_rasters(path, srs, reproj_rasters, cache_dir=None, parallel=False):
+        """Parses rasters (geotiffs) and returns a raster catalogue along with the coverage information.
+
+        If a cache directory is given, the metadata of each raster is cached there so that it does not need to
+        be read again. Metadata can also be read in parallel, which helps with large catalogues of rasters.
+        """
         import thelper.data.geo as geo
         logger.info(f"parsing rasters from path '{path}'...")
         raster_paths = thelper.utils.get_file_paths(path, ".", allow_glob=True)
-        rasters_data, coverage = geo.utils.parse_rasters(raster_paths, srs, reproj_rasters)
+        rasters_data, coverage = geo.utils.parse_rasters(raster_paths, srs, reproj_rasters,
+                                                         cache_dir=cache_dir, parallel=parallel)
         assert rasters_data, f"could not find any usable rasters at '{raster_paths}'"
         logger.debug(f"rasters total coverage area = {coverage.area:.2f}")
         for idx, data in enumerate(rasters_data):
@@ -187,21 +230,26 @@ class VectorCropDataset(Dataset):
                 f"(found {str(data['data_type'])} and {str(rasters_data[0]['data_type'])})"
             data["to_target_transform"] = osr.CoordinateTransformation(data["srs"], srs)
             data["from_target_transform"] = osr.CoordinateTransformation(srs, data["srs"])
-        return rasters_data, coverage
+        return geo.utils.RasterCatalog(rasters_data), coverage
 
     @staticmethod
-    def _parse_features(path, srs, roi, cache_hash, allow_outlying, clip_outlying, cleaner):
+    def _parse_features(path, srs, roi, cache_hash, allow_outlying, clip_outlying, cleaner, cache_format="columnar"):
         """Parses vector files (geojsons) and returns geometry information."""
         import thelper.data.geo as geo
         logger.info(f"parsing vectors from path '{path}'...")
         assert os.path.isfile(path) and path.endswith("geojson"), \
             "vector file must be provided as geojson (shapefile support still incomplete)"
-        cache_file_path = os.path.join(os.path.dirname(path), cache_hash + ".feats.pkl") \
-            if cache_hash else None
-        if cache_file_path is not None and os.path.exists(cache_file_path):
+        assert cache_format in ["columnar", "pickle"], f"unexpected cache format '{cache_format}'"
+        cache_file_path = os.path.join(os.path.dirname(path), cache_hash + (
+            ".feats" if cache_format == "columnar" else ".feats.pkl")) if cache_hash else None
+        if cache_file_path is not None and os.path.exists(cache_file_path) and \
+                (cache_format != "columnar" or geo.cache.is_columnar_cache(cache_file_path)):
             logger.debug(f"parsing cached feature data from '{cache_file_path}'...")
-            with open(cache_file_path, "rb") as fd:
-                features = pickle.load(fd)
+            if cache_format == "columnar":
+                features = list(geo.cache.ColumnarTable(cache_file_path))
+            else:
+                with open(cache_file_path, "rb") as fd:
+                    features = pickle.load(fd)
         else:
             with open(path) as vector_fd:
                 vector_data = json.load(vector_fd)
@@ -210,59 +258,148 @@ class VectorCropDataset(Dataset):
             features = cleaner(features)
             if cache_file_path is not None:
                 logger.debug(f"caching clean data to '{cache_file_path}'...")
-                with open(cache_file_path, "wb") as fd:
-                    pickle.dump(features, fd)
+                if cache_format == "columnar":
+                    geo.cache.write_columnar_cache(cache_file_path, features)
+                else:
+                    with open(cache_file_path, "wb") as fd:
+                        pickle.dump(features, fd)
         logger.debug(f"cleanup resulted in {len([f for f in features if f['clean']])} features of interest")
         return features
 
     def _parse_crops(self, cropper, cache_file_path, cache_hash):
         """Parses crops based on prior feature/raster data.
 
-        Each 'crop' corresponds to a sample that can be loaded at runtime.
+        Each 'crop' corresponds to a sample that can be loaded at runtime. With the columnar cache format,
+        the returned samples are lightweight views over the (memory-mapped) cache, and reference the features.
         """
+        import thelper.data.geo as geo
         logger.info("preparing crops...")
-        cache_file_path = os.path.join(os.path.dirname(cache_file_path), cache_hash + ".crops.pkl") \
-            if cache_hash else None
-        if cache_file_path is not None and os.path.exists(cache_file_path):
+        cache_file_path = os.path.join(os.path.dirname(cache_file_path), cache_hash + (
+            ".crops" if self.cache_format == "columnar" else ".crops.pkl")) if cache_hash else None
+        if cache_file_path is not None and os.path.exists(cache_file_path) and \
+                (self.cache_format != "columnar" or geo.cache.is_columnar_cache(cache_file_path)):
             logger.debug(f"parsing cached crop data from '{cache_file_path}'...")
-            with open(cache_file_path, "rb") as fd:
-                samples = pickle.load(fd)
+            if self.cache_format == "columnar":
+                samples = geo.cache.ColumnarTable(cache_file_path, links=self.features)
+            else:
+                with open(cache_file_path, "rb") as fd:
+                    samples = pickle.load(fd)
         else:
             samples = cropper(self.features, self.rasters_data, self.coverage, self.srs_target)
             if cache_file_path is not None:
                 logger.debug(f"caching crop data to '{cache_file_path}'...")
-                with open(cache_file_path, "wb") as fd:
-                    pickle.dump(samples, fd)
+                if self.cache_format == "columnar":
+                    geo.cache.write_columnar_cache(cache_file_path, samples, links=self.features)
+                    samples = geo.cache.ColumnarTable(cache_file_path, links=self.features)
+                else:
+                    with open(cache_file_path, "wb") as fd:
+                        pickle.dump(samples, fd)
         return samples
 
-    def _process_crop(self, sample):
-        """Returns a crop for a specific (internal) set of sampled features."""
+    def _cache_crops(self, cache_file_path, force_parse):
+        """Precomputes all crops along with their rasterized masks, and stores them in a chunked HDF5 archive.
+
+        All crops and masks are flattened and concatenated in the archive datasets; the returned offsets
+        array is used to locate each sample in these datasets at runtime. Once this cache is ready, no GDAL
+        operation is performed while loading samples, meaning the dataset can be used in many loader workers.
+        """
+        import h5py
         import thelper.data.geo as geo
+        crop_sizes = np.asarray([s["crop_height"] * s["crop_width"] for s in self.samples], dtype=np.int64)
+        offsets = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(crop_sizes)])
+        if not force_parse and os.path.exists(cache_file_path):
+            with h5py.File(cache_file_path, "r") as fd:
+                if fd.attrs.get("complete", False) and np.array_equal(fd["offsets"][()], offsets):
+                    logger.debug(f"using cached crop data from '{cache_file_path}'...")
+                    return offsets
+        logger.info(f"caching crop data to '{cache_file_path}'...")
+        crop_datatype = geo.utils.GDAL2NUMPY_TYPE_CONV[self.rasters_data[0]["data_type"]]
+        band_count = self.rasters_data[0]["band_count"]
+        # chunks are sized to fit the largest crop so that each sample is read by touching at most two chunks
+        chunk_len = int(crop_sizes.max()) if len(crop_sizes) else 0
+        with h5py.File(cache_file_path, "w") as fd:
+            fd.attrs["complete"] = False
+            fd.create_dataset("offsets", data=offsets)
+            crop_dset = fd.create_dataset("crop", shape=(offsets[-1], band_count), dtype=crop_datatype,
+                                          chunks=(chunk_len, band_count) if chunk_len else None)
+            nodata_dset = fd.create_dataset("nodata", shape=(offsets[-1], band_count), dtype=bool,
+                                            chunks=(chunk_len, band_count) if chunk_len else None)
+            mask_dset = fd.create_dataset("mask", shape=(offsets[-1],), dtype=np.uint8,
+                                          chunks=(chunk_len,) if chunk_len else None)
+            for idx, sample in enumerate(tqdm.tqdm(self.samples, desc="caching crops")):
+                crop, mask = self._process_crop(sample)
+                crop_dset[offsets[idx]:offsets[idx + 1]] = crop.data.reshape(-1, band_count)
+                nodata_dset[offsets[idx]:offsets[idx + 1]] = np.ma.getmaskarray(crop).reshape(-1, band_count)
+                mask_dset[offsets[idx]:offsets[idx + 1]] = mask.reshape(-1)
+            fd.attrs["complete"] = True
+        return offsets
+
+    def _load_cached_crop(self, idx):
+        """Returns a precomputed crop and mask from the HDF5 crop cache (see ``cache_crops``)."""
+        import h5py
+        if self.crop_cache_handle is None or self.crop_cache_pid != os.getpid():
+            # note: hdf5 handles cannot be shared across processes, so each loader worker opens its own
+            self.crop_cache_handle = h5py.File(self.crop_cache_path, "r")
+            self.crop_cache_pid = os.getpid()
+        sample = self.samples[idx]
+        begin, end = self.crop_cache_offsets[idx], self.crop_cache_offsets[idx + 1]
+        crop_size = (sample["crop_height"], sample["crop_width"], self.rasters_data[0]["band_count"])
+        crop = np.ma.array(self.crop_cache_handle["crop"][begin:end].reshape(crop_size),
+                           mask=self.crop_cache_handle["nodata"][begin:end].reshape(crop_size))
+        mask = self.crop_cache_handle["mask"][begin:end].reshape(crop_size[0:2])
+        return crop, mask
+
+    def __getstate__(self):
+        """Returns the picklable state of this dataset (used when it is copied to loader workers)."""
+        state = self.__dict__.copy()
+        state["crop_cache_handle"], state["crop_cache_pid"] = None, None
+        return state
+
+    def _process_crop(self, sample, idx=None):
+        """Returns a crop for a specific (internal) set of sampled features.
+
+        If the sample index is given and crops were cached beforehand, the crop is loaded from the cache.
+        """
+        import thelper.data.geo as geo
+        if idx is not None and self.crop_cache_path is not None:
+            return self._load_cached_crop(idx)
         # remember: we assume that all rasters have the same intrinsic settings
         crop_datatype = geo.utils.GDAL2NUMPY_TYPE_CONV[self.rasters_data[0]["data_type"]]
         crop_size = (sample["crop_height"], sample["crop_width"], self.rasters_data[0]["band_count"])
         crop = np.ma.array(np.zeros(crop_size, dtype=crop_datatype), mask=np.ones(crop_size, dtype=np.uint8))
-        mask = np.zeros(crop_size[0:2], dtype=np.uint8)
+        mosaic = getattr(self.rasters_data, "mosaic", None)
+        if self.fast_crops:
+            # fast path: rasterize with opencv, and use windowed reads if all rasters are already aligned
+            mask = geo.utils.rasterize_geometries([f["geometry"] for f in sample["features"]],
+                                                  sample["geotransform"], crop_size[1], crop_size[0])
+            raster_windows = [geo.utils.get_crop_window(self.rasters_data[raster_idx], sample["geotransform"],
+                                                        self.srs_target) for raster_idx in sample["raster_hits"]]
+            if mosaic is not None and (len(raster_windows) > 1 or not all([w is not None for w in raster_windows])):
+                # crops that touch several rasters are served by a single windowed read in the mosaic, if possible
+                mosaic_window = geo.utils.get_crop_window(mosaic, sample["geotransform"], self.srs_target)
+                if mosaic_window is not None:
+                    rasterfile = geo.utils.open_rasterfile(mosaic, keep_rasters_open=self.keep_rasters_open)
+                    geo.utils.read_crop_window(rasterfile, mosaic_window, crop)
+                    return crop, mask
+            if all([w is not None for w in raster_windows]):
+                for raster_idx, window in zip(sample["raster_hits"], raster_windows):
+                    rasterfile = geo.utils.open_rasterfile(self.rasters_data[raster_idx],
+                                                           keep_rasters_open=self.keep_rasters_open)
+                    geo.utils.read_crop_window(rasterfile, window, crop)
+                return crop, mask
+        else:
+            mask = geo.utils.rasterize_geometries_gdal([f["geometry"] for f in sample["features"]],
+                                                       sample["geotransform"], crop_size[1], crop_size[0],
+                                                       srs=self.srs_target)
         crop_raster_gdal = gdal.GetDriverByName("MEM").Create("", crop_size[1], crop_size[0],
                                                               crop_size[2], self.rasters_data[0]["data_type"])
         crop_raster_gdal.SetGeoTransform(sample["geotransform"])
         crop_raster_gdal.SetProjection(self.srs_target.ExportToWkt())
-        crop_mask_gdal = gdal.GetDriverByName("MEM").Create("", crop_size[1], crop_size[0], 1, gdal.GDT_Byte)
-        crop_mask_gdal.SetGeoTransform(sample["geotransform"])
-        crop_mask_gdal.SetProjection(self.srs_target.ExportToWkt())
-        crop_mask_gdal.GetRasterBand(1).WriteArray(np.zeros(crop_size[0:2], dtype=np.uint8))
-        ogr_dataset = ogr.GetDriverByName("Memory").CreateDataSource("mask")
-        ogr_layer = ogr_dataset.CreateLayer("feature_mask", srs=self.srs_target)
-        for feature in sample["features"]:
-            ogr_feature = ogr.Feature(ogr_layer.GetLayerDefn())
-            ogr_geometry = ogr.CreateGeometryFromWkt(feature["geometry"].wkt)
-            ogr_feature.SetGeometry(ogr_geometry)
-            ogr_layer.CreateFeature(ogr_feature)
-        gdal.RasterizeLayer(crop_mask_gdal, [1], ogr_layer, burn_values=[1], options=["ALL_TOUCHED=TRUE"])
-        np.copyto(dst=mask, src=crop_mask_gdal.GetRasterBand(1).ReadAsArray())
-        for raster_idx in sample["raster_hits"]:
-            rasterfile = geo.utils.open_rasterfile(self.rasters_data[raster_idx],
-                                                   keep_rasters_open=self.keep_rasters_open)
+        # if a mosaic is available, the crop is warped once from it instead of once per raster
+        raster_hits = [self.rasters_data[raster_idx] for raster_idx in sample["raster_hits"]] \
+            if mosaic is None or len(sample["raster_hits"]) <= 1 else [mosaic]
+        for raster_data in raster_hits:
+            rasterfile = geo.utils.open_rasterfile(raster_data, keep_rasters_open=self.keep_rasters_open)
             assert rasterfile.RasterCount == crop_size[2], "unexpected raster count"
             # using all cpus should be ok since we probably cant parallelize this loader anyway (swig serialization issues)
             options = ["NUM_THREADS=ALL_CPUS"] if self.reproj_all_cpus else []
@@ -273,12 +410,9 @@ class VectorCropDataset(Dataset):
                 flag_mask = curr_band_array != curr_band.GetNoDataValue()
                 np.copyto(dst=crop.data[:, :, raster_band_idx], src=curr_band_array, where=flag_mask)
                 np.bitwise_and(crop.mask[:, :, raster_band_idx], np.invert(flag_mask), out=crop.mask[:, :, raster_band_idx])
-        # ogr_dataset = None  # noqa # close local fd
         # noinspection PyUnusedLocal
         crop_raster_gdal = None  # noqa # close local fd
         # noinspection PyUnusedLocal
-        crop_mask_gdal = None  # noqa # close local fd
-        # noinspection PyUnusedLocal
         rasterfile = None  # noqa # close input fd
         return crop, mask
 
@@ -290,7 +424,7 @@ class VectorCropDataset(Dataset):
         if idx < 0:
             idx = len(self.samples) + idx
         sample = self.samples[idx]
-        crop, mask = self._process_crop(sample)
+        crop, mask = self._process_crop(sample, idx)
         if self.display_debug:
             crop = cv.cvtColor(crop, cv.COLOR_GRAY2BGR)
             mask = cv.cvtColor(mask, cv.COLOR_GRAY2BGR)
@@ -318,10 +452,14 @@ class TileDataset(VectorCropDataset):
                  vector_target_prop=None, master_roi=None, srs_target="3857",
                  raster_key="raster", mask_key="mask", cleaner=None,
                  force_parse=False, reproj_rasters=False,
-                 reproj_all_cpus=True, keep_rasters_open=True, transforms=None):
+                 reproj_all_cpus=True, keep_rasters_open=True,
+                 fast_crops=False, cache_crops=False, cache_format="columnar",
+                 raster_mosaic=False, parallel=None, transforms=None):
         # note1: input 'tile_size' must be given in pixels
         # note2: input 'tile_overlap' must be given in pixels
         # note3: input 'px_size' must be given in meters/degrees
+        # note4: by default ('parallel=None'), only the validation of nodata tiles (i.e. the reprojection of all
+        #        tile candidates, which is by far the slowest step) is dispatched to a pool of processes
         if isinstance(tile_size, (float, int)):
             tile_size = (tile_size, tile_size)
         assert isinstance(tile_size, (tuple, list)) and len(tile_size) == 2, \
@@ -335,17 +473,54 @@ class TileDataset(VectorCropDataset):
         assert isinstance(skip_nodata_tiles, bool), "unexpected flag type (should be bool)"
         cropper = functools.partial(self._tile_cropper, tile_size=tile_size, tile_overlap=tile_overlap,
                                     skip_empty_tiles=skip_empty_tiles, skip_nodata_tiles=skip_nodata_tiles,
-                                    keep_rasters_open=keep_rasters_open, px_size=px_size)
+                                    keep_rasters_open=keep_rasters_open, px_size=px_size, parallel=parallel,
+                                    cache_dir=os.path.dirname(vector_path))
         super().__init__(raster_path=raster_path, vector_path=vector_path, px_size=px_size, skew=None,
                          allow_outlying_vectors=allow_outlying_vectors, clip_outlying_vectors=clip_outlying_vectors,
                          vector_area_min=vector_area_min, vector_area_max=vector_area_max, vector_target_prop=vector_target_prop,
                          master_roi=master_roi, srs_target=srs_target, raster_key=raster_key, mask_key=mask_key,
                          cleaner=cleaner, cropper=cropper, force_parse=force_parse, reproj_rasters=reproj_rasters,
-                         reproj_all_cpus=reproj_all_cpus, keep_rasters_open=keep_rasters_open, transforms=transforms)
+                         reproj_all_cpus=reproj_all_cpus, keep_rasters_open=keep_rasters_open,
+                         fast_crops=fast_crops, cache_crops=cache_crops, cache_format=cache_format,
+                         raster_mosaic=raster_mosaic, parallel=parallel, transforms=transforms)
+
+    @staticmethod
+    def _validate_tiles(tiles, rasters_data, srs_target, tile_size, parallel=False, cache_dir=None):
+        """Returns the subset of tiles that overlap valid (non-nodata) raster data.
+
+        Tiles are first tested against a low-resolution validity mask of each raster (built once, and cached
+        if possible), which rejects most empty tiles without any reprojection. The remaining tiles are then
+        reprojected and checked exactly, possibly in a pool of processes.
+        """
+        import thelper.data.geo as geo
+        raster_paths = [r["reproj_path"] if r["reproj_path"] is not None else r["file_path"] for r in rasters_data]
+        hit_raster_idxs = sorted(set([raster_idx for tile in tiles for raster_idx in tile["raster_hits"]]))
+        masks = geo.utils.get_validity_masks([raster_paths[idx] for idx in hit_raster_idxs],
+                                             cache_dir=cache_dir, parallel=parallel)
+        tile_bboxes = np.asarray([tile["roi"].bounds for tile in tiles])
+        maybe_valid = np.zeros((len(tiles), len(rasters_data)), dtype=bool)
+        for raster_idx, (mask, mask_geotransform) in zip(hit_raster_idxs, masks):
+            tile_idxs = np.asarray([idx for idx, tile in enumerate(tiles) if raster_idx in tile["raster_hits"]])
+            # note: reprojected rasters are already in the target srs, so their bboxes need no transform
+            srs_transform = rasters_data[raster_idx]["from_target_transform"] \
+                if rasters_data[raster_idx]["reproj_path"] is None else None
+            bboxes = geo.utils.transform_bboxes(tile_bboxes[tile_idxs], srs_transform)
+            maybe_valid[tile_idxs, raster_idx] = geo.utils.get_validity_hits(mask, mask_geotransform, bboxes)
+        candidates = [(idx, tile) for idx, tile in enumerate(tiles) if maybe_valid[idx].any()]
+        logger.debug(f"validity masks rejected {len(tiles) - len(candidates)} tiles out of {len(tiles)}")
+        flags = geo.utils.map_chunks(
+            geo.utils.check_tiles_data,
+            [(tile["geotransform"], [raster_paths[r] for r in tile["raster_hits"] if maybe_valid[idx, r]])
+             for idx, tile in candidates],
+            parallel=parallel, desc="validating crop candidates", tile_size=tile_size,
+            data_type=rasters_data[0]["data_type"], band_count=rasters_data[0]["band_count"],
+            srs_target_wkt=srs_target.ExportToWkt())
+        return [tile for (_, tile), flag in zip(candidates, flags) if flag]
 
     @staticmethod
     def _tile_cropper(features, rasters_data, coverage, srs_target, tile_size, tile_overlap,
-                      skip_empty_tiles, skip_nodata_tiles, keep_rasters_open, px_size):
+                      skip_empty_tiles, skip_nodata_tiles, keep_rasters_open, px_size, parallel=False,
+                      cache_dir=None):
         """Returns the ROI information for a given feature (may be modified in derived classes)."""
         import thelper.data.geo as geo
         # instead of iterating over features to generate samples, we tile the raster(s)
@@ -353,21 +528,12 @@ class TileDataset(VectorCropDataset):
         roi_tl, roi_br = geo.utils.get_feature_bbox(coverage)
         roi_geotransform = (roi_tl[0], px_size[0], 0.0,
                             roi_tl[1], 0.0, px_size[1])
-        srs_target_wkt = srs_target.ExportToWkt()
-        # remember: we assume that all rasters have the same intrinsic settings
-        crop_datatype = geo.utils.GDAL2NUMPY_TYPE_CONV[rasters_data[0]["data_type"]]
-        crop_raster_gdal = gdal.GetDriverByName("MEM").Create("",
-                                                              int(round(tile_size[1])),
-                                                              int(round(tile_size[0])),
-                                                              rasters_data[0]["band_count"],
-                                                              rasters_data[0]["data_type"])
-        crop_raster_gdal.SetProjection(srs_target_wkt)
-        samples = []
+        tiles = []
         crop_id = 0
         roi_px_br = geo.utils.get_pxcoord(roi_geotransform, *roi_br)
         nb_iter_y = int(math.ceil((roi_px_br[1] + tile_overlap) / (tile_size[1] - tile_overlap)))
         nb_iter_x = int(math.ceil((roi_px_br[0] + tile_overlap) / (tile_size[0] - tile_overlap)))
-        pbar = tqdm.tqdm(total=nb_iter_y * nb_iter_x, desc="validating crop candidates")
+        pbar = tqdm.tqdm(total=nb_iter_y * nb_iter_x, desc="generating crop candidates")
         roi_offset_px_y = -tile_overlap
         while roi_offset_px_y < roi_px_br[1]:
             roi_offset_px_x = -tile_overlap
@@ -381,47 +547,33 @@ class TileDataset(VectorCropDataset):
                                                       crop_br, (crop_tl[0], crop_br[1])])
                 crop_geotransform = (crop_tl[0], px_size[0], 0.0,
                                      crop_tl[1], 0.0, px_size[1])
-                crop_raster_gdal.SetGeoTransform(crop_geotransform)
-                raster_hits = []
-                found_valid_intersection = False or not skip_nodata_tiles
-                for raster_idx, raster_data in enumerate(rasters_data):
-                    if raster_data["target_roi"].intersects(crop_geom):
-                        if not found_valid_intersection:
-                            rasterfile = geo.utils.open_rasterfile(raster_data, keep_rasters_open=keep_rasters_open)
-                            # yeah, we reproject the crop, preprocessing is slow, deal with it
-                            geo.utils.reproject_crop(rasterfile, crop_raster_gdal, tile_size, crop_datatype, fill_nodata=True)
-                            for raster_band_idx in range(crop_raster_gdal.RasterCount):
-                                curr_band = crop_raster_gdal.GetRasterBand(raster_band_idx + 1)
-                                found_valid_intersection = found_valid_intersection or \
-                                    np.count_nonzero(curr_band.ReadAsArray() != curr_band.GetNoDataValue()) > 0
-                        raster_hits.append(raster_idx)
-                if raster_hits and found_valid_intersection:
-                    crop_centroid = crop_geom.centroid
-                    crop_radius = np.linalg.norm(np.asarray(crop_tl) - np.asarray(crop_br)) / 2
-                    crop_features = []
-                    for f in features:
-                        if f["geometry"].distance(crop_centroid) > crop_radius:
-                            continue
-                        inters = f["geometry"].intersection(crop_geom)
-                        if inters.is_empty:
-                            continue
-                        crop_features.append(f)
-                    if crop_features or not skip_empty_tiles:
-                        # prepare actual 'sample' for crop generation at runtime
-                        samples.append({
-                            "features": crop_features,
-                            "id": crop_id,
-                            "roi": crop_geom,
-                            "roi_tl": crop_tl,
-                            "roi_br": crop_br,
-                            "raster_hits": raster_hits,
-                            "crop_width": int(round(tile_size[0])),
-                            "crop_height": int(round(tile_size[1])),
-                            "geotransform": np.asarray(crop_geotransform),
-                        })
+                raster_hits = rasters_data.intersects(crop_geom)
+                if raster_hits:
+                    tiles.append({
+                        "id": crop_id,
+                        "roi": crop_geom,
+                        "roi_tl": crop_tl,
+                        "roi_br": crop_br,
+                        "raster_hits": raster_hits,
+                        "crop_width": int(round(tile_size[0])),
+                        "crop_height": int(round(tile_size[1])),
+                        "geotransform": np.asarray(crop_geotransform),
+                    })
                 crop_id += 1
                 roi_offset_px_x += tile_size[0] - tile_overlap
             roi_offset_px_y += tile_size[1] - tile_overlap
+        if skip_nodata_tiles and tiles:
+            tiles = TileDataset._validate_tiles(tiles, rasters_data, srs_target, tile_size,
+                                                parallel if parallel is not None else True, cache_dir)
+        # once all valid tiles are known, we look up their features via the spatial index (can be done in parallel)
+        feature_index = geo.utils.SpatialIndex([f["geometry"] for f in features])
+        tiles_feature_idxs = geo.utils.query_intersections(feature_index, [t["roi"] for t in tiles], parallel=parallel,
+                                                           desc="looking up crop features")
+        samples = []
+        for tile, feature_idxs in zip(tiles, tiles_feature_idxs):
+            if feature_idxs or not skip_empty_tiles:
+                # prepare actual 'sample' for crop generation at runtime
+                samples.append({"features": [features[idx] for idx in feature_idxs], **tile})
         return samples
 
 
@@ -1,9 +1,12 @@
+import collections.abc
+import concurrent.futures
 import json
 import logging
 import math
 import os
 
 import affine
+import cv2 as cv
 import gdal
 import geojson
 import numpy as np
@@ -12,9 +15,13 @@ import osr
 import shapely
 import shapely.geometry
 import shapely.ops
+import shapely.prepared
+import shapely.strtree
 import shapely.wkt
 import tqdm
 
+import thelper.utils
+
 logger = logging.getLogger(__name__)
 
 NUMPY2GDAL_TYPE_CONV = {
@@ -73,7 +80,301 @@ def reproject_coords(coords, src_srs, tgt_srs):
     return trans_coords
 
 
-def parse_rasters(raster_paths, srs_target=None, reproj=False):
+class SpatialIndex:
+    """STRtree-based spatial index used to speed up geometry lookups over large feature/raster sets.
+
+    The index is built once over a list of geometries, and then queried with other geometries; all queries
+    return the (sorted) indices of the matching geometries in the original list. The bounding box test is done
+    via the R-tree, and only the remaining candidates are tested with their real geometry. The index can be
+    pickled (e.g. to be sent to other processes); it will simply be rebuilt on the other side.
+    """
+
+    def __init__(self, geoms):
+        self.geoms = list(geoms)
+        self.tree = shapely.strtree.STRtree(self.geoms) if self.geoms else None
+        # note: shapely<2.0 queries return the geometries themselves, so we keep a reverse lookup map
+        self.geom_idxs = {id(geom): idx for idx, geom in enumerate(self.geoms)}
+
+    def __len__(self):
+        return len(self.geoms)
+
+    def __reduce__(self):
+        return SpatialIndex, (self.geoms,)
+
+    def query(self, geom):
+        """Returns the indices of all indexed geometries whose bounding box intersects the given geometry's."""
+        if self.tree is None:
+            return []
+        hits = self.tree.query(geom)
+        if len(hits) and not isinstance(hits[0], (int, np.integer)):
+            hits = [self.geom_idxs[id(hit)] for hit in hits]
+        return sorted([int(hit) for hit in hits])
+
+    def intersects(self, geom):
+        """Returns the indices of all indexed geometries that intersect the given geometry."""
+        candidates = self.query(geom)
+        if len(candidates) > 1:
+            geom = shapely.prepared.prep(geom)  # only worth the cost if we have many tests to do
+        return [idx for idx in candidates if geom.intersects(self.geoms[idx])]
+
+    def within_distance(self, geom, distance):
+        """Returns the indices of all indexed geometries that are closer than a given distance to the geometry."""
+        bounds = geom.bounds
+        bbox = shapely.geometry.box(bounds[0] - distance, bounds[1] - distance,
+                                    bounds[2] + distance, bounds[3] + distance)
+        return [idx for idx in self.query(bbox) if geom.distance(self.geoms[idx]) < distance]
+
+
+_worker_kwargs = None
+"""Keyword arguments shared by all chunks, set in :func:`map_chunks` worker processes by :func:`_init_chunk_worker`."""
+
+
+def _init_chunk_worker(kwargs):
+    """Initializes a :func:`map_chunks` worker process (the keyword arguments are only transferred once)."""
+    global _worker_kwargs
+    _worker_kwargs = kwargs
+
+
+def _map_chunk(func, chunk):
+    return func(chunk, **_worker_kwargs)
+
+
+def map_chunks(func, items, parallel=False, desc=None, **kwargs):
+    """Applies a function to chunks of items, possibly in a pool of processes, and returns the flattened results.
+
+    The function must receive a list of items (and the given keyword arguments) and return one result per item.
+    If ``parallel`` is set (as a bool or as a process count), the chunks are dispatched to worker processes, so
+    the function, the items, and the keyword arguments must be picklable. The keyword arguments are only sent
+    once to each worker process (via its initializer) instead of once per chunk, so they can hold large shared
+    objects such as spatial indices or feature lists.
+    """
+    items = list(items)
+    if not parallel or len(items) <= 1:
+        return func(items, **kwargs)
+    if isinstance(parallel, bool):
+        import multiprocessing
+        parallel = multiprocessing.cpu_count()
+    assert parallel > 0, "unexpected min core count"
+    chunk_count = min(len(items), parallel * 4)  # a few chunks per process to balance the load
+    chunks = [items[idx::chunk_count] for idx in range(chunk_count)]
+    results = [None] * len(items)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=parallel, initializer=_init_chunk_worker,
+                                                initargs=(kwargs,)) as executor:
+        futures = [executor.submit(_map_chunk, func, chunk) for chunk in chunks]
+        for chunk_idx, future in enumerate(tqdm.tqdm(futures, desc=desc)):
+            results[chunk_idx::chunk_count] = future.result()
+    return results
+
+
+def _query_intersections(geoms, index):
+    return [index.intersects(geom) for geom in geoms]
+
+
+def query_intersections(index, geoms, parallel=False, desc="querying spatial index"):
+    """Returns, for each given geometry, the indices of the geometries of a spatial index that intersect it.
+
+    If ``parallel`` is set (as a bool or as a process count), the queries are split into chunks that are
+    dispatched to a pool of worker processes; the index is only sent to (and rebuilt in) each process once.
+    """
+    assert isinstance(index, SpatialIndex), "unexpected spatial index type"
+    if not parallel:
+        return [index.intersects(geom) for geom in tqdm.tqdm(geoms, desc=desc)]
+    return map_chunks(_query_intersections, geoms, parallel=parallel, desc=desc, index=index)
+
+
+def get_validity_mask(raster_path, max_size=1024):
+    """Returns a low-resolution mask of the valid (non-nodata) pixels of a raster, along with its geotransform.
+
+    Each mask pixel covers a square block of source pixels, and it is only invalid if none of these pixels is valid
+    in any band (according to the GDAL mask bands, which handle nodata values, alpha bands, and per-dataset masks).
+    The source pixels are read at full resolution in strips, as decimated reads (or overviews built with nearest
+    neighbor resampling) could drop sparse valid pixels. The mask is also dilated by one pixel so that it stays
+    conservative around its borders once tile bounds are reprojected; it can thus be used to reject regions without
+    any valid data, but not to confirm that a region has valid data.
+    """
+    rasterfile = gdal.Open(raster_path, gdal.GA_ReadOnly)
+    assert rasterfile is not None, f"could not open raster data file at '{raster_path}'"
+    cols, rows = rasterfile.RasterXSize, rasterfile.RasterYSize
+    block_size = max(int(math.ceil(max(cols, rows) / max_size)), 1)
+    mask_cols, mask_rows = int(math.ceil(cols / block_size)), int(math.ceil(rows / block_size))
+    mask = np.zeros((mask_rows, mask_cols), dtype=np.uint8)
+    bands = [rasterfile.GetRasterBand(idx + 1) for idx in range(rasterfile.RasterCount)]
+    if any([band.GetMaskFlags() & gdal.GMF_ALL_VALID for band in bands]):
+        mask.fill(1)  # all pixels are valid in at least one band (e.g. if it has no nodata value)
+    else:
+        mask_bands = [band.GetMaskBand() for band in bands]
+        strip_mask_rows = max(2 ** 22 // (mask_cols * block_size * block_size), 1)  # ~4M source pixels per read
+        for mask_row in range(0, mask_rows, strip_mask_rows):
+            row_start = mask_row * block_size
+            row_count = min(strip_mask_rows * block_size, rows - row_start)
+            curr_mask_rows = int(math.ceil(row_count / block_size))
+            valid = np.zeros((curr_mask_rows * block_size, mask_cols * block_size), dtype=bool)
+            for mask_band in mask_bands:
+                valid[:row_count, :cols] |= mask_band.ReadAsArray(0, row_start, cols, row_count) > 0
+            valid = valid.reshape(curr_mask_rows, block_size, mask_cols, block_size)
+            mask[mask_row:mask_row + curr_mask_rows] = valid.any(axis=(1, 3))
+    mask = cv.dilate(mask, np.ones((3, 3), dtype=np.uint8))
+    geotransform = np.asarray(rasterfile.GetGeoTransform(), dtype=np.float64)
+    geotransform[[1, 2, 4, 5]] *= block_size
+    rasterfile = None  # noqa # close input fd
+    return mask, geotransform
+
+
+def _get_validity_masks(raster_paths, max_size):
+    return [get_validity_mask(raster_path, max_size) for raster_path in raster_paths]
+
+
+def get_validity_masks(raster_paths, cache_dir=None, max_size=1024, parallel=False):
+    """Returns the validity masks (see :func:`get_validity_mask`) of a list of rasters, building them if needed.
+
+    If a cache directory is provided, masks are loaded from it if they were already built, and saved there
+    otherwise. Missing masks can be built in parallel (see :func:`map_chunks` for the ``parallel`` values).
+    """
+    cache_paths = [os.path.join(cache_dir, thelper.utils.get_params_hash(
+        os.path.abspath(raster_path), os.path.getmtime(raster_path), max_size) + ".valid.npz")
+        if cache_dir is not None else None for raster_path in raster_paths]
+    masks = [None] * len(raster_paths)
+    for idx, cache_path in enumerate(cache_paths):
+        if cache_path is not None and os.path.exists(cache_path):
+            with np.load(cache_path) as cache_data:
+                masks[idx] = cache_data["mask"], cache_data["geotransform"]
+    missing_idxs = [idx for idx, mask in enumerate(masks) if mask is None]
+    missing_masks = map_chunks(_get_validity_masks, [raster_paths[idx] for idx in missing_idxs],
+                               parallel=parallel, desc="building raster validity masks", max_size=max_size)
+    for idx, mask in zip(missing_idxs, missing_masks):
+        masks[idx] = mask
+        if cache_paths[idx] is not None:
+            logger.debug(f"caching raster validity mask to '{cache_paths[idx]}'...")
+            np.savez(cache_paths[idx], mask=mask[0], geotransform=mask[1])
+    return masks
+
+
+def get_validity_hits(mask, mask_geotransform, bboxes):
+    """Returns whether each bbox overlaps at least one valid pixel of a validity mask (via an integral image).
+
+    The bboxes must be given as an Nx4 array of ``(minx, miny, maxx, maxy)`` coordinates in the mask's SRS.
+    """
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    integral = cv.integral(mask)  # note: has one more row/col than the mask itself
+    inv_transform = ~affine.Affine.from_gdal(*mask_geotransform)
+    px_x, px_y = [], []
+    for x_idx, y_idx in [(0, 1), (0, 3), (2, 1), (2, 3)]:
+        corner_px = inv_transform * (bboxes[:, x_idx], bboxes[:, y_idx])
+        px_x.append(corner_px[0])
+        px_y.append(corner_px[1])
+    px_x, px_y = np.stack(px_x, axis=1), np.stack(px_y, axis=1)
+    x0 = np.clip(np.floor(px_x.min(axis=1)), 0, mask.shape[1]).astype(np.int64)
+    x1 = np.clip(np.ceil(px_x.max(axis=1)), 0, mask.shape[1]).astype(np.int64)
+    y0 = np.clip(np.floor(px_y.min(axis=1)), 0, mask.shape[0]).astype(np.int64)
+    y1 = np.clip(np.ceil(px_y.max(axis=1)), 0, mask.shape[0]).astype(np.int64)
+    sums = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+    return np.logical_and(sums > 0, np.logical_and(x1 > x0, y1 > y0))
+
+
+def transform_bboxes(bboxes, srs_transform):
+    """Transforms an Nx4 array of ``(minx, miny, maxx, maxy)`` bboxes and returns the bboxes of their corners."""
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    if srs_transform is None or not len(bboxes):
+        return bboxes
+    corners = np.stack([bboxes[:, [0, 1]], bboxes[:, [0, 3]], bboxes[:, [2, 1]], bboxes[:, [2, 3]]], axis=1)
+    corners = np.asarray(srs_transform.TransformPoints(corners.reshape(-1, 2).tolist()))[:, 0:2].reshape(-1, 4, 2)
+    return np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1)
+
+
+def check_tiles_data(tiles, tile_size, data_type, band_count, srs_target_wkt):
+    """Returns whether each tile overlaps valid (non-nodata) raster data after being reprojected.
+
+    Each tile must be given as a tuple of its geotransform and of the list of raster paths to check (in order).
+    This function only relies on picklable arguments so that it can be dispatched to worker processes.
+    """
+    crop_datatype = GDAL2NUMPY_TYPE_CONV[data_type]
+    crop_raster_gdal = gdal.GetDriverByName("MEM").Create("", int(round(tile_size[1])), int(round(tile_size[0])),
+                                                          band_count, data_type)
+    crop_raster_gdal.SetProjection(srs_target_wkt)
+    rasterfiles, flags = {}, []
+    for geotransform, raster_paths in tiles:
+        crop_raster_gdal.SetGeoTransform(tuple(geotransform))
+        found_valid_intersection = False
+        for raster_path in raster_paths:
+            if found_valid_intersection:
+                break
+            if raster_path not in rasterfiles:
+                rasterfiles[raster_path] = gdal.Open(raster_path, gdal.GA_ReadOnly)
+                assert rasterfiles[raster_path] is not None, f"could not open raster data file at '{raster_path}'"
+            # yeah, we reproject the crop, preprocessing is slow, deal with it
+            reproject_crop(rasterfiles[raster_path], crop_raster_gdal, tile_size, crop_datatype, fill_nodata=True)
+            for raster_band_idx in range(crop_raster_gdal.RasterCount):
+                curr_band = crop_raster_gdal.GetRasterBand(raster_band_idx + 1)
+                found_valid_intersection = found_valid_intersection or \
+                    np.count_nonzero(curr_band.ReadAsArray() != curr_band.GetNoDataValue()) > 0
+        flags.append(found_valid_intersection)
+    rasterfiles = None  # noqa # close input fds
+    crop_raster_gdal = None  # noqa # close local fd
+    return flags
+
+
+def read_raster_info(raster_path):
+    """Returns the (picklable) metadata of a raster that is needed to parse it, without keeping it open.
+
+    The spatial reference is returned as WKT, or as ``None`` if the raster does not provide one.
+    """
+    rasterfile = gdal.Open(raster_path, gdal.GA_ReadOnly)
+    assert rasterfile is not None, f"could not open raster data file at '{raster_path}'"
+    logger.debug(f"Raster '{raster_path}' metadata printing below...")
+    logger.debug(f"{str(rasterfile)}")
+    logger.debug(f"{str(rasterfile.GetMetadata())}")
+    logger.debug(f"band count: {str(rasterfile.RasterCount)}")
+    raster_datatype = None
+    for raster_band_idx in range(rasterfile.RasterCount):
+        curr_band = rasterfile.GetRasterBand(raster_band_idx + 1)  # offset, starts at 1
+        assert curr_band is not None, f"found invalid raster band in '{raster_path}'"
+        if not raster_datatype:
+            raster_datatype = curr_band.DataType
+        assert raster_datatype == curr_band.DataType, "expected identical data types in all bands"
+    raster_srs_str = rasterfile.GetProjectionRef()
+    raster_info = {
+        "srs_wkt": raster_srs_str if raster_srs_str and "unknown" not in raster_srs_str else None,
+        "geotransform": list(rasterfile.GetGeoTransform()),
+        "band_count": rasterfile.RasterCount,
+        "cols": rasterfile.RasterXSize,
+        "rows": rasterfile.RasterYSize,
+        "data_type": raster_datatype,
+    }
+    rasterfile = None  # noqa # close input fd
+    return raster_info
+
+
+def _read_rasters_info(raster_paths):
+    return [read_raster_info(raster_path) for raster_path in raster_paths]
+
+
+def get_rasters_info(raster_paths, cache_dir=None, parallel=False):
+    """Returns the metadata (see :func:`read_raster_info`) of a list of rasters, reading it if needed.
+
+    If a cache directory is provided, the metadata of each raster is loaded from it if it was already read (and
+    if the raster was not modified since), and saved there otherwise. Missing metadata can be read in parallel
+    (see :func:`map_chunks` for the ``parallel`` values), which helps a lot with large catalogues of rasters.
+    """
+    cache_paths = [os.path.join(cache_dir, thelper.utils.get_params_hash(
+        os.path.abspath(raster_path), os.path.getmtime(raster_path)) + ".meta.json")
+        if cache_dir is not None else None for raster_path in raster_paths]
+    rasters_info = [None] * len(raster_paths)
+    for idx, cache_path in enumerate(cache_paths):
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path) as fd:
+                rasters_info[idx] = json.load(fd)
+    missing_idxs = [idx for idx, info in enumerate(rasters_info) if info is None]
+    missing_info = map_chunks(_read_rasters_info, [raster_paths[idx] for idx in missing_idxs],
+                              parallel=parallel, desc="reading raster metadata")
+    for idx, info in zip(missing_idxs, missing_info):
+        rasters_info[idx] = info
+        if cache_paths[idx] is not None:
+            with open(cache_paths[idx], "w") as fd:
+                json.dump(info, fd)
+    return rasters_info
+
+
+def parse_rasters(raster_paths, srs_target=None, reproj=False, cache_dir=None, parallel=False):
     # note: the rasters will not be projected in this function if an SRS is given
     assert isinstance(raster_paths, list) and all([isinstance(s, str) for s in raster_paths]), \
         "input raster paths must be provided as a list of strings"
@@ -88,37 +389,25 @@ def parse_rasters(raster_paths, srs_target=None, reproj=False):
             srs_target_obj = osr.SpatialReference()
             srs_target_obj.ImportFromEPSG(srs_target)
             srs_target = srs_target_obj
+    rasters_info = get_rasters_info(raster_paths, cache_dir=cache_dir, parallel=parallel)
     rasters_data = []
     target_rois = []
-    for raster_path in raster_paths:
-        rasterfile = gdal.Open(raster_path, gdal.GA_ReadOnly)
-        assert rasterfile is not None, f"could not open raster data file at '{raster_path}'"
-        logger.debug(f"Raster '{raster_path}' metadata printing below...")
-        logger.debug(f"{str(rasterfile)}")
-        logger.debug(f"{str(rasterfile.GetMetadata())}")
-        logger.debug(f"band count: {str(rasterfile.RasterCount)}")
-        raster_geotransform = rasterfile.GetGeoTransform()
+    for raster_path, raster_info in zip(raster_paths, rasters_info):
+        raster_geotransform = tuple(raster_info["geotransform"])
         px_width, px_height = raster_geotransform[1], raster_geotransform[5]
         logger.debug(f"pixel WxH resolution: {px_width} x {px_height}")
         skew_x, skew_y = raster_geotransform[2], raster_geotransform[4]
         logger.debug(f"grid X/Y skew: {skew_x} / {skew_y}")
-        raster_extent = get_geoextent(raster_geotransform, 0, 0, rasterfile.RasterXSize, rasterfile.RasterYSize)
+        raster_extent = get_geoextent(raster_geotransform, 0, 0, raster_info["cols"], raster_info["rows"])
         logger.debug(f"extent: {str(raster_extent)}")  # [tl, bl, br, tr]
         raster_curr_srs = osr.SpatialReference()
-        raster_curr_srs_str = rasterfile.GetProjectionRef()
-        if "unknown" not in raster_curr_srs_str:
-            raster_curr_srs.ImportFromWkt(raster_curr_srs_str)
+        if raster_info["srs_wkt"] is not None:
+            raster_curr_srs.ImportFromWkt(raster_info["srs_wkt"])
         else:
             assert srs_target is not None, "raster did not provide an srs, and no target EPSG srs provided"
             raster_curr_srs = srs_target
         logger.debug(f"spatial ref:\n{str(raster_curr_srs)}")
-        raster_datatype = None
-        for raster_band_idx in range(rasterfile.RasterCount):
-            curr_band = rasterfile.GetRasterBand(raster_band_idx + 1)  # offset, starts at 1
-            assert curr_band is not None, f"found invalid raster band in '{raster_path}'"
-            if not raster_datatype:
-                raster_datatype = curr_band.DataType
-            assert raster_datatype == curr_band.DataType, "expected identical data types in all bands"
+        raster_datatype = raster_info["data_type"]
         local_roi = shapely.geometry.Polygon([list(pt) for pt in raster_extent])
         reproj_path = None
         if srs_target is not None and not raster_curr_srs.IsSame(srs_target):
@@ -130,7 +419,7 @@ def parse_rasters(raster_paths, srs_target=None, reproj=False):
                 reproj_path = raster_path + ".reproj.tif"
                 if not os.path.exists(reproj_path):
                     logger.info(f"reprojecting raster to '{reproj_path}'...")
-                    gdal.Warp(reproj_path, rasterfile, dstSRS=srs_target.ExportToWkt(),
+                    gdal.Warp(reproj_path, raster_path, dstSRS=srs_target.ExportToWkt(),
                               outputType=raster_datatype, xRes=px_width, yRes=px_height,
                               callback=lambda *args: logger.debug(f"reprojection @ {int(args[0] * 100)} %"),
                               options=["NUM_THREADS=ALL_CPUS"])
@@ -145,20 +434,99 @@ def parse_rasters(raster_paths, srs_target=None, reproj=False):
             "extent": raster_extent,
             "skew": (skew_x, skew_y),
             "resolution": (px_width, px_height),
-            "band_count": rasterfile.RasterCount,
-            "cols": rasterfile.RasterXSize,
-            "rows": rasterfile.RasterYSize,
+            "band_count": raster_info["band_count"],
+            "cols": raster_info["cols"],
+            "rows": raster_info["rows"],
             "data_type": raster_datatype,
             "local_roi": local_roi,
             "target_roi": target_roi,
             "file_path": raster_path,
             "reproj_path": reproj_path
         })
-        rasterfile = None  # noqa # close input fd
     target_coverage = shapely.ops.cascaded_union(target_rois)
     return rasters_data, target_coverage
 
 
+class RasterCatalog(collections.abc.Sequence):
+    """Catalogue of parsed rasters that indexes their footprints for fast lookups.
+
+    This catalogue behaves like the list of raster metadata dictionaries returned by :func:`parse_rasters`,
+    but it also holds an R-tree (see :class:`SpatialIndex`) of the raster footprints in the target SRS. Its
+    ``intersects`` function should be used by croppers to find which rasters are touched by a crop.
+
+    If a mosaic is provided (see :func:`build_vrt_mosaic`), it can be used to read crops that touch several
+    rasters at once instead of reading (or warping) each raster separately.
+    """
+
+    def __init__(self, rasters_data, mosaic=None):
+        self.rasters_data = list(rasters_data)
+        self.index = SpatialIndex([r["target_roi"] for r in self.rasters_data])
+        self.mosaic = mosaic
+
+    def __len__(self):
+        return len(self.rasters_data)
+
+    def __getitem__(self, idx):
+        return self.rasters_data[idx]
+
+    def intersects(self, geom):
+        """Returns the indices of all rasters whose footprint intersects the given geometry (in the target SRS)."""
+        return self.index.intersects(geom)
+
+
+def build_vrt_mosaic(rasters_data, vrt_path, srs_target=None, tolerance=1e-3):
+    """Builds a GDAL VRT mosaic of a list of parsed rasters, and returns its metadata dictionary.
+
+    The mosaic can only be built if all rasters (or their reprojected versions, if available) have the same
+    SRS and pixel resolution, no skew, and if their pixel grids are aligned; otherwise, ``None`` is returned.
+    The rasters are added to the mosaic in order, so where they overlap, the valid (non-nodata) pixels of the
+    last rasters are used, which is the same behavior as when crops are read from each raster in turn. The VRT
+    file is only a small XML file that references the original rasters; it is reused if it already exists.
+    """
+    assert rasters_data, "cannot build mosaic without rasters"
+    raster_paths, raster_srses, raster_geotransforms = [], [], []
+    for raster_data in rasters_data:
+        if raster_data["reproj_path"] is not None:
+            assert srs_target is not None, "missing target srs for reprojected rasters"
+            rasterfile = gdal.Open(raster_data["reproj_path"], gdal.GA_ReadOnly)
+            assert rasterfile is not None, f"could not open raster data file at '{raster_data['reproj_path']}'"
+            raster_paths.append(raster_data["reproj_path"])
+            raster_srses.append(srs_target)
+            raster_geotransforms.append(np.asarray(rasterfile.GetGeoTransform(), dtype=np.float64))
+            rasterfile = None  # noqa # close input fd
+        else:
+            raster_paths.append(raster_data["file_path"])
+            raster_srses.append(raster_data["srs"])
+            raster_geotransforms.append(np.asarray(raster_data["geotransform"], dtype=np.float64))
+    ref_geotransform = raster_geotransforms[0]
+    for raster_path, raster_srs, raster_geotransform in zip(raster_paths, raster_srses, raster_geotransforms):
+        offsets = (raster_geotransform[[0, 3]] - ref_geotransform[[0, 3]]) / ref_geotransform[[1, 5]]
+        if not raster_srs.IsSame(raster_srses[0]) or not np.allclose(raster_geotransform[[2, 4]], 0) or \
+                not np.allclose(raster_geotransform[[1, 5]], ref_geotransform[[1, 5]]) or \
+                np.abs(offsets - np.round(offsets)).max() > tolerance:
+            logger.warning(f"cannot build raster mosaic, '{raster_path}' is not aligned with other rasters")
+            return None
+    if not os.path.exists(vrt_path):
+        logger.info(f"building raster mosaic at '{vrt_path}'...")
+        vrtfile = gdal.BuildVRT(vrt_path, raster_paths)
+        assert vrtfile is not None, f"could not build raster mosaic at '{vrt_path}'"
+        vrtfile = None  # noqa # flush and close output fd
+    vrtfile = gdal.Open(vrt_path, gdal.GA_ReadOnly)
+    assert vrtfile is not None, f"could not open raster mosaic at '{vrt_path}'"
+    mosaic_data = {
+        "srs": raster_srses[0],
+        "geotransform": np.asarray(vrtfile.GetGeoTransform()),
+        "band_count": vrtfile.RasterCount,
+        "cols": vrtfile.RasterXSize,
+        "rows": vrtfile.RasterYSize,
+        "data_type": vrtfile.GetRasterBand(1).DataType,
+        "file_path": vrt_path,
+        "reproj_path": None,
+    }
+    vrtfile = None  # noqa # close input fd
+    return mosaic_data
+
+
 def parse_geojson_crs(body):
     """Imports a coordinate reference system (CRS) from a GeoJSON tree."""
     crs_body = body.get("crs") or body.get("srs")
@@ -204,8 +572,9 @@ def parse_geojson(geojson, srs_target=None, roi=None, allow_outlying=False, clip
         if not srs_origin.IsSame(srs_target):
             srs_transform = osr.CoordinateTransformation(srs_origin, srs_target)
     kept_features = []
+    roi_prepared = shapely.prepared.prep(roi) if roi is not None else None
     for feature in tqdm.tqdm(features, desc="parsing raw geojson features"):
-        _postproc_feature(feature, kept_features, srs_transform, roi, allow_outlying, clip_outlying)
+        _postproc_feature(feature, kept_features, srs_transform, roi, allow_outlying, clip_outlying, roi_prepared)
     logger.debug(f"kept {len(kept_features)} features after roi validation")
     return kept_features
 
@@ -232,17 +601,19 @@ def parse_shapefile(shapefile_path, srs_target=None, roi=None, allow_outlying=Fa
             srs_transform = osr.CoordinateTransformation(srs_origin, srs_target)
     kept_features = []
     attribs = [layer.GetLayerDefn().GetFieldDefn(i) for i in range(layer.GetLayerDefn().GetFieldCount())]
+    roi_prepared = shapely.prepared.prep(roi) if roi is not None else None
     for feature in tqdm.tqdm(layer, desc="parsing raw shapefile features"):
         feature = {
             "geometry": shapely.wkt.loads(feature.GetGeometryRef().ExportToWkt()),
             "properties": {attribs[i].GetNameRef(): feature.GetField(i) for i in range(len(attribs))},
         }
-        _postproc_feature(feature, kept_features, srs_transform, roi, allow_outlying, clip_outlying)
+        _postproc_feature(feature, kept_features, srs_transform, roi, allow_outlying, clip_outlying, roi_prepared)
     logger.debug(f"kept {len(kept_features)} features after roi validation")
     return kept_features
 
 
-def _postproc_feature(feature, kept_features, srs_transform=None, roi=None, allow_outlying=False, clip_outlying=False):
+def _postproc_feature(feature, kept_features, srs_transform=None, roi=None, allow_outlying=False,
+                      clip_outlying=False, roi_prepared=None):
     if isinstance(feature["geometry"], dict):
         assert feature["geometry"]["type"] in ["Polygon", "MultiPolygon"], \
             f"unhandled raw geometry type: {feature['geometry']['type']}"
@@ -278,10 +649,12 @@ def _postproc_feature(feature, kept_features, srs_transform=None, roi=None, allo
     if roi is None:
         kept_features.append(feature)
     else:
-        if (allow_outlying and roi.intersects(feature["geometry"])) or \
-                (not allow_outlying and roi.contains(feature["geometry"])):
+        # note: a prepared roi makes the repeated intersection/containment tests much faster for large rois
+        roi_test = roi_prepared if roi_prepared is not None else roi
+        if (allow_outlying and roi_test.intersects(feature["geometry"])) or \
+                (not allow_outlying and roi_test.contains(feature["geometry"])):
             if clip_outlying:
-                if not roi.contains(feature["geometry"]):
+                if not roi_test.contains(feature["geometry"]):
                     feature["clipped"] = True
                     feature["geometry"] = roi.intersection(feature["geometry"])
                 assert feature["geometry"].type in ["Polygon", "MultiPolygon"], \
@@ -356,7 +729,8 @@ def get_feature_roi(geom, px_size, skew, roi_buffer=None, crop_img_size=None, cr
 
 def open_rasterfile(raster_data, keep_rasters_open=False):
     assert isinstance(raster_data, dict), "unexpected raster data type (should be internal dict)"
-    if "rasterfile" in raster_data:
+    # note: gdal handles cannot be shared across processes, so forked loader workers reopen their own
+    if "rasterfile" in raster_data and raster_data.get("rasterfile_pid") == os.getpid():
         rasterfile = raster_data["rasterfile"]
     else:
         if raster_data["reproj_path"] is not None:
@@ -367,6 +741,7 @@ def open_rasterfile(raster_data, keep_rasters_open=False):
         assert rasterfile is not None, f"could not open raster data file at '{raster_path}'"
         if keep_rasters_open:
             raster_data["rasterfile"] = rasterfile
+            raster_data["rasterfile_pid"] = os.getpid()
     return rasterfile
 
 
@@ -388,6 +763,119 @@ def reproject_crop(raster, crop_raster, crop_size, crop_datatype,
     assert res == 0, "reprojection failed"
 
 
+def get_crop_window(raster_data, crop_geotransform, srs_target, tolerance=1e-3):
+    """Returns the pixel window of a crop inside a raster if it can be read without any reprojection.
+
+    A crop can be read directly from a raster (i.e. with a windowed read instead of a warp) only if the raster
+    is already in the target SRS, if it has the same pixel resolution as the crop (up to a sign flip), if neither
+    grid is skewed, and if the crop origin falls on a raster pixel corner. If any of these conditions is not
+    met, ``None`` is returned, and the crop should be reprojected via :func:`reproject_crop` instead.
+
+    Returns:
+        A tuple of ``(xoff, yoff, flip_x, flip_y)`` where the offsets are the raster pixel coordinates of the
+        crop corner that is closest to the raster origin, and where the flags indicate along which axes the
+        crop must be flipped with respect to the raster.
+    """
+    if raster_data["reproj_path"] is not None or not raster_data["srs"].IsSame(srs_target):
+        return None
+    raster_geotransform = np.asarray(raster_data["geotransform"], dtype=np.float64)
+    crop_geotransform = np.asarray(crop_geotransform, dtype=np.float64)
+    if not np.allclose(raster_geotransform[[2, 4]], 0) or not np.allclose(crop_geotransform[[2, 4]], 0):
+        return None
+    if not np.allclose(np.abs(raster_geotransform[[1, 5]]), np.abs(crop_geotransform[[1, 5]])):
+        return None
+    offset_x, offset_y = get_pxcoord(raster_geotransform, crop_geotransform[0], crop_geotransform[3])
+    if abs(offset_x - round(offset_x)) > tolerance or abs(offset_y - round(offset_y)) > tolerance:
+        return None
+    flip_x = bool(np.sign(raster_geotransform[1]) != np.sign(crop_geotransform[1]))
+    flip_y = bool(np.sign(raster_geotransform[5]) != np.sign(crop_geotransform[5]))
+    return int(round(offset_x)), int(round(offset_y)), flip_x, flip_y
+
+
+def read_crop_window(rasterfile, window, crop):
+    """Reads a raster window (obtained via :func:`get_crop_window`) into a masked crop array.
+
+    Only the raster pixels that overlap the crop and that are not 'nodata' are copied; the crop mask is
+    cleared at these locations, and left untouched everywhere else (similarly to :func:`reproject_crop`).
+    """
+    assert isinstance(crop, np.ma.MaskedArray) and crop.ndim == 3, "unexpected crop array type"
+    assert rasterfile.RasterCount == crop.shape[2], "unexpected raster band count"
+    xoff, yoff, flip_x, flip_y = window
+    rows, cols = crop.shape[0:2]
+    # if the crop is flipped along an axis, it grows towards the raster origin along that axis
+    xoff, yoff = xoff - cols if flip_x else xoff, yoff - rows if flip_y else yoff
+    x0, y0 = max(xoff, 0), max(yoff, 0)
+    x1, y1 = min(xoff + cols, rasterfile.RasterXSize), min(yoff + rows, rasterfile.RasterYSize)
+    if x1 <= x0 or y1 <= y0:
+        return
+    if crop.mask is np.ma.nomask:
+        crop.mask = np.ones(crop.shape, dtype=bool)
+    crop_data, crop_mask = crop.data, crop.mask
+    if flip_x:
+        crop_data, crop_mask = crop_data[:, ::-1], crop_mask[:, ::-1]
+    if flip_y:
+        crop_data, crop_mask = crop_data[::-1], crop_mask[::-1]
+    crop_data = crop_data[y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff]
+    crop_mask = crop_mask[y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff]
+    for raster_band_idx in range(rasterfile.RasterCount):
+        curr_band = rasterfile.GetRasterBand(raster_band_idx + 1)
+        curr_band_array = curr_band.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+        nodataval = curr_band.GetNoDataValue()
+        flag_mask = curr_band_array != nodataval if nodataval is not None else \
+            np.ones(curr_band_array.shape, dtype=bool)
+        np.copyto(dst=crop_data[:, :, raster_band_idx], src=curr_band_array, where=flag_mask, casting="unsafe")
+        np.bitwise_and(crop_mask[:, :, raster_band_idx], np.invert(flag_mask), out=crop_mask[:, :, raster_band_idx])
+
+
+def rasterize_geometries(geoms, geotransform, cols, rows, all_touched=True):
+    """Rasterizes a list of (multi)polygons into a binary mask without relying on GDAL/OGR.
+
+    This is an OpenCV-based replacement for ``gdal.RasterizeLayer`` that does not need any in-memory raster
+    or vector layer. When ``all_touched`` is set, the polygon rings are also drawn so that every pixel touched
+    by a geometry is burned in (this closely approximates GDAL's ``ALL_TOUCHED=TRUE`` behavior). Geometries
+    that are not made only of polygons (e.g. points, lines, or collections that contain them) cannot be drawn
+    this way, so the whole list is rasterized with :func:`rasterize_geometries_gdal` instead.
+    """
+    polys = [poly for geom in geoms for poly in getattr(geom, "geoms", [geom]) if not poly.is_empty]
+    if any([poly.geom_type != "Polygon" for poly in polys]):
+        return rasterize_geometries_gdal(geoms, geotransform, cols, rows, all_touched=all_touched)
+    shift = 8  # number of fractional bits used by opencv to draw with subpixel precision
+    mask = np.zeros((rows, cols), dtype=np.uint8)
+    inv_transform = ~affine.Affine.from_gdal(*geotransform)
+    for poly in polys:
+        rings = []
+        for ring in [poly.exterior, *poly.interiors]:
+            coords = np.asarray(ring.coords, dtype=np.float64)
+            px_x, px_y = inv_transform * (coords[:, 0], coords[:, 1])
+            # note: opencv vertices are located at pixel centers, gdal's are located at pixel corners
+            px_coords = np.stack([px_x - 0.5, px_y - 0.5], axis=-1) * (1 << shift)
+            rings.append(np.round(px_coords).astype(np.int32))
+        cv.fillPoly(mask, rings, color=1, lineType=cv.LINE_8, shift=shift)
+        if all_touched:
+            cv.polylines(mask, rings, isClosed=True, color=1, thickness=1, lineType=cv.LINE_8, shift=shift)
+    return mask
+
+
+def rasterize_geometries_gdal(geoms, geotransform, cols, rows, all_touched=True, srs=None):
+    """Rasterizes a list of geometries (of any type) into a binary mask using ``gdal.RasterizeLayer``."""
+    mask_gdal = gdal.GetDriverByName("MEM").Create("", cols, rows, 1, gdal.GDT_Byte)
+    mask_gdal.SetGeoTransform(geotransform)
+    if srs is not None:
+        mask_gdal.SetProjection(srs.ExportToWkt())
+    mask_gdal.GetRasterBand(1).WriteArray(np.zeros((rows, cols), dtype=np.uint8))
+    ogr_dataset = ogr.GetDriverByName("Memory").CreateDataSource("mask")
+    ogr_layer = ogr_dataset.CreateLayer("feature_mask", srs=srs)
+    for geom in geoms:
+        ogr_feature = ogr.Feature(ogr_layer.GetLayerDefn())
+        ogr_feature.SetGeometry(ogr.CreateGeometryFromWkt(geom.wkt))
+        ogr_layer.CreateFeature(ogr_feature)
+    options = ["ALL_TOUCHED=TRUE"] if all_touched else []
+    gdal.RasterizeLayer(mask_gdal, [1], ogr_layer, burn_values=[1], options=options)
+    mask = mask_gdal.GetRasterBand(1).ReadAsArray().astype(np.uint8)
+    mask_gdal = None  # noqa # close local fd
+    return mask
+
+
 def export_geotiff(filepath, crop, srs, geotransform):
     assert isinstance(filepath, str), "filepath should be given as string"
     assert isinstance(crop, np.ndarray), "crop data should be given as numpy array"
@@ -578,6 +578,8 @@ class LoaderFactory:
                         sampler_sig = inspect.signature(sampler_type)
                         if "seeds" in sampler_sig.parameters:
                             sampler_params = {**sampler_params, "seeds": self.seeds}
+                        if "dataset" in sampler_sig.parameters:
+                            sampler_params = {**sampler_params, "dataset": dataset}
                         if "scale" in sampler_sig.parameters:
                             assert "scale" not in sampler_params, "specified scale in both sampler config and loader config"
                             sampler_params = {**sampler_params, "scale": scale}
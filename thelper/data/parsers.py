@@ -16,6 +16,7 @@ import PIL.Image
 import torch
 import torch.utils.data
 
+import thelper.data.codecs
 import thelper.tasks
 import thelper.utils
 
@@ -172,12 +173,15 @@ class HDF5Dataset(Dataset):
 
     This specialization is compatible with the HDF5 packages made by the CLI's "split" operation. The
     archives it loads contains pre-split datasets that can be reloaded without having to resplit their
-    data. The archive also contains useful metadata, and a task interface.
+    data. The archive also contains useful metadata, and a task interface. Elements that were compressed in
+    blocks of consecutive samples are read through a :class:`thelper.utils.HDF5BlockReader`, which keeps the
+    ``block_cache_size`` most recently decompressed blocks of each element in memory.
 
     Attributes:
         archive: file descriptor for the opened hdf5 dataset.
         subset: hdf5 group section representing the targeted set.
         target_args: list decompression args required for each sample key.
+        block_readers: map of sample keys to the readers used for elements compressed in blocks.
         source: source logstamp of the hdf5 dataset.
         git_sha1: framework git tag of the hdf5 dataset.
         version: version of the framework that saved the hdf5 dataset.
@@ -188,7 +192,7 @@ class HDF5Dataset(Dataset):
         | :func:`thelper.data.utils.create_hdf5`
     """
 
-    def __init__(self, root, subset="train", transforms=None):
+    def __init__(self, root, subset="train", transforms=None, block_cache_size=8):
         """HDF5 dataset parser constructor.
 
         This constructor receives the path to the HDF5 archive as well as a subset indicating which
@@ -210,15 +214,24 @@ class HDF5Dataset(Dataset):
         sample_count = self.subset.attrs["count"]
         self.samples = [{}] * sample_count
         self.target_args = {}
+        self.block_readers = {}
         for key in self.task.keys:
             dset = self.subset[key]
+            key_compr_config = thelper.utils.get_key_def(key, compr_config, default={})
+            compr_kwargs = thelper.utils.get_key_def(["decode_params", "decode_kwargs"], key_compr_config, default={})
+            if dset.attrs.get("storage") == "block":
+                self.block_readers[key] = thelper.utils.HDF5BlockReader(dset, block_cache_size, **compr_kwargs)
+                assert len(self.block_readers[key]) == len(self.samples)
+                continue
             assert dset.len() == len(self.samples)
             dtype = dset.attrs["orig_dtype"] if "orig_dtype" in dset.attrs else None
             shape = dset.attrs["orig_shape"] if "orig_shape" in dset.attrs else None
-            compr_config = thelper.utils.get_key_def(key, compr_config, default={})
-            compr_type = thelper.utils.get_key_def("type", compr_config, default="none")
-            compr_kwargs = thelper.utils.get_key_def(["decode_params", "decode_kwargs"], compr_config, default={})
-            self.target_args[key] = {"dset": dset, "dtype": dtype, "shape": shape, "compr_type": compr_type, "compr_kwargs": compr_kwargs}
+            compr_type = thelper.utils.get_key_def("type", key_compr_config, default="none")
+            decoder = None  # decoders are resolved once per key (chunk filters are applied by hdf5 itself)
+            if compr_type not in thelper.utils.chunk_compression_flags:
+                decoder = thelper.data.codecs.get_decoder(compr_type, **compr_kwargs)
+            self.target_args[key] = {"dset": dset, "dtype": dtype, "shape": shape, "compr_type": compr_type,
+                                     "compr_kwargs": compr_kwargs, "decoder": decoder}
 
     def __getitem__(self, idx):
         """Returns the data sample (a dictionary) for a specific (0-based) index."""
@@ -228,13 +241,38 @@ class HDF5Dataset(Dataset):
             raise AssertionError("sample index is out-of-range")
         sample = {
             key: thelper.utils.fetch_hdf5_sample(args["dset"], idx, args["dtype"], args["shape"],
-                                                 args["compr_type"], **args["compr_kwargs"])
+                                                 args["compr_type"], decoder=args["decoder"])
             for key, args in self.target_args.items()
         }
+        for key, reader in self.block_readers.items():
+            sample[key] = reader[idx]
         if self.transforms:
             sample = self.transforms(sample)
         return sample
 
+    def get_block_boundaries(self):
+        """Returns the indices at which the storage blocks of the subset start, followed by the sample count.
+
+        The boundaries of elements compressed in blocks are returned first; otherwise, the boundaries of the HDF5
+        chunks of elements compressed with chunk filters are returned. If no element is stored in multi-sample
+        blocks or chunks, ``None`` is returned. These boundaries are used by locality-aware samplers.
+
+        .. seealso::
+            | :class:`thelper.data.samplers.BlockShuffleSampler`
+        """
+        for reader in self.block_readers.values():
+            return reader.get_block_boundaries()
+        for args in self.target_args.values():
+            chunks = args["dset"].chunks
+            if args["compr_type"] in thelper.utils.chunk_compression_flags and chunks is not None and chunks[0] > 1:
+                return np.append(np.arange(0, len(self.samples), chunks[0]), len(self.samples))
+        return None
+
+    def reserve_block_cache(self, block_count):
+        """Makes sure that the block readers of all elements can keep at least ``block_count`` decoded blocks."""
+        for reader in self.block_readers.values():
+            reader.cache_size = max(reader.cache_size, int(block_count))
+
     def close(self):
         """Closes the internal HDF5 file."""
         # note: if we dont do it explicitly, it will be done by the garbage collector on destruction, but it might take time...
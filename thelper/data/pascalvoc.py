@@ -16,21 +16,29 @@ import thelper.data
 import thelper.tasks
 import thelper.utils
 from thelper.data.parsers import Dataset
+from thelper.data.preload import SharedPreloadMixin
 
 logger = logging.getLogger(__name__)
 
 
-class PASCALVOC(Dataset):
+class PASCALVOC(Dataset, SharedPreloadMixin):
     """PASCAL VOC dataset parser.
 
     This class can be used to parse the PASCAL VOC dataset for either semantic segmentation or object
     detection. The task object it exposes will be changed accordingly. In all cases, the 2012 version
     of the dataset will be used.
 
+    If ``preload`` is used, all images (and segmentation label maps) are decoded in the constructor. By default,
+    they are kept in the sample dictionaries, meaning each data loader worker process ends up with its own copy.
+    If ``preload_backend`` is specified ('shm' or 'memmap'), they are instead packed in a shared arena that all
+    workers access without copying it (see :class:`thelper.data.preload.SharedArrayArena`). In that case, the
+    loaded images and label maps are read-only arrays.
+
     TODO: Add support for semantic instance segmentation.
 
     .. seealso::
         | :class:`thelper.data.parsers.Dataset`
+        | :class:`thelper.data.preload.SharedPreloadMixin`
     """
 
     _label_name_map = {
@@ -70,7 +78,8 @@ class PASCALVOC(Dataset):
 
     def __init__(self, root, task="segm", subset="trainval", target_labels=None, download=False, preload=True, use_difficult=False,
                  use_occluded=True, use_truncated=True, transforms=None, image_key="image", sample_name_key="name", idx_key="idx",
-                 image_path_key="image_path", gt_path_key="gt_path", bboxes_key="bboxes", label_map_key="label_map"):
+                 image_path_key="image_path", gt_path_key="gt_path", bboxes_key="bboxes", label_map_key="label_map",
+                 preload_backend=None):
         self.task_name = task
         assert self.task_name in self._supported_tasks, f"unrecognized task type '{self.task_name}'"
         assert subset in self._supported_subsets, f"unrecognized data subset '{subset}'"
@@ -97,6 +106,7 @@ class PASCALVOC(Dataset):
         assert os.path.isdir(dataset_path), f"could not locate image sets folder at '{imagesets_path}'"
         super().__init__(transforms=transforms)
         self.preload = preload
+        self.preload_shared = bool(preload and preload_backend)
         # should use_difficult be true for training, but false for validation?
         self.image_key = image_key
         self.idx_key = idx_key
@@ -166,6 +176,9 @@ class PASCALVOC(Dataset):
         action = "preloading" if self.preload else "initializing"
         logger.info("%s pascal voc dataset for task='%s' and set='%s'..." % (action, self.task_name, subset))
         self.samples = []
+        if self.preload_shared:
+            self._init_preload_arena([self.image_key, self.gt_key] if self.task_name == "segm" else [self.image_key],
+                                     backend=preload_backend)
         if self.preload:
             from tqdm import tqdm
         else:
@@ -223,6 +236,10 @@ class PASCALVOC(Dataset):
                                                        confidence=None, image_id=image_id, task=self.task))
                 if not gt:
                     continue
+            if self.preload_shared:
+                self._preload_sample_arrays({self.image_key: image, self.gt_key: gt})
+                image = None
+                gt = gt if self.task_name == "detect" else None  # bboxes are not arrays, and stay in the samples
             self.samples.append({
                 self.sample_name_key: sample_name,
                 self.image_path_key: image_path,
@@ -230,6 +247,8 @@ class PASCALVOC(Dataset):
                 self.image_key: image,
                 self.gt_key: gt,
             })
+        if self.preload_shared:
+            self._finalize_preload()
         logger.info("initialized %d samples" % len(self.samples))
 
     def __getitem__(self, idx):
@@ -253,6 +272,10 @@ class PASCALVOC(Dataset):
                     gt = self.encode_label_map(gt)
             elif self.task_name == "detect":
                 gt = thelper.utils.get_key_def(self.gt_key, sample)
+        elif self.preload_shared:
+            arrays = self._get_preloaded_arrays(idx)
+            image = arrays[self.image_key]
+            gt = arrays[self.gt_key] if self.task_name == "segm" else thelper.utils.get_key_def(self.gt_key, sample)
         else:
             image = sample[self.image_key]
             gt = thelper.utils.get_key_def(self.gt_key, sample)
@@ -0,0 +1,276 @@
+"""Shared-memory preloading module.
+
+This module contains the arena used to preload decoded sample arrays (e.g. images and label maps) in memory that
+is shared by all data loader worker processes, and the mixin that dataset parsers can inherit from to opt into it.
+Parsers that keep decoded arrays in Python lists end up with one copy of the dataset per worker process, as the
+reference counting of the list items touches (and therefore copies-on-write) the memory pages that hold them.
+Arrays packed in an arena are instead stored in a few large shared segments, and are returned as zero-copy views.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # pragma: no cover
+    shared_memory = None  # only available in python >= 3.8; the memmap backend is used instead
+
+arena_backends = ["shm", "memmap"]
+"""List of supported arena backends (shared memory segments and memory-mapped files, respectively)."""
+
+shm_path = "/dev/shm"
+"""Mount point of the shared memory filesystem whose free space is checked before allocating shm segments."""
+
+
+def get_shm_free_space():
+    """Returns the free space (in bytes) of the shared memory filesystem, or ``None`` if it cannot be checked."""
+    if not os.path.isdir(shm_path):
+        return None  # e.g. on macOS/Windows, where shared memory is not backed by a tmpfs mount
+    return shutil.disk_usage(shm_path).free
+
+
+class SharedArrayArena:
+    """Packs numpy arrays into shared memory segments, and indexes them by offset, shape, and type.
+
+    Arrays are appended one at a time to fixed-size segments, and new segments are allocated as needed, so the
+    total size of the arrays does not need to be known in advance. Once all arrays are appended, the arena must be
+    sealed, and arrays can then be fetched by index as read-only views of the segments. The index is kept in a few
+    numpy arrays instead of one Python object per array, so fetching arrays does not touch per-array memory pages.
+
+    When the arena is pickled (e.g. when a dataset is sent to worker processes started with the 'spawn' method),
+    only the segment names and the index are serialized, and the unpickled arena attaches to the existing segments
+    without copying any data. Worker processes started with the 'fork' method inherit the segment mappings directly.
+    The arena is never copied when its parser is deep-copied (it is read-only once sealed).
+
+    Two backends are supported: ``shm`` (shared memory segments, via :mod:`multiprocessing.shared_memory`) and
+    ``memmap`` (memory-mapped files in a directory, which are shared through the page cache). By default, ``shm``
+    is used if it is available and if ``/dev/shm`` has enough free space for at least one segment; ``memmap`` is
+    used otherwise. Note that shared memory may be limited in some environments (e.g. docker containers have a 64MB
+    ``/dev/shm`` by default), and that its pages are only reserved once they are written to. To avoid crashing (with
+    SIGBUS) while copying arrays into a segment that does not fit, the free space of ``/dev/shm`` is checked before
+    each shm segment is allocated, and an error is raised if it is too small; use the ``memmap`` backend (or a
+    smaller segment size) there. The process that creates the arena owns its segments, and releases them when
+    :func:`close` is called or when the arena is garbage-collected; arrays that are still referenced stay valid.
+
+    Attributes:
+        backend: name of the backend used to allocate segments ('shm' or 'memmap').
+        segment_size: minimum size of the allocated segments, in bytes.
+        path: directory where segment files are written (memmap backend only).
+        segment_names: names (shm backend) or file paths (memmap backend) of the allocated segments.
+        sealed: specifies whether the arena is sealed (i.e. read-only, and ready to be shared).
+
+    .. seealso::
+        | :class:`thelper.data.preload.SharedPreloadMixin`
+    """
+
+    alignment = 64
+    """Alignment of the array offsets in segments, in bytes."""
+
+    def __init__(self, backend=None, segment_size=256 * 2 ** 20, path=None):
+        """Initializes an empty arena.
+
+        Args:
+            backend: name of the backend used to allocate segments ('shm' or 'memmap'; ``None`` = automatic, see above).
+            segment_size: minimum size of the allocated segments, in bytes (larger arrays get their own segment).
+            path: directory where segment files are written with the memmap backend (``None`` = temporary
+                directory that is removed when the arena is closed).
+        """
+        if backend is None:
+            shm_free_space = get_shm_free_space() if shared_memory is not None else 0
+            backend = "shm" if shm_free_space is None or shm_free_space >= int(segment_size) else "memmap"
+        assert backend in arena_backends, f"unsupported arena backend '{backend}' (should be in {arena_backends})"
+        assert backend != "shm" or shared_memory is not None, "shared memory backend requires python >= 3.8"
+        assert int(segment_size) > 0, "segment size should be strictly positive"
+        self.backend = backend
+        self.segment_size = int(segment_size)
+        self.owner_pid = os.getpid()  # forked processes inherit the arena, but never own its segments
+        self.temp_path = backend == "memmap" and path is None
+        self.path = tempfile.mkdtemp(prefix="thelper-arena-") if self.temp_path else path
+        if backend == "memmap":
+            os.makedirs(self.path, exist_ok=True)
+        self.segment_names, self.segment_sizes, self.segments, self.buffers = [], [], [], []
+        self.sealed = False
+        self._fill = 0  # number of bytes used in the last segment
+        self._entries = []  # (segment index, offset, shape, dtype) tuples, until the arena is sealed
+        self.offsets = self.segment_idxs = self.shapes = self.ndims = self.dtype_idxs = None
+        self.dtypes = []
+
+    def _allocate_segment(self, size):
+        """Allocates a new segment of (at least) the given size, and returns its index."""
+        segment_idx = len(self.segments)
+        if self.backend == "shm":
+            shm_free_space = get_shm_free_space()
+            assert shm_free_space is None or shm_free_space >= size, \
+                f"not enough free space in {shm_path} for a new {size / 2 ** 20:.1f} MB segment " \
+                f"({shm_free_space / 2 ** 20:.1f} MB left); use the 'memmap' arena backend instead"
+            segment = shared_memory.SharedMemory(create=True, size=size)
+            self.segment_names.append(segment.name)
+            self.buffers.append(segment.buf)
+        else:
+            segment_path = os.path.join(self.path, f"segment{segment_idx:04d}.bin")
+            segment = np.memmap(segment_path, dtype=np.uint8, mode="w+", shape=(size,))
+            self.segment_names.append(segment_path)
+            self.buffers.append(segment)
+        self.segments.append(segment)
+        self.segment_sizes.append(size)
+        return segment_idx
+
+    def _attach_segments(self):
+        """Attaches to the existing segments of the arena (in a process that does not own them)."""
+        self.segments, self.buffers = [], []
+        for segment_name, segment_size in zip(self.segment_names, self.segment_sizes):
+            if self.backend == "shm":
+                # note: the segment is also registered in the resource tracker of the owner process here (worker
+                # processes share it), and it will only be unlinked once the owner closes the arena
+                segment = shared_memory.SharedMemory(name=segment_name)
+                self.buffers.append(segment.buf)
+            else:
+                segment = np.memmap(segment_name, dtype=np.uint8, mode="r", shape=(segment_size,))
+                self.buffers.append(segment)
+            self.segments.append(segment)
+
+    def append(self, array):
+        """Copies an array into the arena, and returns its index."""
+        assert not self.sealed, "cannot append arrays to a sealed arena"
+        array = np.ascontiguousarray(array)
+        assert not array.dtype.hasobject, "cannot store arrays of python objects in the arena"
+        offset = -(-self._fill // self.alignment) * self.alignment
+        if not self.segments or offset + array.nbytes > self.segment_sizes[-1]:
+            self._allocate_segment(max(self.segment_size, array.nbytes, 1))
+            offset = 0
+        segment_idx = len(self.segments) - 1
+        if array.nbytes > 0:
+            np.ndarray(array.shape, array.dtype, buffer=self.buffers[segment_idx], offset=offset)[...] = array
+        self._fill = offset + array.nbytes
+        self._entries.append((segment_idx, offset, array.shape, array.dtype.str))
+        return len(self._entries) - 1
+
+    def seal(self):
+        """Seals the arena, i.e. converts its index to numpy arrays; no more arrays can be appended afterwards."""
+        if self.sealed:
+            return
+        max_ndim = max([len(shape) for _, _, shape, _ in self._entries], default=0)
+        self.dtypes = sorted(set([dtype for _, _, _, dtype in self._entries]))
+        self.segment_idxs = np.asarray([entry[0] for entry in self._entries], dtype=np.int32)
+        self.offsets = np.asarray([entry[1] for entry in self._entries], dtype=np.int64)
+        self.ndims = np.asarray([len(entry[2]) for entry in self._entries], dtype=np.int8)
+        self.shapes = np.zeros((len(self._entries), max_ndim), dtype=np.int64)
+        for entry_idx, (_, _, shape, _) in enumerate(self._entries):
+            self.shapes[entry_idx, :len(shape)] = shape
+        self.dtype_idxs = np.asarray([self.dtypes.index(entry[3]) for entry in self._entries], dtype=np.int16)
+        if self.backend == "memmap":
+            for segment in self.segments:
+                segment.flush()
+        self._entries = []
+        self.sealed = True
+
+    def __len__(self):
+        """Returns the number of arrays stored in the arena."""
+        return len(self.offsets) if self.sealed else len(self._entries)
+
+    def __getitem__(self, idx):
+        """Returns a read-only (zero-copy) view of the array at the given index."""
+        assert self.sealed, "arena must be sealed before arrays can be fetched"
+        shape = tuple(self.shapes[idx, :self.ndims[idx]].tolist())
+        array = np.ndarray(shape, np.dtype(self.dtypes[self.dtype_idxs[idx]]),
+                           buffer=self.buffers[self.segment_idxs[idx]], offset=int(self.offsets[idx]))
+        array.flags.writeable = False
+        return array
+
+    def get_size(self):
+        """Returns the total size of the allocated segments, in bytes."""
+        return sum(self.segment_sizes)
+
+    def close(self):
+        """Releases the segments of the arena (and removes them, if this process owns them)."""
+        owner = self.owner_pid == os.getpid()
+        self.buffers = []
+        for segment in self.segments:
+            if self.backend == "shm":
+                try:
+                    segment.close()
+                except BufferError:
+                    pass  # some fetched arrays are still alive; the mapping is released with them
+                if owner:
+                    segment.unlink()
+        self.segments = []
+        if owner and self.temp_path and self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __getstate__(self):
+        """Returns the picklable state of the arena (segment names and index only; no array data)."""
+        assert self.sealed, "arena must be sealed before it can be shared with other processes"
+        state = {key: val for key, val in self.__dict__.items() if key not in ["segments", "buffers"]}
+        state["owner_pid"] = None
+        return state
+
+    def __setstate__(self, state):
+        """Restores the arena by attaching to the existing segments."""
+        self.__dict__.update(state)
+        self._attach_segments()
+
+    def __deepcopy__(self, memo):
+        """Returns the arena itself, as sealed arenas are read-only (this avoids copying the dataset arrays)."""
+        return self
+
+    def __repr__(self):
+        """Returns a print-friendly representation of the arena."""
+        return self.__class__.__module__ + "." + self.__class__.__qualname__ + \
+            f"(backend={repr(self.backend)}, segment_size={self.segment_size}, path={repr(self.path)})"
+
+
+class SharedPreloadMixin:
+    """Mixin for dataset parsers that preload decoded sample arrays in a :class:`SharedArrayArena`.
+
+    A parser that opts into shared preloading calls :func:`_init_preload_arena` with the sample keys of the arrays
+    to preload, then :func:`_preload_sample_arrays` once for each sample (in the same order as its ``samples``
+    list), and finally :func:`_finalize_preload` once all samples are parsed. In its ``__getitem__`` function, it can
+    then fetch the preloaded arrays of a sample with :func:`_get_preloaded_arrays`. The sample dictionaries should
+    not hold the preloaded arrays themselves. See :class:`thelper.data.pascalvoc.PASCALVOC` for an example.
+
+    Note that the preloaded arrays are returned as read-only views; transformation operations should therefore not
+    try to modify them in-place.
+
+    Attributes:
+        preload_keys: list of sample keys whose arrays are preloaded.
+        preload_arena: the arena holding the preloaded arrays.
+        preload_array_idxs: ``(N, len(preload_keys))`` array of arena indices for each sample (-1 = no array).
+    """
+
+    def _init_preload_arena(self, keys, backend=None, segment_size=256 * 2 ** 20, path=None):
+        """Creates the arena used to preload the arrays of the given sample keys."""
+        assert isinstance(keys, (list, tuple)) and keys, "should provide a list of sample keys to preload"
+        self.preload_keys = list(keys)
+        self.preload_arena = SharedArrayArena(backend=backend, segment_size=segment_size, path=path)
+        self.preload_array_idxs = []
+
+    def _preload_sample_arrays(self, arrays):
+        """Copies the arrays of a sample (given as a dictionary) into the arena; missing arrays can be ``None``."""
+        assert not isinstance(self.preload_array_idxs, np.ndarray), "preloading was already finalized"
+        self.preload_array_idxs.append([self.preload_arena.append(arrays[key]) if arrays.get(key) is not None
+                                        else -1 for key in self.preload_keys])
+
+    def _finalize_preload(self):
+        """Seals the arena and converts the sample index to a numpy array; must be called after preloading."""
+        self.preload_arena.seal()
+        self.preload_array_idxs = np.asarray(self.preload_array_idxs, dtype=np.int64).reshape(-1, len(self.preload_keys))
+        logger.debug(f"preloaded {len(self.preload_arena)} arrays in {len(self.preload_arena.segment_names)} "
+                     f"{self.preload_arena.backend} segment(s) ({self.preload_arena.get_size() / 2 ** 20:.1f} MB)")
+
+    def _get_preloaded_arrays(self, sample_idx):
+        """Returns a dictionary of the preloaded (read-only) arrays of a sample, with ``None`` for missing arrays."""
+        return {key: self.preload_arena[array_idx] if array_idx >= 0 else None
+                for key, array_idx in zip(self.preload_keys, self.preload_array_idxs[sample_idx].tolist())}
@@ -397,3 +397,212 @@ class FixedWeightSubsetSampler(torch.utils.data.sampler.Sampler):
         This number is the scaled size of the originally provided sample indices list.
         """
         return self.nb_samples
+
+
+def get_dataset_block_boundaries(dataset):
+    """Returns the sample indices at which the storage blocks (or chunks) of a dataset start, if it reports them.
+
+    Datasets report their block boundaries via a ``get_block_boundaries`` function that returns the index of the
+    first sample of each block, followed by the total sample count (see e.g.
+    :func:`thelper.data.parsers.HDF5Dataset.get_block_boundaries`). Concatenated datasets are also supported. If
+    the dataset (or one of the concatenated datasets) does not report its boundaries, ``None`` is returned.
+    """
+    if isinstance(dataset, torch.utils.data.ConcatDataset):
+        boundaries, offset = [], 0
+        for subdataset in dataset.datasets:
+            subboundaries = get_dataset_block_boundaries(subdataset)
+            if subboundaries is None:
+                return None
+            boundaries.append(np.asarray(subboundaries[:-1], dtype=np.int64) + offset)
+            offset += len(subdataset)
+        return np.append(np.concatenate(boundaries), offset)
+    if hasattr(dataset, "get_block_boundaries") and callable(dataset.get_block_boundaries):
+        boundaries = dataset.get_block_boundaries()
+        return np.asarray(boundaries, dtype=np.int64) if boundaries is not None else None
+    return None
+
+
+def get_sampling_locality_stats(order, block_ids, cache_size=1):
+    """Returns statistics on the storage locality and the randomness of a sampling order.
+
+    The locality is measured by simulating an LRU cache of ``cache_size`` decoded blocks, and by counting how many
+    blocks would need to be decoded per sample (1.0 is the worst case, and one over the block size is the best
+    case). The randomness is measured by the spread of each block's samples across the sampling order, i.e. the
+    average distance between the first and last sample of each block, normalized by the sample count (a uniformly
+    random permutation gives nearly 1.0, and sequential sampling gives one over the block count).
+
+    Args:
+        order: the sampled (storage) indices, in order.
+        block_ids: the array of block ids for all storage indices (i.e. ``block_ids[idx]`` is the block of ``idx``).
+        cache_size: number of decoded blocks kept in the simulated cache.
+
+    Returns:
+        A dictionary with the ``decodes_per_sample`` and ``block_spread`` values.
+    """
+    order = np.asarray(order, dtype=np.int64)
+    if len(order) == 0:
+        return {"decodes_per_sample": 0.0, "block_spread": 0.0}
+    order_block_ids = np.asarray(block_ids)[order]
+    cache, decodes = collections.OrderedDict(), 0
+    for block_id in order_block_ids.tolist():
+        if block_id in cache:
+            cache.move_to_end(block_id)
+            continue
+        decodes += 1
+        cache[block_id] = None
+        if len(cache) > cache_size:
+            cache.popitem(last=False)
+    _, block_inverse = np.unique(order_block_ids, return_inverse=True)
+    positions = np.arange(len(order))
+    first_pos = np.full(block_inverse.max() + 1, len(order), dtype=np.int64)
+    last_pos = np.zeros(block_inverse.max() + 1, dtype=np.int64)
+    np.minimum.at(first_pos, block_inverse, positions)
+    np.maximum.at(last_pos, block_inverse, positions)
+    block_spread = (last_pos - first_pos + 1).mean() / len(order)
+    return {"decodes_per_sample": decodes / len(order), "block_spread": float(block_spread)}
+
+
+class BlockShuffleSampler(torch.utils.data.sampler.Sampler):
+    r"""Samples elements in a locality-aware random order, for datasets stored in compressed blocks or chunks.
+
+    Fully random sampling over datasets stored in compressed chunks (e.g. HDF5 archives with ``chunk_lz4``
+    compression or block storage; see :class:`thelper.utils.HDF5BlockWriter`) means that nearly every sample requires
+    a different chunk to be decompressed. This sampler instead shuffles the order of the blocks, and then shuffles
+    the samples within a rolling window of ``window`` blocks: samples are drawn at random from the blocks of the
+    window, and each exhausted block is replaced in the window by the next one. As long as the dataset's block cache
+    can hold ``window + 1`` blocks, each block is then only decompressed about once per epoch. Larger windows give
+    more random orders, at the cost of a larger cache. Use :func:`get_sampling_locality_stats` (or the ``get_stats``
+    function) to measure this trade-off.
+
+    The block of each sample is determined from the block boundaries reported by the dataset (if it is given and
+    provides them; see :func:`get_dataset_block_boundaries`), or from a fixed ``block_size``. If the dataset has a
+    ``reserve_block_cache`` function, it will be called so that its cache can hold all blocks of the window (plus
+    one, as LRU caches may evict a block of the window instead of the exhausted one). Note that with multiple loader
+    workers, consecutive batches are loaded by different workers, each with their own cache; large batch sizes
+    (compared to the block size) therefore work best.
+
+    This sampler handles seeding based on the epoch number like the other samplers of this module, and scaling
+    (via duplication/decimation) of samples like :class:`SubsetRandomSampler`.
+
+    Example configuration file::
+
+        # ...
+        "loaders": {
+            # ...
+            "train_sampler": {
+                "type": "thelper.data.samplers.BlockShuffleSampler",
+                "params": {
+                    # number of blocks over which samples are shuffled at any time
+                    "window": 8,
+                    # only needed if the dataset does not report its block boundaries
+                    "block_size": 64
+                }
+            },
+            # ...
+        },
+        # ...
+
+    Attributes:
+        indices: list of sample indices to sample from.
+        block_boundaries: sorted array of the indices at which blocks start, followed by the total sample count.
+        window: number of blocks over which samples are shuffled at any time.
+        num_samples: number of sample indices to generate for each epoch (scaled size of the indices list).
+        seeds: dictionary of seeds to use when initializing RNG state.
+        epoch: epoch number used to reinitialize the RNG to an epoch-specific state.
+
+    .. seealso::
+        | :class:`thelper.utils.HDF5BlockReader`
+        | :class:`thelper.data.parsers.HDF5Dataset`
+    """
+
+    def __init__(self, indices, window=8, block_size=None, dataset=None, seeds=None, epoch=0, scale=1.0):
+        """Receives sample indices, the shuffling window size, and the block layout (or a dataset that has one)."""
+        super().__init__(indices)
+        assert isinstance(window, int) and window >= 1, "invalid window size (should be a positive block count)"
+        self.seeds = {}
+        if seeds is not None:
+            assert isinstance(seeds, dict), "unexpected seed pack type"
+            self.seeds = seeds
+        assert isinstance(epoch, int) and epoch >= 0, "invalid epoch index value"
+        self.epoch = epoch
+        self.indices = indices
+        self.window = window
+        assert isinstance(scale, float) and scale >= 0, "invalid scale parameter; should be greater than zero"
+        self.num_samples = int(round(len(self.indices) * scale))
+        max_index = int(np.max(indices)) + 1 if len(indices) > 0 else 0
+        self.block_boundaries = get_dataset_block_boundaries(dataset) if dataset is not None else None
+        if self.block_boundaries is None:
+            assert block_size is not None and block_size >= 1, \
+                "missing block size (dataset does not report its block boundaries)"
+            self.block_boundaries = np.append(np.arange(0, max_index, block_size, dtype=np.int64), max_index)
+        assert self.block_boundaries[-1] >= max_index, "block boundaries do not cover all sample indices"
+        datasets = dataset.datasets if isinstance(dataset, torch.utils.data.ConcatDataset) else [dataset]
+        for subdataset in datasets:
+            if subdataset is not None and hasattr(subdataset, "reserve_block_cache") and \
+                    callable(subdataset.reserve_block_cache):
+                subdataset.reserve_block_cache(window + 1)
+
+    def set_epoch(self, epoch=0):
+        """Sets the current epoch number in order to offset the RNG state for sampling."""
+        assert isinstance(epoch, int) and epoch >= 0, "invalid epoch index value"
+        self.epoch = epoch
+
+    def get_block_ids(self, indices):
+        """Returns the block ids of the given sample indices."""
+        return np.searchsorted(self.block_boundaries, np.asarray(indices, dtype=np.int64), side="right") - 1
+
+    def _get_block_shuffled_indices(self, rng):
+        """Returns one full pass over the indices in block-shuffled order."""
+        indices = np.asarray(self.indices, dtype=np.int64)
+        block_ids = self.get_block_ids(indices)
+        sort_idxs = np.argsort(block_ids, kind="stable")
+        block_splits = np.flatnonzero(np.diff(block_ids[sort_idxs])) + 1
+        blocks = np.split(indices[sort_idxs], block_splits)
+        block_order = rng.permutation(len(blocks)).tolist()
+        pool, remaining, result = [], {}, []  # pool of (sample index, block) pairs of the active blocks
+        for block_idx in block_order[:self.window]:
+            pool.extend((idx, block_idx) for idx in blocks[block_idx].tolist())
+            remaining[block_idx] = len(blocks[block_idx])
+        next_block = min(self.window, len(blocks))
+        while pool:
+            pick = int(rng.integers(len(pool)))
+            pool[pick], pool[-1] = pool[-1], pool[pick]
+            idx, block_idx = pool.pop()
+            result.append(idx)
+            remaining[block_idx] -= 1
+            if remaining[block_idx] == 0 and next_block < len(blocks):
+                # the block is exhausted, replace it in the window by the next one
+                block_idx = block_order[next_block]
+                pool.extend((idx, block_idx) for idx in blocks[block_idx].tolist())
+                remaining[block_idx] = len(blocks[block_idx])
+                next_block += 1
+        return result
+
+    def __iter__(self):
+        if "torch" in self.seeds:
+            seed = self.seeds["torch"] + self.epoch
+        else:
+            seed = int(torch.randint(2 ** 31, (1,)).item())  # follows the global torch RNG state
+        rng = np.random.default_rng(seed)
+        result = []
+        while len(result) < self.num_samples:
+            result += self._get_block_shuffled_indices(rng)
+        self.epoch += 1
+        return iter(result[:self.num_samples])
+
+    def get_stats(self, cache_size=None):
+        """Returns the locality/randomness statistics of the current epoch's sampling order.
+
+        See :func:`get_sampling_locality_stats` for more information; the simulated cache holds as many blocks as
+        the shuffling window (plus one) by default.
+        """
+        epoch = self.epoch
+        order = list(iter(self))
+        self.epoch = epoch
+        storage_order = np.sort(np.asarray(self.indices, dtype=np.int64))
+        storage_ranks = np.searchsorted(storage_order, order)  # remaps sample indices to 0..N-1
+        block_ids = self.get_block_ids(storage_order)
+        return get_sampling_locality_stats(storage_ranks, block_ids, cache_size or self.window + 1)
+
+    def __len__(self):
+        return self.num_samples
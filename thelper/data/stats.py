@@ -0,0 +1,664 @@
+"""Dataset statistics module.
+
+This module contains the classes and functions used to compute dataset statistics such as class sample counts,
+per-pixel class histograms (for segmentation tasks), and per-band input data statistics (mean, std, min/max, and
+approximate percentiles) in a single streaming pass over any dataset. The pass can be split into shards that are
+processed in parallel by worker processes, and the results are cached in memory as well as on disk (next to the
+data, when possible) so that they can be reused to compute loss weights and normalization parameters without
+reloading the dataset. Per-band statistics can also be exported to a json file that normalization operations can
+load directly (see :func:`DatasetStatistics.save_band_stats`). Note that samplers do not use these statistics, as
+they rebalance the samples of their own split based on per-sample labels (see
+:class:`thelper.data.samplers.WeightedSubsetRandomSampler`).
+"""
+
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+import torch.utils.data
+import tqdm
+
+import thelper.tasks
+import thelper.utils
+
+logger = logging.getLogger(__name__)
+
+_stats_cache = {}
+"""In-memory cache of the statistics computed in this process, indexed by dataset/task key."""
+
+_stats_version = 2
+"""Version of the statistics format; part of the cache keys, so that outdated cache files are recomputed."""
+
+
+class QuantileSketch:
+    """Mergeable streaming quantile sketch for each column of 2D arrays (one column per band).
+
+    This is a KLL-like sketch: items are kept in a hierarchy of compactors, where items at level ``h`` each stand
+    for ``2 ** h`` original items. When a level exceeds its capacity, its items are sorted and every other item
+    (with a random offset) is promoted to the next level. Higher levels have larger capacities, so the memory
+    footprint stays in ``O(size)`` per band while the rank error of quantile estimates is roughly ``O(1 / size)``.
+    Since compaction only relies on sorting, all columns are compacted at once with vectorized operations. Two
+    sketches can be merged by concatenating their levels before compacting them again, which allows sketches
+    computed over dataset shards in different processes to be combined.
+
+    Attributes:
+        size: capacity of the top level (larger = more accurate, but more memory and slower compactions).
+        levels: list of item arrays of shape ``(N, bands)`` for each level (``None`` for empty levels).
+    """
+
+    def __init__(self, size=512, seed=0):
+        """Initializes an empty sketch with a given top-level capacity and compaction RNG seed."""
+        assert int(size) >= 8, "sketch size should be at least 8"
+        self.size = int(size)
+        self.levels = []
+        self.rng = np.random.default_rng(seed)
+
+    def _get_capacity(self, level):
+        """Returns the capacity of a level (capacities decrease geometrically from the top level)."""
+        return max(int(self.size * (2 / 3) ** (len(self.levels) - 1 - level)), 8)
+
+    def _append(self, level, items):
+        """Appends items to a level, creating it if needed."""
+        while len(self.levels) <= level:
+            self.levels.append(None)
+        self.levels[level] = items if self.levels[level] is None else np.concatenate([self.levels[level], items])
+
+    def _compress(self):
+        """Compacts all levels that exceed their capacity, from the bottom to the top of the hierarchy."""
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if items is not None and len(items) > self._get_capacity(level):
+                items = np.sort(items, axis=0)
+                if len(items) % 2:
+                    self.levels[level], items = items[-1:], items[:-1]  # keep one item, so weights stay exact
+                else:
+                    self.levels[level] = None
+                self._append(level + 1, items[int(self.rng.integers(2))::2])
+            level += 1
+
+    def update(self, array):
+        """Adds the rows of a ``(N, bands)`` array to the sketch."""
+        array = np.asarray(array, dtype=np.float64)
+        assert array.ndim == 2, "sketch expects 2D arrays with one column per band"
+        if len(array) > 0:
+            self._append(0, array)
+            self._compress()
+
+    def merge(self, other):
+        """Merges another sketch (computed over other items of the same bands) into this one."""
+        assert isinstance(other, QuantileSketch), "unexpected sketch type"
+        for level, items in enumerate(other.levels):
+            if items is not None:
+                self._append(level, items)
+        self._compress()
+        return self
+
+    def get_quantiles(self, quantiles):
+        """Returns the estimated quantiles (in ``[0, 1]``) of each band, as a ``(len(quantiles), bands)`` array."""
+        levels = [(level, items) for level, items in enumerate(self.levels) if items is not None]
+        assert levels, "sketch is empty"
+        items = np.concatenate([items for _, items in levels])
+        weights = np.concatenate([np.full(len(items), 2.0 ** level) for level, items in levels])
+        order = np.argsort(items, axis=0)
+        sorted_items = np.take_along_axis(items, order, axis=0)
+        cum_weights = np.cumsum(weights[order], axis=0)
+        band_idxs = np.arange(items.shape[1])
+        result = []
+        for quantile in np.atleast_1d(np.asarray(quantiles, dtype=np.float64)):
+            assert 0 <= quantile <= 1, "quantiles should be in [0, 1]"
+            rank_idxs = np.argmax(cum_weights >= quantile * cum_weights[-1], axis=0)
+            result.append(sorted_items[rank_idxs, band_idxs])
+        return np.stack(result)
+
+    def state_dict(self):
+        """Returns a json-compatible dictionary of the sketch."""
+        return {"size": self.size, "levels": [items.tolist() if items is not None else None for items in self.levels]}
+
+    def load_state_dict(self, state):
+        """Reloads the sketch from a dictionary created by :func:`state_dict`."""
+        self.size = state["size"]
+        self.levels = [np.asarray(items, dtype=np.float64) if items is not None else None for items in state["levels"]]
+        return self
+
+
+class DatasetStatistics:
+    """Holds the class counts and per-band input statistics of a dataset, and updates them one sample at a time.
+
+    For classification tasks, the class counts are the number of samples of each class. For segmentation tasks,
+    the class counts are the number of samples in which each class appears, and the per-pixel class histogram
+    (i.e. the number of elements of each class in all label maps) is also kept. Input statistics are computed
+    for each band (i.e. each channel of the input arrays) using Welford's online algorithm, and partial statistics
+    computed over different subsets of a dataset can be merged together with :func:`merge`. The minimum and
+    maximum value of each band are also tracked, and percentiles can be estimated with a :class:`QuantileSketch`
+    (disabled by default, as it is much more costly than the other statistics).
+
+    Attributes:
+        class_names: list of class names of the task (``None`` if it is not a classification/segmentation task).
+        sample_count: number of samples that were accumulated.
+        class_counts: array of sample counts for each class.
+        pixel_counts: array of element counts for each class (segmentation tasks only).
+        dontcare_count: number of elements labeled with the 'dontcare' value (segmentation tasks only).
+        unknown_count: number of elements labeled with values that are not mapped to any class.
+        band_count: number of input elements accumulated for each band.
+        band_mean: array of the running mean of each input band.
+        band_m2: array of the running sum of squared differences to the mean of each input band.
+        band_min: array of the minimum value of each input band.
+        band_max: array of the maximum value of each input band.
+        band_sketch: quantile sketch of the values of each input band (``None`` if disabled).
+        key: identifier of the dataset/task pair the statistics were computed for (used for caching).
+
+    .. seealso::
+        | :func:`thelper.data.stats.compute_dataset_stats`
+        | :func:`thelper.data.stats.get_dataset_stats`
+    """
+
+    def __init__(self, task=None, band_axis=-1, input_key=None, sketch_size=0, band_stats=True, key=None):
+        """Initializes empty statistics for a given task.
+
+        Args:
+            task: the task defining the input/groundtruth keys and classes (may be ``None`` for input stats only).
+            band_axis: axis of the input arrays that corresponds to bands (i.e. channels); -1 = last (HxWxC).
+            input_key: key of the input arrays in samples (by default, the input key of the task).
+            sketch_size: size of the quantile sketch used to estimate percentiles (0 = disabled).
+            band_stats: toggles whether per-band input statistics should be accumulated (e.g. not needed for loss
+                weights, which only depend on class counts).
+            key: identifier of the dataset/task pair the statistics are computed for (used for caching).
+        """
+        self.task = task
+        self.band_axis = band_axis
+        self.input_key = None
+        if band_stats:
+            self.input_key = input_key if input_key is not None else getattr(task, "input_key", None)
+        self.sketch_size = sketch_size if band_stats else 0
+        self.key = key
+        self.class_names = None
+        if isinstance(task, (thelper.tasks.Classification, thelper.tasks.Segmentation)):
+            self.class_names = list(task.class_names)
+        self.sample_count = 0
+        self.class_counts = np.zeros(len(self.class_names), dtype=np.int64) if self.class_names else None
+        self.pixel_counts = None
+        if isinstance(task, thelper.tasks.Segmentation):
+            self.pixel_counts = np.zeros(len(self.class_names), dtype=np.int64)
+        self.dontcare_count = 0
+        self.unknown_count = 0
+        self.band_count = 0
+        self.band_mean = None
+        self.band_m2 = None
+        self.band_min = None
+        self.band_max = None
+        self.band_sketch = QuantileSketch(self.sketch_size) if self.sketch_size else None
+
+    @property
+    def band_std(self):
+        """Returns the (population) standard deviation of each input band, or ``None`` if no input was seen."""
+        if self.band_m2 is None:
+            return None
+        return np.sqrt(self.band_m2 / max(self.band_count, 1))
+
+    def update(self, sample):
+        """Accumulates the labels and input data of a loaded sample (dictionary) into the statistics."""
+        self.sample_count += 1
+        if self.input_key is not None and self.input_key in sample and sample[self.input_key] is not None:
+            self._update_bands(_to_array(sample[self.input_key]))
+        if self.task is None or self.task.gt_key is None or self.task.gt_key not in sample or sample[self.task.gt_key] is None:
+            return
+        if isinstance(self.task, thelper.tasks.Segmentation):
+            self._update_label_map(_to_array(sample[self.task.gt_key]))
+        elif isinstance(self.task, thelper.tasks.Classification):
+            self._update_label(sample[self.task.gt_key])
+
+    def _update_bands(self, array):
+        """Accumulates the per-band statistics of an input array using a batched Welford update."""
+        if array.ndim > 2:
+            array = np.moveaxis(array, self.band_axis, -1)
+            array = array.reshape(-1, array.shape[-1])
+        else:
+            array = array.reshape(-1, 1)
+        if array.shape[0] == 0:
+            return
+        array = array.astype(np.float64, copy=False)
+        count = array.shape[0]
+        mean = array.mean(axis=0)
+        m2 = np.square(array - mean).sum(axis=0)
+        self._merge_bands(count, mean, m2, array.min(axis=0), array.max(axis=0))
+        if self.band_sketch is not None:
+            self.band_sketch.update(array)
+
+    def _merge_bands(self, count, mean, m2, min_val, max_val):
+        """Merges the per-band count, mean, m2, and min/max values of another data subset (Chan et al.'s formula)."""
+        if self.band_mean is None:
+            self.band_count, self.band_mean, self.band_m2 = count, mean.copy(), m2.copy()
+            self.band_min, self.band_max = min_val.copy(), max_val.copy()
+            return
+        assert self.band_mean.shape == mean.shape, \
+            f"input band count mismatch ({self.band_mean.shape[0]} vs {mean.shape[0]})"
+        total = self.band_count + count
+        delta = mean - self.band_mean
+        self.band_mean += delta * (count / total)
+        self.band_m2 += m2 + np.square(delta) * (self.band_count * count / total)
+        self.band_count = total
+        np.minimum(self.band_min, min_val, out=self.band_min)
+        np.maximum(self.band_max, max_val, out=self.band_max)
+
+    def _update_label_map(self, labels):
+        """Accumulates the per-class element counts of a segmentation label map."""
+        labels = labels.reshape(-1)
+        if labels.size == 0:
+            return
+        if np.issubdtype(labels.dtype, np.integer) and labels.min() >= 0 and labels.max() < 2 ** 16:
+            value_counts = np.bincount(labels.astype(np.intp, copy=False), minlength=1)
+            values = np.flatnonzero(value_counts)
+            value_counts = value_counts[values]
+        else:
+            values, value_counts = np.unique(labels, return_counts=True)
+        value_map = {value: count for value, count in zip(values.tolist(), value_counts.tolist())}
+        for class_idx, class_name in enumerate(self.class_names):
+            count = value_map.pop(self.task.class_indices[class_name], 0)
+            self.pixel_counts[class_idx] += count
+            self.class_counts[class_idx] += count > 0
+        if self.task.dontcare is not None:
+            self.dontcare_count += value_map.pop(self.task.dontcare, 0)
+        self.unknown_count += sum(value_map.values())
+
+    def _update_label(self, label):
+        """Accumulates the class sample counts of a classification label (or multi-label list/flags)."""
+        if isinstance(label, torch.Tensor):
+            label = label.cpu().numpy()
+        if self.task.multi_label and not isinstance(label, str) and not thelper.utils.is_scalar(label):
+            label = list(label)
+            if all([isinstance(gt, str) for gt in label]):
+                for gt in label:
+                    self.class_counts[self.task.class_indices[gt]] += 1
+            else:
+                assert len(label) == len(self.class_names), "unexpected multi-label one-hot vector shape"
+                self.class_counts += np.asarray(label, dtype=bool)
+            return
+        if isinstance(label, str):
+            assert label in self.task.class_indices, f"label '{label}' not found in task class names"
+            self.class_counts[self.task.class_indices[label]] += 1
+        else:
+            label = int(np.asarray(label).item())
+            assert 0 <= label < len(self.class_names), "class name given as out-of-range index"
+            self.class_counts[label] += 1
+
+    def merge(self, other):
+        """Merges the statistics computed over another subset of the same dataset into this object."""
+        assert isinstance(other, DatasetStatistics), "unexpected statistics object type"
+        assert self.class_names == other.class_names, "cannot merge statistics with different class names"
+        self.sample_count += other.sample_count
+        if self.class_counts is not None:
+            self.class_counts += other.class_counts
+        if self.pixel_counts is not None:
+            self.pixel_counts += other.pixel_counts
+        self.dontcare_count += other.dontcare_count
+        self.unknown_count += other.unknown_count
+        if other.band_mean is not None:
+            self._merge_bands(other.band_count, other.band_mean, other.band_m2, other.band_min, other.band_max)
+            if self.band_sketch is not None and other.band_sketch is not None:
+                self.band_sketch.merge(other.band_sketch)
+        return self
+
+    def get_class_sizes(self):
+        """Returns a map of class sizes, as returned by the ``get_class_sizes`` function of the task.
+
+        For segmentation tasks, the sizes are element (pixel) counts, and the 'dontcare' count is also returned
+        if the task defines a 'dontcare' value.
+        """
+        assert self.class_names is not None, "task does not define classes"
+        counts = self.pixel_counts if self.pixel_counts is not None else self.class_counts
+        class_sizes = {class_name: int(count) for class_name, count in zip(self.class_names, counts)}
+        if self.pixel_counts is not None and self.task.dontcare is not None:
+            class_sizes["dontcare"] = int(self.dontcare_count)
+        return class_sizes
+
+    def get_class_weights(self, stype="linear", **kwargs):
+        """Returns a map of class weights computed from the class sizes of the whole dataset (e.g. for loss weights).
+
+        See :func:`thelper.data.utils.get_class_weights` for more information on the arguments.
+        """
+        import thelper.data.utils
+        return thelper.data.utils.get_class_weights(self.get_class_sizes(), stype, **kwargs)
+
+    def get_normalization_params(self):
+        """Returns the per-band mean and std values, as expected by the normalization operation.
+
+        .. seealso::
+            | :class:`thelper.transforms.operations.NormalizeZeroMeanUnitVar`
+        """
+        assert self.band_mean is not None, "no input data was accumulated"
+        std = self.band_std
+        return {"mean": self.band_mean.tolist(), "std": np.where(std > 0, std, 1.0).tolist()}
+
+    def get_band_percentiles(self, percentiles):
+        """Returns the estimated percentiles (in ``[0, 100]``) of each band, as a ``(len(percentiles), bands)`` array.
+
+        The exact minimum and maximum values are returned for the 0th and 100th percentiles.
+        """
+        assert self.band_sketch is not None, "quantile sketch is disabled"
+        assert self.band_mean is not None, "no input data was accumulated"
+        percentiles = np.atleast_1d(np.asarray(percentiles, dtype=np.float64))
+        values = self.band_sketch.get_quantiles(percentiles / 100)
+        values[percentiles == 0] = self.band_min
+        values[percentiles == 100] = self.band_max
+        return values
+
+    def get_band_stats(self, percentiles=(1, 5, 50, 95, 99)):
+        """Returns a json-compatible dictionary of the per-band statistics.
+
+        The dictionary contains the number of elements per band (``count``), and the per-band ``mean``, ``std``,
+        ``min``, and ``max`` value lists, as well as a map of per-band percentile value lists (if the quantile
+        sketch is enabled). The ``mean`` and ``std`` lists can be used directly as normalization parameters.
+        """
+        band_stats = {
+            "count": int(self.band_count),
+            **self.get_normalization_params(),
+            "min": self.band_min.tolist(),
+            "max": self.band_max.tolist(),
+        }
+        if self.band_sketch is not None and percentiles:
+            band_stats["percentiles"] = {
+                str(percentile): values.tolist()
+                for percentile, values in zip(percentiles, self.get_band_percentiles(percentiles))
+            }
+        return band_stats
+
+    def save_band_stats(self, path, percentiles=(1, 5, 50, 95, 99)):
+        """Saves the per-band statistics to a json file that normalization operations can load directly.
+
+        For example, to normalize the input images of a dataset using the saved statistics::
+
+            # ...
+            "transforms": [
+                {
+                    "operation": "thelper.transforms.NormalizeZeroMeanUnitVar",
+                    "params": {
+                        "stats_path": "<path_to_band_stats.json>"
+                    },
+                    "target_keys": ["image"]
+                },
+                # ...
+            ]
+
+        .. seealso::
+            | :class:`thelper.transforms.operations.NormalizeZeroMeanUnitVar`
+        """
+        with open(path, "w") as fd:
+            json.dump(self.get_band_stats(percentiles), fd, indent=4)
+
+    def state_dict(self):
+        """Returns a json-compatible dictionary of the statistics (without the task object)."""
+        return {
+            "key": self.key,
+            "band_axis": self.band_axis,
+            "input_key": self.input_key,
+            "class_names": self.class_names,
+            "sample_count": self.sample_count,
+            "class_counts": self.class_counts.tolist() if self.class_counts is not None else None,
+            "pixel_counts": self.pixel_counts.tolist() if self.pixel_counts is not None else None,
+            "dontcare_count": self.dontcare_count,
+            "unknown_count": self.unknown_count,
+            "band_count": self.band_count,
+            "band_mean": self.band_mean.tolist() if self.band_mean is not None else None,
+            "band_m2": self.band_m2.tolist() if self.band_m2 is not None else None,
+            "band_min": self.band_min.tolist() if self.band_min is not None else None,
+            "band_max": self.band_max.tolist() if self.band_max is not None else None,
+            "band_sketch": self.band_sketch.state_dict() if self.band_sketch is not None else None,
+        }
+
+    def load_state_dict(self, state):
+        """Reloads the statistics from a dictionary created by :func:`state_dict`."""
+        assert state["class_names"] == self.class_names, "cannot reload statistics with different class names"
+        self.key, self.band_axis, self.input_key = state["key"], state["band_axis"], state["input_key"]
+        self.sample_count = state["sample_count"]
+        self.dontcare_count, self.unknown_count = state["dontcare_count"], state["unknown_count"]
+        for name in ["class_counts", "pixel_counts"]:
+            setattr(self, name, np.asarray(state[name], dtype=np.int64) if state[name] is not None else None)
+        self.band_count = state["band_count"]
+        for name in ["band_mean", "band_m2", "band_min", "band_max"]:
+            setattr(self, name, np.asarray(state[name], dtype=np.float64) if state[name] is not None else None)
+        self.band_sketch = None
+        if state["band_sketch"] is not None:
+            self.band_sketch = QuantileSketch().load_state_dict(state["band_sketch"])
+            self.sketch_size = self.band_sketch.size
+        return self
+
+    def save(self, path):
+        """Saves the statistics to a json file."""
+        with open(path, "w") as fd:
+            json.dump(self.state_dict(), fd, indent=4)
+
+    def __repr__(self):
+        """Returns a print-friendly representation of the statistics."""
+        return self.__class__.__module__ + "." + self.__class__.__qualname__ + \
+            f"(key={repr(self.key)}, sample_count={self.sample_count})"
+
+
+def load_band_stats(path):
+    """Loads per-band statistics saved by :func:`DatasetStatistics.save_band_stats` (``mean``/``std`` as arrays)."""
+    with open(path, "r") as fd:
+        band_stats = json.load(fd)
+    assert "mean" in band_stats and "std" in band_stats, f"invalid band statistics file: {path}"
+    for key in ["mean", "std", "min", "max"]:
+        if key in band_stats:
+            band_stats[key] = np.asarray(band_stats[key], dtype=np.float64)
+    return band_stats
+
+
+def _to_array(data):
+    """Converts a sample element (tensor, PIL image, or array-like) to a numpy array."""
+    if isinstance(data, torch.Tensor):
+        return data.detach().cpu().numpy()
+    return np.asarray(data)
+
+
+def _get_datasets(dataset):
+    """Returns the list of datasets wrapped by a dataset (i.e. all concatenated datasets, or itself)."""
+    return dataset.datasets if isinstance(dataset, torch.utils.data.ConcatDataset) else [dataset]
+
+
+@contextlib.contextmanager
+def _disable_transforms(dataset):
+    """Temporarily disables the transforms of a dataset (or of all concatenated datasets) to load raw samples."""
+    datasets = [d for d in _get_datasets(dataset) if getattr(d, "transforms", None) is not None]
+    transforms = [d.transforms for d in datasets]
+    for d in datasets:
+        d.transforms = None
+    try:
+        yield dataset
+    finally:
+        for d, t in zip(datasets, transforms):
+            d.transforms = t
+
+
+def _get_data_stamp(dataset):
+    """Returns the size and modification time of the data file/directory of a dataset, or ``None`` if unknown."""
+    paths = [getattr(dataset, "root", None), getattr(getattr(dataset, "archive", None), "filename", None),
+             getattr(dataset, "hdf5_path", None)]
+    stamp = []
+    for path in [path for path in paths if isinstance(path, str) and os.path.exists(path)]:
+        if os.path.isdir(path):
+            # the directory's own mtime changes when statistics are saved in it, so stamp its top-level entries
+            entries = [e for e in os.scandir(path) if not e.name.startswith("thelper-stats-")]
+            stamp.append([len(entries), sum([e.stat().st_size for e in entries]),
+                          max([e.stat().st_mtime for e in entries], default=0)])
+        else:
+            stamp.append([os.path.getsize(path), os.path.getmtime(path)])
+    return stamp or None
+
+
+_worker_dataset = None
+"""Dataset/task/statistics arguments tuple set in statistics worker processes by :func:`_init_stats_worker`."""
+
+
+def _init_stats_worker(dataset, task, stats_kwargs):
+    """Initializes a statistics worker process (the dataset is only transferred once per worker)."""
+    global _worker_dataset
+    _worker_dataset = (dataset, task, stats_kwargs)
+
+
+def _compute_shard_stats(start, end, dataset=None, task=None, stats_kwargs=None):
+    """Returns the statistics of a contiguous range of samples (in a worker process if no dataset is given)."""
+    if dataset is None:
+        dataset, task, stats_kwargs = _worker_dataset
+    stats = DatasetStatistics(task, **stats_kwargs)
+    for idx in range(start, end):
+        stats.update(dataset[idx])
+    return stats
+
+
+def compute_dataset_stats(dataset, task=None, num_workers=0, band_axis=-1, input_key=None, sketch_size=0,
+                          band_stats=True, shard_size=256, progress_bar=False):
+    """Computes the class counts and per-band input statistics of a dataset in a single (parallel) pass.
+
+    The dataset is split into contiguous shards of ``shard_size`` samples (contiguous shards preserve the
+    storage locality of chunked archives) that are processed by ``num_workers`` worker processes, and the partial
+    statistics of all shards are merged in the calling process. If the dataset cannot be pickled to be sent to
+    the workers, it is processed in the calling process instead. Any dataset that returns sample dictionaries is
+    supported; if it has no task, an ``input_key`` must be given, and only per-band statistics are computed. The
+    transforms of the dataset (e.g. random augmentations) are disabled while statistics are computed, so that
+    the results describe the raw data and do not vary across runs.
+
+    Args:
+        dataset: the dataset to compute the statistics of (samples must be dictionaries).
+        task: the task defining the input/groundtruth keys and classes (by default, the dataset's task).
+        num_workers: number of worker processes to use (0 = process all samples in the calling process).
+        band_axis: axis of the input arrays that corresponds to bands (i.e. channels); -1 = last (HxWxC).
+        input_key: key of the input arrays in samples (by default, the input key of the task).
+        sketch_size: size of the quantile sketch used to estimate percentiles (0 = disabled).
+        band_stats: toggles whether per-band input statistics should be computed (class counts are always computed).
+        shard_size: number of samples in each shard processed by a worker.
+        progress_bar: toggles whether a progress bar should be displayed while processing shards.
+
+    Returns:
+        The :class:`DatasetStatistics` of the dataset.
+    """
+    task = task if task is not None else getattr(dataset, "task", None)
+    assert task is None or isinstance(task, thelper.tasks.Task), "invalid task object"
+    assert int(shard_size) >= 1, "shard size should be strictly positive"
+    assert task is not None or (band_stats and input_key is not None), "need a task or an input key to compute statistics"
+    stats_kwargs = {"band_axis": band_axis, "input_key": input_key, "sketch_size": sketch_size, "band_stats": band_stats}
+    shards = [(start, min(start + int(shard_size), len(dataset))) for start in range(0, len(dataset), int(shard_size))]
+    with _disable_transforms(dataset):
+        return _compute_stats(dataset, task, shards, stats_kwargs, num_workers, progress_bar)
+
+
+def _compute_stats(dataset, task, shards, stats_kwargs, num_workers, progress_bar):
+    """Computes and merges the statistics of all shards of a dataset (see :func:`compute_dataset_stats`)."""
+    stats = DatasetStatistics(task, **stats_kwargs)
+    if num_workers > 0 and len(shards) > 1:
+        try:
+            import pickle
+            pickle.dumps(dataset)
+        except Exception as e:
+            logger.warning(f"cannot send dataset to statistics workers ({e}); will process it in this process")
+            num_workers = 0
+    if num_workers <= 0 or len(shards) <= 1:
+        for start, end in tqdm.tqdm(shards, desc="computing dataset statistics", disable=not progress_bar):
+            stats.merge(_compute_shard_stats(start, end, dataset=dataset, task=task, stats_kwargs=stats_kwargs))
+        return stats
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, initializer=_init_stats_worker,
+                                                initargs=(dataset, task, stats_kwargs)) as executor:
+        futures = [executor.submit(_compute_shard_stats, start, end) for start, end in shards]
+        for future in tqdm.tqdm(futures, desc="computing dataset statistics", disable=not progress_bar):
+            stats.merge(future.result())  # merged in order, so results do not depend on worker scheduling
+    return stats
+
+
+def get_dataset_stats_key(dataset, task=None, band_axis=-1, input_key=None, sketch_size=0, band_stats=True):
+    """Returns a key identifying a dataset/task pair, or ``None`` if the dataset has no stable representation.
+
+    The key is derived from the representation strings of the dataset (or of all concatenated datasets, without
+    their transforms, which are disabled when computing statistics), of its data location (``root`` and ``subset``
+    attributes, if any), of the size and modification time of its data files, and of the task, so it changes
+    whenever the dataset parameters (e.g. its root), its data, or the task change.
+    """
+    task = task if task is not None else getattr(dataset, "task", None)
+    dataset_reprs = []
+    with _disable_transforms(dataset):
+        for d in _get_datasets(dataset):
+            location = [getattr(getattr(d, name), "name", getattr(d, name)) for name in ["root", "subset"] if hasattr(d, name)]
+            dataset_reprs.append(repr(d) + repr(location) + repr(_get_data_stamp(d)))
+    if any([" at 0x" in r for r in dataset_reprs]):
+        return None  # default object representations change across runs
+    stats_args = [repr(task), str(len(dataset)), str(_stats_version)]
+    if band_stats:
+        stats_args += [str(band_axis), repr(input_key), str(sketch_size)]
+    key_str = "\n".join(dataset_reprs + stats_args)
+    return hashlib.sha1(key_str.encode()).hexdigest()
+
+
+def get_default_stats_path(dataset, key):
+    """Returns the default path where the statistics of a dataset are saved (next to its data), if any.
+
+    The data location is determined from the ``root`` attribute of the dataset, or from the path of its HDF5
+    archive. If the location cannot be determined (e.g. for concatenated datasets), ``None`` is returned.
+    """
+    root = getattr(dataset, "root", None)
+    if root is None and hasattr(dataset, "archive"):
+        root = getattr(dataset.archive, "filename", None)
+    if key is None or not isinstance(root, str) or not os.path.exists(root):
+        return None
+    if os.path.isdir(root):
+        return os.path.join(root, f"thelper-stats-{key[:16]}.json")
+    return os.path.join(os.path.dirname(os.path.abspath(root)), f"{os.path.basename(root)}.stats-{key[:16]}.json")
+
+
+def get_dataset_stats(dataset, task=None, cache_path=None, num_workers=0, band_axis=-1, input_key=None,
+                      sketch_size=0, band_stats=True, force=False, progress_bar=True):
+    """Returns the statistics of a dataset, reusing cached results whenever possible.
+
+    Statistics are cached in memory for the lifetime of the process, and on disk in a json file. By default, this
+    file is saved next to the data (see :func:`get_default_stats_path`); if the statistics cannot be saved, a
+    warning is logged and the results are only cached in memory. Cached results are only reused if the dataset
+    and task representations and the data files have not changed since they were computed (see
+    :func:`get_dataset_stats_key`).
+
+    Args:
+        dataset: the dataset to compute the statistics of (samples must be dictionaries).
+        task: the task defining the input/groundtruth keys and classes (by default, the dataset's task).
+        cache_path: path to the json file where statistics are cached (``None`` = use the default path).
+        num_workers: number of worker processes to use if statistics need to be computed.
+        band_axis: axis of the input arrays that corresponds to bands (i.e. channels); -1 = last (HxWxC).
+        input_key: key of the input arrays in samples (by default, the input key of the task).
+        sketch_size: size of the quantile sketch used to estimate percentiles (0 = disabled).
+        band_stats: toggles whether per-band input statistics should be computed (class counts are always computed).
+        force: toggles whether cached statistics should be ignored and recomputed.
+        progress_bar: toggles whether a progress bar should be displayed while computing statistics.
+
+    Returns:
+        The :class:`DatasetStatistics` of the dataset.
+    """
+    task = task if task is not None else getattr(dataset, "task", None)
+    key = get_dataset_stats_key(dataset, task, band_axis, input_key, sketch_size, band_stats)
+    if cache_path is None:
+        cache_path = get_default_stats_path(dataset, key)
+    if not force and key is not None:
+        if key in _stats_cache:
+            return _stats_cache[key]
+        if cache_path is not None and os.path.isfile(cache_path):
+            with open(cache_path, "r") as fd:
+                state = json.load(fd)
+            if state.get("key") == key:
+                logger.debug(f"reloading dataset statistics from '{cache_path}'")
+                _stats_cache[key] = DatasetStatistics(task, input_key=input_key, band_stats=band_stats).load_state_dict(state)
+                return _stats_cache[key]
+            logger.debug(f"ignoring outdated dataset statistics at '{cache_path}'")
+    stats = compute_dataset_stats(dataset, task=task, num_workers=num_workers, band_axis=band_axis,
+                                  input_key=input_key, sketch_size=sketch_size, band_stats=band_stats,
+                                  progress_bar=progress_bar)
+    stats.key = key
+    if key is not None:
+        _stats_cache[key] = stats
+        if cache_path is not None:
+            try:
+                stats.save(cache_path)
+                logger.debug(f"saved dataset statistics to '{cache_path}'")
+            except OSError as e:
+                logger.warning(f"could not save dataset statistics to '{cache_path}': {e}")
+    return stats
@@ -13,6 +13,7 @@ import sys
 import numpy as np
 import tqdm
 
+import thelper.data.codecs
 import thelper.tasks
 import thelper.transforms
 import thelper.utils
@@ -366,9 +367,12 @@ def create_hdf5(archive_path, task, train_loader, valid_loader, test_loader, com
     contain three groups (`train`, `valid`, and `test`), and each group will contain a dataset for each element
     originally found in the samples.
 
-    Note that the compression operates at the sample level, not at the dataset level. This means that elements of
-    each sample will be compressed individually, not as an array. Therefore, if you are trying to compress very
-    correlated samples (e.g. frames in a video sequence), this approach will be pretty bad.
+    Note that by default, the compression operates at the sample level, not at the dataset level. This means that
+    elements of each sample will be compressed individually, not as an array. Therefore, if you are trying to
+    compress very correlated samples (e.g. frames in a video sequence), this approach will be pretty bad. In that
+    case, a ``block_size`` can be specified for an element, and the elements of that many consecutive samples will
+    be compressed together using a byte codec (e.g. ``lz4`` or ``zstd``); see :class:`thelper.utils.HDF5BlockWriter`
+    for more information.
 
     Args:
         archive_path: path pointing where the HDF5 archive should be created.
@@ -388,7 +392,7 @@ def create_hdf5(archive_path, task, train_loader, valid_loader, test_loader, com
             # each field is a key that corresponds to an element in each sample
             "key1": {
                 # the 'type' identifies the compression approach to use
-                # (see thelper.utils.encode_data for more information)
+                # (see thelper.data.codecs for the list of available codecs)
                 "type": "jpg",
                 # extra parameters might be needed to encode the data
                 # (see thelper.utils.encode_data for more information)
@@ -401,6 +405,11 @@ def create_hdf5(archive_path, task, train_loader, valid_loader, test_loader, com
                 # this explicitly means that no encoding should be performed
                 "type": "none"
             },
+            "key3": {
+                # this means that blocks of 64 consecutive elements will be compressed together
+                "type": "zstd",
+                "block_size": 64
+            },
             ...
             # if a key is missing, its elements will not be compressed
         }
@@ -410,6 +419,7 @@ def create_hdf5(archive_path, task, train_loader, valid_loader, test_loader, com
         | :class:`thelper.data.parsers.HDF5Dataset`
         | :func:`thelper.utils.encode_data`
         | :func:`thelper.utils.decode_data`
+        | :mod:`thelper.data.codecs`
     """
     if compression is None:
         compression = {}
@@ -430,7 +440,11 @@ def create_hdf5(archive_path, task, train_loader, valid_loader, test_loader, com
             compr_type = thelper.utils.get_key_def("type", config, default="none")
             encode_params = thelper.utils.get_key_def("encode_params", config, default={})
             flatten_arrays = thelper.utils.get_key_def("flatten", config, default=False)
-            return compr_type, encode_params, flatten_arrays
+            block_size = thelper.utils.get_key_def("block_size", config, default=None)
+            encoder = None  # encoders are resolved once per key (chunk filters are applied by hdf5 itself)
+            if compr_type not in thelper.utils.chunk_compression_flags and not block_size:
+                encoder = thelper.data.codecs.get_encoder(compr_type, **encode_params)
+            return compr_type, encode_params, flatten_arrays, encoder, block_size
 
         for loader, group in [(train_loader, "train"), (valid_loader, "valid"), (test_loader, "test")]:
             if loader is None:
@@ -442,7 +456,17 @@ def create_hdf5(archive_path, task, train_loader, valid_loader, test_loader, com
             for batch in tqdm.tqdm(loader, desc=f"packing {group} loader"):
                 for key in target_keys:
                     tensor = thelper.utils.to_numpy(batch[key])
-                    if datasets[key] is None:
+                    block_size = datasets_compr[key][4]
+                    if datasets[key] is None and block_size:
+                        datasets[key] = thelper.utils.HDF5BlockWriter(
+                            fd=fd,
+                            name=group + "/" + key,
+                            max_len=max_dataset_len,
+                            batch_like=tensor,
+                            compression=datasets_compr[key][0],
+                            block_size=block_size,
+                            **datasets_compr[key][1])
+                    elif datasets[key] is None:
                         datasets[key] = thelper.utils.create_hdf5_dataset(
                             fd=fd,
                             name=group + "/" + key,
@@ -451,6 +475,11 @@ def create_hdf5(archive_path, task, train_loader, valid_loader, test_loader, com
                             compression=datasets_compr[key][:2],
                             chunk_size=None,  # will auto-compute
                             flatten=datasets_compr[key][2])
+                    if block_size:
+                        for idx in range(tensor.shape[0]):
+                            datasets[key].append(tensor[idx])
+                        datasets_len[key] += tensor.shape[0]
+                        continue
                     for idx in range(tensor.shape[0]):
                         thelper.utils.fill_hdf5_sample(
                             dset=datasets[key],
@@ -458,12 +487,15 @@ def create_hdf5(archive_path, task, train_loader, valid_loader, test_loader, com
                             array_idx=idx,
                             array=tensor,
                             compression=datasets_compr[key][0],
-                            **datasets_compr[key][1])
+                            encoder=datasets_compr[key][3])
                         datasets_len[key] += 1
             assert len(set(datasets_len.values())) == 1
             fd[group].attrs["count"] = datasets_len[task.input_key]
             for key in target_keys:
-                datasets[key].resize(size=(datasets_len[key], *datasets[key].attrs["orig_shape"],))
+                if isinstance(datasets[key], thelper.utils.HDF5BlockWriter):
+                    datasets[key].close()
+                else:
+                    datasets[key].resize(size=(datasets_len[key], *datasets[key].attrs["orig_shape"],))
 
 
 def get_class_weights(label_map, stype="linear", maxw=float('inf'), minw=0.0, norm=True, invmax=False):
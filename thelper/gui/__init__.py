@@ -7,11 +7,24 @@ but can be helpful when debugging them. They can also be used to annotate and ex
 
 import logging
 
-import thelper.gui.annotators  # noqa: F401
-import thelper.gui.utils  # noqa: F401
-from thelper.gui.annotators import Annotator  # noqa: F401
-from thelper.gui.annotators import ImageSegmentAnnotator  # noqa: F401
-from thelper.gui.utils import create_annotator  # noqa: F401
-from thelper.gui.utils import create_key_listener  # noqa: F401
+import thelper.lazy
+
+__getattr__, __dir__, __all__ = thelper.lazy.attach(
+    __name__,
+    submodules=[
+        "annotators",
+        "utils",
+    ],
+    attributes={
+        "thelper.gui.annotators": [
+            "Annotator",
+            "ImageSegmentAnnotator",
+        ],
+        "thelper.gui.utils": [
+            "create_annotator",
+            "create_key_listener",
+        ],
+    },
+)
 
 logger = logging.getLogger("thelper.gui")
@@ -5,8 +5,37 @@ This package contains classes specialized for inference of models on various tas
 
 import logging
 
-from thelper.infer.base import Tester  # noqa: F401
-from thelper.infer.impl import ImageClassifTester, ImageSegmTester, ObjDetectTester, RegressionTester  # noqa: F401
-from thelper.infer.utils import create_tester  # noqa: F401
+import thelper.lazy
+
+__getattr__, __dir__, __all__ = thelper.lazy.attach(
+    __name__,
+    submodules=[
+        "base",
+        "impl",
+        "pipeline",
+        "sharding",
+        "utils",
+    ],
+    attributes={
+        "thelper.infer.base": [
+            "Tester",
+        ],
+        "thelper.infer.impl": [
+            "ImageClassifTester",
+            "ImageSegmTester",
+            "ObjDetectTester",
+            "RegressionTester",
+        ],
+        "thelper.infer.pipeline": [
+            "run_pipelined_eval",
+        ],
+        "thelper.infer.sharding": [
+            "run_sharded_eval",
+        ],
+        "thelper.infer.utils": [
+            "create_tester",
+        ],
+    },
+)
 
 logger = logging.getLogger(__name__)
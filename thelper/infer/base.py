@@ -23,6 +23,8 @@ def make_tester_from_trainer(trainer):
                 cls.__wrapped__ = tester
                 setattr(cls, "eval", lambda *a, **kw: trainer.eval(*a, **kw))
                 setattr(cls, "eval_epoch", lambda *a, **kw: trainer.eval_epoch(*a, **kw))
+                if trainer.eval_batch is not Trainer.eval_batch:
+                    setattr(cls, "eval_batch", lambda *a, **kw: trainer.eval_batch(*a, **kw))
                 # if item correctly inherits from Tester, redirects should already be there
                 # but make sure that a direct reference to a Trainer class for inference will still work
                 if not hasattr(cls, "test"):
@@ -61,6 +63,7 @@ class Tester(Trainer):
                  ckptdata=None    # type: Optional[thelper.typedefs.CheckpointContentType]
                  ):
         super(Trainer, self).__init__(session_name, session_dir, model, task, loaders, config, ckptdata=ckptdata)
+        self._load_runner_params(config, ckptdata)
 
     def train(self):
         raise RuntimeError(f"Invalid call to 'train' using '{type(self).__name__}' (Tester)")
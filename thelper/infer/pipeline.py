@@ -0,0 +1,213 @@
+"""Pipelined inference module.
+
+This module contains the runner used by testers to overlap the loading of samples, the forwarding of batches
+through the model, and the update of metrics/loggers/writers. Each of these three stages runs in its own thread,
+and the stages are connected with bounded queues, so that the model never waits for the (often slower) data loader
+or result writers as long as these can keep up on average. See :func:`run_pipelined_eval` for more information.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+
+import torch
+
+import thelper.train.utils
+
+logger = logging.getLogger(__name__)
+
+_END_OF_STAGE = object()
+"""Sentinel put in the stage queues once all batches have been forwarded (or if an error occurred)."""
+
+
+def _put(stage_queue, item, stop):
+    """Puts an item in a bounded queue, giving up if the pipeline is stopped while waiting for a free slot."""
+    while not stop.is_set():
+        try:
+            stage_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(stage_queue, stop):
+    """Gets an item from a queue, returning the end-of-stage sentinel if the pipeline is stopped while waiting."""
+    while not stop.is_set():
+        try:
+            return stage_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _END_OF_STAGE
+
+
+def run_pipelined_eval(runner, model, epoch, dev, loader, metrics, output_path,
+                       prefetch=2, max_in_flight=2, consumer_threads=2):
+    """Evaluates a model on all batches of a loader with pipelined loading, inference, and result consumption.
+
+    The pipeline is made of three stages connected by bounded queues:
+
+      - the loader stage (background thread) fetches batches from the loader, converts them to tensors with the
+        runner's ``_to_tensor`` function, and uploads the inputs to the target device. At most ``prefetch`` batches
+        are kept ready for the model stage.
+      - the model stage (calling thread, so that autocast and no-grad contexts apply) forwards batches with the
+        runner's ``eval_batch`` function, and launches the (non-blocking) copy of the predictions to host memory.
+        With CUDA devices, the model stage does not wait for these copies to complete, so up to ``max_in_flight``
+        batches can be in flight between the model and consumer stages.
+      - the consumer stage (background thread) waits for host copies to complete, and dispatches metric updates
+        to a pool of ``consumer_threads`` worker threads. Each metric/consumer is always updated by the same worker,
+        so its updates are still received in order and never concurrently, but slow consumers (e.g. file writers)
+        no longer delay each other. Iteration loggers (i.e. the ``*_logger_callback`` consumers of session runners)
+        evaluate the other metrics, so they are only updated once all other consumers are done with their batch.
+
+    The runner is expected to be a :class:`thelper.train.base.Trainer` instance that implements the
+    :func:`thelper.train.base.Trainer.eval_batch` function. Errors raised in any stage stop the whole pipeline, and
+    are re-raised in the calling thread.
+
+    Args:
+        runner: the session runner providing the ``_to_tensor``, ``_move_tensor``, and ``eval_batch`` functions.
+        model: the model to evaluate that is already uploaded to the target device(s).
+        epoch: the epoch index we are evaluating for (0-based).
+        dev: the target device that tensors should be uploaded to.
+        loader: the data loader used to get transformed valid/test samples.
+        metrics: the dictionary of metrics/consumers to update for every batch.
+        output_path: directory where output files should be written, if necessary.
+        prefetch: maximum number of loaded batches waiting to be forwarded.
+        max_in_flight: maximum number of forwarded batches waiting to be consumed.
+        consumer_threads: number of worker threads used to update metrics/consumers.
+
+    Returns:
+        A dictionary of throughput statistics, i.e. the number of processed batches and images, the elapsed time,
+        the end-to-end images per second, and the utilization (busy time fraction) of each stage.
+    """
+    assert loader, "no available data to load"
+    assert isinstance(metrics, dict), "expect metrics as dict object"
+    assert int(prefetch) >= 1 and int(max_in_flight) >= 1 and int(consumer_threads) >= 1, \
+        "pipeline queue sizes and consumer thread count should be strictly positive"
+    epoch_size = len(loader)
+    skip_iter = getattr(runner, "skip_eval_iter", 0)
+    max_epochs = getattr(runner, "epochs", 1)
+    task = runner.task
+    loaded_queue = queue.Queue(maxsize=int(prefetch))
+    forwarded_queue = queue.Queue(maxsize=int(max_in_flight))
+    stop, errors = threading.Event(), []
+    busy_time = collections.defaultdict(float)
+    logger_metrics = [metric for key, metric in metrics.items() if key.endswith("_logger_callback")]
+    lane_metrics = [metric for key, metric in metrics.items() if not key.endswith("_logger_callback")]
+    lane_count = min(int(consumer_threads), max(len(lane_metrics), 1))
+    lanes = [concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"infer-consumer{idx}")
+             for idx in range(lane_count)]
+    lane_lock = threading.Lock()
+
+    def fail(error):
+        errors.append(error)
+        stop.set()
+
+    def load_stage():
+        try:
+            loader_iter = iter(enumerate(loader))
+            while not stop.is_set():
+                start = time.perf_counter()
+                idx, sample = next(loader_iter, (None, None))
+                if idx is None:
+                    break
+                if idx < skip_iter:
+                    continue  # skip until previous iter count (if set externally; no effect otherwise)
+                input_val, target_val = runner._to_tensor(sample)
+                input_dev = runner._move_tensor(input_val, dev)
+                busy_time["loader"] += time.perf_counter() - start
+                if not _put(loaded_queue, (idx, sample, input_val, input_dev, target_val), stop):
+                    break
+        except Exception as e:
+            fail(e)
+        finally:
+            _put(loaded_queue, _END_OF_STAGE, stop)
+
+    def update_metric(metric, kwargs):
+        start = time.perf_counter()
+        try:
+            metric.update(**kwargs)
+        except Exception as e:
+            fail(e)
+        with lane_lock:
+            busy_time["consumer"] += time.perf_counter() - start
+
+    def consume_stage():
+        pending = collections.deque()
+        try:
+            while True:
+                item = _get(forwarded_queue, stop)
+                if item is _END_OF_STAGE:
+                    break
+                idx, sample, input_val, pred_cpu, target_cpu, copy_done = item
+                if copy_done is not None:
+                    copy_done.synchronize()  # the model stage does not wait for device-to-host copies
+                kwargs = dict(task=task, input=input_val, pred=pred_cpu, target=target_cpu, sample=sample,
+                              loss=None, iter_idx=idx, max_iters=epoch_size, epoch_idx=epoch,
+                              max_epochs=max_epochs, output_path=output_path)
+                futures = [lanes[metric_idx % lane_count].submit(update_metric, metric, kwargs)
+                           for metric_idx, metric in enumerate(lane_metrics)]
+                if logger_metrics:
+                    concurrent.futures.wait(futures)  # loggers must see the metrics updated with this batch
+                    for metric in logger_metrics:
+                        update_metric(metric, kwargs)
+                    futures = []
+                pending.append(futures)
+                while len(pending) > int(max_in_flight):
+                    concurrent.futures.wait(pending.popleft())
+            for futures in pending:
+                concurrent.futures.wait(futures)
+        except Exception as e:
+            fail(e)
+
+    stats = {"batches": 0, "images": 0}
+    threads = [threading.Thread(target=load_stage, name="infer-loader", daemon=True),
+               threading.Thread(target=consume_stage, name="infer-consumer", daemon=True)]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    try:
+        with torch.no_grad():
+            while True:
+                item = _get(loaded_queue, stop)
+                if item is _END_OF_STAGE:
+                    break
+                start = time.perf_counter()
+                idx, sample, input_val, input_dev, target_val = item
+                pred, target_val = runner.eval_batch(model, input_dev, target_val, dev)
+                pred_cpu = runner._move_tensor(pred, dev="cpu", detach=True)
+                target_cpu = runner._move_tensor(target_val, dev="cpu", detach=True)
+                copy_done = None
+                if torch.cuda.is_initialized():
+                    copy_done = torch.cuda.Event()
+                    copy_done.record()  # will be waited upon by the consumer stage only
+                busy_time["model"] += time.perf_counter() - start
+                stats["batches"] += 1
+                stats["images"] += thelper.train.utils.get_batch_size(input_val)
+                if not _put(forwarded_queue, (idx, sample, input_val, pred_cpu, target_cpu, copy_done), stop):
+                    break
+    except Exception as e:
+        fail(e)
+    finally:
+        _put(forwarded_queue, _END_OF_STAGE, stop)
+        for thread in threads:
+            thread.join()
+        for lane in lanes:
+            lane.shutdown(wait=True)
+    if errors:
+        raise errors[0]
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    stats["elapsed_sec"] = elapsed
+    stats["images_per_sec"] = stats["images"] / elapsed
+    stats["utilization"] = {
+        "loader": busy_time["loader"] / elapsed,
+        "model": busy_time["model"] / elapsed,
+        "consumer": busy_time["consumer"] / (elapsed * lane_count),
+    }
+    logger.info(f"pipelined inference: {stats['images']} images in {stats['batches']} batches, "
+                f"{elapsed:.2f} sec ({stats['images_per_sec']:.1f} images/sec); stage utilization: " +
+                ", ".join([f"{name}={val:.0%}" for name, val in stats["utilization"].items()]))
+    return stats
@@ -0,0 +1,162 @@
+"""Sharded (multi-process) inference module.
+
+This module contains the runner used to spread the evaluation of a model over several CPU worker processes.
+Each worker holds its own copy of the model and of the session runner, and forwards an interleaved subset of the
+batches of the evaluation loader; the predictions are sent back to the main process, which updates all metrics
+and consumers in the original batch order. See :func:`run_sharded_eval` for more information.
+"""
+
+import copy
+import logging
+import os
+import queue
+import time
+import traceback
+
+import torch
+import torch.multiprocessing
+
+import thelper.data.loaders
+import thelper.train.utils
+import thelper.utils
+
+logger = logging.getLogger(__name__)
+
+
+def get_shard_batches(batches, shard_idx, shard_count):
+    """Returns the (batch index, sample indices) pairs of a list of batches that belong to a given shard.
+
+    Batches are assigned to shards in a round-robin fashion, so that all shards progress at the same rate when
+    their outputs are consumed in the original batch order.
+    """
+    assert 0 <= shard_idx < shard_count, "invalid shard index"
+    return [(batch_idx, batch) for batch_idx, batch in enumerate(batches) if batch_idx % shard_count == shard_idx]
+
+
+def _run_shard(shard_idx, num_threads, runner_type, session_name, session_dir, config, model, task,
+               dataset, batches, loader_params, output_queue, done):
+    """Forwards the batches of a single shard in a worker process, and sends the predictions to the main process.
+
+    An error message string is sent instead of predictions if an exception is raised, and ``None`` is sent once all
+    batches have been forwarded. The worker then waits for the main process to receive all of its outputs, as the
+    shared memory behind tensors sent through queues must stay alive until it is received.
+    """
+    try:
+        torch.set_num_threads(num_threads)
+        thelper.utils.setup_globals(config)
+        loader = thelper.data.loaders.DataLoader(dataset, batch_sampler=[batch for _, batch in batches],
+                                                 **loader_params)
+        runner = runner_type(session_name, session_dir, model, task, (None, None, loader), config)
+        model = runner._upload_model(runner.model, runner.devices)
+        model = runner._compile_model(model)
+        model.eval()
+        with torch.no_grad(), runner._autocast():
+            for (batch_idx, _), sample in zip(batches, loader):
+                input_val, target_val = runner._to_tensor(sample)
+                pred, target_val = runner.eval_batch(model, input_val, target_val, runner.devices)
+                pred = runner._move_tensor(pred, dev="cpu", detach=True)
+                target_val = runner._move_tensor(target_val, dev="cpu", detach=True)
+                output_queue.put((batch_idx, sample, input_val, pred, target_val))
+    except Exception:
+        output_queue.put(f"exception in inference shard #{shard_idx}:\n{traceback.format_exc()}")
+    finally:
+        output_queue.put(None)
+        done.wait()
+
+
+def _get_shard_output(output_queue, process):
+    """Returns the next output of a shard, raising an error if its worker process died without sending it."""
+    while True:
+        try:
+            return output_queue.get(timeout=1.0)
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError(f"inference shard process exited unexpectedly (code={process.exitcode})")
+
+
+def run_sharded_eval(runner, model, epoch, loader, metrics, output_path, shard_count, shard_threads=0, prefetch=2):
+    """Evaluates a model on all batches of a loader by spreading the batches over several CPU worker processes.
+
+    The batches of the loader are assigned to ``shard_count`` worker processes (started with the 'spawn' method) in
+    a round-robin fashion. Each worker rebuilds a session runner of the same type (with its own session directory
+    under ``<session_dir>/shards``), limits its intra-op thread count to ``shard_threads`` (by default, the number of
+    CPU cores divided by the number of shards), and forwards its batches with the runner's ``eval_batch`` function.
+    Predictions are sent back to the main process through shared memory, and all metrics/consumers are updated in the
+    main process in the original batch order, so their outputs are the same as with a single process.
+
+    The runner is expected to be a :class:`thelper.train.base.Trainer` instance that implements the
+    :func:`thelper.train.base.Trainer.eval_batch` function, and its model and dataset must be picklable. Note that
+    each worker also starts its own data loader workers, if the loader is configured to use them.
+
+    Args:
+        runner: the session runner whose type, configuration, and task will be used in the worker processes.
+        model: the model to evaluate (it will be uploaded to the CPU in each worker process).
+        epoch: the epoch index we are evaluating for (0-based).
+        loader: the data loader used to get transformed valid/test samples.
+        metrics: the dictionary of metrics/consumers to update for every batch.
+        output_path: directory where output files should be written, if necessary.
+        shard_count: number of worker processes to spread the batches over.
+        shard_threads: number of intra-op threads to use in each worker process (0 = automatic).
+        prefetch: maximum number of forwarded batches waiting to be consumed for each worker process.
+
+    Returns:
+        A dictionary of throughput statistics, i.e. the number of processed batches and images, the elapsed time, the
+        end-to-end images per second, and the number of shards.
+    """
+    assert loader, "no available data to load"
+    assert isinstance(metrics, dict), "expect metrics as dict object"
+    assert int(shard_count) >= 1, "shard count should be strictly positive"
+    shard_count = int(shard_count)
+    shard_threads = int(shard_threads) or max((os.cpu_count() or 1) // shard_count, 1)
+    skip_iter = getattr(runner, "skip_eval_iter", 0)
+    batches = [batch if batch_idx >= skip_iter else None for batch_idx, batch in enumerate(loader.batch_sampler)]
+    epoch_size = len(batches)
+    worker_config = copy.deepcopy(runner.config)
+    worker_runner_config = thelper.utils.get_key(["trainer", "runner", "tester"], worker_config)
+    for key in ["shards", "shard_threads", "pipeline", "devices", "train_device"]:
+        worker_runner_config.pop(key, None)  # workers only forward batches one at a time, on cpu
+    worker_runner_config["device"] = "cpu"
+    loader_params = {"collate_fn": loader.collate_fn, "num_workers": loader.num_workers, "seeds": loader.seeds}
+    context = torch.multiprocessing.get_context("spawn")
+    done = context.Event()
+    shard_batches, output_queues, processes = [], [], []
+    start_time = time.perf_counter()
+    for shard_idx in range(shard_count):
+        shard_batches.append([(batch_idx, batch) for batch_idx, batch in get_shard_batches(batches, shard_idx, shard_count)
+                              if batch is not None])
+        output_queues.append(context.Queue(maxsize=int(prefetch)))
+        shard_dir = os.path.join(runner.session_dir, "shards", f"shard{shard_idx}")
+        processes.append(context.Process(
+            target=_run_shard, name=f"infer-shard{shard_idx}",
+            args=(shard_idx, shard_threads, type(runner), runner.name, shard_dir, worker_config, model,
+                  runner.task, loader.dataset, shard_batches[-1], loader_params, output_queues[-1], done)))
+        processes[-1].start()
+    logger.debug(f"started {shard_count} inference shards with {shard_threads} thread(s) each")
+    stats = {"batches": 0, "images": 0}
+    try:
+        for batch_idx in range(skip_iter, epoch_size):
+            shard_idx = batch_idx % shard_count
+            output = _get_shard_output(output_queues[shard_idx], processes[shard_idx])
+            if isinstance(output, str):
+                raise RuntimeError(output)
+            assert output is not None and output[0] == batch_idx, "unexpected shard output order"
+            _, sample, input_val, pred, target = output
+            for metric in metrics.values():
+                metric.update(task=runner.task, input=input_val, pred=pred, target=target, sample=sample,
+                              loss=None, iter_idx=batch_idx, max_iters=epoch_size, epoch_idx=epoch,
+                              max_epochs=runner.epochs, output_path=output_path)
+            stats["batches"] += 1
+            stats["images"] += thelper.train.utils.get_batch_size(input_val)
+    finally:
+        done.set()
+        for process in processes:
+            process.join(timeout=10.0)
+            if process.is_alive():
+                process.terminate()
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    stats["elapsed_sec"] = elapsed
+    stats["images_per_sec"] = stats["images"] / elapsed
+    stats["shards"] = shard_count
+    logger.info(f"sharded inference: {stats['images']} images in {stats['batches']} batches over {shard_count} "
+                f"processes, {elapsed:.2f} sec ({stats['images_per_sec']:.1f} images/sec)")
+    return stats
@@ -0,0 +1,53 @@
+"""Lazy module loading utilities.
+
+This module contains the helper used by the framework's packages to defer the import of their subpackages,
+submodules, and re-exported attributes until these are first accessed (see PEP 562). This keeps ``import
+thelper`` (and therefore every CLI call, or every data loader worker started with the 'spawn' method) from
+paying for the import of heavy dependencies that it might never use. This module must only rely on the
+standard library, as it is imported before anything else in the framework.
+"""
+
+import importlib
+import sys
+
+
+def attach(package_name, submodules=None, attributes=None):
+    """Returns the ``__getattr__``, ``__dir__``, and ``__all__`` objects to use in a lazy package.
+
+    Usage example (inside a package's ``__init__.py`` file)::
+
+        __getattr__, __dir__, __all__ = thelper.lazy.attach(
+            __name__,
+            submodules=["parsers", "utils"],
+            attributes={"thelper.data.parsers": ["Dataset"]},
+        )
+
+    Args:
+        package_name: the name of the package to attach to (i.e. its ``__name__``).
+        submodules: list of submodule names that will be imported when accessed as package attributes.
+        attributes: map of full module names to lists of attribute names that will be imported from these
+            modules when accessed as package attributes (e.g. classes or functions re-exported by the package).
+
+    Returns:
+        A tuple of the ``__getattr__`` function, the ``__dir__`` function, and the ``__all__`` list to assign in
+        the package's namespace.
+    """
+    submodules = set(submodules) if submodules else set()
+    attr_to_module = {attr_name: module_name for module_name, attr_names in (attributes or {}).items()
+                      for attr_name in attr_names}
+    assert not submodules & set(attr_to_module), "attribute names should not override submodule names"
+    __all__ = sorted(submodules | set(attr_to_module))
+
+    def __getattr__(name):
+        if name in submodules:
+            return importlib.import_module(f"{package_name}.{name}")
+        if name in attr_to_module:
+            value = getattr(importlib.import_module(attr_to_module[name]), name)
+            setattr(sys.modules[package_name], name, value)  # next lookups will not go through here
+            return value
+        raise AttributeError(f"module '{package_name}' has no attribute '{name}'")
+
+    def __dir__():
+        return sorted(set(vars(sys.modules[package_name])) | set(__all__))
+
+    return __getattr__, __dir__, __all__
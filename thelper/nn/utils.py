@@ -4,9 +4,12 @@ This module contains base interfaces and utility functions used to define and in
 neural network models.
 """
 
+import copy
+import importlib
 import inspect
 import logging
 import os
+import time
 from abc import abstractmethod
 
 import numpy as np
@@ -33,6 +36,8 @@ def create_model(config, task, save_dir=None, ckptdata=None):
     be used to make sure that the model has the required input/output layers for the requested objective.
 
     If checkpoint data is provided by the caller, the weights it contains will be loaded into the returned model.
+    Checkpoints exported with dynamic int8 quantization (see :func:`thelper.nn.utils.quantize_model`) are loaded
+    into a model that is quantized the same way.
 
     Usage examples inside a session configuration file::
 
@@ -167,6 +172,11 @@ def create_model(config, task, save_dir=None, ckptdata=None):
                 model = ExternalClassifModule(model_type, task=task, **model_params)
             else:
                 model = ExternalModule(model_type, task=task, **model_params)
+        quantization = thelper.utils.get_key_def("quantization", ckptdata or {}, None)
+        if model_state is not None and quantization and quantization["mode"] == "dynamic_int8":
+            # the quantized state can only be loaded in a model that was quantized the same way
+            logger.debug("applying dynamic quantization to model before loading its state")
+            model = quantize_model(model, quantization["mode"], backend=quantization.get("backend"))
         if model_state is not None:
             logger.debug("loading state dictionary from checkpoint into model")
             model.load_state_dict(model_state)
@@ -395,3 +405,195 @@ class ExternalDetectModule(ExternalModule):
 def get_learnable_param_count(model: torch.nn.Module) -> int:
     """Returns the learnable (grad-enabled) parameter count in a module."""
     return sum(p.numel() for p in model.parameters() if p.requires_grad)
+
+
+EXECUTION_BACKENDS = ["eager", "script", "trace", "compile"]
+"""Names of the execution backends supported by :func:`thelper.nn.utils.compile_model`."""
+
+
+def compile_model(model, backend="eager", example_input=None, training=False):
+    """Returns a model prepared for execution with a given backend, or the original model if preparation fails.
+
+    The supported backends are:
+
+    - ``eager``: the model is returned as-is (regular PyTorch execution).
+    - ``script``: the model is compiled via ``torch.jit.script``, and then frozen/optimized for inference.
+    - ``trace``: the model is traced via ``torch.jit.trace`` using the example input (which is then required), and
+      then frozen/optimized for inference.
+    - ``compile``: the model is compiled via ``torch.compile`` (requires PyTorch >= 2.0). The compiled model shares
+      its parameters with the original model, so it can also be used for training.
+
+    Frozen TorchScript modules hold copies of the original model's parameters, so the ``script`` and ``trace``
+    backends are only used for evaluation; if ``training`` is true, they fall back to eager mode. If an example input
+    is provided, it is forwarded once through the prepared model (in eval mode, without gradients) to validate it and
+    to trigger any lazy compilation. Any failure is logged as a warning, and the original model is then returned.
+    """
+    assert backend in EXECUTION_BACKENDS, f"unknown execution backend '{backend}'"
+    if backend == "eager":
+        return model
+    if training and backend in ["script", "trace"]:
+        logger.warning(f"'{backend}' backend can only be used for evaluation, falling back to eager mode")
+        return model
+    was_training = model.training
+    try:
+        if backend == "compile":
+            assert hasattr(torch, "compile"), "torch.compile is not available (requires PyTorch >= 2.0)"
+            compiled_model = torch.compile(model)
+        else:
+            model.eval()
+            if isinstance(model, torch.jit.ScriptModule):
+                compiled_model = model  # e.g. model trace loaded from an exported checkpoint
+            elif backend == "script":
+                compiled_model = torch.jit.script(model)
+            else:
+                assert example_input is not None, "cannot trace a model without an example input"
+                compiled_model = torch.jit.trace(model, example_input, strict=False)
+            if hasattr(torch.jit, "optimize_for_inference"):
+                compiled_model = torch.jit.optimize_for_inference(compiled_model)  # also freezes the module
+            else:
+                compiled_model = torch.jit.freeze(compiled_model)
+        if example_input is not None:
+            model.eval()
+            with torch.no_grad():
+                compiled_model(example_input)
+    except Exception as e:
+        logger.warning(f"could not prepare model for '{backend}' backend, falling back to eager mode\n\t{e}")
+        compiled_model = model
+    finally:
+        model.train(was_training)
+    return compiled_model
+
+
+class DeferredCompiledModel(torch.nn.Module):
+    """Wrapper that prepares a model for an execution backend when it is first called, for evaluation only.
+
+    The input of the first call is used as the example input required by :func:`thelper.nn.utils.compile_model`, so
+    no batch has to be drawn from a data loader ahead of time (which would shift its data order). If the prepared
+    model later fails on an input (e.g. a traced model that depends on the batch size receiving a smaller last batch),
+    a warning is logged and the original (eager) model is used for that call and all following ones.
+    """
+
+    def __init__(self, model, backend):
+        super().__init__()
+        self.model = model
+        self.backend = backend
+        self.compiled_model = None
+
+    def forward(self, input):
+        if self.compiled_model is None:
+            self.compiled_model = compile_model(self.model, self.backend, example_input=input)
+        if self.compiled_model is not self.model:
+            try:
+                return self.compiled_model(input)
+            except RuntimeError as e:
+                logger.warning(f"'{self.backend}' model failed on input with shape {tuple(input.shape)}, "
+                               f"falling back to eager mode\n\t{e}")
+                self.compiled_model = self.model
+        return self.model(input)
+
+
+QUANTIZATION_MODES = ["dynamic_int8", "static_int8", "fp16"]
+"""Names of the post-training quantization modes supported by :func:`thelper.nn.utils.quantize_model`."""
+
+
+def _get_quantization_module():
+    """Returns the PyTorch quantization module (its location changed in PyTorch 1.10)."""
+    if hasattr(torch, "ao") and hasattr(torch.ao, "quantization"):
+        return torch.ao.quantization
+    return torch.quantization
+
+
+def get_quantization_backend(backend=None):
+    """Returns the name of the quantized CPU kernel backend to use (the best supported one, if not specified)."""
+    supported_engines = torch.backends.quantized.supported_engines
+    if backend is None:
+        backend = next((name for name in ["x86", "fbgemm", "qnnpack"] if name in supported_engines), None)
+    assert backend in supported_engines, f"unsupported quantization backend '{backend}' (should be in {supported_engines})"
+    return backend
+
+
+def quantize_model(model, mode, calib_inputs=None, backend=None):
+    """Returns a post-training quantized copy of a model for CPU inference.
+
+    The supported modes are:
+
+    - ``dynamic_int8``: the weights of ``Linear`` and recurrent (LSTM/GRU) layers are quantized to int8, and their
+      activations are quantized on-the-fly at runtime. No calibration is needed, and the quantized model can be
+      re-created from its state dictionary by applying the same transformation to an fp32 model.
+    - ``static_int8``: all supported layers are quantized to int8 along with their activations, using the value
+      ranges observed while forwarding the calibration inputs (required). This relies on FX graph mode quantization,
+      so the model must be symbolically traceable. The quantized model should be exported as a trace.
+    - ``fp16``: the weights are converted to half precision. Note that CPU kernels are usually not faster in fp16,
+      so this mode mostly halves the size of exported checkpoints; weights loaded back into an fp32 model are
+      upcast automatically.
+
+    The original model is not modified. Quantized int8 models can only be executed on CPU.
+    """
+    assert mode in QUANTIZATION_MODES, f"unknown quantization mode '{mode}'"
+    model = copy.deepcopy(model).cpu().eval()
+    if mode == "fp16":
+        return model.half()
+    quant = _get_quantization_module()
+    torch.backends.quantized.engine = get_quantization_backend(backend)
+    if mode == "dynamic_int8":
+        layer_types = {torch.nn.Linear, torch.nn.LSTM, torch.nn.GRU, torch.nn.LSTMCell, torch.nn.GRUCell}
+        return quant.quantize_dynamic(model, layer_types, dtype=torch.qint8)
+    assert calib_inputs, "static quantization requires at least one calibration input"
+    quantize_fx = importlib.import_module(quant.__name__ + ".quantize_fx")
+    if hasattr(quant, "get_default_qconfig_mapping"):
+        qconfig = quant.get_default_qconfig_mapping(torch.backends.quantized.engine)
+    else:
+        qconfig = {"": quant.get_default_qconfig(torch.backends.quantized.engine)}  # PyTorch < 1.13
+    try:
+        prepared_model = quantize_fx.prepare_fx(model, qconfig, example_inputs=(calib_inputs[0],))
+    except TypeError:
+        prepared_model = quantize_fx.prepare_fx(model, qconfig)  # PyTorch < 1.13 (no example inputs)
+    with torch.no_grad():
+        for calib_input in calib_inputs:
+            prepared_model(calib_input)
+    return quantize_fx.convert_fx(prepared_model)
+
+
+def compare_quantized_model(model, quant_model, inputs, targets=None, warmup_runs=1):
+    """Returns a report comparing the outputs and CPU latency of a quantized model with those of its fp32 version.
+
+    The report contains the mean latency per batch (in milliseconds) of both models, the speedup, and the mean/max
+    absolute difference between their outputs. For outputs with a class dimension, the rate of agreement of their
+    top-1 predictions is also reported, as well as the accuracy of both models if targets are provided (one target
+    tensor per input batch).
+    """
+    assert inputs, "cannot compare models without inputs"
+    model, quant_model = model.cpu().eval(), quant_model.eval()
+    quant_param = next(iter(quant_model.parameters()), None)  # int8 models usually hold packed (non-param) weights
+    quant_dtype = torch.float16 if quant_param is not None and quant_param.dtype == torch.float16 else None
+    report = {"batches": len(inputs)}
+    latencies, outputs = {"fp32": 0., "quantized": 0.}, {"fp32": [], "quantized": []}
+    with torch.no_grad():
+        for name, curr_model in [("fp32", model), ("quantized", quant_model)]:
+            for input_idx, input_val in enumerate(inputs):
+                input_val = input_val.cpu()
+                if name == "quantized" and quant_dtype is not None:
+                    input_val = input_val.to(quant_dtype)
+                for _ in range(warmup_runs if input_idx == 0 else 0):
+                    curr_model(input_val)
+                start = time.perf_counter()
+                output = curr_model(input_val)
+                latencies[name] += time.perf_counter() - start
+                outputs[name].append(output.float() if isinstance(output, torch.Tensor) else output)
+    report["fp32_latency_ms"] = latencies["fp32"] * 1000 / len(inputs)
+    report["quantized_latency_ms"] = latencies["quantized"] * 1000 / len(inputs)
+    report["speedup"] = latencies["fp32"] / max(latencies["quantized"], 1e-9)
+    if all([isinstance(output, torch.Tensor) for output in outputs["fp32"] + outputs["quantized"]]):
+        diffs = [(ref - out).abs() for ref, out in zip(outputs["fp32"], outputs["quantized"])]
+        report["mean_abs_diff"] = float(torch.cat([diff.flatten() for diff in diffs]).mean())
+        report["max_abs_diff"] = float(max([float(diff.max()) for diff in diffs]))
+        if all([output.ndim >= 2 for output in outputs["fp32"]]):
+            fp32_labels = torch.cat([output.argmax(dim=1).flatten() for output in outputs["fp32"]])
+            quant_labels = torch.cat([output.argmax(dim=1).flatten() for output in outputs["quantized"]])
+            report["top1_agreement"] = float((fp32_labels == quant_labels).float().mean())
+            if targets is not None and all([isinstance(target, torch.Tensor) for target in targets]):
+                targets = torch.cat([target.flatten() for target in targets]).long()
+                if targets.numel() == fp32_labels.numel():
+                    report["fp32_accuracy"] = float((fp32_labels == targets).float().mean())
+                    report["quantized_accuracy"] = float((quant_labels == targets).float().mean())
+    return report
@@ -6,29 +6,49 @@ and optimization methods used to control the learning behavior of these models.
 
 import logging
 
-import thelper.optim.eval  # noqa: F401
-import thelper.optim.metrics  # noqa: F401
-import thelper.optim.schedulers  # noqa: F401
-import thelper.optim.utils  # noqa: F401
-from thelper.optim.eval import compute_average_precision  # noqa: F401
-from thelper.optim.eval import compute_bbox_iou  # noqa: F401
-from thelper.optim.eval import compute_mask_iou  # noqa: F401
-from thelper.optim.eval import compute_pascalvoc_metrics  # noqa: F401
-from thelper.optim.losses import FocalLoss  # noqa: F401
-from thelper.optim.metrics import PSNR  # noqa: F401
-from thelper.optim.metrics import Accuracy  # noqa: F401
-from thelper.optim.metrics import AveragePrecision  # noqa: F401
-from thelper.optim.metrics import ExternalMetric  # noqa: F401
-from thelper.optim.metrics import IntersectionOverUnion  # noqa: F401
-from thelper.optim.metrics import MeanAbsoluteError  # noqa: F401
-from thelper.optim.metrics import MeanSquaredError  # noqa: F401
-from thelper.optim.metrics import Metric  # noqa: F401
-from thelper.optim.metrics import ROCCurve  # noqa: F401
-from thelper.optim.schedulers import CustomStepLR  # noqa: F401
-from thelper.optim.utils import create_loss_fn  # noqa: F401
-from thelper.optim.utils import create_metrics  # noqa: F401
-from thelper.optim.utils import create_optimizer  # noqa: F401
-from thelper.optim.utils import create_scheduler  # noqa: F401
-from thelper.optim.utils import get_lr  # noqa: F401
+import thelper.lazy
+
+__getattr__, __dir__, __all__ = thelper.lazy.attach(
+    __name__,
+    submodules=[
+        "eval",
+        "losses",
+        "metrics",
+        "schedulers",
+        "utils",
+    ],
+    attributes={
+        "thelper.optim.eval": [
+            "compute_average_precision",
+            "compute_bbox_iou",
+            "compute_mask_iou",
+            "compute_pascalvoc_metrics",
+        ],
+        "thelper.optim.losses": [
+            "FocalLoss",
+        ],
+        "thelper.optim.metrics": [
+            "PSNR",
+            "Accuracy",
+            "AveragePrecision",
+            "ExternalMetric",
+            "IntersectionOverUnion",
+            "MeanAbsoluteError",
+            "MeanSquaredError",
+            "Metric",
+            "ROCCurve",
+        ],
+        "thelper.optim.schedulers": [
+            "CustomStepLR",
+        ],
+        "thelper.optim.utils": [
+            "create_loss_fn",
+            "create_metrics",
+            "create_optimizer",
+            "create_scheduler",
+            "get_lr",
+        ],
+    },
+)
 
 logger = logging.getLogger("thelper.optim")
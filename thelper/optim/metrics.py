@@ -11,7 +11,6 @@ from abc import abstractmethod
 from typing import Any, AnyStr, Optional  # noqa: F401
 
 import numpy as np
-import sklearn.metrics
 import torch
 
 import thelper.concepts
@@ -853,6 +852,7 @@ class ROCCurve(Metric, ClassNamesHandler):
         self.drop_intermediate = drop_intermediate
 
         def gen_curve(y_true, y_score, _target_idx, _target_inv, _sample_weight=sample_weight, _drop_intermediate=drop_intermediate):
+            import sklearn.metrics
             assert _target_idx is not None, "missing positive target idx at run time"
             _y_true, _y_score = [], []
             for sample_idx, label_idx in enumerate(y_true):
@@ -862,6 +862,7 @@ class ROCCurve(Metric, ClassNamesHandler):
             return res
 
         def gen_auc(y_true, y_score, _target_idx, _target_inv, _sample_weight=sample_weight):
+            import sklearn.metrics
             assert _target_idx is not None, "missing positive target idx at run time"
             _y_true, _y_score = [], []
             for sample_idx, label_idx in enumerate(y_true):
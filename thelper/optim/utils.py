@@ -66,6 +66,9 @@ def create_loss_fn(config, model, loader=None, uploader=None):
     - ``weight_max`` (optional, default=inf): the maximum weight that can be assigned to a class.
     - ``weight_min`` (optional, default=0): the minimum weight that can be assigned to a class.
     - ``weight_norm`` (optional, default=True): specifies whether the weights should be normalized or not.
+    - ``weight_stats_workers`` (optional, default=0): number of worker processes used to compute class sizes.
+    - ``weight_stats_path`` (optional, default=None): path where the dataset statistics (class sizes) should be
+      cached. By default, they are cached next to the data, if possible. See :mod:`thelper.data.stats`.
 
     This function also supports an extra special parameter if the task is related to semantic segmentation:
     ``ignore_index``. If this parameter is found and not ``None`` (integer), then the loss function will ignore
@@ -129,7 +132,13 @@ def create_loss_fn(config, model, loader=None, uploader=None):
             if weight_distrib != "uniform":
                 if loader is None or not loader:
                     raise AssertionError("cannot get class sizes, no training data available")
-                label_sizes_map = model.task.get_class_sizes(loader.dataset)
+                stats = thelper.data.stats.get_dataset_stats(
+                    loader.dataset, task=model.task, band_stats=False,  # loss weights only need class counts
+                    cache_path=thelper.utils.get_key_def("weight_stats_path", config, None),
+                    num_workers=int(thelper.utils.get_key_def("weight_stats_workers", config, 0)))
+                if stats.unknown_count > 0:
+                    logger.warning("some label maps contain values that are unknown (i.e. with no proper class mapping)")
+                label_sizes_map = stats.get_class_sizes()
                 weight_norm = False
             else:
                 label_sizes_map = {label: -1 for label in model.task.class_names}  # counts don't matter
@@ -16,6 +16,7 @@ import torch
 import thelper.data
 import thelper.nn
 import thelper.optim
+import thelper.session.checkpoint
 import thelper.tasks
 import thelper.typedefs
 import thelper.utils
@@ -32,6 +33,7 @@ class SessionRunner:
 
     Attributes:
         checkpoint_dir: session checkpoint output directory (located within the 'session directory').
+        checkpoint_writer: writer used to save checkpoints in the background (see :mod:`thelper.session.checkpoint`).
         config: session configuration dictionary holding all original settings, including trainer configuration.
         devices: list of (cuda) device IDs to upload the model/tensors to; can be empty if only the CPU is available.
         epochs: number of epochs to train the model for.
@@ -94,12 +96,19 @@ class SessionRunner:
         self.logger.debug(f"logstamp = {logstamp}")
         self.logger.debug(f"version = {repover}")
         self.name = session_name
+        self.session_dir = session_dir
         self.epochs = 1
         self.save_freq = int(thelper.utils.get_key_def("save_freq", trainer_config, 1))
         assert self.save_freq >= 1, "checkpoint save frequency should be strictly positive integer"
         self.save_raw = thelper.utils.str2bool(thelper.utils.get_key_def("save_raw", trainer_config, True))
         self.checkpoint_dir = os.path.join(session_dir, "checkpoints")
         os.makedirs(self.checkpoint_dir, exist_ok=True)
+        self.checkpoint_writer = thelper.session.checkpoint.CheckpointWriter(
+            self.checkpoint_dir,
+            keep_last=int(thelper.utils.get_key_def(["keep_last_ckpts", "keep_last_checkpoints"], trainer_config, 0)),
+            async_write=thelper.utils.str2bool(thelper.utils.get_key_def("async_save", trainer_config, True)),
+            layout=thelper.utils.get_key_def(["ckpt_layout", "checkpoint_layout"], trainer_config, "single"),
+        )
         output_root_dir = thelper.utils.get_key_def("output_dir", trainer_config)
         if not output_root_dir:
             # append session name for cleaner TBX folder merging
@@ -113,6 +122,8 @@ class SessionRunner:
         devices_str = thelper.utils.get_key_def(["device", "devices", "train_device"], trainer_config, None)
         self.devices = self._load_devices(devices_str)
         self.skip_eval_iter = thelper.utils.get_key_def("skip_eval_iter", trainer_config, 0)
+        self.backend = thelper.utils.get_key_def(["backend", "execution_backend"], trainer_config, "eager")
+        assert self.backend in thelper.nn.utils.EXECUTION_BACKENDS, f"unknown execution backend '{self.backend}'"
 
         # parse and prepare tbx stuff
         tbx_config_flags = ["use_tbx", "tbx", "use_tb", "tb", "tensorboard"]
@@ -281,6 +292,20 @@ class SessionRunner:
         else:
             return model.to(dev)
 
+    def _compile_model(self, model, training=False):
+        """Returns the model prepared for execution with the session's backend.
+
+        For evaluation, the model is wrapped so that it is prepared using its first input as the example input
+        required for tracing; see :class:`thelper.nn.utils.DeferredCompiledModel` and
+        :func:`thelper.nn.utils.compile_model` for more information.
+        """
+        if self.backend == "eager":
+            return model
+        self.logger.debug(f"preparing model for '{self.backend}' backend...")
+        if not training:
+            return thelper.nn.utils.DeferredCompiledModel(model, self.backend)
+        return thelper.nn.utils.compile_model(model, self.backend, training=training)
+
     @staticmethod
     def _move_tensor(tensor, dev, non_blocking=True, detach=False):
         """Uploads a tensor to a specific device."""
@@ -510,6 +535,7 @@ class SessionRunner:
             "model_type": self.model.get_name(),
             "model_params": self.model.config if self.model.config else {},
             "optimizer": optimizer.state_dict() if optimizer is not None else None,
+            "grad_scaler": self.grad_scaler.state_dict() if getattr(self, "grad_scaler", None) is not None else None,
             "scheduler": scheduler.state_dict() if (scheduler is not None and
                                                     hasattr(scheduler, "state_dict")) else None,
             "monitor_best": self.monitor_best,
@@ -517,10 +543,6 @@ class SessionRunner:
             "config": self.config  # note: this is the global app config
         }
         filename = f"ckpt.{epoch:04d}.{log_stamp}.pth"
-        filename = os.path.join(self.checkpoint_dir, filename)
-        self.logger.debug(f"writing checkpoint to {os.path.abspath(filename)}")
-        torch.save(curr_state, filename)
-        if save_best:
-            filename_best = os.path.join(self.checkpoint_dir, "ckpt.best.pth")
-            self.logger.debug(f"writing checkpoint to {os.path.abspath(filename_best)}")
-            torch.save(curr_state, filename_best)
+        self.logger.debug(f"writing checkpoint to {os.path.abspath(os.path.join(self.checkpoint_dir, filename))}")
+        # note: the state is copied to cpu here, but it is serialized/written to disk in the background
+        self.checkpoint_writer.save(curr_state, filename, save_best=save_best)
@@ -0,0 +1,240 @@
+"""Session checkpoint writing module.
+
+This module contains the writer used by session runners to save checkpoints in the background, so that
+the training loop does not stall while large state dictionaries are serialized and written to disk. The
+writer also keeps a manifest file up to date in the checkpoint directory, so that the latest and best
+checkpoints can be found without listing and parsing all checkpoint names (see
+:func:`thelper.utils.load_checkpoint`).
+"""
+
+import collections
+import concurrent.futures
+import copy
+import json
+import logging
+import os
+import shutil
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_MANIFEST_NAME = "manifest.json"
+"""Name of the manifest file written in checkpoint directories."""
+
+CHECKPOINT_LAYOUTS = ["single", "split"]
+"""Names of the supported checkpoint layouts (all state in one file, or weights/optimizer/metadata files)."""
+
+SPLIT_CHECKPOINT_PARTS = {"model": "weights", "optimizer": "optim"}
+"""Map of state keys to the file name prefixes used to store them separately in the 'split' checkpoint layout."""
+
+
+def snapshot_state(state):
+    """Returns a copy of a (nested) checkpoint state in which all tensors are detached CPU copies.
+
+    The returned state does not share any tensor memory or container with the original one, so it can be
+    serialized in another thread while training continues to update the model and optimizer states in-place.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, snapshot_state(val)) for key, val in state.items())
+    if isinstance(state, list):
+        return [snapshot_state(val) for val in state]
+    if isinstance(state, tuple):
+        return tuple(snapshot_state(val) for val in state)
+    if isinstance(state, torch.nn.Module):
+        return copy.deepcopy(state).cpu()  # only happens when saving non-raw objects (e.g. 'save_raw' is false)
+    return copy.deepcopy(state)
+
+
+def get_checkpoint_epoch_stamp(path):
+    """Returns the (epoch, day, time) stamp of a checkpoint based on its name, or ``None`` for 'best' checkpoints.
+
+    Checkpoint names are expected to follow the ``ckpt.<epoch>.<log_stamp>.pth`` pattern used by session runners.
+    """
+    split = os.path.basename(path).split(".")
+    if len(split) < 3 or not split[1].isdigit():
+        return None  # 'best' checkpoint, or unknown name format
+    log_stamp = ".".join(split[2:-1]).rsplit("-", 2)  # note: platform names might contain dots or dashes
+    if len(log_stamp) != 3 or not log_stamp[1].isdigit() or not log_stamp[2].isdigit():
+        log_stamp = ["fake", "0", "0"]
+    return int(split[1]), int(log_stamp[1]), int(log_stamp[2])
+
+
+def find_checkpoint(checkpoint_dir, always_load_latest=False):
+    """Returns the path to the best (or latest) checkpoint listed in a directory's manifest, or ``None``.
+
+    If ``always_load_latest`` is false and a best checkpoint exists, it will be returned; otherwise, the latest
+    checkpoint is returned. ``None`` is returned if the directory has no (valid) manifest, or if the listed
+    checkpoint file is missing, in which case the caller should fall back to listing the directory.
+    """
+    manifest_path = os.path.join(checkpoint_dir, CHECKPOINT_MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return None
+    try:
+        with open(manifest_path, "r") as fd:
+            manifest = json.load(fd)
+    except (OSError, ValueError):
+        logger.warning(f"could not parse checkpoint manifest at {os.path.abspath(manifest_path)}")
+        return None
+    ckpt_name = manifest.get("latest") if always_load_latest or not manifest.get("best") else manifest["best"]
+    ckpt_name = ckpt_name or manifest.get("best")
+    if not ckpt_name or not os.path.isfile(os.path.join(checkpoint_dir, ckpt_name)):
+        return None
+    return os.path.join(checkpoint_dir, ckpt_name)
+
+
+def _replace_file(src_path, dst_path, link=False):
+    """Atomically replaces a file with a copy of (or hard link to) another file."""
+    tmp_path = dst_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        if not link:
+            raise OSError
+        os.link(src_path, tmp_path)
+    except OSError:
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+
+
+def _save_atomic(obj, path):
+    """Serializes an object via ``torch.save`` into a temporary file, and then renames it to its final name."""
+    tmp_path = path + ".tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter:
+    """Checkpoint writer that serializes session states in a background thread.
+
+    When :func:`CheckpointWriter.save` is called, the state is first copied to CPU memory on the calling thread (see
+    :func:`snapshot_state`), and it is then serialized by a single background worker, so writes always happen in
+    order. Files are first written under a temporary name and then renamed, so a checkpoint that exists under its
+    final name is always complete, even if the process is killed mid-write. When a checkpoint is also the best one,
+    ``ckpt.best.pth`` is created as a hard link to the new checkpoint (or as a copy, if hard links are not supported)
+    instead of serializing the same state twice. Finally, old epoch checkpoints can be pruned automatically to only
+    keep the most recent ones.
+
+    With the 'split' layout, the model weights and optimizer state are saved in their own files (named
+    ``weights.<epoch>.<log_stamp>.pth`` and ``optim.<epoch>.<log_stamp>.pth``), and the checkpoint file itself only
+    holds metadata along with the names of these files. This allows evaluation/inference sessions to only load model
+    weights (see :func:`thelper.utils.load_checkpoint`). In that case, the best weights/optimizer files are linked,
+    and only the (small) best metadata file is serialized again. After each write, the ``manifest.json`` file of the
+    checkpoint directory is updated with the names of the latest and best checkpoints.
+
+    At most ``max_pending`` snapshots are kept in memory while waiting to be written; if more saves are requested,
+    the calling thread blocks until the oldest write is done. Errors that occur in the background are raised on the
+    calling thread during the next call to :func:`CheckpointWriter.save` or :func:`CheckpointWriter.flush`.
+
+    Attributes:
+        checkpoint_dir: directory where checkpoints are written.
+        keep_last: number of most recent epoch checkpoints to keep (0 = keep all); the best checkpoint is never pruned.
+        async_write: specifies whether checkpoints should be written in a background thread or synchronously.
+        max_pending: maximum number of checkpoints that can wait to be written in the background.
+        layout: checkpoint file layout (``single`` or ``split``).
+    """
+
+    def __init__(self, checkpoint_dir, keep_last=0, async_write=True, max_pending=1, layout="single"):
+        """Receives the checkpoint directory and writing settings."""
+        assert layout in CHECKPOINT_LAYOUTS, f"unknown checkpoint layout '{layout}'"
+        assert int(keep_last) >= 0, "number of checkpoints to keep should be positive (or 0 to keep all)"
+        assert int(max_pending) >= 1, "max pending checkpoint count should be strictly positive"
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = int(keep_last)
+        self.async_write = async_write
+        self.max_pending = int(max_pending)
+        self.layout = layout
+        self._executor = None
+        self._pending = collections.deque()
+
+    def __repr__(self):
+        return self.__class__.__module__ + "." + self.__class__.__qualname__ + \
+            f"(checkpoint_dir={repr(self.checkpoint_dir)}, keep_last={self.keep_last}, " + \
+            f"async_write={self.async_write}, max_pending={self.max_pending}, layout={repr(self.layout)})"
+
+    def _wait_pending(self, max_count):
+        """Waits until at most ``max_count`` writes are pending, re-raising any error from completed writes."""
+        while self._pending and (len(self._pending) > max_count or self._pending[0].done()):
+            self._pending.popleft().result()
+
+    def save(self, state, filename, save_best=False):
+        """Saves a checkpoint state under the given file name (and as the best checkpoint, if needed)."""
+        assert isinstance(filename, str) and filename.endswith(".pth"), "unexpected checkpoint file name"
+        self._wait_pending(self.max_pending - 1)
+        state = snapshot_state(state)
+        if not self.async_write:
+            self._write(state, filename, save_best)
+            return
+        if self._executor is None:
+            # note: the executor's thread is joined at exit, so pending checkpoints are not lost
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="ckpt-writer")
+        self._pending.append(self._executor.submit(self._write, state, filename, save_best))
+
+    def flush(self):
+        """Blocks until all pending checkpoints are written to disk."""
+        self._wait_pending(0)
+
+    def _write(self, state, filename, save_best):
+        """Writes a checkpoint state atomically, updates the best checkpoint, and prunes old checkpoints."""
+        path = os.path.join(self.checkpoint_dir, filename)
+        best_path = os.path.join(self.checkpoint_dir, "ckpt.best.pth")
+        if self.layout == "split":
+            # parts are written first, so that the metadata file never refers to missing files
+            ckpt_tag = filename[len("ckpt."):-len(".pth")]
+            best_state = dict(state)
+            for key, prefix in SPLIT_CHECKPOINT_PARTS.items():
+                if state.get(key) is None or isinstance(state[key], str):
+                    continue
+                part_name = f"{prefix}.{ckpt_tag}.pth"
+                _save_atomic(state[key], os.path.join(self.checkpoint_dir, part_name))
+                if save_best:
+                    best_state[key] = f"{prefix}.best.pth"
+                    _replace_file(os.path.join(self.checkpoint_dir, part_name),
+                                  os.path.join(self.checkpoint_dir, best_state[key]), link=True)
+                state[key] = part_name
+            _save_atomic(state, path)
+            if save_best:
+                _save_atomic(best_state, best_path)
+        else:
+            _save_atomic(state, path)
+            if save_best:
+                _replace_file(path, best_path, link=True)
+        logger.debug(f"checkpoint written to {os.path.abspath(path)}")
+        if self.keep_last > 0:
+            self.prune()
+        self._write_manifest(filename)
+
+    def _get_epoch_checkpoints(self):
+        """Returns the sorted list of (stamp, filename) pairs for all epoch checkpoints in the directory."""
+        stamped_names = []
+        for filename in os.listdir(self.checkpoint_dir):
+            if filename.startswith("ckpt.") and filename.endswith(".pth"):
+                stamp = get_checkpoint_epoch_stamp(filename)
+                if stamp is not None:
+                    stamped_names.append((stamp, filename))
+        return sorted(stamped_names)
+
+    def _write_manifest(self, latest_name):
+        """Updates the manifest file listing the latest, best, and all other checkpoints of the directory."""
+        manifest = {
+            "layout": self.layout,
+            "latest": latest_name,
+            "best": "ckpt.best.pth" if os.path.isfile(os.path.join(self.checkpoint_dir, "ckpt.best.pth")) else None,
+            "checkpoints": [{"file": filename, "epoch": stamp[0]} for stamp, filename in self._get_epoch_checkpoints()],
+        }
+        manifest_path = os.path.join(self.checkpoint_dir, CHECKPOINT_MANIFEST_NAME)
+        with open(manifest_path + ".tmp", "w") as fd:
+            json.dump(manifest, fd, indent=4)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def prune(self):
+        """Removes the oldest epoch checkpoints from the checkpoint directory, keeping the most recent ones."""
+        for _, filename in self._get_epoch_checkpoints()[:-self.keep_last]:
+            logger.debug(f"pruning old checkpoint at {os.path.abspath(os.path.join(self.checkpoint_dir, filename))}")
+            ckpt_tag = filename[len("ckpt."):-len(".pth")]
+            part_names = [f"{prefix}.{ckpt_tag}.pth" for prefix in SPLIT_CHECKPOINT_PARTS.values()]
+            for name in [filename] + part_names:
+                if os.path.isfile(os.path.join(self.checkpoint_dir, name)):
+                    os.remove(os.path.join(self.checkpoint_dir, name))
@@ -5,16 +5,44 @@ This package contains classes specialized for training models on various tasks.
 
 import logging
 
-from thelper.train.base import Trainer  # noqa: F401
-from thelper.train.classif import ImageClassifTrainer  # noqa: F401
-from thelper.train.detect import ObjDetectTrainer  # noqa: F401
-from thelper.train.regr import RegressionTrainer  # noqa: F401
-from thelper.train.segm import ImageSegmTrainer  # noqa: F401
-from thelper.train.utils import ClassifLogger  # noqa: F401
-from thelper.train.utils import ClassifReport  # noqa: F401
-from thelper.train.utils import ConfusionMatrix  # noqa: F401
-from thelper.train.utils import DetectLogger  # noqa: F401
-from thelper.train.utils import create_consumers  # noqa: F401
-from thelper.train.utils import create_trainer  # noqa: F401
+import thelper.lazy
+
+__getattr__, __dir__, __all__ = thelper.lazy.attach(
+    __name__,
+    submodules=[
+        "ae",
+        "base",
+        "classif",
+        "detect",
+        "regr",
+        "segm",
+        "utils",
+    ],
+    attributes={
+        "thelper.train.base": [
+            "Trainer",
+        ],
+        "thelper.train.classif": [
+            "ImageClassifTrainer",
+        ],
+        "thelper.train.detect": [
+            "ObjDetectTrainer",
+        ],
+        "thelper.train.regr": [
+            "RegressionTrainer",
+        ],
+        "thelper.train.segm": [
+            "ImageSegmTrainer",
+        ],
+        "thelper.train.utils": [
+            "ClassifLogger",
+            "ClassifReport",
+            "ConfusionMatrix",
+            "DetectLogger",
+            "create_consumers",
+            "create_trainer",
+        ],
+    },
+)
 
 logger = logging.getLogger("thelper.train")
@@ -131,7 +131,7 @@ class AutoEncoderTrainer(Trainer):
                 reconstr_edge_loss = self.reconstr_l1_loss(reconstr_gradients, input_gradients)
                 reconstr_loss += reconstr_edge_loss
             iter_loss = classif_loss + self.reconstr_scale * reconstr_loss
-            iter_loss.backward()
+            self._backward(iter_loss)
             optimizer.step()
             iter_loss = iter_loss.item()
             for metric in metrics.values():
@@ -13,6 +13,8 @@ import torch
 
 import thelper.optim
 import thelper.tasks
+import thelper.train.utils
+import thelper.utils
 from thelper.session.base import SessionRunner
 
 logger = logging.getLogger(__name__)
@@ -41,11 +43,46 @@ class Trainer(SessionRunner):
       information on special parameters.
     - ``save_freq`` (optional, default=1): checkpoint save frequency (will save every epoch multiple of given number).
     - ``save_raw`` (optional, default=True): specifies whether to save raw types or thelper objects in checkpoints.
+    - ``async_save`` (optional, default=True): specifies whether checkpoints should be written in a background thread.
+      Pending writes are always flushed before training or evaluation returns, even if it fails.
+    - ``keep_last_ckpts`` (optional, default=0): number of most recent epoch checkpoints to keep on disk (0 = keep
+      all); older ones are pruned after each save. The best checkpoint is always kept.
+    - ``ckpt_layout`` (optional, default=single): checkpoint file layout; with ``split``, model weights, optimizer
+      state, and metadata are saved in separate files so that evaluation/inference sessions can load only weights.
     - ``use_tbx`` (optional, default=False): defines whether to use tensorboardX writers for logging or not.
     - ``device`` (optional): specifies which device to train/evaluate the model on (default=all available).
     - ``metrics``: list of metrics to instantiate and update during training/evaluation; see related loading function for
       more information.
     - ``monitor``: specifies the name of the metric that should be monitored on the validation set for model improvement.
+    - ``grad_accum_steps`` (optional, default=1): number of loader batches over which to accumulate gradients before
+      each optimizer step (i.e. the effective batch size is this number times the loader batch size).
+    - ``micro_batch_size`` (optional, default=0): maximum number of samples to forward/backward at once while training;
+      larger loader batches are split into micro-batches whose gradients are accumulated before the optimizer step,
+      which allows large batch recipes to fit a memory budget. See :class:`thelper.train.utils.GradientAccumulator`.
+    - ``backend`` (optional, default=eager): execution backend used to run the model (``eager``, ``script``,
+      ``trace``, or ``compile``). TorchScript backends are only used for evaluation. If a backend cannot be used with
+      the model, the session falls back to eager mode. See :func:`thelper.nn.utils.compile_model` for more info.
+    - ``mixed_precision`` (optional, default=None): enables automatic mixed precision for forward passes and losses in
+      both training and evaluation. Can be ``bf16`` (supported on CPUs and recent GPUs) or ``fp16`` (CUDA only, with
+      gradient scaling). Model weights and checkpoints remain in fp32, and predictions are converted back to fp32
+      before being given to metrics and consumers.
+    - ``tta`` (optional): sub-dictionary containing test-time augmentation parameters used during evaluation. Its
+      ``views`` list defines the flips/shifts applied to each evaluation batch (see
+      :func:`thelper.train.utils.parse_tta_views`), ``reduction`` defines how the predictions of all views are
+      combined (``mean``, ``max``, or ``gmean``; default=``mean``), and ``max_batch_size`` limits the number of
+      samples forwarded at once across all views (default=0, i.e. all views are forwarded as a single batch). The
+      reduction and batch size are also used when evaluation samples are augmented into lists by the data loader.
+    - ``pipeline`` (optional, default=None): sub-dictionary of parameters for the pipelined evaluation runner, in
+      which loading, inference, and metric/consumer updates run concurrently (see
+      :func:`thelper.infer.pipeline.run_pipelined_eval`). Its ``prefetch`` and ``max_in_flight`` values bound the
+      queues between stages (default=2), and ``consumer_threads`` sets the number of workers used to update metrics
+      (default=2). Can also be set to ``true``/``false``. Only used by trainers that implement ``eval_batch`` and
+      that do not override the stock ``eval_epoch`` implementation (see :func:`supports_eval_batch`).
+    - ``shards`` (optional, default=0): number of CPU worker processes over which to spread evaluation batches, each
+      with its own model copy (see :func:`thelper.infer.sharding.run_sharded_eval`). Metrics and consumers are still
+      updated in the main process. ``shard_threads`` sets the number of intra-op threads of each worker (default=0,
+      i.e. the CPU core count divided by the number of shards). Only used on CPU, under the same conditions as
+      ``pipeline``, over which it takes precedence.
 
     Example configuration file::
 
@@ -89,6 +126,12 @@ class Trainer(SessionRunner):
                     # visualization parameters would be provided here
                 }
             },
+            # test-time augmentation block (optional)
+            "tta": {
+                # predictions over the original and flipped images will be averaged
+                "views": ["identity", "hflip"],
+                "reduction": "mean"
+            },
             # in this example, we use two consumers in total
             # (one metric for monitoring, and one for logging)
             "metrics": {
@@ -128,6 +171,101 @@ class Trainer(SessionRunner):
                  ckptdata=None    # type: Optional[thelper.typedefs.CheckpointContentType]
                  ):
         super(Trainer, self).__init__(session_name, session_dir, model, task, loaders, config, ckptdata=ckptdata)
+        self._load_runner_params(config, ckptdata)
+
+    def _load_runner_params(self, config, ckptdata=None):
+        """Parses the trainer parameters related to test-time augmentation, gradient accumulation, precision, etc.
+
+        This is called by the constructors of both trainers and testers (which skip the trainer constructor).
+        """
+        trainer_config = thelper.utils.get_key(["trainer", "runner", "tester"], config)
+        self._load_tta_params(trainer_config)
+        self.grad_accum_steps = int(thelper.utils.get_key_def("grad_accum_steps", trainer_config, 1))
+        assert self.grad_accum_steps >= 1, "gradient accumulation step count should be strictly positive"
+        self.micro_batch_size = int(thelper.utils.get_key_def("micro_batch_size", trainer_config, 0))
+        assert self.micro_batch_size >= 0, "micro-batch size should be positive (or 0 to disable splitting)"
+        mixed_precision = thelper.utils.get_key_def(["mixed_precision", "amp"], trainer_config, None)
+        if isinstance(mixed_precision, str) and mixed_precision.lower() in ["none", "fp32", "false"]:
+            mixed_precision = None
+        assert mixed_precision in [None, "bf16", "fp16"], \
+            f"unexpected mixed precision mode '{mixed_precision}' (should be 'bf16', 'fp16', or None)"
+        self.amp_device_type = "cuda" if self.devices else "cpu"
+        self.amp_dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(mixed_precision, None)
+        assert self.amp_dtype != torch.float16 or self.amp_device_type == "cuda", \
+            "fp16 mixed precision requires cuda devices (use 'bf16' for cpu)"
+        self.grad_scaler = None
+        if self.amp_dtype == torch.float16:
+            # bf16 has the same range as fp32, so only fp16 needs gradients to be scaled to avoid underflows
+            self.grad_scaler = torch.amp.GradScaler("cuda") if hasattr(torch.amp, "GradScaler") \
+                else torch.cuda.amp.GradScaler()
+            grad_scaler_state = thelper.utils.get_key_def("grad_scaler", ckptdata or {}, None)
+            if grad_scaler_state is not None:
+                self.grad_scaler.load_state_dict(grad_scaler_state)
+        pipeline_config = thelper.utils.get_key_def("pipeline", trainer_config, None)
+        if isinstance(pipeline_config, bool):
+            pipeline_config = {} if pipeline_config else None
+        assert pipeline_config is None or isinstance(pipeline_config, dict), \
+            "unexpected pipeline config type (should be dict or bool)"
+        self.pipeline_config = pipeline_config
+        self.shard_count = int(thelper.utils.get_key_def("shards", trainer_config, 0))
+        assert self.shard_count >= 0, "shard count should be positive (or 0 to disable sharding)"
+        self.shard_threads = int(thelper.utils.get_key_def("shard_threads", trainer_config, 0))
+        assert self.shard_threads >= 0, "shard thread count should be positive (or 0 for automatic)"
+
+    def _load_tta_params(self, trainer_config):
+        """Parses the test-time augmentation parameters used during evaluation (see ``tta`` in the class docs)."""
+        tta_config = thelper.utils.get_key_def("tta", trainer_config, {})
+        assert isinstance(tta_config, dict), "unexpected tta config type (should be dict)"
+        self.tta_views = thelper.train.utils.parse_tta_views(thelper.utils.get_key_def("views", tta_config, []))
+        self.tta_reduction = thelper.utils.get_key_def("reduction", tta_config, "mean")
+        assert self.tta_reduction in thelper.train.utils.TTA_REDUCTIONS, \
+            f"unknown tta reduction '{self.tta_reduction}'"
+        self.tta_max_batch_size = int(thelper.utils.get_key_def("max_batch_size", tta_config, 0))
+        assert self.tta_max_batch_size >= 0, "tta max batch size should be positive (or 0 to disable chunking)"
+
+    def _autocast(self):
+        """Returns the autocast context in which forward passes and losses should be computed (no-op in fp32)."""
+        return torch.autocast(self.amp_device_type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None)
+
+    def _backward(self, loss):
+        """Backpropagates a loss tensor, scaling it first if a gradient scaler is needed for mixed precision.
+
+        Derived trainers should call this instead of ``loss.backward()`` so that mixed precision training works. The
+        backward pass is always done outside autocast regions, as recommended by PyTorch.
+        """
+        with torch.autocast(self.amp_device_type, enabled=False):
+            if self.grad_scaler is not None:
+                loss = self.grad_scaler.scale(loss)
+            loss.backward()
+
+    def _wrap_metrics(self, metrics):
+        """Returns the metrics to update during epochs, wrapped to receive fp32 tensors under mixed precision."""
+        if self.amp_dtype is None:
+            return metrics
+        return {name: thelper.train.utils.FullPrecisionConsumer(metric) for name, metric in metrics.items()}
+
+    def _run_eval_epoch(self, model, loader, metrics, output_path):
+        """Runs an evaluation epoch, using the sharded/pipelined runners if enabled and supported by the trainer."""
+        metrics = self._wrap_metrics(metrics)
+        if self.shard_count > 1:
+            if self.devices or not self.supports_eval_batch():
+                self.logger.warning(f"trainer '{type(self).__name__}' cannot use sharded evaluation "
+                                    "(only supported on cpu, for trainers that use the stock 'eval_epoch')")
+            else:
+                import thelper.infer.sharding
+                return thelper.infer.sharding.run_sharded_eval(
+                    self, self.model, self.current_epoch, loader, metrics, output_path,
+                    shard_count=self.shard_count, shard_threads=self.shard_threads)
+        with self._autocast():
+            if self.pipeline_config is not None:
+                if self.supports_eval_batch():
+                    import thelper.infer.pipeline
+                    return thelper.infer.pipeline.run_pipelined_eval(
+                        self, model, self.current_epoch, self.devices, loader, metrics, output_path,
+                        **self.pipeline_config)
+                self.logger.warning(f"trainer '{type(self).__name__}' does not use the stock 'eval_epoch' with "
+                                    "'eval_batch', cannot use pipelined evaluation")
+            return self.eval_epoch(model, self.current_epoch, self.devices, loader, metrics, output_path)
 
     def train(self, my_opt = None):
         """Starts the training process.
@@ -150,64 +288,176 @@ class Trainer(SessionRunner):
         if scheduler is not None and self.scheduler_state is not None:
             scheduler.load_state_dict(self.scheduler_state)
             self.scheduler_state = None
+        model = self._compile_model(model, training=True)
         self.logger.info(f"loss: {str(loss)}")
         self.logger.info(f"optimizer: {str(optimizer)}")
+        train_optimizer, train_loader = optimizer, self.train_loader
+        if optimizer is not None and (self.grad_accum_steps > 1 or self.micro_batch_size > 0 or self.grad_scaler):
+            # derived trainers step the optimizer every iteration; the wrapper decides when to actually apply updates
+            train_optimizer = thelper.train.utils.GradientAccumulator(optimizer, self.grad_accum_steps,
+                                                                      self.micro_batch_size, self.task.input_key,
+                                                                      grad_scaler=self.grad_scaler)
+            train_loader = train_optimizer.wrap_loader(self.train_loader)
+            self.logger.info(f"gradient accumulation: {str(train_optimizer)}")
+        if self.amp_dtype is not None:
+            self.logger.info(f"mixed precision: {str(self.amp_dtype)} autocast on {self.amp_device_type}")
         latest_loss = math.inf
-        while self.current_epoch < self.epochs:
-            self.writers["train"] = self._init_writer(self.writers["train"], self.output_paths["train"])
-            self.logger.info(f"at epoch#{self.current_epoch} for '{self.name}' (dev={str(self.devices)})")
-            if scheduler:
-                if scheduler_step_metric:
-                    if scheduler_step_metric == "loss":
-                        # todo: use validation loss instead? more stable?
-                        scheduler.step(metrics=latest_loss, epoch=self.current_epoch)
+        try:
+            while self.current_epoch < self.epochs:
+                self.writers["train"] = self._init_writer(self.writers["train"], self.output_paths["train"])
+                self.logger.info(f"at epoch#{self.current_epoch} for '{self.name}' (dev={str(self.devices)})")
+                if scheduler:
+                    if scheduler_step_metric:
+                        if scheduler_step_metric == "loss":
+                            # todo: use validation loss instead? more stable?
+                            scheduler.step(metrics=latest_loss, epoch=self.current_epoch)
+                        else:
+                            metric = None
+                            if self.valid_loader and scheduler_step_metric in self.valid_metrics:
+                                metric = self.valid_metrics[scheduler_step_metric]
+                            elif self.train_loader and scheduler_step_metric in self.train_metrics:
+                                metric = self.train_metrics[scheduler_step_metric]
+                            # note: makes no sense to look for it in test metrics
+                            assert metric is not None, f"cannot find metric '{scheduler_step_metric}' for scheduler step"
+                            assert isinstance(metric, thelper.optim.metrics.Metric), "monitoring consumer must be metric"
+                            metric_anti_goal = thelper.optim.Metric.maximize \
+                                if metric.goal == thelper.optim.Metric.minimize \
+                                else thelper.optim.Metric.minimize
+                            metric_val = metric.eval() if self.current_epoch > 0 else metric_anti_goal
+                            scheduler.step(metrics=metric_val, epoch=self.current_epoch)
                     else:
-                        metric = None
-                        if self.valid_loader and scheduler_step_metric in self.valid_metrics:
-                            metric = self.valid_metrics[scheduler_step_metric]
-                        elif self.train_loader and scheduler_step_metric in self.train_metrics:
-                            metric = self.train_metrics[scheduler_step_metric]
-                        # note: makes no sense to look for it in test metrics
-                        assert metric is not None, f"cannot find metric '{scheduler_step_metric}' for scheduler step"
-                        assert isinstance(metric, thelper.optim.metrics.Metric), "monitoring consumer must be metric"
-                        metric_anti_goal = thelper.optim.Metric.maximize \
-                            if metric.goal == thelper.optim.Metric.minimize \
-                            else thelper.optim.Metric.minimize
-                        metric_val = metric.eval() if self.current_epoch > 0 else metric_anti_goal
-                        scheduler.step(metrics=metric_val, epoch=self.current_epoch)
-                else:
-                    scheduler.step(epoch=self.current_epoch)
-            if self.writers["train"] and not self.skip_tbx_histograms and \
-                    (self.current_epoch % self.tbx_histogram_freq) == 0:
-                for pname, param in model.named_parameters():
-                    if "bn" in pname:
-                        continue  # skip batch norm modules
-                    pname = pname.replace(".", "/")  # for proper grouping
-                    if pname.startswith("module/"):
-                        pname = pname.replace("module/", "", 1)
-                    if pname.startswith("model/"):
-                        pname = pname.replace("model/", "", 1)
-                    data = param.data.cpu().numpy().flatten()
-                    self.writers["train"].add_histogram(pname, data, self.current_epoch)
-                    if param.grad is not None:
-                        grad = param.grad.data.cpu().numpy().flatten()
-                        self.writers["train"].add_histogram(pname + '/grad', grad, self.current_epoch)
-            self.logger.debug(f"learning rate at {thelper.optim.get_lr(optimizer):.8f}")
-            self._set_rng_state(self.train_loader.seeds, self.current_epoch)
-            model.train()
-            if hasattr(self.train_loader, "set_epoch") and callable(self.train_loader.set_epoch):
-                self.train_loader.set_epoch(self.current_epoch)
-            train_loss = self.train_epoch(model, self.current_epoch, self.devices, loss, optimizer,
-                                          self.train_loader, self.train_metrics, self.output_paths["train"])
-            self._write_metrics_data(self.current_epoch, self.train_metrics,
-                                     self.writers["train"], self.output_paths["train"],
-                                     loss=train_loss, optimizer=optimizer)
-            train_metric_vals = {metric_name: metric.eval() for metric_name, metric in self.train_metrics.items()
-                                 if isinstance(metric, thelper.optim.metrics.Metric)}
-            result = {"train/loss": train_loss, "train/metrics": train_metric_vals}
-            monitor_type_key = "train/metrics"  # if we cannot run validation, will monitor progression on training metrics
-            valid_loss = None
-            if self.valid_loader:
+                        scheduler.step(epoch=self.current_epoch)
+                if self.writers["train"] and not self.skip_tbx_histograms and \
+                        (self.current_epoch % self.tbx_histogram_freq) == 0:
+                    for pname, param in model.named_parameters():
+                        if "bn" in pname:
+                            continue  # skip batch norm modules
+                        pname = pname.replace(".", "/")  # for proper grouping
+                        if pname.startswith("module/"):
+                            pname = pname.replace("module/", "", 1)
+                        if pname.startswith("_orig_mod/"):
+                            pname = pname.replace("_orig_mod/", "", 1)  # prefix added by torch.compile
+                        if pname.startswith("model/"):
+                            pname = pname.replace("model/", "", 1)
+                        data = param.data.cpu().numpy().flatten()
+                        self.writers["train"].add_histogram(pname, data, self.current_epoch)
+                        if param.grad is not None:
+                            grad = param.grad.data.cpu().numpy().flatten()
+                            self.writers["train"].add_histogram(pname + '/grad', grad, self.current_epoch)
+                self.logger.debug(f"learning rate at {thelper.optim.get_lr(optimizer):.8f}")
+                self._set_rng_state(self.train_loader.seeds, self.current_epoch)
+                model.train()
+                if hasattr(self.train_loader, "set_epoch") and callable(self.train_loader.set_epoch):
+                    self.train_loader.set_epoch(self.current_epoch)
+                with self._autocast():
+                    train_loss = self.train_epoch(model, self.current_epoch, self.devices, loss, train_optimizer, train_loader,
+                                                  self._wrap_metrics(self.train_metrics), self.output_paths["train"])
+                self._write_metrics_data(self.current_epoch, self.train_metrics,
+                                         self.writers["train"], self.output_paths["train"],
+                                         loss=train_loss, optimizer=optimizer)
+                train_metric_vals = {metric_name: metric.eval() for metric_name, metric in self.train_metrics.items()
+                                     if isinstance(metric, thelper.optim.metrics.Metric)}
+                result = {"train/loss": train_loss, "train/metrics": train_metric_vals}
+                monitor_type_key = "train/metrics"  # if we cannot run validation, will monitor progression on training metrics
+                valid_loss = None
+                if self.valid_loader:
+                    self._set_rng_state(self.valid_loader.seeds, self.current_epoch)
+                    model.eval()
+                    self.writers["valid"] = self._init_writer(self.writers["valid"], self.output_paths["valid"])
+                    for metric in self.valid_metrics.values():
+                        metric.reset()  # force reset here, we always evaluate from a clean state
+                    if hasattr(self.valid_loader, "set_epoch") and callable(self.valid_loader.set_epoch):
+                        self.valid_loader.set_epoch(self.current_epoch)
+                    with self._autocast():
+                        valid_loss = self.eval_epoch(model, self.current_epoch, self.devices, self.valid_loader,
+                                                     self._wrap_metrics(self.valid_metrics), self.output_paths["valid"])
+                    # note: valid_loss might be None if evaluator did not implement/compute it
+                    self._write_metrics_data(self.current_epoch, self.valid_metrics,
+                                             self.writers["valid"], self.output_paths["valid"],
+                                             loss=valid_loss)
+                    valid_metric_vals = {metric_name: metric.eval() for metric_name, metric in self.valid_metrics.items()
+                                         if isinstance(metric, thelper.optim.metrics.Metric)}
+                    result = {**result, "valid/metrics": valid_metric_vals}
+                    monitor_type_key = "valid/metrics"  # since validation is available, use that to monitor progression
+                    uploader = functools.partial(self._move_tensor, dev=self.devices, detach=True)
+                    wrapped_loader = thelper.data.DataLoaderWrapper(self.valid_loader, uploader)
+                    for viz, kwargs in self.viz.items():
+                        viz_data = thelper.viz.visualize(model, self.task, wrapped_loader, viz_type=viz, **kwargs)
+                        self._write_data(viz_data, "epoch/", f"-{self.current_epoch:04d}", self.writers["valid"],
+                                         self.output_paths["valid"], self.current_epoch)
+                latest_loss = valid_loss if valid_loss is not None else train_loss
+                new_best = False
+                monitor_val = None
+                if self.monitor == "loss":
+                    monitor_val = latest_loss
+                    if self.monitor_best > latest_loss:
+                        new_best = True
+                for key, value in result.items():
+                    if key == monitor_type_key and self.monitor is not None and self.monitor != "loss":
+                        assert self.monitor in value, f"not monitoring required variable '{self.monitor}' in metrics"
+                        monitor_val = value[self.monitor]
+                        if (self.monitor_goal == thelper.optim.Metric.minimize and monitor_val < self.monitor_best) or \
+                           (self.monitor_goal == thelper.optim.Metric.maximize and monitor_val > self.monitor_best):
+                            self.monitor_best = monitor_val
+                            self.monitor_best_epoch = self.current_epoch
+                            new_best = True
+                    if not isinstance(value, dict):
+                        self.logger.info(f" epoch#{self.current_epoch} result =>  {str(key)}: {value}")
+                    else:
+                        for subkey, subvalue in value.items():
+                            self.logger.info(f" epoch#{self.current_epoch} result =>  {str(key)}:{str(subkey)}: {subvalue}")
+                if self.monitor is not None:
+                    assert monitor_val is not None, f"training/validation did not evaluate required metric '{self.monitor}'"
+                    if new_best:
+                        best_str = "(new best value)"
+                    else:
+                        best_str = f"(previous best = {self.monitor_best} @ epoch = {self.monitor_best_epoch})"
+                    self.logger.info(f"epoch {self.current_epoch}, monitored {self.monitor} = {monitor_val}  {best_str}")
+                self.outputs[self.current_epoch] = result
+                if new_best or (self.current_epoch % self.save_freq) == 0:
+                    self.logger.info(f"saving checkpoint @ epoch#{self.current_epoch}")
+                    self._save(self.current_epoch, self.current_iter, optimizer, scheduler, save_best=new_best)
+                self.current_epoch += 1
+        finally:
+            self.checkpoint_writer.flush()  # make sure all checkpoints are on disk, even if training failed
+        self.logger.info(f"training for session '{self.name}' done")
+        return self.outputs
+
+    def eval(self):
+        """Starts the evaluation process.
+
+        This function will evaluate the model using the test data (or the validation data, if no test data is available),
+        and return the results. Note that the code related to the forwarding of samples inside the model itself is implemented
+        in a derived class via :func:`thelper.train.base.Trainer.eval_epoch`.
+        """
+        assert self.valid_loader or self.test_loader, "missing validation/test data, invalid loaders!"
+        self.logger.debug(f"uploading model to '{str(self.devices)}'...")
+        model = self._upload_model(self.model, self.devices)
+        model = self._compile_model(model)
+        try:
+            result = {}
+            output_group = None, None
+            if self.test_loader:
+                self._set_rng_state(self.test_loader.seeds, self.current_epoch)
+                model.eval()
+                self.writers["test"] = self._init_writer(self.writers["test"], self.output_paths["test"])
+                for metric in self.test_metrics.values():
+                    metric.reset()  # force reset here, we always evaluate from a clean state
+                if hasattr(self.test_loader, "set_epoch") and callable(self.test_loader.set_epoch):
+                    self.test_loader.set_epoch(self.current_epoch)
+                self._run_eval_epoch(model, self.test_loader, self.test_metrics, self.output_paths["test"])
+                self._write_metrics_data(self.current_epoch, self.test_metrics,
+                                         self.writers["test"], self.output_paths["test"], use_suffix=False)
+                test_metric_vals = {metric_name: metric.eval() for metric_name, metric in self.test_metrics.items()
+                                    if isinstance(metric, thelper.optim.metrics.Metric)}
+                result = {**result, **test_metric_vals}
+                output_group = "test/metrics"
+                uploader = functools.partial(self._move_tensor, dev=self.devices, detach=True)
+                wrapped_loader = thelper.data.DataLoaderWrapper(self.test_loader, uploader)
+                for viz, kwargs in self.viz.items():
+                    viz_data = thelper.viz.visualize(model, self.task, wrapped_loader, viz_type=viz, **kwargs)
+                    self._write_data(viz_data, "epoch/", "", self.writers["test"], self.output_paths["test"], self.current_epoch)
+            elif self.valid_loader:
                 self._set_rng_state(self.valid_loader.seeds, self.current_epoch)
                 model.eval()
                 self.writers["valid"] = self._init_writer(self.writers["valid"], self.output_paths["valid"])
@@ -215,124 +465,55 @@ class Trainer(SessionRunner):
                     metric.reset()  # force reset here, we always evaluate from a clean state
                 if hasattr(self.valid_loader, "set_epoch") and callable(self.valid_loader.set_epoch):
                     self.valid_loader.set_epoch(self.current_epoch)
-                valid_loss = self.eval_epoch(model, self.current_epoch, self.devices, self.valid_loader,
-                                             self.valid_metrics, self.output_paths["valid"])
-                # note: valid_loss might be None if evaluator did not implement/compute it
+                self._run_eval_epoch(model, self.valid_loader, self.valid_metrics, self.output_paths["valid"])
                 self._write_metrics_data(self.current_epoch, self.valid_metrics,
-                                         self.writers["valid"], self.output_paths["valid"],
-                                         loss=valid_loss)
+                                         self.writers["valid"], self.output_paths["valid"], use_suffix=False)
                 valid_metric_vals = {metric_name: metric.eval() for metric_name, metric in self.valid_metrics.items()
                                      if isinstance(metric, thelper.optim.metrics.Metric)}
-                result = {**result, "valid/metrics": valid_metric_vals}
-                monitor_type_key = "valid/metrics"  # since validation is available, use that to monitor progression
+                result = {**result, **valid_metric_vals}
+                output_group = "valid/metrics"
                 uploader = functools.partial(self._move_tensor, dev=self.devices, detach=True)
                 wrapped_loader = thelper.data.DataLoaderWrapper(self.valid_loader, uploader)
                 for viz, kwargs in self.viz.items():
                     viz_data = thelper.viz.visualize(model, self.task, wrapped_loader, viz_type=viz, **kwargs)
-                    self._write_data(viz_data, "epoch/", f"-{self.current_epoch:04d}", self.writers["valid"],
-                                     self.output_paths["valid"], self.current_epoch)
-            latest_loss = valid_loss if valid_loss is not None else train_loss
-            new_best = False
-            monitor_val = None
-            if self.monitor == "loss":
-                monitor_val = latest_loss
-                if self.monitor_best > latest_loss:
-                    new_best = True
+                    self._write_data(viz_data, "epoch/", "", self.writers["valid"], self.output_paths["valid"], self.current_epoch)
             for key, value in result.items():
-                if key == monitor_type_key and self.monitor is not None and self.monitor != "loss":
-                    assert self.monitor in value, f"not monitoring required variable '{self.monitor}' in metrics"
-                    monitor_val = value[self.monitor]
-                    if (self.monitor_goal == thelper.optim.Metric.minimize and monitor_val < self.monitor_best) or \
-                       (self.monitor_goal == thelper.optim.Metric.maximize and monitor_val > self.monitor_best):
-                        self.monitor_best = monitor_val
-                        self.monitor_best_epoch = self.current_epoch
-                        new_best = True
                 if not isinstance(value, dict):
-                    self.logger.info(f" epoch#{self.current_epoch} result =>  {str(key)}: {value}")
+                    self.logger.info(f" final result =>  {str(key)}: {value}")
                 else:
                     for subkey, subvalue in value.items():
-                        self.logger.info(f" epoch#{self.current_epoch} result =>  {str(key)}:{str(subkey)}: {subvalue}")
-            if self.monitor is not None:
-                assert monitor_val is not None, f"training/validation did not evaluate required metric '{self.monitor}'"
-                if new_best:
-                    best_str = "(new best value)"
-                else:
-                    best_str = f"(previous best = {self.monitor_best} @ epoch = {self.monitor_best_epoch})"
-                self.logger.info(f"epoch {self.current_epoch}, monitored {self.monitor} = {monitor_val}  {best_str}")
-            self.outputs[self.current_epoch] = result
-            if new_best or (self.current_epoch % self.save_freq) == 0:
-                self.logger.info(f"saving checkpoint @ epoch#{self.current_epoch}")
-                self._save(self.current_epoch, self.current_iter, optimizer, scheduler, save_best=new_best)
-            self.current_epoch += 1
-        self.logger.info(f"training for session '{self.name}' done")
+                        self.logger.info(f" final result =>  {str(key)}:{str(subkey)}: {subvalue}")
+            if self.current_epoch not in self.outputs:
+                # probably using an 'untrained model' (such as a FCN adapted from a classifier)
+                self.outputs[self.current_epoch] = {}
+            self.outputs[self.current_epoch][output_group] = result
+            self.logger.info(f"evaluation for session '{self.name}' done")
+        finally:
+            self.checkpoint_writer.flush()  # checkpoints saved by the session must be on disk once it ends
         return self.outputs
 
-    def eval(self):
-        """Starts the evaluation process.
+    def _forward_views(self, model, views, dev, output_key=None):
+        """Forwards a list of views (i.e. augmented versions) of the same batch, and returns their stacked predictions.
 
-        This function will evaluate the model using the test data (or the validation data, if no test data is available),
-        and return the results. Note that the code related to the forwarding of samples inside the model itself is implemented
-        in a derived class via :func:`thelper.train.base.Trainer.eval_epoch`.
+        If all views have the same shape, they are concatenated and forwarded as a single batch, or in chunks of at
+        most ``max_batch_size`` samples if a memory budget is specified in the ``tta`` configuration. Otherwise, each
+        view is forwarded separately. The returned predictions are stacked with the view index first (VxBx...).
         """
-        assert self.valid_loader or self.test_loader, "missing validation/test data, invalid loaders!"
-        self.logger.debug(f"uploading model to '{str(self.devices)}'...")
-        model = self._upload_model(self.model, self.devices)
-        result = {}
-        output_group = None, None
-        if self.test_loader:
-            self._set_rng_state(self.test_loader.seeds, self.current_epoch)
-            model.eval()
-            self.writers["test"] = self._init_writer(self.writers["test"], self.output_paths["test"])
-            for metric in self.test_metrics.values():
-                metric.reset()  # force reset here, we always evaluate from a clean state
-            if hasattr(self.test_loader, "set_epoch") and callable(self.test_loader.set_epoch):
-                self.test_loader.set_epoch(self.current_epoch)
-            self.eval_epoch(model, self.current_epoch, self.devices, self.test_loader,
-                            self.test_metrics, self.output_paths["test"])
-            self._write_metrics_data(self.current_epoch, self.test_metrics,
-                                     self.writers["test"], self.output_paths["test"], use_suffix=False)
-            test_metric_vals = {metric_name: metric.eval() for metric_name, metric in self.test_metrics.items()
-                                if isinstance(metric, thelper.optim.metrics.Metric)}
-            result = {**result, **test_metric_vals}
-            output_group = "test/metrics"
-            uploader = functools.partial(self._move_tensor, dev=self.devices, detach=True)
-            wrapped_loader = thelper.data.DataLoaderWrapper(self.test_loader, uploader)
-            for viz, kwargs in self.viz.items():
-                viz_data = thelper.viz.visualize(model, self.task, wrapped_loader, viz_type=viz, **kwargs)
-                self._write_data(viz_data, "epoch/", "", self.writers["test"], self.output_paths["test"], self.current_epoch)
-        elif self.valid_loader:
-            self._set_rng_state(self.valid_loader.seeds, self.current_epoch)
-            model.eval()
-            self.writers["valid"] = self._init_writer(self.writers["valid"], self.output_paths["valid"])
-            for metric in self.valid_metrics.values():
-                metric.reset()  # force reset here, we always evaluate from a clean state
-            if hasattr(self.valid_loader, "set_epoch") and callable(self.valid_loader.set_epoch):
-                self.valid_loader.set_epoch(self.current_epoch)
-            self.eval_epoch(model, self.current_epoch, self.devices, self.valid_loader,
-                            self.valid_metrics, self.output_paths["valid"])
-            self._write_metrics_data(self.current_epoch, self.valid_metrics,
-                                     self.writers["valid"], self.output_paths["valid"], use_suffix=False)
-            valid_metric_vals = {metric_name: metric.eval() for metric_name, metric in self.valid_metrics.items()
-                                 if isinstance(metric, thelper.optim.metrics.Metric)}
-            result = {**result, **valid_metric_vals}
-            output_group = "valid/metrics"
-            uploader = functools.partial(self._move_tensor, dev=self.devices, detach=True)
-            wrapped_loader = thelper.data.DataLoaderWrapper(self.valid_loader, uploader)
-            for viz, kwargs in self.viz.items():
-                viz_data = thelper.viz.visualize(model, self.task, wrapped_loader, viz_type=viz, **kwargs)
-                self._write_data(viz_data, "epoch/", "", self.writers["valid"], self.output_paths["valid"], self.current_epoch)
-        for key, value in result.items():
-            if not isinstance(value, dict):
-                self.logger.info(f" final result =>  {str(key)}: {value}")
-            else:
-                for subkey, subvalue in value.items():
-                    self.logger.info(f" final result =>  {str(key)}:{str(subkey)}: {subvalue}")
-        if self.current_epoch not in self.outputs:
-            # probably using an 'untrained model' (such as a FCN adapted from a classifier)
-            self.outputs[self.current_epoch] = {}
-        self.outputs[self.current_epoch][output_group] = result
-        self.logger.info(f"evaluation for session '{self.name}' done")
-        return self.outputs
+        assert isinstance(views, list) and views, "cannot forward an empty list of views"
+        view_count, batch_size = len(views), len(views[0])
+        if all([view.shape == views[0].shape for view in views]):
+            chunks = torch.cat(views, dim=0)
+            chunks = torch.split(chunks, self.tta_max_batch_size) if self.tta_max_batch_size else [chunks]
+        else:
+            chunks = views
+        preds = []
+        for chunk in chunks:
+            pred = model(self._move_tensor(chunk, dev))
+            if output_key is not None and isinstance(pred, dict):
+                pred = pred[output_key]
+            preds.append(pred)
+        preds = torch.cat(preds, dim=0) if len(preds) > 1 else preds[0]
+        return preds.reshape(view_count, batch_size, *preds.shape[1:])
 
     @abstractmethod
     def train_epoch(self, model, epoch, dev, loss, optimizer, loader, metrics, output_path):
@@ -350,6 +531,35 @@ class Trainer(SessionRunner):
         """
         raise NotImplementedError
 
+    def supports_eval_batch(self):
+        """Returns whether evaluation epochs can be delegated to the batch-level interface (see ``eval_batch``).
+
+        This is only the case if the trainer implements ``eval_batch`` and still relies on one of the stock
+        ``eval_epoch`` implementations built on top of it; trainers that override ``eval_epoch`` are never bypassed.
+        """
+        import thelper.train
+        stock_eval_epochs = [thelper.train.ImageClassifTrainer.eval_epoch, thelper.train.ImageSegmTrainer.eval_epoch,
+                             thelper.train.RegressionTrainer.eval_epoch]
+        return type(self).eval_batch is not Trainer.eval_batch and type(self).eval_epoch in stock_eval_epochs
+
+    def eval_batch(self, model, input_val, target_val, dev):
+        """Computes the predictions of the model for a single batch of evaluation samples.
+
+        Implementing this function is optional; it is used by the pipelined evaluation runner (see
+        :func:`thelper.infer.pipeline.run_pipelined_eval`), which handles the loading of samples and the update of
+        metrics itself. The predictions and targets returned here should not be moved to the CPU.
+
+        Args:
+            model: the model to evaluate that is already uploaded to the target device(s).
+            input_val: the batched input tensor (or list of augmented input tensors) to forward.
+            target_val: the batched target tensor (or list of augmented target tensors), or ``None``.
+            dev: the target device that tensors should be uploaded to.
+
+        Returns:
+            A tuple of the prediction tensor and of the target tensor to give to the metrics.
+        """
+        raise NotImplementedError
+
     @abstractmethod
     def eval_epoch(self, model, epoch, device, loader, metrics, output_path):
         """Evaluates the model using the provided objects.
@@ -6,6 +6,7 @@ import torch
 import torch.optim
 
 import thelper.concepts
+import thelper.train.utils
 import thelper.typedefs as typ  # noqa: F401
 import thelper.utils
 from thelper.train.base import Trainer
@@ -38,6 +39,8 @@ class ImageClassifTrainer(Trainer):
         super().__init__(session_name, session_dir, model, task, loaders, config, ckptdata=ckptdata)
         assert isinstance(self.task, thelper.tasks.Classification), "expected task to be classification"
         self.warned_no_shuffling_augments = False
+        assert not self.task.multi_label or self.tta_reduction != "gmean", \
+            "geometric mean tta reduction is not compatible with multi-label classification"
 
     def _to_tensor(self, sample):
         """Fetches and returns tensors of input images and class labels from a batched sample dictionary."""
@@ -123,25 +126,21 @@ class ImageClassifTrainer(Trainer):
                                         "gradient steps might be affected")
                     # see the docstring of thelper.transforms.operations.Duplicator for more information
                     self.warned_no_shuffling_augments = True
-                iter_loss = None
-                iter_pred = None
+                iter_loss, iter_pred = None, []
                 augs_count = len(input_val)
                 for input_idx in range(augs_count):
                     aug_pred = model(self._move_tensor(input_val[input_idx], dev))
                     aug_loss = loss(aug_pred, self._move_tensor(target_val[input_idx], dev))
-                    aug_loss.backward()  # test backprop all at once? might not fit in memory...
-                    if iter_pred is None:
-                        iter_loss = aug_loss.clone().detach()
-                        iter_pred = aug_pred.clone().detach()
-                    else:
-                        iter_loss += aug_loss.detach()
-                        iter_pred = torch.cat((aug_pred.detach(), iter_pred), dim=0)
+                    self._backward(aug_loss)  # test backprop all at once? might not fit in memory...
+                    iter_loss = aug_loss.detach() if iter_loss is None else iter_loss + aug_loss.detach()
+                    iter_pred.append(aug_pred.detach())
+                iter_pred = torch.cat(iter_pred, dim=0)  # same order as the concatenated targets below
                 iter_loss /= augs_count
                 target_val = torch.cat(target_val, dim=0)
             else:  # this is the default (simple) case where we generate predictions without augmentations
                 iter_pred = model(self._move_tensor(input_val, dev))
                 iter_loss = loss(iter_pred, self._move_tensor(target_val, dev))
-                iter_loss.backward()
+                self._backward(iter_loss)
             optimizer.step()
             iter_pred_cpu = self._move_tensor(iter_pred, dev="cpu", detach=True)
             target_val_cpu = self._move_tensor(target_val, dev="cpu", detach=True)
@@ -155,6 +154,37 @@ class ImageClassifTrainer(Trainer):
         epoch_loss /= epoch_size
         return epoch_loss
 
+    def eval_batch(self, model, input_val, target_val, dev):
+        """Computes the predictions of the model for a single batch of evaluation samples.
+
+        Args:
+            model: the model to evaluate that is already uploaded to the target device(s).
+            input_val: the batched input tensor (or list of augmented input tensors) to forward.
+            target_val: the batched target tensor (or list of identical target tensors), or ``None``.
+            dev: the target device that tensors should be uploaded to.
+
+        Returns:
+            A tuple of the (reduced) prediction tensor and of the target tensor to give to the metrics.
+        """
+        views = None
+        if isinstance(input_val, list):  # evaluation samples got augmented, we need to reduce the predictions
+            assert input_val, "cannot eval with empty post-augment sample lists"
+            assert isinstance(target_val, list) and len(target_val) == len(input_val), \
+                "target should also be a list of the same length as input"
+            if target_val[0] is not None:
+                assert (torch.stack(target_val) == target_val[0]).all(), \
+                    "all target values should be identical! (why do eval-time augment otherwise?)"
+            target_val = target_val[0]  # since all identical, just pick the first and pretend its the only one
+            views = input_val
+        elif self.tta_views:  # test-time augmentation is done here instead of in the data loader
+            views = [thelper.train.utils.apply_tta_view(input_val, view) for view in self.tta_views]
+        if views is not None:
+            preds = self._forward_views(model, views, dev)
+            pred = thelper.train.utils.reduce_tta_preds(preds, self.tta_reduction)
+        else:  # this is the default (simple) case where we generate predictions without augmentations
+            pred = model(self._move_tensor(input_val, dev))
+        return pred, target_val
+
     def eval_epoch(self, model, epoch, dev, loader, metrics, output_path):
         """Evaluates the model using the provided objects.
 
@@ -175,24 +205,7 @@ class ImageClassifTrainer(Trainer):
                 if idx < self.skip_eval_iter:
                     continue  # skip until previous iter count (if set externally; no effect otherwise)
                 input_val, target_val = self._to_tensor(sample)
-                if isinstance(input_val, list):  # evaluation samples got augmented, we need to get the mean prediction
-                    assert input_val, "cannot eval with empty post-augment sample lists"
-                    assert isinstance(target_val, list) and len(target_val) == len(input_val), \
-                        "target should also be a list of the same length as input"
-                    # this might be costly for nothing, we could remove the check and assume user is not dumb
-                    assert not any([not torch.eq(lbl, target_val[0]).all() for lbl in target_val]), \
-                        "all target values should be identical! (why do eval-time augment otherwise?)"
-                    target_val = target_val[0]  # since all identical, just pick the first and pretend its the only one
-                    preds = None
-                    for input_idx in range(len(input_val)):
-                        pred = model(self._move_tensor(input_val[input_idx], dev))
-                        if preds is None:
-                            preds = torch.unsqueeze(pred.clone(), 0)
-                        else:
-                            preds = torch.cat((preds, torch.unsqueeze(pred, 0)), 0)
-                    pred = torch.mean(preds, dim=0)
-                else:  # this is the default (simple) case where we generate predictions without augmentations
-                    pred = model(self._move_tensor(input_val, dev))
+                pred, target_val = self.eval_batch(model, input_val, target_val, dev)
                 pred_cpu = self._move_tensor(pred, dev="cpu", detach=True)
                 target_val_cpu = self._move_tensor(target_val, dev="cpu", detach=True)
                 for metric in metrics.values():
@@ -151,7 +151,7 @@ class ObjDetectTrainer(Trainer):
             pred, pred_losses = model.roi_heads(features, proposals, images_dev.image_sizes, targets_dev)
             pred = model.transform.postprocess(pred, images_dev.image_sizes, original_image_sizes)
             iter_loss = sum(loss for loss in {**pred_losses, **proposal_losses}.values())
-            iter_loss.backward()
+            self._backward(iter_loss)
             optimizer.step()
             pred = self._from_tensor(pred, sample)
             target_bboxes = [target["refs"] for target in targets]
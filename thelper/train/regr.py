@@ -99,7 +99,7 @@ class RegressionTrainer(Trainer):
             target = self._move_tensor(target, dev)
             iter_pred = model(self._move_tensor(input_val, dev))
             iter_loss = loss(iter_pred, target.float())
-            iter_loss.backward()
+            self._backward(iter_loss)
             optimizer.step()
             iter_pred_cpu = self._move_tensor(iter_pred, dev="cpu", detach=True)
             target_cpu = self._move_tensor(target, dev="cpu", detach=True)
@@ -113,6 +113,21 @@ class RegressionTrainer(Trainer):
         epoch_loss /= epoch_size
         return epoch_loss
 
+    def eval_batch(self, model, input_val, target, dev):
+        """Computes the predictions of the model for a single batch of evaluation samples.
+
+        Args:
+            model: the model to evaluate that is already uploaded to the target device(s).
+            input_val: the batched input tensor to forward.
+            target: the batched target tensor, or ``None``.
+            dev: the target device that tensors should be uploaded to.
+
+        Returns:
+            A tuple of the prediction tensor and of the target tensor to give to the metrics.
+        """
+        assert not isinstance(input_val, list), "missing regr trainer support for duped minibatches"
+        return model(self._move_tensor(input_val, dev)), target
+
     def eval_epoch(self, model, epoch, dev, loader, metrics, output_path):
         """Evaluates the model using the provided objects.
 
@@ -133,8 +148,7 @@ class RegressionTrainer(Trainer):
                 if idx < self.skip_eval_iter:
                     continue  # skip until previous iter count (if set externally; no effect otherwise)
                 input_val, target = self._to_tensor(sample)
-                assert not isinstance(input_val, list), "missing regr trainer support for duped minibatches"
-                pred = model(self._move_tensor(input_val, dev))
+                pred, target = self.eval_batch(model, input_val, target, dev)
                 pred_cpu = self._move_tensor(pred, dev="cpu", detach=True)
                 target_cpu = self._move_tensor(target, dev="cpu", detach=True)
                 for metric in metrics.values():
@@ -6,6 +6,7 @@ import torch
 import torch.optim
 
 import thelper.concepts
+import thelper.train.utils
 import thelper.typedefs as typ  # noqa: F401
 import thelper.utils
 from thelper.train.base import Trainer
@@ -100,8 +101,7 @@ class ImageSegmTrainer(Trainer):
                     self.logger.warning("using training augmentation without global shuffling, gradient steps might be affected")
                     # see the docstring of thelper.transforms.operations.Duplicator for more information
                     self.warned_no_shuffling_augments = True
-                iter_loss = None
-                iter_pred = None
+                iter_loss, iter_pred = None, []
                 augs_count = len(input_val)
                 for aug_idx in range(augs_count):
                     aug_pred = model(self._move_tensor(input_val[aug_idx], dev))
@@ -109,14 +109,11 @@ class ImageSegmTrainer(Trainer):
                         aug_pred = aug_pred[self.output_pred_key]
                     if self.scale_preds:
                         aug_pred = torch.nn.functional.interpolate(aug_pred, size=input_val[aug_idx].shape[-2:], mode="bilinear")
-                    aug_loss = loss(aug_pred, label_map[aug_idx].long())
-                    aug_loss.backward()  # test backprop all at once? might not fit in memory...
-                    if iter_pred is None:
-                        iter_loss = aug_loss.clone().detach()
-                        iter_pred = aug_pred.clone().detach()
-                    else:
-                        iter_loss += aug_loss.detach()
-                        iter_pred = torch.cat((aug_pred.detach(), iter_pred), dim=0)
+                    aug_loss = loss(aug_pred, self._move_tensor(label_map[aug_idx], dev).long())
+                    self._backward(aug_loss)  # test backprop all at once? might not fit in memory...
+                    iter_loss = aug_loss.detach() if iter_loss is None else iter_loss + aug_loss.detach()
+                    iter_pred.append(aug_pred.detach())
+                iter_pred = torch.cat(iter_pred, dim=0)  # same order as the concatenated label maps below
                 iter_loss /= augs_count
                 label_map = torch.cat(label_map, dim=0)
             else:  # this is the default (simple) case where we generate predictions without augmentations
@@ -126,7 +123,7 @@ class ImageSegmTrainer(Trainer):
                 if self.scale_preds:
                     iter_pred = torch.nn.functional.interpolate(iter_pred, size=input_val.shape[-2:], mode="bilinear")
                 iter_loss = loss(iter_pred, self._move_tensor(label_map, dev).long())
-                iter_loss.backward()
+                self._backward(iter_loss)
             optimizer.step()
             iter_pred_cpu = self._move_tensor(iter_pred, dev="cpu", detach=True)
             label_map_cpu = self._move_tensor(label_map, dev="cpu", detach=True)
@@ -140,6 +137,52 @@ class ImageSegmTrainer(Trainer):
         epoch_loss /= epoch_size
         return epoch_loss
 
+    def eval_batch(self, model, input_val, label_map, dev):
+        """Computes the predictions of the model for a single batch of evaluation samples.
+
+        Args:
+            model: the model to evaluate that is already uploaded to the target device(s).
+            input_val: the batched input tensor (or list of augmented input tensors) to forward.
+            label_map: the batched label map tensor (or list of identical label map tensors), or ``None``.
+            dev: the target device that tensors should be uploaded to.
+
+        Returns:
+            A tuple of the (reduced) prediction tensor and of the label map tensor to give to the metrics.
+        """
+        views, tta_views = None, None
+        if isinstance(input_val, list):
+            # evaluation samples got augmented, we need to reduce the predictions
+            assert input_val, "cannot eval with empty post-augment sample lists"
+            assert isinstance(label_map, list) and len(label_map) == len(input_val), \
+                "label maps should also be provided via a list of the same length as the input_val"
+            if label_map[0] is not None:
+                assert (torch.stack(label_map) == label_map[0]).all(), \
+                    "all label maps should be identical! (why do eval-time augment otherwise?)"
+            label_map = label_map[0]  # since all identical, just pick the first one and pretend its the only one
+            views = input_val
+        elif self.tta_views:  # test-time augmentation is done here instead of in the data loader
+            tta_views = self.tta_views
+            views = [thelper.train.utils.apply_tta_view(input_val, view) for view in tta_views]
+        if views is not None:
+            preds = self._forward_views(model, views, dev, output_key=self.output_pred_key)
+            input_size = views[0].shape[-2:]
+            if self.scale_preds:
+                preds = torch.nn.functional.interpolate(preds.flatten(0, 1), size=input_size, mode="bilinear")
+                preds = preds.reshape(len(views), -1, *preds.shape[1:])
+            valid = None
+            if tta_views is not None:  # flips/shifts must be inverted to realign the prediction maps
+                preds, valid = zip(*[thelper.train.utils.invert_tta_view(view_preds, view, input_size)
+                                     for view_preds, view in zip(preds, tta_views)])
+                preds, valid = torch.stack(preds), torch.stack(valid)[:, None, None]  # valid: Vx1x1xHxW
+            pred = thelper.train.utils.reduce_tta_preds(preds, self.tta_reduction, valid=valid)
+        else:  # this is the default (simple) case where we generate predictions without augmentations
+            pred = model(self._move_tensor(input_val, dev))
+            if isinstance(pred, dict):
+                pred = pred[self.output_pred_key]
+            if self.scale_preds:
+                pred = torch.nn.functional.interpolate(pred, size=input_val.shape[-2:], mode="bilinear")
+        return pred, label_map
+
     def eval_epoch(self, model, epoch, dev, loader, metrics, output_path):
         """Evaluates the model using the provided objects.
 
@@ -160,31 +203,7 @@ class ImageSegmTrainer(Trainer):
                 if idx < self.skip_eval_iter:
                     continue  # skip until previous iter count (if set externally; no effect otherwise)
                 input_val, label_map = self._to_tensor(sample)
-                if isinstance(input_val, list):
-                    # evaluation samples got augmented, we need to get the mean prediction
-                    assert input_val, "cannot eval with empty post-augment sample lists"
-                    assert isinstance(label_map, list) and len(label_map) == len(input_val), \
-                        "label maps should also be provided via a list of the same length as the input_val"
-                    # this might be costly for nothing, we could remove the check and assume user is not dumb
-                    assert not any([not torch.eq(lbl, label_map[0]).all() for lbl in label_map]), \
-                        "all label maps should be identical! (why do eval-time augment otherwise?)"
-                    label_map = label_map[0]  # since all identical, just pick the first one and pretend its the only one
-                    preds = None
-                    for input_idx in range(len(input_val)):
-                        pred = model(self._move_tensor(input_val[input_idx], dev))
-                        if isinstance(pred, dict):
-                            pred = pred[self.output_pred_key]
-                        if preds is None:
-                            preds = torch.unsqueeze(pred.clone(), 0)
-                        else:
-                            preds = torch.cat((preds, torch.unsqueeze(pred, 0)), 0)
-                    pred = torch.mean(preds, dim=0)
-                else:  # this is the default (simple) case where we generate predictions without augmentations
-                    pred = model(self._move_tensor(input_val, dev))
-                    if isinstance(pred, dict):
-                        pred = pred[self.output_pred_key]
-                if self.scale_preds:
-                    pred = torch.nn.functional.interpolate(pred, size=input_val.shape[-2:], mode="bilinear")
+                pred, label_map = self.eval_batch(model, input_val, label_map, dev)
                 pred_cpu = self._move_tensor(pred, dev="cpu", detach=True)
                 label_map_cpu = self._move_tensor(label_map, dev="cpu", detach=True)
                 for metric in metrics.values():
@@ -7,15 +7,16 @@ training. See :mod:`thelper.optim.metrics` for more information on metrics.
 
 import json
 import logging
+import math
 import os
 from typing import Any, AnyStr, Dict, List, Optional, Union  # noqa: F401
 
 import cv2 as cv
 import numpy as np
-import sklearn.metrics
 import torch
 
 import thelper.concepts
+import thelper.data.loaders
 import thelper.ifaces
 import thelper.typedefs  # noqa: F401
 import thelper.utils
@@ -390,6 +391,7 @@ class ClassifReport(PredictionConsumer, ClassNamesHandler, FormatHandler):
         _y_true = [self.class_names[classid] for classid in y_true]
         _y_pred = [self.class_names[classid] if (0 <= classid < len(self.class_names)) else "<unset>"
                    for classid in y_pred]
+        import sklearn.metrics
         return sklearn.metrics.classification_report(_y_true, _y_pred, sample_weight=self.sample_weight,
                                                      digits=self.digits, output_dict=as_dict)
 
@@ -811,6 +813,7 @@ class ConfusionMatrix(PredictionConsumer, ClassNamesHandler):
         """
 
         def gen_matrix(y_true, y_pred, _class_names):
+            import sklearn.metrics
             _y_true = [_class_names[classid] for classid in y_true]
             _y_pred = [_class_names[classid] if (0 <= classid < len(_class_names)) else "<unset>" for classid in y_pred]
             return sklearn.metrics.confusion_matrix(_y_true, _y_pred, labels=_class_names)
@@ -897,6 +900,317 @@ class ConfusionMatrix(PredictionConsumer, ClassNamesHandler):
         self.target = None
 
 
+TTA_REDUCTIONS = ["mean", "max", "gmean"]
+"""Names of the reductions that can be used to combine test-time augmentation predictions."""
+
+
+def parse_tta_views(views):
+    """Parses and returns a list of test-time augmentation (TTA) view definitions.
+
+    Each view can be given as a string (``"identity"``, ``"hflip"``, or ``"vflip"``), or as a dictionary that
+    combines flips with a shift, e.g. ``{"hflip": true, "shift": [8, 0]}``. Shifts are given as ``(dx, dy)`` pixel
+    offsets, and are applied after flips. The returned views are all normalized as dictionaries.
+
+    .. seealso::
+        | :func:`thelper.train.utils.apply_tta_view`
+        | :func:`thelper.train.utils.invert_tta_view`
+    """
+    assert isinstance(views, (list, tuple)), "tta views should be provided as a list"
+    parsed_views = []
+    for view in views:
+        if isinstance(view, str):
+            assert view in ["identity", "hflip", "vflip"], f"unknown tta view name '{view}'"
+            view = {} if view == "identity" else {view: True}
+        assert isinstance(view, dict) and all([k in ["hflip", "vflip", "shift"] for k in view]), \
+            "tta views should be provided as names or as dictionaries of flip/shift parameters"
+        shift = view["shift"] if "shift" in view else (0, 0)
+        assert isinstance(shift, (list, tuple)) and len(shift) == 2 and all([isinstance(s, int) for s in shift]), \
+            "tta view shift should be provided as a pair of integer pixel offsets (dx, dy)"
+        parsed_views.append({"hflip": thelper.utils.str2bool(view["hflip"]) if "hflip" in view else False,
+                             "vflip": thelper.utils.str2bool(view["vflip"]) if "vflip" in view else False,
+                             "shift": (int(shift[0]), int(shift[1]))})
+    return parsed_views
+
+
+def _shift_tensor(tensor, dx, dy):
+    """Translates the last two dimensions of a tensor by a number of pixels, padding with zeros."""
+    if dx == 0 and dy == 0:
+        return tensor
+    out = torch.zeros_like(tensor)
+    rows, cols = tensor.shape[-2:]
+    if abs(dx) >= cols or abs(dy) >= rows:
+        return out
+    src_y, dst_y = (slice(0, rows - dy), slice(dy, rows)) if dy >= 0 else (slice(-dy, rows), slice(0, rows + dy))
+    src_x, dst_x = (slice(0, cols - dx), slice(dx, cols)) if dx >= 0 else (slice(-dx, cols), slice(0, cols + dx))
+    out[..., dst_y, dst_x] = tensor[..., src_y, src_x]
+    return out
+
+
+def _get_flip_dims(view):
+    return [dim for dim, flag in [(-1, view["hflip"]), (-2, view["vflip"])] if flag]
+
+
+def apply_tta_view(tensor, view):
+    """Applies a test-time augmentation view (see :func:`parse_tta_views`) to a batch of images (BxCxHxW)."""
+    flip_dims = _get_flip_dims(view)
+    if flip_dims:
+        tensor = torch.flip(tensor, flip_dims)
+    return _shift_tensor(tensor, *view["shift"])
+
+
+def invert_tta_view(tensor, view, input_size=None):
+    """Inverts a test-time augmentation view on a batch of prediction maps, and returns them with a validity mask.
+
+    If the input image size (``HxW``) is provided and differs from the size of the prediction maps, the view shift
+    is rescaled accordingly. Since pixels shifted out of the image are lost, the returned boolean mask (``HxW``)
+    flags the locations where the inverted prediction maps are valid.
+    """
+    dx, dy = view["shift"]
+    if input_size is not None and tuple(input_size[-2:]) != tuple(tensor.shape[-2:]):
+        dx = int(round(dx * tensor.shape[-1] / input_size[-1]))
+        dy = int(round(dy * tensor.shape[-2] / input_size[-2]))
+    valid = torch.ones(tensor.shape[-2:], dtype=torch.bool, device=tensor.device)
+    valid = _shift_tensor(_shift_tensor(valid, dx, dy), -dx, -dy)
+    tensor = _shift_tensor(tensor, -dx, -dy)
+    flip_dims = _get_flip_dims(view)
+    if flip_dims:
+        tensor, valid = torch.flip(tensor, flip_dims), torch.flip(valid, flip_dims)
+    return tensor, valid
+
+
+def reduce_tta_preds(preds, reduction="mean", valid=None):
+    """Reduces the stacked predictions obtained for different views of a batch (VxBxCx...) to a single batch.
+
+    The ``mean`` reduction averages the raw model outputs, and ``max`` keeps their element-wise maximum. The ``gmean``
+    reduction computes the geometric mean of the class probabilities (with class scores in the third dimension), and
+    returns it as log-probabilities, which can be used as logits downstream. If a boolean mask broadcastable to the
+    predictions is provided via ``valid``, only the valid predictions are reduced at each location.
+    """
+    assert reduction in TTA_REDUCTIONS, f"unknown tta reduction '{reduction}'"
+    if reduction == "gmean":
+        preds = torch.log_softmax(preds, dim=2)
+    if valid is None:
+        return torch.max(preds, dim=0)[0] if reduction == "max" else torch.mean(preds, dim=0)
+    valid = valid.expand_as(preds)
+    if reduction == "max":
+        preds = torch.max(preds.masked_fill(~valid, float("-inf")), dim=0)[0]
+        return preds.masked_fill(~torch.any(valid, dim=0), 0)
+    counts = torch.clamp(torch.sum(valid, dim=0), min=1).to(preds.dtype)
+    return torch.sum(preds.masked_fill(~valid, 0), dim=0) / counts
+
+
+def get_batch_size(input_val):
+    """Returns the number of samples in a batched input (tensor, list of augmented tensors, or list of samples)."""
+    if isinstance(input_val, torch.Tensor):
+        return input_val.shape[0] if input_val.ndim > 0 else 1
+    assert isinstance(input_val, (list, tuple)), f"unexpected batched input type '{type(input_val)}'"
+    if input_val and isinstance(input_val[0], torch.Tensor) and input_val[0].ndim > 0:
+        return input_val[0].shape[0]  # list of augmented (but still batched) tensors
+    return len(input_val)
+
+
+def _slice_batch(value, begin, end, batch_size, augmented):
+    """Slices a batched sample value (tensor, list, or dictionary) along its batch dimension."""
+    if isinstance(value, torch.Tensor):
+        return value[begin:end] if value.ndim > 0 and value.shape[0] == batch_size else value
+    if isinstance(value, dict):
+        return {key: _slice_batch(val, begin, end, batch_size, augmented) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        if augmented and value and all([isinstance(v, torch.Tensor) and v.ndim > 0 and v.shape[0] == batch_size
+                                        for v in value]):
+            return [v[begin:end] for v in value]
+        if len(value) == batch_size:
+            return value[begin:end]
+    return value
+
+
+def split_batch(sample, max_size, input_key):
+    """Splits a batched sample dictionary into micro-batches of at most ``max_size`` samples.
+
+    All tensors and lists whose first dimension matches the batch size (as determined from the input tensor under
+    ``input_key``) are sliced; other values are shared by all micro-batches. If the samples were augmented into
+    lists of batched tensors (e.g. by :class:`thelper.transforms.operations.Duplicator`), each tensor of these lists
+    is sliced instead. Returns a list of ``(micro_batch, micro_batch_size)`` tuples.
+    """
+    assert isinstance(sample, dict) and input_key in sample, "unexpected sample type or missing input key"
+    assert max_size > 0, "micro-batch size should be strictly positive"
+    batch_size = get_batch_size(sample[input_key])
+    if batch_size <= max_size:
+        return [(sample, batch_size)]
+    augmented = isinstance(sample[input_key], (list, tuple))
+    return [({key: _slice_batch(val, begin, min(begin + max_size, batch_size), batch_size, augmented)
+              for key, val in sample.items()}, min(begin + max_size, batch_size) - begin)
+            for begin in range(0, batch_size, max_size)]
+
+
+class GradientAccumulator:
+    """Optimizer wrapper used to accumulate gradients over several batches (and micro-batches) before each step.
+
+    This wrapper is used by :class:`thelper.train.base.Trainer` when gradient accumulation or micro-batching is
+    enabled, and it is transparent to the ``train_epoch`` implementations of derived trainers: these receive this
+    object in place of the optimizer, and the loader returned by :func:`GradientAccumulator.wrap_loader` in place of
+    the training data loader. The wrapped loader splits each loader batch into micro-batches of at most
+    ``micro_batch_size`` samples (if needed), and the trainer still calls ``zero_grad()``, ``backward()``, and
+    ``step()`` once per (micro-)batch. The real optimizer is however only stepped once every ``accum_steps`` loader
+    batches (and at the end of the epoch), and its gradients are only zeroed after that step.
+
+    Since the micro-batches might not all have the same size, the accumulated gradients are rescaled in-place when
+    needed so that, once stepped, they correspond to the sample-weighted average of the gradients of all accumulated
+    micro-batches. This means that the losses should be averaged over the batch dimension (as is the default for
+    PyTorch losses), and that the loss values reported to metrics are not affected by accumulation.
+
+    If a gradient scaler is provided (for fp16 mixed precision training), it is used to unscale the gradients and
+    to step the optimizer, and it is only updated after each real step so that the scale stays constant while
+    gradients are accumulated.
+
+    Attributes:
+        optimizer: the wrapped optimizer; its other attributes (e.g. ``param_groups``) are directly accessible.
+        accum_steps: number of loader batches to accumulate gradients for before stepping the optimizer.
+        micro_batch_size: maximum number of samples per forward/backward pass (0 = loader batches are not split).
+        input_key: key of the input tensor in the loaded sample dictionaries (used to determine batch sizes).
+        grad_scaler: gradient scaler used to step the optimizer in mixed precision mode (optional).
+    """
+
+    def __init__(self, optimizer, accum_steps=1, micro_batch_size=0, input_key=None, grad_scaler=None):
+        """Receives the optimizer to wrap and the accumulation settings."""
+        assert isinstance(optimizer, torch.optim.Optimizer), "unexpected optimizer type"
+        assert int(accum_steps) >= 1, "gradient accumulation step count should be strictly positive"
+        assert int(micro_batch_size) >= 0, "micro-batch size should be positive (or 0 to disable splitting)"
+        assert input_key is not None, "input key is required to determine batch sizes"
+        self.optimizer = optimizer
+        self.accum_steps = int(accum_steps)
+        self.micro_batch_size = int(micro_batch_size)
+        self.input_key = input_key
+        self.grad_scaler = grad_scaler
+        self._curr_size = 0  # sample count of the current micro-batch
+        self._prev_size = 0  # sample count of the previous micro-batch (whose gradients are still accumulated)
+        self._accum_size = 0  # total sample count of all accumulated micro-batches
+        self._step_ready = True  # whether the real optimizer should be stepped at the end of the current micro-batch
+
+    def __getattr__(self, name):
+        if name == "optimizer":
+            raise AttributeError(name)  # avoids infinite recursion before init (e.g. while unpickling)
+        return getattr(self.optimizer, name)
+
+    def __repr__(self):
+        return self.__class__.__module__ + "." + self.__class__.__qualname__ + \
+            f"(optimizer={repr(self.optimizer)}, accum_steps={self.accum_steps}, " + \
+            f"micro_batch_size={self.micro_batch_size}, input_key={repr(self.input_key)}, " + \
+            f"grad_scaler={repr(self.grad_scaler)})"
+
+    def _scale_grads(self, scale):
+        if scale == 1:
+            return
+        for group in self.optimizer.param_groups:
+            for param in group["params"]:
+                if param.grad is not None:
+                    param.grad.mul_(scale)
+
+    def _iter_micro_batches(self, loader):
+        """Yields the micro-batches of all batches in the loader while keeping track of their sizes."""
+        self._accum_size, self._prev_size = 0, 0
+        batch_count = len(loader)
+        for batch_idx, sample in enumerate(loader):
+            if self.micro_batch_size:
+                micro_batches = split_batch(sample, self.micro_batch_size, self.input_key)
+            else:
+                micro_batches = [(sample, get_batch_size(sample[self.input_key]))]
+            last_batch = (batch_idx + 1) % self.accum_steps == 0 or batch_idx + 1 == batch_count
+            for micro_idx, (micro_batch, micro_size) in enumerate(micro_batches):
+                self._curr_size = max(micro_size, 1)
+                self._step_ready = last_batch and micro_idx + 1 == len(micro_batches)
+                yield micro_batch
+
+    def wrap_loader(self, loader):
+        """Returns a wrapped version of a data loader that yields micro-batches and that drives the accumulation."""
+        return _MicroBatchLoaderWrapper(loader, self)
+
+    def zero_grad(self):
+        """Zeroes the gradients of the wrapped optimizer if they were just applied, or rescales them otherwise."""
+        if self._accum_size == 0:
+            self.optimizer.zero_grad()
+        else:  # keep accumulated gradients scaled so that the next backward pass gets the right relative weight
+            self._scale_grads(self._prev_size / self._curr_size)
+
+    def step(self, closure=None):
+        """Steps the wrapped optimizer with the average of the accumulated gradients, if enough were accumulated."""
+        assert closure is None, "optimizer closures are not supported with gradient accumulation"
+        self._accum_size += self._curr_size
+        self._prev_size = self._curr_size
+        if self._step_ready:
+            self._scale_grads(self._curr_size / self._accum_size)
+            if self.grad_scaler is not None:
+                self.grad_scaler.step(self.optimizer)  # unscales gradients and skips the step if any are inf/nan
+                self.grad_scaler.update()
+            else:
+                self.optimizer.step()
+            self._accum_size = 0
+
+
+class FullPrecisionConsumer(PredictionConsumer):
+    """Consumer wrapper that converts reduced-precision tensors to fp32 before forwarding them to another consumer.
+
+    This is used by :class:`thelper.train.base.Trainer` in mixed precision mode, as predictions generated under
+    autocast might be in fp16 or bf16, which are not supported by numpy (and are too imprecise for some metrics).
+    All other attributes of the wrapped consumer are directly accessible.
+    """
+
+    def __init__(self, consumer):
+        """Receives the consumer to wrap."""
+        assert isinstance(consumer, PredictionConsumer), "unexpected consumer type"
+        self.consumer = consumer
+
+    def __getattr__(self, name):
+        if name == "consumer":
+            raise AttributeError(name)  # avoids infinite recursion before init (e.g. while unpickling)
+        return getattr(self.consumer, name)
+
+    def __repr__(self):
+        return self.__class__.__module__ + "." + self.__class__.__qualname__ + f"(consumer={repr(self.consumer)})"
+
+    @staticmethod
+    def _to_full_precision(value):
+        if isinstance(value, torch.Tensor):
+            return value.float() if value.dtype in [torch.float16, torch.bfloat16] else value
+        if isinstance(value, (list, tuple)):
+            converted = [FullPrecisionConsumer._to_full_precision(v) for v in value]
+            return converted if isinstance(value, list) else tuple(converted)
+        if isinstance(value, dict):
+            return {k: FullPrecisionConsumer._to_full_precision(v) for k, v in value.items()}
+        return value
+
+    def reset(self):
+        """Resets the wrapped consumer."""
+        self.consumer.reset()
+
+    def update(self, *args, **kwargs):
+        """Converts all reduced-precision tensors to fp32 and forwards them to the wrapped consumer."""
+        return self.consumer.update(*self._to_full_precision(args), **self._to_full_precision(kwargs))
+
+
+class _MicroBatchLoaderWrapper(thelper.data.loaders.DataLoaderWrapper):
+    """Data loader wrapper used by :class:`GradientAccumulator` to split batches into micro-batches."""
+
+    def __init__(self, loader, accumulator):
+        super().__init__(loader, callback=None)
+        self._accumulator = accumulator
+
+    def __iter__(self):
+        yield from self._accumulator._iter_micro_batches(self._wrapped_loader)
+
+    def __len__(self):
+        batch_count = len(self._wrapped_loader)
+        micro_batch_size, batch_size = self._accumulator.micro_batch_size, self._wrapped_loader.batch_size
+        if not micro_batch_size or not batch_size or batch_size <= micro_batch_size:
+            return batch_count
+        sample_count = len(self._wrapped_loader.sampler)
+        full_batch_count, last_batch_size = divmod(sample_count, batch_size)
+        if self._wrapped_loader.drop_last:
+            last_batch_size = 0
+        return full_batch_count * math.ceil(batch_size / micro_batch_size) + \
+            math.ceil(last_batch_size / micro_batch_size)
+
+
 def create_consumers(config):
     """Instantiates and returns the prediction consumers defined in the configuration dictionary.
 
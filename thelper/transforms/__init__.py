@@ -6,30 +6,48 @@ augmentation, and normalization of data samples.
 
 import logging
 
-import thelper.transforms.operations  # noqa: F401
-import thelper.transforms.utils  # noqa: F401
-import thelper.transforms.wrappers  # noqa: F401
-from thelper.transforms.composers import Compose  # noqa: F401
-from thelper.transforms.composers import CustomStepCompose  # noqa: F401
-from thelper.transforms.operations import Affine  # noqa: F401
-from thelper.transforms.operations import CenterCrop  # noqa: F401
-from thelper.transforms.operations import Duplicator  # noqa: F401
-from thelper.transforms.operations import NormalizeMinMax  # noqa: F401
-from thelper.transforms.operations import NormalizeZeroMeanUnitVar  # noqa: F401
-from thelper.transforms.operations import NoTransform  # noqa: F401
-from thelper.transforms.operations import RandomResizedCrop  # noqa: F401
-from thelper.transforms.operations import RandomShift  # noqa: F401
-from thelper.transforms.operations import Resize  # noqa: F401
-from thelper.transforms.operations import Tile  # noqa: F401
-from thelper.transforms.operations import ToColor  # noqa: F401
-from thelper.transforms.operations import ToGray  # noqa: F401
-from thelper.transforms.operations import ToNumpy  # noqa: F401
-from thelper.transforms.operations import Transpose  # noqa: F401
-from thelper.transforms.operations import Unsqueeze  # noqa: F401
-from thelper.transforms.utils import load_augments  # noqa: F401
-from thelper.transforms.utils import load_transforms  # noqa: F401
-from thelper.transforms.wrappers import AlbumentationsWrapper  # noqa: F401
-from thelper.transforms.wrappers import AugmentorWrapper  # noqa: F401
-from thelper.transforms.wrappers import TransformWrapper  # noqa: F401
+import thelper.lazy
+
+__getattr__, __dir__, __all__ = thelper.lazy.attach(
+    __name__,
+    submodules=[
+        "composers",
+        "operations",
+        "utils",
+        "wrappers",
+    ],
+    attributes={
+        "thelper.transforms.composers": [
+            "Compose",
+            "CustomStepCompose",
+        ],
+        "thelper.transforms.operations": [
+            "Affine",
+            "CenterCrop",
+            "Duplicator",
+            "NormalizeMinMax",
+            "NormalizeZeroMeanUnitVar",
+            "NoTransform",
+            "RandomResizedCrop",
+            "RandomShift",
+            "Resize",
+            "Tile",
+            "ToColor",
+            "ToGray",
+            "ToNumpy",
+            "Transpose",
+            "Unsqueeze",
+        ],
+        "thelper.transforms.utils": [
+            "load_augments",
+            "load_transforms",
+        ],
+        "thelper.transforms.wrappers": [
+            "AlbumentationsWrapper",
+            "AugmentorWrapper",
+            "TransformWrapper",
+        ],
+    },
+)
 
 logger = logging.getLogger("thelper.transforms")
@@ -14,6 +14,7 @@ now, these representations are used for debugging more than anything else.
 
 import copy
 import itertools
+import json
 import logging
 import math
 
@@ -1042,20 +1043,30 @@ class NormalizeZeroMeanUnitVar:
     This can be used for whitening; see https://en.wikipedia.org/wiki/Whitening_transformation
     for more information. Note that this operation is also not restricted to images.
 
+    The mean and standard deviation values can also be loaded from a json file that contains ``mean`` and ``std``
+    lists, such as the band statistics files saved by :func:`thelper.data.stats.DatasetStatistics.save_band_stats`.
+
     Attributes:
         mean: an array of mean values to subtract from data samples.
         std: an array of standard deviation values to divide with.
         out_type: the output data type to cast the normalization result to.
     """
 
-    def __init__(self, mean, std, out_type=np.float32):
+    def __init__(self, mean=None, std=None, out_type=np.float32, stats_path=None):
         """Validates and initializes normalization parameters.
 
         Args:
             mean: an array of mean values to subtract from data samples.
             std: an array of standard deviation values to divide with.
             out_type: the output data type to cast the normalization result to.
+            stats_path: path to a json file from which to load the mean and std values (instead of giving them).
         """
+        if stats_path is not None:
+            assert mean is None and std is None, "normalization params should be given directly or via file, not both"
+            with open(stats_path, "r") as fd:
+                stats = json.load(fd)
+            mean, std = stats["mean"], stats["std"]
+        assert mean is not None and std is not None, "missing normalization params"
         self.out_type = out_type
         self.mean = np.asarray(mean).astype(out_type)
         self.std = np.asarray(std).astype(out_type)
@@ -5,10 +5,13 @@ Typing definitions for thelper.
 import io
 import typing
 
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
 
+if typing.TYPE_CHECKING:
+    import matplotlib.axes
+    import matplotlib.figure
+
 ModelType = "thelper.nn.Module"
 LoaderType = "thelper.data.loaders.DataLoader"
 TaskType = "thelper.tasks.Task"
@@ -24,7 +27,7 @@ LabelIndex = typing.AnyStr
 LabelType = typing.AnyStr
 LabelDict = typing.Dict[LabelIndex, LabelType]
 LabelList = typing.List[LabelType]
-DrawingType = typing.Optional[typing.Tuple[plt.Figure, plt.Axes]]
+DrawingType = typing.Optional[typing.Tuple["matplotlib.figure.Figure", "matplotlib.axes.Axes"]]
 ClassColorMap = typing.Dict[ClassIdType, typing.Union[int, typing.Tuple[int, int, int]]]
 
 Number = typing.Union[int, float]
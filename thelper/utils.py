@@ -3,6 +3,7 @@
 This module only contains non-ML specific functions, i/o helpers,
 and matplotlib/pyplot drawing calls.
 """
+import collections
 import copy
 import errno
 import functools
@@ -42,7 +43,7 @@ bypass_queries = False
 warned_generic_draw = False
 fixed_yaml_parsing = False
 no_compression_flags = ["None", "none", "raw", "", None]
-chunk_compression_flags = ["chunk_lz4", "gzip", "lzf", "szip"]
+chunk_compression_flags = ["chunk_lz4", "chunk_zstd", "chunk_blosc", "gzip", "lzf", "szip"]
 
 
 class Struct:
@@ -178,13 +179,21 @@ def load_checkpoint(ckpt,                      # type: thelper.typedefs.Checkpoi
                     map_location=None,         # type: Optional[thelper.typedefs.MapLocationType]
                     always_load_latest=False,  # type: Optional[bool]
                     check_version=True,        # type: Optional[bool]
+                    model_only=False,          # type: Optional[bool]
                     ):                         # type: (...) -> thelper.typedefs.CheckpointContentType
     """Loads a session checkpoint via PyTorch, check its compatibility, and returns its data.
 
     If the ``ckpt`` parameter is a path to a valid directory, then that directly will be searched for
     a checkpoint. If multiple checkpoints are found, the latest will be returned (based on the epoch
     index in its name). iF ``always_load_latest`` is set to False and if a checkpoint named
-    ``ckpt.best.pth`` is found, it will be returned instead.
+    ``ckpt.best.pth`` is found, it will be returned instead. If the directory contains a manifest
+    written by :class:`thelper.session.checkpoint.CheckpointWriter`, it is used to find the checkpoint
+    directly instead of listing the directory.
+
+    Checkpoints saved with the 'split' layout store the model weights and optimizer state in separate
+    files next to the checkpoint; these are loaded here as well, unless ``model_only`` is set, in which
+    case the optimizer state is skipped (and set to ``None``) and the weights are memory-mapped (if
+    supported by PyTorch). This is useful for evaluation and inference sessions.
 
     Args:
         ckpt: a file-like object or a path to the checkpoint file or session directory.
@@ -194,6 +203,7 @@ def load_checkpoint(ckpt,                      # type: thelper.typedefs.Checkpoi
             if a session directory is provided (instead of loading the 'best' checkpoint).
         check_version: toggles whether the checkpoint's version should be checked for
             compatibility issues, and query the user for how to proceed.
+        model_only: toggles whether only the model weights (and metadata) should be loaded.
 
     Returns:
         Content of the checkpoint (a dictionary).
@@ -207,25 +217,30 @@ def load_checkpoint(ckpt,                      # type: thelper.typedefs.Checkpoi
             search_dir = search_ckpt_dir
         else:
             search_dir = ckpt
-        ckpt_paths = glob.glob(os.path.join(search_dir, "ckpt.*.pth"))
-        if not ckpt_paths:
-            raise AssertionError("could not find any valid checkpoint files in directory '%s'" % search_dir)
-        latest_epoch, latest_day, latest_time = -1, -1, -1
-        for ckpt_path in ckpt_paths:
-            # note: the 2nd field in the name should be the epoch index, or 'best' if final checkpoint
-            split = os.path.basename(ckpt_path).split(".")
-            tag = split[1]
-            if tag == "best" and (not always_load_latest or latest_epoch == -1):
-                # if eval-only, always pick the best checkpoint; otherwise, only pick if nothing else exists
-                ckpt = ckpt_path
-                if not always_load_latest:
-                    break
-            elif tag != "best":
-                log_stamp = split[2] if len(split) > 2 else ""
-                log_stamp = "fake-0-0" if log_stamp.count("-") != 2 else log_stamp
-                epoch_stamp, day_stamp, time_stamp = int(tag), int(log_stamp.split("-")[1]), int(log_stamp.split("-")[2])
-                if epoch_stamp > latest_epoch or day_stamp > latest_day or time_stamp > latest_time:
-                    ckpt, latest_epoch, latest_day, latest_time = ckpt_path, epoch_stamp, day_stamp, time_stamp
+        import thelper.session.checkpoint
+        manifest_ckpt = thelper.session.checkpoint.find_checkpoint(search_dir, always_load_latest)
+        if manifest_ckpt is not None:
+            ckpt = manifest_ckpt  # no need to list and parse all checkpoint names
+        else:
+            ckpt_paths = glob.glob(os.path.join(search_dir, "ckpt.*.pth"))
+            if not ckpt_paths:
+                raise AssertionError("could not find any valid checkpoint files in directory '%s'" % search_dir)
+            latest_epoch, latest_day, latest_time = -1, -1, -1
+            for ckpt_path in ckpt_paths:
+                # note: the 2nd field in the name should be the epoch index, or 'best' if final checkpoint
+                split = os.path.basename(ckpt_path).split(".")
+                tag = split[1]
+                if tag == "best" and (not always_load_latest or latest_epoch == -1):
+                    # if eval-only, always pick the best checkpoint; otherwise, only pick if nothing else exists
+                    ckpt = ckpt_path
+                    if not always_load_latest:
+                        break
+                elif tag != "best":
+                    log_stamp = split[2] if len(split) > 2 else ""
+                    log_stamp = "fake-0-0" if log_stamp.count("-") != 2 else log_stamp
+                    epoch_stamp, day_stamp, time_stamp = int(tag), int(log_stamp.split("-")[1]), int(log_stamp.split("-")[2])
+                    if epoch_stamp > latest_epoch or day_stamp > latest_day or time_stamp > latest_time:
+                        ckpt, latest_epoch, latest_day, latest_time = ckpt_path, epoch_stamp, day_stamp, time_stamp
         if not os.path.isfile(ckpt):
             raise AssertionError("could not find valid checkpoint at '%s'" % ckpt)
     basepath = None
@@ -276,12 +291,30 @@ def load_checkpoint(ckpt,                      # type: thelper.typedefs.Checkpoi
             trace_path = os.path.join(basepath, ckptdata["model"])
         if trace_path is not None:
             if trace_path.endswith(".pth"):
-                ckptdata["model"] = torch.load(trace_path, map_location=map_location)
+                ckptdata["model"] = _load_tensor_file(trace_path, map_location=map_location, mmap=model_only)
             elif trace_path.endswith(".zip"):
                 ckptdata["model"] = torch.jit.load(trace_path, map_location=map_location)
+    # load optimizer state if saved separately (split layout), or drop it if only the model is needed
+    if "optimizer" in ckptdata and model_only:
+        ckptdata["optimizer"] = None
+    elif "optimizer" in ckptdata and isinstance(ckptdata["optimizer"], str) and basepath is not None:
+        optim_path = os.path.join(basepath, ckptdata["optimizer"])
+        if not os.path.isfile(optim_path):
+            raise AssertionError("could not find optimizer state file at '%s'" % optim_path)
+        ckptdata["optimizer"] = torch.load(optim_path, map_location=map_location)
     return ckptdata
 
 
+def _load_tensor_file(path, map_location=None, mmap=False):
+    """Loads a file saved via ``torch.save``, memory-mapping its tensors if requested and supported."""
+    if mmap:
+        try:
+            return torch.load(path, map_location=map_location, mmap=True)
+        except (TypeError, RuntimeError):
+            pass  # older PyTorch versions, or legacy (non-zip) serialization format
+    return torch.load(path, map_location=map_location)
+
+
 def check_version(version_check, version_required):
     # type: (AnyStr, AnyStr) -> Tuple[bool, List[Union[int, AnyStr]], List[Union[int, AnyStr]]]
     """Verifies that the checked version is not greater than the required one (ie: not a future version).
@@ -789,57 +822,31 @@ def encode_data(data, approach="lz4", **kwargs):
 
     Args:
         data: the numpy array to encode.
-        approach: the encoding; supports `none`, `lz4`, `jpg`, `png`.
+        approach: the encoding; supports all codecs registered in :mod:`thelper.data.codecs`, e.g. `none`,
+            `lz4`, `zstd`, `blosc`, `jpg`, `png`, `webp`, and `webp_lossless`.
 
     .. seealso::
         | :func:`thelper.utils.decode_data`
+        | :mod:`thelper.data.codecs`
     """
-    supported_approaches = [*no_compression_flags, "lz4", "jpg", "png"]
-    assert approach in supported_approaches, f"unexpected approach '{approach}'"
-    if approach in no_compression_flags:
-        assert not kwargs
-        return data
-    elif approach == "lz4":
-        import lz4
-        return lz4.frame.compress(data, **kwargs)
-    elif approach == "jpg" or approach == "jpeg":
-        import cv2 as cv
-        ret, buf = cv.imencode(".jpg", data, **kwargs)
-    elif approach == "png":
-        import cv2 as cv
-        ret, buf = cv.imencode(".png", data, **kwargs)
-    else:
-        raise NotImplementedError
-    assert ret, "failed to encode data"
-    return buf
+    import thelper.data.codecs
+    return thelper.data.codecs.get_encoder(approach, **kwargs)(data)
 
 
-def decode_data(data, approach="lz4", **kwargs):
+def decode_data(data, approach="lz4", out=None, **kwargs):
     """Decodes a binary array using a given coding approach.
 
     Args:
         data: the binary array to decode.
-        approach: the encoding; supports `none`, `lz4`, `jpg`, `png`.
+        approach: the encoding; supports all codecs registered in :mod:`thelper.data.codecs`.
+        out: optional contiguous array into which the decoded data will be written (and then returned).
 
     .. seealso::
         | :func:`thelper.utils.encode_data`
+        | :mod:`thelper.data.codecs`
     """
-    supported_approaches = [*no_compression_flags, "lz4", "jpg", "png"]
-    assert approach in supported_approaches, f"unexpected approach '{approach}'"
-    if approach in no_compression_flags:
-        assert not kwargs
-        return data
-    elif approach == "lz4":
-        import lz4
-        return lz4.frame.decompress(data, **kwargs)
-    elif approach in ["jpg", "jpeg", "png"]:
-        kwargs = copy.deepcopy(kwargs)
-        if isinstance(kwargs["flags"], str):  # required arg by opencv
-            kwargs["flags"] = eval(kwargs["flags"])
-        import cv2 as cv
-        return cv.imdecode(data, **kwargs)
-    else:
-        raise NotImplementedError
+    import thelper.data.codecs
+    return thelper.data.codecs.get_decoder(approach, **kwargs)(data, out=out)
 
 
 def get_class_logger(skip=0, base=False):
@@ -1504,13 +1511,20 @@ def create_hdf5_dataset(fd, name, max_len, batch_like, compression="chunk_lz4",
         assert auto_chunker or 10 * (2 ** 10) <= chunk_byte_size < 2 ** 20, \
             f"unrecommended chunk byte size ({chunk_byte_size}) should be in [10KiB,1MiB];" \
             " see http://docs.h5py.org/en/stable/high/dataset.html#chunked-storage"
-        if compression == "chunk_lz4":
+        if compression in ["chunk_lz4", "chunk_zstd", "chunk_blosc"]:
+            if compression == "chunk_lz4":
+                filter_args = hdf5plugin.LZ4(nbytes=0)
+            elif compression == "chunk_zstd":
+                filter_args = hdf5plugin.Zstd(**compression_args)
+            else:  # byte-shuffled lz4 by default, which works well with multi-byte (e.g. uint16) samples
+                filter_args = hdf5plugin.Blosc(**{"cname": "lz4", "shuffle": hdf5plugin.Blosc.SHUFFLE,
+                                                  **compression_args})
             dset = fd.create_dataset(
                 name=name,
                 shape=(max_len, *batch_like.shape[1:]),
                 chunks=chunk_size,
                 dtype=batch_like.dtype,
-                **hdf5plugin.LZ4(nbytes=0)
+                **filter_args
             )
         else:
             assert compression not in no_compression_flags or len(compression_args) == 0
@@ -1536,11 +1550,18 @@ def create_hdf5_dataset(fd, name, max_len, batch_like, compression="chunk_lz4",
     return dset
 
 
-def fill_hdf5_sample(dset, dset_idx, array_idx, array, compression="chunk_lz4", **compr_kwargs):
-    """Fills a sample inside the specified HDF5 dataset object."""
+def fill_hdf5_sample(dset, dset_idx, array_idx, array, compression="chunk_lz4", encoder=None, **compr_kwargs):
+    """Fills a sample inside the specified HDF5 dataset object.
+
+    If an encoder callable is provided (see :func:`thelper.data.codecs.get_encoder`), it is used instead of
+    resolving the encoder from the compression type and parameters.
+    """
     sample = array[array_idx]
     if compression not in chunk_compression_flags:
-        sample = thelper.utils.encode_data(sample, compression, **compr_kwargs)
+        if encoder is not None:
+            sample = encoder(sample)
+        else:
+            sample = thelper.utils.encode_data(sample, compression, **compr_kwargs)
         if compression not in no_compression_flags:
             sample = np.frombuffer(sample, dtype=np.uint8)
     if not np.issubdtype(array.dtype, np.number):
@@ -1551,23 +1572,37 @@ def fill_hdf5_sample(dset, dset_idx, array_idx, array, compression="chunk_lz4",
     dset[dset_idx] = sample
 
 
-def fetch_hdf5_sample(dset, idx, dtype="auto", shape="auto", compression="auto", **decompr_kwargs):
-    """Returns a sample from the specified HDF5 dataset object."""
+def fetch_hdf5_sample(dset, idx, dtype="auto", shape="auto", compression="auto", decoder=None, out=None,
+                      **decompr_kwargs):
+    """Returns a sample from the specified HDF5 dataset object.
+
+    If a decoder callable is provided (see :func:`thelper.data.codecs.get_decoder`), it is used instead of
+    resolving the decoder from the compression type and parameters. If an output array is provided, the sample
+    is decoded (or read) directly into it, and it is returned; its type and size must match the sample's.
+    """
     if compression == "auto":
         compression = dset.attrs.get("compression")
     if shape == "auto":
         shape = dset.attrs.get("orig_shape")
+    if out is not None and compression in chunk_compression_flags:
+        dset.read_direct(out, source_sel=np.s_[idx])
+        return out
     sample = dset[idx]
     if compression not in chunk_compression_flags:
-        sample = thelper.utils.decode_data(sample, compression, **decompr_kwargs)
+        if decoder is None:
+            import thelper.data.codecs
+            decoder = thelper.data.codecs.get_decoder(compression, **decompr_kwargs)
         if dtype == "auto":
             dtype = np.dtype(dset.attrs.get("orig_dtype"))
-        if dtype is not None:
-            if np.issubdtype(dtype, np.dtype(str).type):
-                assert shape is None or len(shape) == 0, "missing impl for string array reconstr"
-                sample = sample.tobytes().decode()
-            elif sample.dtype != dtype:
-                sample = np.frombuffer(sample, dtype=dtype)
+        is_str = dtype is not None and np.issubdtype(dtype, np.dtype(str).type)
+        if out is not None and not is_str:
+            return decoder(sample, out=out)
+        sample = decoder(sample)
+        if is_str:
+            assert shape is None or len(shape) == 0, "missing impl for string array reconstr"
+            sample = bytes(sample).decode()
+        elif dtype is not None and (isinstance(sample, (bytes, bytearray)) or sample.dtype != dtype):
+            sample = np.frombuffer(sample, dtype=dtype)
     else:
         assert dtype == "auto" or dtype == sample.dtype
     if shape is not None and len(shape) > 0 and sample.shape != tuple(shape):
@@ -1575,6 +1610,135 @@ def fetch_hdf5_sample(dset, idx, dtype="auto", shape="auto", compression="auto",
     return sample
 
 
+class HDF5BlockWriter:
+    """Writes samples into an HDF5 group in compressed blocks of consecutive samples.
+
+    Compressing samples one at a time (as done by :func:`fill_hdf5_sample`) works poorly when samples are very
+    correlated (e.g. frames of a video sequence, or neighbouring tiles), and each read then costs a full
+    decompression. Here, the raw bytes of ``block_size`` consecutive samples are concatenated and compressed
+    together with a byte codec (see :mod:`thelper.data.codecs`). The group contains a ``blocks`` dataset with
+    the compressed blocks, and an ``index`` dataset with the (block index, start byte, end byte) location of each
+    sample inside its decompressed block, so that samples can still be accessed randomly (see
+    :class:`HDF5BlockReader`).
+
+    .. seealso::
+        | :func:`thelper.data.utils.create_hdf5`
+        | :class:`thelper.utils.HDF5BlockReader`
+    """
+
+    image_codecs = ["jpg", "jpeg", "png", "webp", "webp_lossless"]
+    """Codecs that cannot be used to compress blocks (they only support individual images)."""
+
+    def __init__(self, fd, name, max_len, batch_like, compression="lz4", block_size=64, **compr_kwargs):
+        """Creates the block group in the HDF5 file, and binds the block encoder."""
+        import thelper.data.codecs
+        assert int(block_size) >= 1, "block size should be strictly positive"
+        assert compression not in self.image_codecs and compression not in chunk_compression_flags, \
+            f"unsupported block compression '{compression}' (should be a byte codec, e.g. lz4 or zstd)"
+        self.group = fd.create_group(name)
+        self.group.attrs["storage"] = "block"
+        self.group.attrs["block_size"] = int(block_size)
+        self.group.attrs["orig_shape"] = batch_like.shape[1:]  # removes batch dim
+        self.group.attrs["orig_dtype"] = batch_like.dtype.str
+        self.group.attrs["compression"] = "none" if compression in no_compression_flags else compression
+        self.blocks = self.group.create_dataset("blocks", shape=(0,), maxshape=(None,), chunks=(16,),
+                                                dtype=h5py.special_dtype(vlen=np.uint8))
+        self.max_len = max_len
+        self.block_size = int(block_size)
+        self.encoder = thelper.data.codecs.get_encoder(compression, **compr_kwargs)
+        self.pending, self.pending_bytes, self.index = [], 0, []
+
+    def __len__(self):
+        return len(self.index)
+
+    def append(self, sample):
+        """Appends a sample (array, scalar, or string) to the current block, writing the block once it is full."""
+        if isinstance(sample, str):
+            sample = sample.encode()
+        else:
+            sample = np.ascontiguousarray(sample).tobytes()
+        assert len(self.index) < self.max_len, "too many samples for block dataset"
+        self.index.append((len(self.blocks), self.pending_bytes, self.pending_bytes + len(sample)))
+        self.pending.append(sample)
+        self.pending_bytes += len(sample)
+        if len(self.pending) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        """Compresses and writes the current (possibly partial) block."""
+        if not self.pending:
+            return
+        block = np.frombuffer(self.encoder(b"".join(self.pending)), dtype=np.uint8)
+        self.blocks.resize((len(self.blocks) + 1,))
+        self.blocks[len(self.blocks) - 1] = block
+        self.pending, self.pending_bytes = [], 0
+
+    def close(self):
+        """Writes the last block, and then the sample index."""
+        self.flush()
+        self.group.create_dataset("index", data=np.asarray(self.index, dtype=np.int64).reshape((-1, 3)))
+
+
+class HDF5BlockReader:
+    """Reads samples from an HDF5 group written by :class:`HDF5BlockWriter`, with an LRU cache of decoded blocks.
+
+    The sample index is loaded in memory once, and the ``cache_size`` most recently used blocks are kept
+    decompressed, so that sequential or locality-aware sampling only decompresses each block once. The number of
+    cache hits and misses is tracked for profiling.
+
+    .. seealso::
+        | :class:`thelper.utils.HDF5BlockWriter`
+        | :class:`thelper.data.parsers.HDF5Dataset`
+        | :class:`thelper.data.samplers.BlockShuffleSampler`
+    """
+
+    def __init__(self, group, cache_size=8, **decompr_kwargs):
+        """Loads the sample index of the block group, and binds the block decoder."""
+        import thelper.data.codecs
+        assert group.attrs.get("storage") == "block", "unexpected hdf5 group (should be written in block mode)"
+        assert int(cache_size) >= 1, "block cache size should be strictly positive"
+        self.group = group
+        self.blocks = group["blocks"]
+        self.index = group["index"][()]
+        self.block_size = int(group.attrs["block_size"])
+        self.shape = tuple(group.attrs["orig_shape"])
+        self.dtype = np.dtype(group.attrs["orig_dtype"])
+        self.decoder = thelper.data.codecs.get_decoder(group.attrs["compression"], **decompr_kwargs)
+        self.cache_size = int(cache_size)
+        self.cache = collections.OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_block(self, block_idx):
+        """Returns a decompressed block as a byte array, decoding it only if it is not cached already."""
+        block = self.cache.get(block_idx)
+        if block is not None:
+            self.cache.move_to_end(block_idx)
+            self.hits += 1
+            return block
+        self.misses += 1
+        block = np.frombuffer(self.decoder(self.blocks[block_idx]), dtype=np.uint8)
+        self.cache[block_idx] = block
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return block
+
+    def get_block_boundaries(self):
+        """Returns the sample index at which each block starts, followed by the total sample count."""
+        return np.append(np.flatnonzero(np.diff(self.index[:, 0], prepend=-1)), len(self.index))
+
+    def __getitem__(self, idx):
+        block_idx, start, end = self.index[idx]
+        data = self.get_block(int(block_idx))[start:end]
+        if np.issubdtype(self.dtype, np.dtype(str).type):
+            return data.tobytes().decode()
+        # note: samples are copied out of the cached block, so they can be modified in-place safely
+        sample = data.view(self.dtype).copy()
+        return sample.reshape(self.shape) if len(self.shape) > 0 else sample[0]
+
+
 def get_slurm_tmpdir() -> str:
     """Returns the local SLURM_TMPDIR path if available, or ``None``."""
     slurm_tmpdir = os.getenv("SLURM_TMPDIR")
@@ -11,9 +11,18 @@ displayed using the :mod:`thelper.draw` module.
 import logging
 from typing import Any, AnyStr  # noqa: F401
 
+import thelper.lazy
 import thelper.typedefs  # noqa: F401
-import thelper.viz.tsne  # noqa: F401
-import thelper.viz.umap  # noqa: F401
+
+__getattr__, __dir__, __all__ = thelper.lazy.attach(
+    __name__,
+    submodules=[
+        "tsne",
+        "umap",
+        "utils",
+    ],
+)
+__all__.extend(["supported_types", "visualize"])
 
 logger = logging.getLogger("thelper.viz")
 
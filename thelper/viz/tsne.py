@@ -11,11 +11,10 @@ import cv2 as cv
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
-import sklearn.manifold
 import torch
-import tqdm
 
 import thelper.utils
+import thelper.viz.utils
 
 
 def plot(projs,                # type: np.ndarray
@@ -34,13 +33,19 @@ def plot(projs,                # type: np.ndarray
                      facecolor="w", edgecolor="k", clear=True)
     ax = fig.add_subplot(1, 1, 1)
     default_color = thelper.utils.get_key_def("default_color", kwargs, "#666666")
-    for i in range(projs.shape[0]):
-        pred_color = color_map[preds[i]] if color_map else default_color
-        plt.plot(projs[i, 0], projs[i, 1], "o", color=pred_color, MarkerSize=8)
-        if preds[i] != targets[i]:
-            plt.plot(projs[i, 0], projs[i, 1], "o", color="#FFFFFF", MarkerSize=5)
-        target_color = color_map[targets[i]] if color_map else default_color
-        plt.plot(projs[i, 0], projs[i, 1], "o", color=target_color, MarkerSize=4)
+    preds, targets = np.asarray(preds), np.asarray(targets)
+    if color_map:
+        pred_colors = [color_map[pred] for pred in preds.tolist()]
+        target_colors = [color_map[target] for target in targets.tolist()]
+    else:
+        pred_colors = target_colors = default_color
+    # all points are drawn with three vectorized scatter calls (border: prediction, center: target)
+    marker_scale = thelper.utils.get_key_def("marker_scale", kwargs, 1.0)
+    ax.scatter(projs[:, 0], projs[:, 1], s=64 * marker_scale, c=pred_colors, marker="o", linewidths=0)
+    errors = preds != targets
+    if np.any(errors):
+        ax.scatter(projs[errors, 0], projs[errors, 1], s=25 * marker_scale, c="#FFFFFF", marker="o", linewidths=0)
+    ax.scatter(projs[:, 0], projs[:, 1], s=16 * marker_scale, c=target_colors, marker="o", linewidths=0)
     fig.set_tight_layout(True)
     if task is not None and isinstance(task, thelper.tasks.Classification) and \
             not task.multi_label:
@@ -67,12 +72,15 @@ def visualize(model,              # type: thelper.typedefs.ModelType
     """
     Creates (and optionally displays) a 2D t-SNE visualization of sample embeddings.
 
-    By default, all samples from the data loader will be projected using the model and used
-    for the visualization. If the task is related to classification, the prediction and groundtruth
-    labels will be highlighting using various colors.
+    By default, all samples from the data loader will be forwarded through the model, and a uniform subsample of
+    at most ``max_points`` of their embeddings will be projected for the visualization. If the task is related to
+    classification, the prediction and groundtruth labels will be highlighting using various colors.
 
-    If the model does not possess a ``get_embedding`` attribute, its raw output will be
-    used for projections. Otherwise, ``get_embedding`` will be called.
+    The embeddings and predictions are extracted in a single forward pass via a hook on the model (see
+    :class:`thelper.viz.utils.EmbeddingExtractor`); by default, the model's ``get_embedding`` function is used if it
+    exists, and the input of the last linear layer of the model is used as embedding otherwise. If no such layer
+    exists (or if ``embedding_layer`` is ``None``), the model's raw output is used instead. The embeddings are
+    reduced with PCA before the projection (see :func:`thelper.viz.utils.project_embeddings`).
 
     Args:
         model: the model which will be used to produce embeddings.
@@ -80,8 +88,14 @@ def visualize(model,              # type: thelper.typedefs.ModelType
         loader: the data loader used to get data samples to project.
         draw: boolean flag used to toggle internal display call on or off.
         color_map: map of RGB triplets used to color predictions (for classification only).
-        max_samples: maximum number of samples to draw from the data loader.
+        max_samples: maximum number of minibatches to draw from the data loader.
         return_meta: toggles whether sample metadata should be provided as output or not.
+        max_points: maximum number of (uniformly subsampled) embeddings to project (default=10000).
+        embedding_layer: name of the model layer whose output should be used as embedding (default='auto').
+        pca_dims: number of dimensions to reduce embeddings to with PCA before the projection (default=50).
+        projection: name of the projection backend to use (default='tsne'; see
+            :func:`thelper.viz.utils.project_embeddings`).
+        tsne_args: extra arguments to give to the projection backend.
 
     Returns:
         A dictionary of the visualization result (an RGB image in numpy format), a list of projected
@@ -92,7 +106,6 @@ def visualize(model,              # type: thelper.typedefs.ModelType
     assert task is not None and isinstance(task, thelper.tasks.Task), "invalid task"
     assert max_samples is None or max_samples > 0, "invalid maximum loader sample count"
     thelper.viz.logger.debug("fetching data loader samples for t-SNE visualization...")
-    embeddings, labels, preds, idxs = [], [], [], []
     if isinstance(task, thelper.tasks.Classification) and not task.multi_label:
         assert all([isinstance(n, str) for n in task.class_names]), "unexpected class name types"
         if not color_map:
@@ -105,46 +118,17 @@ def visualize(model,              # type: thelper.typedefs.ModelType
         return_meta = task.meta_keys if return_meta else []
     assert isinstance(return_meta, list) and all([isinstance(key, str) for key in return_meta]), \
         "sample metadata keys must be provided as a list of strings"
-    meta = {key: [] for key in return_meta}
-    for sample_idx, sample in tqdm.tqdm(enumerate(loader), desc="extracting embeddings"):
-        if max_samples is not None and sample_idx > max_samples:
-            break
-        with torch.no_grad():
-            input_tensor = sample[task.input_key]
-            if task is not None and isinstance(task, thelper.tasks.Classification) and \
-                    not task.multi_label and task.gt_key in sample:
-                label = sample[task.gt_key]
-                if isinstance(label, torch.Tensor):
-                    label = label.cpu().numpy()
-                if all([isinstance(lbl, str) for lbl in label]):
-                    label = [task.class_indices[lbl] for lbl in label]
-                pred = model(input_tensor).topk(k=1, dim=1)[1].view(input_tensor.size(0)).cpu().numpy()
-                labels.append(label)
-                preds.append(pred)
-            if hasattr(model, "get_embedding"):
-                embedding = model.get_embedding(input_tensor)
-            else:
-                if not thelper.viz.warned_missing_get_embedding:
-                    thelper.viz.logger.warning("missing 'get_embedding' function in model object; will use output instead")
-                    thelper.viz.warned_missing_get_embedding = True
-                embedding = model(input_tensor)
-            if embedding.dim() > 2:  # reshape to BxC
-                embedding = embedding.view(embedding.size(0), -1)
-        embeddings.append(embedding.cpu().numpy())
-        idxs.append(sample_idx)
-        for key in return_meta:
-            for v in sample[key]:
-                meta[key].append(v)
-    embeddings = np.concatenate(embeddings)
-    if labels and preds:
-        labels, preds = np.concatenate(labels), np.concatenate(preds)
-    else:
-        labels, preds = [0] * len(embeddings), [0] * len(embeddings)
-    default_tsne_args = {"n_components": 2, "init": "pca", "random_state": 0}
+    seed = thelper.utils.get_key_def("seed", kwargs, 0)
+    embeddings, labels, preds, idxs, meta = thelper.viz.utils.extract_embeddings(
+        model, task, loader, max_samples=max_samples, return_meta=return_meta, seed=seed,
+        max_points=thelper.utils.get_key_def("max_points", kwargs, 10000),
+        embedding_layer=thelper.utils.get_key_def("embedding_layer", kwargs, "auto"))
+    projection = thelper.utils.get_key_def("projection", kwargs, "tsne")
+    default_tsne_args = {"n_components": 2, "init": "pca", "random_state": seed} if projection == "tsne" else {}
     tsne_args = thelper.utils.get_key_def("tsne_args", kwargs, default_tsne_args)
-    tsne = sklearn.manifold.TSNE(**tsne_args)
-    thelper.viz.logger.debug("computing t-SNE projection...")
-    embeddings = tsne.fit_transform(embeddings)
+    embeddings = thelper.viz.utils.project_embeddings(
+        embeddings, backend=projection,
+        pca_dims=thelper.utils.get_key_def("pca_dims", kwargs, 50), seed=seed, backend_args=tsne_args)
     fig = plot(embeddings, labels, preds, color_map=color_map, task=task, **kwargs)
     img = thelper.draw.fig2array(fig).copy()
     if draw:
@@ -156,7 +140,7 @@ def visualize(model,              # type: thelper.typedefs.ModelType
         "tsne-projs/pickle": embeddings,
         "tsne-labels/json": labels.tolist(),
         "tsne-preds/json": preds.tolist(),
-        "tsne-idxs/json": idxs,
+        "tsne-idxs/json": idxs.tolist(),
         "tsne-meta/json": meta,
         "tsne/image": img
     }
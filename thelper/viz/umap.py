@@ -9,9 +9,9 @@ from typing import Any, AnyStr, Dict, List, Optional, Union  # noqa: F401
 import cv2 as cv
 import numpy as np
 import torch
-import tqdm
 
 import thelper.utils
+import thelper.viz.utils
 from thelper.viz.tsne import plot
 
 
@@ -27,12 +27,13 @@ def visualize(model,              # type: thelper.typedefs.ModelType
     """
     Creates (and optionally displays) a 2D UMAP visualization of sample embeddings.
 
-    By default, all samples from the data loader will be projected using the model and used
-    for the visualization. If the task is related to classification, the prediction and groundtruth
-    labels will be highlighting using various colors.
+    By default, all samples from the data loader will be forwarded through the model, and a uniform subsample of
+    at most ``max_points`` of their embeddings will be projected for the visualization. If the task is related to
+    classification, the prediction and groundtruth labels will be highlighting using various colors.
 
-    If the model does not possess a ``get_embedding`` attribute, its raw output will be
-    used for projections. Otherwise, ``get_embedding`` will be called.
+    The embeddings are extracted as in :func:`thelper.viz.tsne.visualize`, i.e. with the model's ``get_embedding``
+    function if it exists, and otherwise in a single forward pass with the input of the last linear layer of the
+    model (or the ``embedding_layer`` output) used as embedding. They are reduced with PCA before the projection.
 
     Args:
         model: the model which will be used to produce embeddings.
@@ -40,8 +41,12 @@ def visualize(model,              # type: thelper.typedefs.ModelType
         loader: the data loader used to get data samples to project.
         draw: boolean flag used to toggle internal display call on or off.
         color_map: map of RGB triplets used to color predictions (for classification only).
-        max_samples: maximum number of samples to draw from the data loader.
+        max_samples: maximum number of minibatches to draw from the data loader.
         return_meta: toggles whether sample metadata should be provided as output or not.
+        max_points: maximum number of (uniformly subsampled) embeddings to project (default=10000).
+        embedding_layer: name of the model layer whose output should be used as embedding (default='auto').
+        pca_dims: number of dimensions to reduce embeddings to with PCA before the projection (default=50).
+        umap_args: extra arguments to give to the UMAP projection engine.
 
     Returns:
         A dictionary of the visualization result (an RGB image in numpy format), a list of projected
@@ -49,13 +54,11 @@ def visualize(model,              # type: thelper.typedefs.ModelType
     """
     assert thelper.utils.check_installed("umap"), \
         "could not import optional 3rd-party dependency 'umap-learn'; make sure you install it first!"
-    import umap
     assert loader is not None and len(loader) > 0, "no available data to load"
     assert model is not None and isinstance(model, torch.nn.Module), "invalid model"
     assert task is not None and isinstance(task, thelper.tasks.Task), "invalid task"
     assert max_samples is None or max_samples > 0, "invalid maximum loader sample count"
     thelper.viz.logger.debug("fetching data loader samples for UMAP visualization...")
-    embeddings, labels, preds, idxs = [], [], [], []
     if isinstance(task, thelper.tasks.Classification) and not task.multi_label:
         assert all([isinstance(n, str) for n in task.class_names]), "unexpected class name types"
         if not color_map:
@@ -68,52 +71,18 @@ def visualize(model,              # type: thelper.typedefs.ModelType
         return_meta = task.meta_keys if return_meta else []
     assert isinstance(return_meta, list) and all([isinstance(key, str) for key in return_meta]), \
         "sample metadata keys must be provided as a list of strings"
-    meta = {key: [] for key in return_meta}
-    for sample_idx, sample in tqdm.tqdm(enumerate(loader), desc="extracting embeddings"):
-        if max_samples is not None and sample_idx > max_samples:
-            break
-        with torch.no_grad():
-            input_tensor = sample[task.input_key]
-            if task is not None and isinstance(task, thelper.tasks.Classification) and \
-                    not task.multi_label and task.gt_key in sample:
-                label = sample[task.gt_key]
-                if isinstance(label, torch.Tensor):
-                    label = label.cpu().numpy()
-                if all([isinstance(lbl, str) for lbl in label]):
-                    label = [task.class_indices[lbl] for lbl in label]
-                pred = model(input_tensor).topk(k=1, dim=1)[1].view(input_tensor.size(0)).cpu().numpy()
-                labels.append(label)
-                preds.append(pred)
-            if hasattr(model, "get_embedding"):
-                embedding = model.get_embedding(input_tensor)
-            else:
-                if not thelper.viz.warned_missing_get_embedding:
-                    thelper.viz.logger.warning("missing 'get_embedding' function in model object; will use output instead")
-                    thelper.viz.warned_missing_get_embedding = True
-                embedding = model(input_tensor)
-            if embedding.dim() > 2:  # reshape to BxC
-                embedding = embedding.view(embedding.size(0), -1)
-        embeddings.append(embedding.cpu().numpy())
-        idxs.append(sample_idx)
-        for key in return_meta:
-            for v in sample[key]:
-                meta[key].append(v)
-    embeddings = np.concatenate(embeddings)
-    if labels and preds:
-        labels, preds = np.concatenate(labels), np.concatenate(preds)
-    else:
-        labels, preds = [0] * len(embeddings), [0] * len(embeddings)
     seed = thelper.utils.get_key_def("seed", kwargs, 0)
     if seed is None:
         seed = np.random.randint(np.iinfo(np.int32).max)
-    prev_state = np.random.get_state()
-    np.random.seed(seed)
+    embeddings, labels, preds, idxs, meta = thelper.viz.utils.extract_embeddings(
+        model, task, loader, max_samples=max_samples, return_meta=return_meta, seed=seed,
+        max_points=thelper.utils.get_key_def("max_points", kwargs, 10000),
+        embedding_layer=thelper.utils.get_key_def("embedding_layer", kwargs, "auto"))
     default_umap_args = {"n_components": 2}
     umap_args = thelper.utils.get_key_def("umap_args", kwargs, default_umap_args)
-    umap_engine = umap.UMAP(**umap_args)
-    thelper.viz.logger.debug("computing UMAP projection...")
-    embeddings = umap_engine.fit_transform(embeddings)
-    np.random.set_state(prev_state)
+    embeddings = thelper.viz.utils.project_embeddings(
+        embeddings, backend="umap", pca_dims=thelper.utils.get_key_def("pca_dims", kwargs, 50),
+        seed=seed, backend_args=umap_args)
     fig = plot(embeddings, labels, preds, color_map=color_map, task=task, **kwargs)
     img = thelper.draw.fig2array(fig).copy()
     if draw:
@@ -125,7 +94,7 @@ def visualize(model,              # type: thelper.typedefs.ModelType
         "tsne-projs/pickle": embeddings,
         "tsne-labels/json": labels.tolist(),
         "tsne-preds/json": preds.tolist(),
-        "tsne-idxs/json": idxs,
+        "tsne-idxs/json": idxs.tolist(),
         "tsne-meta/json": meta,
         "tsne/image": img
     }
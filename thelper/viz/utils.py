@@ -0,0 +1,261 @@
+"""Visualization utility functions and classes.
+
+This module contains the tools shared by the embedding projection modules (e.g. t-SNE and UMAP) to extract
+embeddings and predictions from a model in a single pass over a data loader, to subsample them into a fixed-size
+reservoir, and to project them into 2D with a configurable backend.
+"""
+
+from typing import Any, AnyStr, Dict, List, Optional, Tuple  # noqa: F401
+
+import numpy as np
+import torch
+import tqdm
+
+import thelper.tasks
+import thelper.utils
+
+projection_backends = ["tsne", "opentsne", "umap", "pca"]
+"""Names of the projection backends supported by :func:`thelper.viz.utils.project_embeddings`."""
+
+
+def find_embedding_layer(model):
+    """Returns the name of the last linear layer of a model (whose input is used as embedding), or ``None``."""
+    layer_name = None
+    for name, module in model.named_modules():
+        if isinstance(module, torch.nn.Linear):
+            layer_name = name
+    return layer_name
+
+
+class EmbeddingExtractor:
+    """Extracts the predictions and embeddings of a model for a batch of inputs in a single forward pass.
+
+    By default (i.e. with ``layer="auto"``), models that define their own ``get_embedding`` function keep using it
+    (in a second forward pass), as in previous versions. For other models, the embeddings are captured with a
+    forward hook on one of the model's layers: with ``layer="auto"``, the input of the last linear layer of the model
+    is captured, which usually corresponds to the penultimate features of a classifier. If a layer name is given,
+    the output of that layer is captured instead (even if the model defines ``get_embedding``). If no layer is found
+    (or if ``layer`` is ``None``), the model's ``get_embedding`` function is used if it exists, and the model's output
+    is used otherwise.
+
+    Usage example::
+
+        with thelper.viz.utils.EmbeddingExtractor(model) as extractor:
+            for sample in loader:
+                preds, embeddings = extractor(sample["input"])
+    """
+
+    def __init__(self, model, layer="auto"):
+        """Receives the model and the name of the layer to hook (see class description)."""
+        assert model is not None and isinstance(model, torch.nn.Module), "invalid model"
+        self.model = model
+        if isinstance(model, torch.jit.ScriptModule):
+            layer = None  # cannot hook into TorchScript modules
+        if layer == "auto" and hasattr(model, "get_embedding"):
+            layer = None  # the model's own embedding function takes priority over hooks
+        self.layer_name = find_embedding_layer(model) if layer == "auto" else layer
+        self._handle = None
+        self._embedding = None
+        if self.layer_name is not None:
+            modules = dict(model.named_modules())
+            assert self.layer_name in modules, f"could not find layer '{self.layer_name}' in model"
+            if layer == "auto":  # we capture the input of the classification layer
+                self._handle = modules[self.layer_name].register_forward_pre_hook(self._pre_hook)
+            else:
+                self._handle = modules[self.layer_name].register_forward_hook(self._hook)
+
+    def _pre_hook(self, module, inputs):
+        self._embedding = inputs[0]
+
+    def _hook(self, module, inputs, output):
+        self._embedding = output
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Removes the forward hook from the model."""
+        if self._handle is not None:
+            self._handle.remove()
+            self._handle = None
+
+    def __call__(self, input_tensor):
+        """Returns the predictions and the (flattened) embeddings of the model for a batch of inputs."""
+        with torch.no_grad():
+            self._embedding = None
+            pred = self.model(input_tensor)
+            embedding = self._embedding
+            if embedding is None:
+                if hasattr(self.model, "get_embedding"):
+                    embedding = self.model.get_embedding(input_tensor)
+                else:
+                    if not thelper.viz.warned_missing_get_embedding:
+                        thelper.viz.logger.warning("missing 'get_embedding' function in model object; will use output instead")
+                        thelper.viz.warned_missing_get_embedding = True
+                    embedding = pred
+            if embedding.dim() > 2:  # reshape to BxC
+                embedding = embedding.reshape(embedding.size(0), -1)
+        return pred, embedding
+
+
+class EmbeddingReservoir:
+    """Uniformly subsamples a stream of embeddings (with their labels/metadata) into a pre-allocated array.
+
+    The first ``max_size`` embeddings are always kept; afterwards, each new embedding replaces a random one with a
+    probability that keeps the reservoir a uniform sample of all embeddings seen so far (i.e. 'algorithm R').
+
+    Attributes:
+        max_size: maximum number of embeddings to keep.
+        seen_count: number of embeddings added so far.
+        embeddings: pre-allocated array of embeddings (allocated on the first batch).
+        labels: array of labels associated with the embeddings.
+        preds: array of predictions associated with the embeddings.
+        idxs: array of the indices (in the stream) of the embeddings.
+        meta: dictionary of per-embedding metadata lists.
+    """
+
+    def __init__(self, max_size, meta_keys=None, seed=0):
+        """Receives the reservoir size, the names of the metadata fields to keep, and the RNG seed."""
+        assert max_size > 0, "invalid reservoir size"
+        self.max_size = int(max_size)
+        self.seen_count = 0
+        self.embeddings = None
+        self.labels = np.zeros(self.max_size, dtype=np.int64)
+        self.preds = np.zeros(self.max_size, dtype=np.int64)
+        self.idxs = np.zeros(self.max_size, dtype=np.int64)
+        self.meta = {key: [None] * self.max_size for key in (meta_keys or [])}
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return min(self.seen_count, self.max_size)
+
+    def add(self, embeddings, labels=None, preds=None, meta=None):
+        """Adds a batch of embeddings (BxC) to the reservoir, along with their labels, predictions, and metadata."""
+        embeddings = embeddings.cpu().numpy() if isinstance(embeddings, torch.Tensor) else np.asarray(embeddings)
+        batch_size = embeddings.shape[0]
+        if self.embeddings is None:
+            self.embeddings = np.empty((self.max_size, *embeddings.shape[1:]), dtype=embeddings.dtype)
+        stream_idxs = np.arange(self.seen_count, self.seen_count + batch_size)
+        slots = np.where(stream_idxs < self.max_size, stream_idxs, self._rng.integers(0, stream_idxs + 1))
+        keep = np.flatnonzero(slots < self.max_size)
+        # if two samples of the same batch get the same slot, only the last one should be kept
+        _, last_idxs = np.unique(slots[keep][::-1], return_index=True)
+        keep = keep[::-1][last_idxs]
+        slots = slots[keep]
+        self.embeddings[slots] = embeddings[keep]
+        self.idxs[slots] = stream_idxs[keep]
+        if labels is not None:
+            self.labels[slots] = np.asarray(labels)[keep]
+        if preds is not None:
+            self.preds[slots] = np.asarray(preds)[keep]
+        for key, vals in (meta or {}).items():
+            if key in self.meta:
+                for slot, idx in zip(slots, keep):
+                    self.meta[key][slot] = vals[idx]
+        self.seen_count += batch_size
+
+    def get(self):
+        """Returns the embeddings, labels, predictions, stream indices, and metadata currently in the reservoir."""
+        count = len(self)
+        embeddings = self.embeddings[:count] if self.embeddings is not None else np.empty((0, 0), dtype=np.float32)
+        meta = {key: vals[:count] for key, vals in self.meta.items()}
+        return embeddings, self.labels[:count], self.preds[:count], self.idxs[:count], meta
+
+
+def extract_embeddings(model,              # type: thelper.typedefs.ModelType
+                       task,               # type: thelper.typedefs.TaskType
+                       loader,             # type: thelper.typedefs.LoaderType
+                       max_samples=None,   # type: Optional[int]
+                       max_points=10000,   # type: int
+                       return_meta=None,   # type: Optional[List[AnyStr]]
+                       embedding_layer="auto",  # type: Optional[AnyStr]
+                       seed=0,             # type: int
+                       ):                  # type: (...) -> Tuple[np.ndarray, ...]
+    """Extracts the embeddings (and predicted/target labels) of the samples of a loader in a single pass.
+
+    Embeddings are extracted with :class:`thelper.viz.utils.EmbeddingExtractor`, and at most ``max_points`` of them
+    are kept (uniformly subsampled) with :class:`thelper.viz.utils.EmbeddingReservoir`. For single-label
+    classification tasks, the predicted and target labels are also returned; otherwise, all labels are zero.
+
+    Args:
+        model: the model which will be used to produce embeddings.
+        task: the task object used to decode predictions and targets (if possible).
+        loader: the data loader used to get data samples to project.
+        max_samples: maximum number of minibatches to draw from the data loader.
+        max_points: maximum number of embeddings to keep.
+        return_meta: list of sample metadata keys to keep for each embedding.
+        embedding_layer: name of the layer whose output should be used as embedding (see
+            :class:`thelper.viz.utils.EmbeddingExtractor`).
+        seed: seed used to subsample the embeddings.
+
+    Returns:
+        A tuple of the embeddings (NxC array), targets, predictions, sample indices, and metadata dictionary.
+    """
+    assert loader is not None and len(loader) > 0, "no available data to load"
+    assert task is not None and isinstance(task, thelper.tasks.Task), "invalid task"
+    assert max_samples is None or max_samples > 0, "invalid maximum loader sample count"
+    is_classif = isinstance(task, thelper.tasks.Classification) and not task.multi_label
+    reservoir = EmbeddingReservoir(max_points, meta_keys=return_meta, seed=seed)
+    with EmbeddingExtractor(model, layer=embedding_layer) as extractor:
+        for sample_idx, sample in tqdm.tqdm(enumerate(loader), desc="extracting embeddings"):
+            if max_samples is not None and sample_idx > max_samples:
+                break
+            input_tensor = sample[task.input_key]
+            pred, embedding = extractor(input_tensor)
+            label = None
+            if is_classif and task.gt_key in sample:
+                label = sample[task.gt_key]
+                if isinstance(label, torch.Tensor):
+                    label = label.cpu().numpy()
+                if all([isinstance(lbl, str) for lbl in label]):
+                    label = [task.class_indices[lbl] for lbl in label]
+                pred = pred.topk(k=1, dim=1)[1].view(input_tensor.size(0)).cpu().numpy()
+            else:
+                pred = None
+            reservoir.add(embedding, labels=label, preds=pred, meta={key: sample[key] for key in (return_meta or [])})
+    return reservoir.get()
+
+
+def project_embeddings(embeddings,         # type: np.ndarray
+                       backend="tsne",     # type: AnyStr
+                       pca_dims=50,        # type: Optional[int]
+                       seed=0,             # type: Optional[int]
+                       backend_args=None,  # type: Optional[Dict[AnyStr, Any]]
+                       ):                  # type: (...) -> np.ndarray
+    """Projects a set of embeddings (NxC) into 2D using the given backend, with an optional PCA pre-reduction.
+
+    The supported backends are ``tsne`` (``scikit-learn``'s Barnes-Hut t-SNE), ``opentsne`` (FFT-accelerated
+    t-SNE from the optional ``openTSNE`` package), ``umap`` (from the optional ``umap-learn`` package), and ``pca``.
+    If ``pca_dims`` is not ``None`` and the embeddings have more dimensions than it, they are first reduced with PCA,
+    which greatly speeds up neighbor searches in the other backends with little effect on the result.
+    """
+    assert backend in projection_backends, f"unknown projection backend '{backend}'"
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    assert embeddings.ndim == 2 and len(embeddings) > 1, "need at least two embeddings (as NxC array) to project"
+    backend_args = {} if backend_args is None else dict(backend_args)
+    import sklearn.decomposition
+    if backend == "pca":
+        pca_args = {"n_components": 2, "random_state": seed, **backend_args}
+        return sklearn.decomposition.PCA(**pca_args).fit_transform(embeddings)
+    if pca_dims is not None and embeddings.shape[1] > pca_dims and len(embeddings) > pca_dims:
+        thelper.viz.logger.debug(f"reducing embeddings from {embeddings.shape[1]} to {pca_dims} dims with PCA...")
+        embeddings = sklearn.decomposition.PCA(n_components=pca_dims, random_state=seed).fit_transform(embeddings)
+    thelper.viz.logger.debug(f"computing projection of {len(embeddings)} embeddings with '{backend}' backend...")
+    if backend == "tsne":
+        import sklearn.manifold
+        tsne_args = {"n_components": 2, "init": "pca", "random_state": seed, **backend_args}
+        return sklearn.manifold.TSNE(**tsne_args).fit_transform(embeddings)
+    if backend == "opentsne":
+        assert thelper.utils.check_installed("openTSNE"), \
+            "could not import optional 3rd-party dependency 'openTSNE'; make sure you install it first!"
+        import openTSNE
+        tsne_args = {"n_components": 2, "random_state": seed, **backend_args}
+        return np.asarray(openTSNE.TSNE(**tsne_args).fit(embeddings))
+    assert thelper.utils.check_installed("umap"), \
+        "could not import optional 3rd-party dependency 'umap-learn'; make sure you install it first!"
+    import umap
+    umap_args = {"n_components": 2, "random_state": seed, **backend_args}
+    return umap.UMAP(**umap_args).fit_transform(embeddings)